@@ -30,6 +30,9 @@ __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
 
 
 import os
+import hashlib
+import tempfile
+import threading
 import collections 
 
 import json
@@ -168,6 +171,174 @@ class Label(object):
         return self.__str__(ident=ident, with_children=False)
 
 
+def _ontology_stamp(label_file, extra_label):
+    """Identifies the label file and extra labels an ontology index was built from."""
+    try:
+        stat = os.stat(label_file)
+        stat = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        stat = None
+    return os.path.abspath(label_file), stat, repr(extra_label)
+
+
+class OntologyIndex(object):
+    """Precomputed lookup tables for the label hierarchy of an annotation.
+
+    The structures are indexed by their row, i.e. their position in the depth
+    first traversal of the label tree, which is also their 'order'.
+    Value columns and key lookup tables are created on first use and cached,
+    so lookups are O(1) per label and vectorized over arrays of labels.
+    """
+
+    dense_limit = 2**24
+    """Integer keys with values below this limit are looked up via a dense array."""
+
+    def __init__(self, root, stamp=None):
+        self.stamp = stamp
+
+        structures = []
+        parents = []
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            parents.append(parent)
+            row = len(structures)
+            structures.append(node)
+            stack.extend((c, row) for c in reversed(node.children))
+
+        self.structures = structures
+        self.parents = np.array(parents, dtype=np.intp)
+        self.levels = np.array([n.level for n in structures], dtype=int)
+
+        n_levels = int(self.levels.max()) + 1 if structures else 0
+        ancestors = np.repeat(np.arange(len(structures))[:, None], n_levels, axis=1)
+        for row in range(1, len(structures)):
+            level = self.levels[row]
+            ancestors[row, :level] = ancestors[self.parents[row], :level]
+        self.ancestors = ancestors
+
+        self._columns = {}
+        self._arrays = {}
+        self._lookups = {}
+
+    @property
+    def n_structures(self):
+        return len(self.structures)
+
+    @property
+    def max_level(self):
+        return int(self.levels.max())
+
+    def invalidate(self, key=None):
+        """Remove cached columns and lookup tables of a key, or of all keys if None."""
+        if key is None:
+            self._columns.clear()
+            self._arrays.clear()
+            self._lookups.clear()
+        else:
+            for cache in (self._columns, self._arrays, self._lookups):
+                cache.pop(key, None)
+
+    def column(self, key, level=None):
+        """List of the values of key for all structures, or their ancestors at level."""
+        if key is None:
+            values = self.structures
+        else:
+            values = self._columns.get(key)
+            if values is None:
+                values = self._columns[key] = [n.data[key] for n in self.structures]
+        if level is not None:
+            values = [values[r] for r in self.ancestors[:, level]]
+        return values
+
+    def array(self, key):
+        """Array of the values of key for all structures."""
+        values = self._arrays.get(key)
+        if values is None:
+            column = self.column(key)
+            try:
+                values = np.array(column)
+            except ValueError:
+                values = None
+            if values is None or values.dtype == object or values.ndim == 0:
+                values = np.empty(len(column), dtype=object)
+                values[:] = column
+            self._arrays[key] = values
+        return values
+
+    def at_level(self, rows, level=None):
+        """Rows of the ancestors at level of the structures in rows."""
+        if level is None:
+            return rows
+        if np.ndim(rows) == 0:
+            return self.ancestors[rows, level] if rows >= 0 else rows
+        return np.where(rows >= 0, self.ancestors[np.maximum(rows, 0), level], rows)
+
+    def _lookup(self, key):
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            rows = {}
+            for r, v in enumerate(self.column(key)):
+                rows[v] = r  # last occurrence as in get_dictionary
+
+            keys = np.array(list(rows.keys())) if rows else np.zeros(0, dtype=int)
+            if keys.ndim == 1 and keys.dtype.kind in 'iu':
+                # dense table for small keys, sorted keys for the few large or negative ones
+                values = np.array(list(rows.values()), dtype=np.intp)
+                small = (keys >= 0) & (keys < self.dense_limit)
+                table = np.full(keys[small].max() + 1 if np.any(small) else 0, -1, dtype=np.intp)
+                table[keys[small]] = values[small]
+                order = np.argsort(keys[~small])
+                lookup = (rows, table, (keys[~small][order], values[~small][order]))
+            else:
+                lookup = (rows, None, None)
+            self._lookups[key] = lookup
+        return lookup
+
+    def row(self, label, key='id'):
+        """Row of the structure with the given key value."""
+        return self._lookup(key)[0][label]
+
+    def rows(self, label, key='id', missing=None):
+        """Rows of the structures with the given key values.
+
+        Arguments
+        ---------
+        label : array
+          The key values.
+        key : str
+          The key.
+        missing : int or None
+          Row for values without structure, if None raise a KeyError.
+
+        Returns
+        -------
+        rows : array
+          The rows of the structures.
+        """
+        rows, table, large = self._lookup(key)
+        label = np.asarray(label)
+
+        if table is not None and label.dtype.kind in 'iu':
+            result = np.full(label.shape, -1, dtype=np.intp)
+            small = (label >= 0) & (label < len(table))
+            result[small] = table[label[small]]
+            keys, values = large
+            if len(keys) > 0:
+                other = ~small
+                position = np.minimum(np.searchsorted(keys, label[other]), len(keys) - 1)
+                result[other] = np.where(keys[position] == label[other], values[position], -1)
+        else:
+            result = np.array([rows.get(l, -1) for l in label.ravel().tolist()], dtype=np.intp).reshape(label.shape)
+
+        if missing is None:
+            if np.any(result < 0):
+                raise KeyError(label[result < 0].ravel()[0].item())
+        elif missing != -1:
+            result[result < 0] = missing
+        return result
+
+
 class Annotation(object):
     """Class that holds information of the annotated regions."""
 
@@ -191,6 +362,9 @@ class Annotation(object):
         self.extra_label = None
         self.annotation_file = None
         self.label_file = None
+        self.index = None
+        self._atlas = None
+        self._children_df = None
 
         self.dict_id_to_acronym = {}
         self.dict_id_to_name = {}
@@ -239,6 +413,22 @@ class Annotation(object):
         self.annotation_file = annotation_file
         self.extra_label = extra_label
 
+        stamp = _ontology_stamp(label_file, extra_label)
+        if self.index is None or self.index.stamp != stamp:
+            self.initialize_ontology(label_file, extra_label, stamp=stamp)
+
+        self._atlas = None  # read on first use
+
+    @property
+    def atlas(self):
+        """The annotated image, read on first use."""
+        if self._atlas is None:
+            self._atlas = clearmap_io.read(self.annotation_file).astype(int)
+        return self._atlas
+
+    def initialize_ontology(self, label_file, extra_label, stamp=None):
+        self.index = None
+
         # initialize label tree
         with open(label_file, 'r') as file_in:
             aba = json.load(file_in)
@@ -259,6 +449,9 @@ class Annotation(object):
             data['atlas_id'] = -1
             node.children.append(Label(data, parent=node, children=[], level=node.level+1))
 
+        # index the label tree
+        self.index = OntologyIndex(self.root, stamp=stamp)
+
         # initialize generic id
         self.add_data('order', range(self.n_structures))
 
@@ -286,9 +479,14 @@ class Annotation(object):
         self.dict_acronym_to_id = self.get_dict(from_='acronym', to='id')
         self.dict_name_to_id = self.get_dict(from_='name', to='id')
 
-        # import atlas
-        self.atlas = clearmap_io.read(self.annotation_file).astype(int)
-        self.children_df = create_label_table(self.label_file, save=False, from_cached=True)
+        self._children_df = None  # built on first use
+
+    @property
+    def children_df(self):
+        """The table of the parents and children of each structure, built on first use."""
+        if self._children_df is None:
+            self._children_df = create_label_table(self.label_file, save=False, from_cached=True)
+        return self._children_df
 
     def initialize_tree(self, root, parent=None, level=0):
         label = Label({k: v for k, v in root.items() if k != "children"}, parent=parent, level=level)
@@ -297,6 +495,8 @@ class Annotation(object):
 
     def get_list(self, key=None, node=None, level=None):
         if node is None:
+            if self.index is not None:
+                return list(self.index.column(key, level=level))
             node = self.root
 
         l = []
@@ -320,10 +520,14 @@ class Annotation(object):
 
     @property
     def n_structures(self):
+        if self.index is not None:
+            return self.index.n_structures
         return len(self.get_list())
 
     @property
     def max_level(self):
+        if self.index is not None:
+            return self.index.max_level
         return np.max(self.get_list('level'))
 
     def get_hierarchical_dictionary(self, node=None):
@@ -337,6 +541,8 @@ class Annotation(object):
 
     def get_dictionary(self, key, value, node=None, level=None, ordered=False):
         if node is None:
+            if self.index is not None:
+                return dict(zip(self.index.column(key), self.index.column(value, level=level)))
             node = self.root
 
         keys = self.get_list(key=key, node=node, level=None)
@@ -361,8 +567,21 @@ class Annotation(object):
         nodes = self.get_list()
         for n, d in zip(nodes, data):
             n.data[name] = d
+        if self.index is not None:
+            self.index.invalidate(name)
 
     def convert_label(self, label, key='order', value='graph_order', node=None, level=None, method='map'):
+        if node is None and self.index is not None:
+            # labels without structure map to 0 for the 'map' method as with the mapping array
+            rows = self.index.rows(label, key=key, missing=-1 if method in ['map'] else None)
+            rows = self.index.at_level(rows, level=level)
+            values = self.index.array(value)
+            if method in ['map']:
+                converted = np.asarray(values[np.maximum(rows, 0)])
+                converted[rows < 0] = 0
+                return converted
+            return values[rows]
+
         if method in ['map']:
             m = self.get_map(key=key, value=value, node=node, level=level)
             return m[label]
@@ -378,6 +597,18 @@ class Annotation(object):
         return cm[label]
 
     def find(self, label, key='id', value=None, node=None, level=None):
+        if node is None and self.index is not None:
+            index = self.index
+            if isinstance(label, np.ndarray):
+                rows = index.at_level(index.rows(label, key=key), level=level)
+                if value is None:
+                    return index.array(None)[rows]
+                return index.array(value)[rows]
+            if isinstance(label, list):
+                return [self.find(l, key=key, value=value, level=level) for l in label]
+            p = index.structures[index.at_level(index.row(label, key=key), level=level)]
+            return p if value is None else p[value]
+
         d = self.get_dictionary(key=key, value=value, node=node, level=level)
         if isinstance(label, list):  # FIXME: iterable
             return [d[l] for l in label]
@@ -385,8 +616,10 @@ class Annotation(object):
             return d[label]
 
     def parents(self, label, key='id', value=None):
-        d = self.get_dictionary(key=key, value=None, node=None, level=None)
-        p = d[label]
+        if self.index is not None:
+            p = self.index.structures[self.index.row(label, key=key)]
+        else:
+            p = self.get_dictionary(key=key, value=None, node=None, level=None)[label]
         l = [p]
         while p.level > 0:
             p = p.parent
@@ -505,8 +738,9 @@ initialized = False
 
 
 def initialize(label_file=None, extra_label=None, annotation_file=None):
+    """Initialize the annotation, the ontology index is only rebuilt if the label file changed."""
     global initialized, annotation, n_structures, get_dictionary, get_list, get_map, find  # FIXME: avoid global
-    annotation = Annotation(label_file=label_file, extra_label=extra_label, annotation_file=annotation_file)
+    annotation.initialize(label_file=label_file, extra_label=extra_label, annotation_file=annotation_file)
 
     n_structures = annotation.n_structures
     get_dictionary = annotation.get_dictionary
@@ -524,13 +758,145 @@ def set_label_file(label_file, extra_label=None):
     initialize(annotation_file=annotation.annotation_file, label_file=label_file, extra_label=extra_label)
 
 
+###############################################################################
+# ## Volume cache
+###############################################################################
+
+default_volume_cache_size = 2 * 1024**3
+"""Maximal size in bytes of the annotation volumes kept in memory by :func:`read_volume`."""
+
+default_volume_cache_directory = None
+"""Directory of the memory mapped volumes of :func:`read_volume` with shared=True.
+
+Note
+----
+  If None, a 'ClearMap_volumes' folder in the temporary directory is used.
+"""
+
+_volume_cache = collections.OrderedDict()
+_volume_cache_lock = threading.Lock()
+
+
+def read_volume(filename, shared=False):
+    """Read an annotation or hemispheres volume via a process wide cache.
+
+    Arguments
+    ---------
+    filename : str
+        File name of the volume.
+    shared : bool
+        If True, the volume is stored once as a npy file in
+        :const:`default_volume_cache_directory` and memory mapped, so that
+        all processes share a single copy. Files of older versions of the
+        volume are removed, :func:`clear_volume_cache` removes all of them.
+
+    Returns
+    -------
+    volume : array
+        The read only volume.
+
+    Note
+    ----
+      Volumes are identified by path and modification time, so changed files
+      are read again. The in memory volumes are bounded by
+      :const:`default_volume_cache_size`, least recently used ones are dropped first.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, shared)
+
+    with _volume_cache_lock:
+        volume = _volume_cache.get(key)
+        if volume is not None:
+            _volume_cache.move_to_end(key)
+            return volume
+
+    if shared:
+        volume = _shared_volume(filename, key)
+    else:
+        volume = np.asarray(clearmap_io.read(filename))
+        volume.setflags(write=False)
+
+    with _volume_cache_lock:
+        for k in [k for k in _volume_cache if k[0] == key[0] and k[1:3] != key[1:3]]:
+            del _volume_cache[k]
+        _volume_cache[key] = volume
+
+        # memory mapped volumes do not count towards the cache size
+        in_memory = [k for k, v in _volume_cache.items() if not isinstance(v, np.memmap)]
+        size = sum(_volume_cache[k].nbytes for k in in_memory)
+        for k in in_memory[:-1]:
+            if size <= default_volume_cache_size:
+                break
+            size -= _volume_cache.pop(k).nbytes
+
+    return volume
+
+
+def clear_volume_cache(remove_files=True):
+    """Remove all volumes from the cache of :func:`read_volume`.
+
+    Arguments
+    ---------
+    remove_files : bool
+        If True, also delete the npy files of the shared volumes.
+
+    Note
+    ----
+      Memory maps that are still open stay valid on posix systems. Files
+      still in use by other processes on Windows are kept.
+    """
+    with _volume_cache_lock:
+        _volume_cache.clear()
+
+    if remove_files:
+        directory = _volume_cache_directory()
+        if os.path.isdir(directory):
+            for f in os.listdir(directory):
+                if f.endswith('.npy'):
+                    _remove_file(os.path.join(directory, f))
+
+
+def _volume_cache_directory():
+    directory = default_volume_cache_directory
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'ClearMap_volumes')
+    return directory
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def _shared_volume(filename, key):
+    directory = _volume_cache_directory()
+    os.makedirs(directory, exist_ok=True)
+
+    # files of the same volume share the prefix, older versions of it are stale
+    name = os.path.splitext(os.path.basename(filename))[0]
+    prefix = f'{name}_{hashlib.sha1(key[0].encode()).hexdigest()[:8]}_'
+    shared_file = os.path.join(directory, f'{prefix}{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}.npy')
+    if not os.path.exists(shared_file):
+        for f in os.listdir(directory):
+            if f.startswith(prefix) and f.endswith('.npy') and not f.endswith('.tmp.npy'):
+                _remove_file(os.path.join(directory, f))
+        temporary_file = f'{shared_file[:-4]}_{os.getpid()}_{threading.get_ident()}.tmp.npy'
+        np.save(temporary_file, np.asarray(clearmap_io.read(filename)))
+        os.replace(temporary_file, shared_file)
+
+    return np.load(shared_file, mmap_mode='r')
+
+
 ###############################################################################
 # ## Labeling
 ###############################################################################
 
 # TODO:use parallel array processing and lut routines to speed up?
 
-def label_points(points, annotation_file=None, invalid=0, key='order', level=None):  # FIXME: document level
+def label_points(points, annotation_file=None, invalid=0, key='order', level=None,
+                 hemispheres_file=None, shared=False):
     """Label points according to the annotation in the labeled image file.
 
     Arguments
@@ -543,28 +909,35 @@ def label_points(points, annotation_file=None, invalid=0, key='order', level=Non
         Label for invalid points.
     key : str
         The key of the label, by default the order of the labels.
-    level
+    level : int or None
+        Label with the parent structures at this level of the hierarchy. If None use full hierarchy.
+    hemispheres_file : str or None
+        If not None, also return the hemisphere labels of the points from this file.
+    shared : bool
+        If True, use memory mapped volumes shared between processes, see :func:`read_volume`.
 
     Returns
     -------
     label : array
         Label of the points corresponding to the given key.
+    hemisphere : array
+        Hemisphere label of the points, only returned if hemispheres_file is not None.
     """
 
     # TODO consider refactoring using annotation.label_points
 
     n_points, n_spatial_dim = points.shape
 
-    atlas = clearmap_io.read(__get_module_annotation_file(annotation_file))
-    if atlas.dtype.kind == 'f':
-        atlas = np.array(atlas, dtype=int)
+    atlas = read_volume(__get_module_annotation_file(annotation_file), shared=shared)
+    if hemispheres_file is not None:
+        hemispheres = read_volume(hemispheres_file, shared=shared)
+        if hemispheres.shape != atlas.shape:
+            raise ValueError(f'The hemispheres shape {hemispheres.shape} does not match '
+                             f'the annotation shape {atlas.shape}!')
 
     # Filter out of atlas coordinates
     points_int = np.asarray(points, dtype=int)
-    valid = np.ones(n_points)
-    for d in range(n_spatial_dim):
-        in_dim_range = np.logical_and(points_int[:, d] >= 0, points_int[:, d] < atlas.shape[d])
-        valid = np.logical_and(valid, in_dim_range)
+    valid = np.all((points_int >= 0) & (points_int < atlas.shape[:n_spatial_dim]), axis=1)
 
     indices = tuple([points_int[valid, d] for d in range(n_spatial_dim)])
     label = np.full(n_points, invalid, dtype=int)
@@ -573,6 +946,11 @@ def label_points(points, annotation_file=None, invalid=0, key='order', level=Non
     if key != 'id' or level is not None:
         label[valid] = convert_label(label[valid], key='id', value=key, level=level)
 
+    if hemispheres_file is not None:
+        hemisphere = np.full(n_points, invalid, dtype=int)
+        hemisphere[valid] = hemispheres[indices]
+        return label, hemisphere
+
     return label
 
 
@@ -39,6 +39,17 @@ Summary
     * point arrays are assumed to be in (x,y,z) coordinates consistent with (x,y,z) array represenation of images in ClearMap
     
 Main routines are: :func:`align`, :func:`transform`.
+
+Each call runs in its own temporary directory, so that several 
+registrations can run concurrently. An :class:`ElastixSession` keeps the
+logs and results of a series of calls and returns the estimated 
+transformations as parsed :class:`TransformParameters` that can be reused in 
+subsequent calls. :func:`align_parallel` runs a queue of registrations in 
+parallel.
+
+Points can optionally be transformed in memory via 
+:func:`transform_points_native` for translation, Euler, affine and cubic 
+B-spline transformations, by default transformix is used.
     
 See Also
 --------
@@ -59,6 +70,8 @@ import platform
 import tempfile
 import shutil
 import re
+import threading
+import concurrent.futures
 from io import UnsupportedOperation
 
 import numpy as np
@@ -271,7 +284,11 @@ def transform_directory_and_file(transform_parameter_file = None, transform_dire
   Notes
   -----
   Only one of the two arguments need to be specified.
+  The transform_parameter_file can also be a :class:`TransformParameters` 
+  object.
   """
+  if isinstance(transform_parameter_file, TransformParameters):
+    transform_parameter_file = transform_parameter_file.filename
   
   if not transform_parameter_file:
     if not transform_directory:
@@ -300,6 +317,9 @@ def set_path_transform_files(result_directory):
   the aboslute path needs to be given in each transformation file 
   to point to the subsequent transformation files. This is done via this 
   routine.
+  
+  Files are only rewritten if a path changes and are replaced atomically, 
+  so that concurrent calls on the same result directory are safe.
   """
   
   files = os.listdir(result_directory)
@@ -311,29 +331,34 @@ def set_path_transform_files(result_directory):
 
   rec = re.compile("\(InitialTransformParametersFileName \"(?P<parname>.*)\"\)")
 
-  for f in files:
-    fh, tmpfn = tempfile.mkstemp()
-    ff = os.path.join(result_directory, f)
-    # print ff
+  with _transform_files_lock:
+    for f in files:
+      ff = os.path.join(result_directory, f)
       
-    with open(tmpfn, 'w') as newfile, open(ff) as parfile:
-      for line in parfile:
-        # print line
+      with open(ff) as parfile:
+        lines = parfile.readlines()
+      
+      changed = False
+      for i, line in enumerate(lines):
         m = rec.match(line)
         if m != None:
           pn = m.group('parname')
           if pn != 'NoInitialTransform':
             pathn, filen = os.path.split(pn)
             filen = os.path.join(result_directory, filen)
-            newfile.write(line.replace(pn, filen))
-          else:
-            newfile.write(line)
-        else:
-          newfile.write(line)
+            if filen != pn:
+              lines[i] = line.replace(pn, filen)
+              changed = True
+      
+      if changed:
+        fh, tmpfn = tempfile.mkstemp(dir=result_directory)
+        with os.fdopen(fh, 'w') as newfile:
+          newfile.writelines(lines)
+        os.replace(tmpfn, ff)
 
-    os.close(fh)
-    os.remove(ff)
-    shutil.move(tmpfn, ff)
+
+_transform_files_lock = threading.Lock()
+"""Lock for rewriting transformation parameter files."""
 
 
 def set_metric_parameter_file(parameter_file, metric):
@@ -411,27 +436,10 @@ def transform_file_size_and_spacing(transform_file):
   spacing : tuple
     The image spacing.
   """
-  resi = re.compile("\(Size (?P<size>.*)\)")
-  resp = re.compile("\(Spacing (?P<spacing>.*)\)")
-
-  si = None
-  sp = None
-  with open(transform_file) as parfile:
-    for line in parfile:
-      m = resi.match(line)
-      if m != None:
-        pn = m.group('size')
-        si = pn.split()
-
-      m = resp.match(line)
-      if m != None:
-        pn = m.group('spacing')
-        sp = pn.split()
-
-      parfile.close()
+  parameters = read_transform_parameters(transform_file)
 
-  si = [float(x) for x in si]
-  sp = [float(x) for x in sp]
+  si = [float(x) for x in parameters['Size']]
+  sp = [float(x) for x in parameters['Spacing']]
 
   return si, sp
 
@@ -501,13 +509,247 @@ def rescale_size_and_spacing(size, spacing, scale):
   return si, sp
 
 
+###############################################################################
+### Transformation parameters
+###############################################################################
+
+class TransformParameters(object):
+  """Parsed elastix transformation parameter file.
+  
+  Arguments
+  ---------
+  filename : str
+    File name of the transformation parameter file.
+  
+  Attributes
+  ----------
+  filename : str
+    Absolute file name of the transformation parameter file.
+  parameters : dict
+    The parameters as lists of values, numbers are converted to int or float.
+  initial : TransformParameters or None
+    The initial transformation of this transformation.
+  
+  Note
+  ----
+  Use :func:`read_transform_parameters` to reuse already parsed files.
+  """
+  def __init__(self, filename):
+    self.filename = os.path.abspath(filename)
+    self.parameters = parse_transform_parameters(self.filename)
+    
+    initial = self.get('InitialTransformParametersFileName', 'NoInitialTransform')
+    if initial != 'NoInitialTransform':
+      if not os.path.isfile(initial):
+        initial = os.path.join(self.directory, os.path.basename(initial))
+      self.initial = read_transform_parameters(initial)
+    else:
+      self.initial = None
+  
+  @property
+  def directory(self):
+    """The directory of the transformation parameter file."""
+    return os.path.dirname(self.filename)
+  
+  @property
+  def transform(self):
+    """The name of the elastix transformation."""
+    return self.get('Transform')
+  
+  @property
+  def chain(self):
+    """The transformations in this chain starting with the initial one."""
+    if self.initial is None:
+      return [self]
+    else:
+      return self.initial.chain + [self]
+  
+  def get(self, name, default = None):
+    """Returns a parameter, single values are returned as scalars."""
+    value = self.parameters.get(name)
+    if value is None:
+      return default
+    return value[0] if len(value) == 1 else value
+  
+  def __getitem__(self, name):
+    return self.parameters[name]
+  
+  def __contains__(self, name):
+    return name in self.parameters
+  
+  def __repr__(self):
+    return '%s(%s)[%s]' % (self.__class__.__name__, self.transform, self.filename)
+
+
+def parse_transform_parameters(filename):
+  """Parses an elastix parameter file.
+  
+  Arguments
+  ---------
+  filename : str
+    File name of the elastix parameter file.
+  
+  Returns
+  -------
+  parameters : dict
+    The parameters as lists of values, unquoted numbers are converted to 
+    int or float.
+  """
+  parameters = {}
+  with open(filename) as parfile:
+    for line in parfile:
+      m = _parameter_line.match(line)
+      if m is None:
+        continue
+      values = m.group('values')
+      if '"' in values:
+        values = [q if u == '' else _parse_value(u) for q, u in _parameter_value.findall(values)]
+      else:
+        values = [_parse_value(v) for v in values.split()]
+      parameters[m.group('name')] = values
+  
+  return parameters
+
+
+_parameter_line = re.compile(r'\s*\((?P<name>\w+)\s*(?P<values>.*)\)')
+
+_parameter_value = re.compile(r'"([^"]*)"|([^\s"]+)')
+
+
+def _parse_value(value):
+  try:
+    return int(value)
+  except ValueError:
+    try:
+      return float(value)
+    except ValueError:
+      return value
+
+
+def read_transform_parameters(transform_parameter_file = None, transform_directory = None):
+  """Returns the parsed transformation parameters.
+  
+  Arguments
+  ---------
+  transform_parameter_file : str, TransformParameters or None
+    The transformation parameter file.
+    If None, the file is determined from the transform_directory.
+  transform_directory : str or None
+    Result directory of elastix alignment.
+    If None the transform_parameter_file has to be given.
+  
+  Returns
+  -------
+  parameters : TransformParameters
+    The parsed transformation parameters.
+  
+  Note
+  ----
+  Parsed files are cached and only parsed again if they are modified.
+  """
+  if isinstance(transform_parameter_file, TransformParameters):
+    return transform_parameter_file
+  
+  _, transform_parameter_file = transform_directory_and_file(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory)
+  transform_parameter_file = os.path.abspath(transform_parameter_file)
+  
+  stat = os.stat(transform_parameter_file)
+  key = (stat.st_mtime_ns, stat.st_size)
+  with _transform_parameters_lock:
+    cached = _transform_parameters_cache.get(transform_parameter_file)
+  if cached is not None and cached[0] == key:
+    return cached[1]
+  
+  parameters = TransformParameters(transform_parameter_file)
+  with _transform_parameters_lock:
+    _transform_parameters_cache[transform_parameter_file] = (key, parameters)
+  
+  return parameters
+
+
+_transform_parameters_cache = {}
+"""Cache of parsed transformation parameter files."""
+
+_transform_parameters_lock = threading.Lock()
+"""Lock for the transformation parameter cache."""
+
+
 ##############################################################################
 ### Elastix Runs
 ##############################################################################
 
+def run_command(cmd, log_file = None, workspace = None):
+  """Runs an elastix or transformix command.
+  
+  Arguments
+  ---------
+  cmd : list of str
+    The command and its arguments.
+  log_file : str or None
+    File to write the output of the command to. 
+    If None, the output is written to stdout.
+  workspace : Workspace or None
+    If not None, the running process is set as workspace.process so that 
+    it can be canceled.
+  
+  Returns
+  -------
+  log_file : str or None
+    The log file of the command.
+  
+  Note
+  ----
+  A :class:`~ClearMap.Utils.exceptions.ClearMapException` is raised if the 
+  command fails, its message contains the end of the log file.
+  """
+  output = open(log_file, 'w') if log_file is not None else sys.stdout
+  try:
+    try:
+      process = subprocess.Popen(cmd, stdout=output, stderr=subprocess.STDOUT)
+    except UnsupportedOperation:
+      process = subprocess.Popen(cmd)
+    if workspace is not None:
+      workspace.process = process
+    return_code = process.wait()
+  except (subprocess.SubprocessError, OSError) as err:
+    raise ClearMapException(f'Failed executing: {" ".join(cmd)}') from err
+  finally:
+    if workspace is not None:
+      workspace.process = None
+    if log_file is not None:
+      output.close()
+  
+  if return_code != 0:
+    message = f'Failed executing: {" ".join(cmd)}, return code {return_code}!'
+    if log_file is not None:
+      with open(log_file) as log:
+        message += '\n' + ''.join(log.readlines()[-20:])
+    raise ClearMapException(message)
+  
+  return log_file
+
+
+def temporary_directory(name = 'elastix', directory = None):
+  """Creates a unique temporary directory for elastix runs.
+  
+  Arguments
+  ---------
+  name : str
+    Prefix of the directory name.
+  directory : str or None
+    The parent directory, if None the system temporary directory is used.
+  
+  Returns
+  -------
+  directory : str
+    The new directory.
+  """
+  return tempfile.mkdtemp(prefix=name + '_', dir=directory)
+
+
 def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_file=None,
           result_directory=None, processes=None,
-          workspace=None, moving_landmarks_path=None, fixed_landmarks_path=None):
+          workspace=None, moving_landmarks_path=None, fixed_landmarks_path=None, log_file=None):
   """
   Align images using elastix, estimates a transformation :math:`T:` fixed image :math:`\\rightarrow` moving image.
   
@@ -522,9 +764,12 @@ def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_fi
   bspline_parameter_file : str or None
     Elastix parameter file for the secondary non-linear transformation.
   result_directory : str or None
-    Elastic result directory.
+    Elastic result directory. If None, a unique temporary directory is created.
   processes : int or None
     Number of threads to use.
+  log_file : str or None
+    File to write the elastix output to. If None, the output is written to 
+    stdout.
       
   Returns
   -------
@@ -537,7 +782,7 @@ def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_fi
   check_elastix_initialized()
 
   # result directory
-  result_directory = result_directory if result_directory is not None else tempfile.gettempdir()
+  result_directory = result_directory if result_directory is not None else temporary_directory('elastix_align')
   
   if not os.path.exists(result_directory):
     os.mkdir(result_directory)
@@ -552,25 +797,12 @@ def align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_fi
     cmd.extend(['-mp', f'{moving_landmarks_path}', '-fp', f'{fixed_landmarks_path}'])
   cmd.extend(['-out', f'{result_directory}'])
 
-  try:
-    with subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stdout) as proc:  # FIXME: check if we need an "if not sys.stdout.fileno"
-      if workspace is not None:
-        workspace.process = proc
-  except UnsupportedOperation:
-    try:
-      subprocess.Popen(cmd)
-    except (subprocess.SubprocessError, OSError) as err:
-      raise ClearMapException(f'Align: failed executing: {" ".join(cmd)}') from err
-  except (subprocess.SubprocessError, OSError) as err:
-    raise ClearMapException(f'Align: failed executing: {" ".join(cmd)}') from err
-  finally:
-    if workspace is not None:
-      workspace.process = None
+  run_command(cmd, log_file=log_file, workspace=workspace)
   
   return result_directory
 
 
-def transform(source, sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None):
+def transform(source, sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None, log_file = None):
   """Transform a raw data set to reference using the elastix alignment results.
   
   Arguments
@@ -580,7 +812,7 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
   sink : str, [] or None
     Image sink to save transformed image to. If [] return the default name 
     of the data file generated by transformix.
-  transform_parameter_file : str or None
+  transform_parameter_file : str, TransformParameters or None
     Parameter file for the primary transformation. 
     If None, the file is determined from the transform_directory.
   transform_directory : str or None
@@ -588,6 +820,9 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
     If None the transform_parameter_file has to be given.
   result_directory : str or None
     The directorty for the transformix results.
+  log_file : str or None
+    File to write the transformix output to. If None, the output is written 
+    to stdout.
       
   Returns
   -------
@@ -606,16 +841,16 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
   source = io.as_source(source)
   if isinstance(source, io.tif.Source):
     imgname = source.location
-    delete_image = None
+    delete_image_directory = None
   else:
-    imgname = os.path.join(tempfile.gettempdir(), 'elastix_input.tif')
-    io.write(source, imgname)
-    delete_image = imgname
+    delete_image_directory = temporary_directory('elastix_input')
+    imgname = os.path.join(delete_image_directory, 'elastix_input.tif')
+    io.write(imgname, source)
 
   # result directory
   delete_result_directory = None
   if result_directory == None:
-    resultdirname = os.path.join(tempfile.gettempdir(), 'elastix_output')
+    resultdirname = temporary_directory('elastix_output')
     delete_result_directory = resultdirname
   else:
     resultdirname = result_directory
@@ -629,16 +864,13 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
   set_path_transform_files(transform_parameter_dir)
 
   #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txx
-  cmd = '%s -in %s -out %s -tp %s' % (transformix_binary, imgname, resultdirname, transform_parameter_file)
-
-  res = os.system(cmd)
-
-  if res != 0:
-    raise RuntimeError('transform_data: failed executing: ' + cmd)
-
-  # read data and clean up
-  if delete_image is not None:
-      os.remove(delete_image)
+  cmd = [transformix_binary, '-in', imgname, '-out', resultdirname, '-tp', transform_parameter_file]
+  
+  try:
+    run_command(cmd, log_file=log_file)
+  finally:
+    if delete_image_directory is not None:
+      shutil.rmtree(delete_image_directory)
 
   if sink == []:
     return result_data_file(resultdirname)
@@ -657,7 +889,7 @@ def transform(source, sink = [], transform_parameter_file = None, transform_dire
   return result
 
 
-def deformation_field(sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None):
+def deformation_field(sink = [], transform_parameter_file = None, transform_directory = None, result_directory = None, log_file = None):
   """Create the deformation field T(x) - x.
       
   Arguments
@@ -665,7 +897,7 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
   sink : str, [] or None
     Image sink to save the transformation field; if [] return the default name 
     of the data file generated by transformix.
-  transform_parameter_file : str or None
+  transform_parameter_file : str, TransformParameters or None
     Parameter file for the primary transformation, if None, the file is 
     determined from the transform_directory.
   transform_directory : str or None
@@ -673,6 +905,9 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
     transform_parameter_file has to be given.
   result_directory : str or None
     The directorty for the transformix results.
+  log_file : str or None
+    File to write the transformix output to. If None, the output is written 
+    to stdout.
       
   Returns
   -------
@@ -689,7 +924,7 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
   # result directory
   delete_result_directory = None
   if result_directory == None:
-    resultdirname = os.path.join(tempfile.gettempdir(), 'elastix_output')
+    resultdirname = temporary_directory('elastix_output')
     delete_result_directory = resultdirname
   else:
     resultdirname = result_directory
@@ -702,12 +937,9 @@ def deformation_field(sink = [], transform_parameter_file = None, transform_dire
   set_path_transform_files(transform_parameter_dir)
 
   #transformix -in inputImage.ext -out outputDirectory -tp TransformParameters.txt
-  cmd = '%s -def all -out %s -tp  %s' % (transformix_binary, resultdirname, transform_parameter_file)
+  cmd = [transformix_binary, '-def', 'all', '-out', resultdirname, '-tp', transform_parameter_file]
   
-  res = os.system(cmd)
-
-  if res != 0:
-    raise RuntimeError('deformation_field: failed executing: ' + cmd)
+  run_command(cmd, log_file=log_file)
 
   # read result and clean up
   if sink == []:
@@ -874,7 +1106,8 @@ def read_points(filename, indices = False, binary = True):
     return points
 
 
-def transform_points(source, sink = None, transform_parameter_file = None, transform_directory = None, indices = False, result_directory = None, temp_file = None, binary = True):
+def transform_points(source, sink = None, transform_parameter_file = None, transform_directory = None, indices = False, result_directory = None, temp_file = None, binary = True, log_file = None,
+                     native = False, processes = None):
   """Transform coordinates math:`x` via elastix estimated transformation to :math:`T(x)`.
 
   Arguments
@@ -883,7 +1116,7 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
     Source of the points.
   sink : str or None
     Sink for transformed points.
-  transform_parameter_file : str or None
+  transform_parameter_file : str, TransformParameters or None
     Parameter file for the primary transformation. 
     If None, the file is determined from the transform_directory.
   transform_directory : str or None
@@ -895,6 +1128,16 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
     Elastic result directory.
   temp_file : str or None
     Optional file name for the elastix point file.
+  log_file : str or None
+    File to write the transformix output to. If None, the output is written 
+    to stdout.
+  native : bool
+    If True, transform spatial coordinates in memory via 
+    :func:`transform_points_native` if the transformation is supported, 
+    otherwise transformix is used. Pixel coordinates (indices is True) are 
+    always transformed via transformix.
+  processes : int or None
+    Number of threads for the native transformation.
       
   Returns
   -------
@@ -907,13 +1150,24 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
   image coordiantes.
   """   
   check_elastix_initialized()
+  
+  # native transformation
+  point_file = isinstance(source, str) and len(source) > 3 and source[-3:] in ['txt', 'bin']
+  if native and not indices and not point_file and sink != []:
+    transform_parameters = read_transform_parameters(transform_parameter_file = transform_parameter_file, transform_directory = transform_directory)
+    if is_native_transform(transform_parameters):
+      points = io.read(source) if isinstance(source, str) else source
+      transpoints = transform_points_native(points, transform_parameters, indices = indices, processes = processes)
+      return io.write(sink, transpoints)
 
   # input point file
+  delete_point_directory = None
   if temp_file == None:
+    delete_point_directory = temporary_directory('elastix_input')
     if binary:
-      temp_file = os.path.join(tempfile.gettempdir(), 'elastix_input.bin')
+      temp_file = os.path.join(delete_point_directory, 'elastix_input.bin')
     else:
-      temp_file = os.path.join(tempfile.gettempdir(), 'elastix_input.txt')
+      temp_file = os.path.join(delete_point_directory, 'elastix_input.txt')
 
   delete_point_file = None
   if isinstance(source, str):
@@ -938,7 +1192,7 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
   
   # result directory
   if result_directory == None:
-    outdirname = os.path.join(tempfile.gettempdir(), 'elastix_output')
+    outdirname = temporary_directory('elastix_output')
     delete_result_directory = outdirname
   else:
     outdirname = result_directory
@@ -952,17 +1206,16 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
   set_path_transform_files(transform_parameter_dir)
 
   #run transformix   
-  cmd = '%s -def %s -out %s -tp %s' % (transformix_binary, pointfile, outdirname, transform_parameter_file)
-  print(cmd)
+  cmd = [transformix_binary, '-def', pointfile, '-out', outdirname, '-tp', transform_parameter_file]
+  print(' '.join(cmd))
   
-  res = os.system(cmd)
-
-  if res != 0:
-    raise RuntimeError('failed executing ' + cmd)
-
-  # read data and clean up
-  if delete_point_file is not None:
-    os.remove(delete_point_file)
+  try:
+    run_command(cmd, log_file=log_file)
+  finally:
+    if delete_point_file is not None:
+      os.remove(delete_point_file)
+    if delete_point_directory is not None:
+      shutil.rmtree(delete_point_directory)
 
   #read data / file 
   if sink == []: # return sink as file name
@@ -983,7 +1236,7 @@ def transform_points(source, sink = None, transform_parameter_file = None, trans
   return io.write(sink, transpoints)
 
 
-def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file = None, transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None):
+def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file = None, transform_parameter_file = None, transform_directory = None, result_directory = None, processes = None, log_file = None):
   """Estimate inverse tranformation :math:`T^{-1}:` moving image :math:`\\rightarrow` fixed image.
   
   Arguments
@@ -994,10 +1247,17 @@ def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file
     The paramter file for the original affine transformation.
   bspline_parameter_file : str
     The paramter file for the original b-spline transformation.
+  transform_parameter_file : str, TransformParameters or None
+    Parameter file of the original transform.
   transform_directory : str
     Elastic result directory of the original transform.
   result_directory : str or None
     Elastic result directory of the inverse transform.
+  processes : int or None
+    Number of threads to use.
+  log_file : str or None
+    File to write the elastix output to. If None, the output is written to 
+    stdout.
       
   Returns
   -------
@@ -1005,11 +1265,13 @@ def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file
     Path to elastix result directory.
   """
   
+  processes = processes if processes is not None else mp.cpu_count()
+  
   check_elastix_initialized()
 
   # result directory
   if result_directory == None:
-      result_directory = tempfile.getgettempdir()()
+      result_directory = temporary_directory('elastix_inverse')
 
   if not os.path.exists(result_directory):
       os.mkdir(result_directory)
@@ -1036,19 +1298,409 @@ def inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file
     affinefile = None
 
   # run elastix
-  if bsplinefile is None:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, affinefile,  result_directory)
-  elif affinefile is None:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, bsplinefile, result_directory)
+  cmd = [elastix_binary, '-threads', str(processes), '-m', fixed_image, '-f', fixed_image, '-t0', transform_parameter_file]
+  for parameter_file in (affinefile, bsplinefile):
+    if parameter_file is not None:
+      cmd.extend(['-p', parameter_file])
+  cmd.extend(['-out', result_directory])
+
+  run_command(cmd, log_file=log_file)
+
+  return result_directory
+
+
+###############################################################################
+### Native point transformations
+###############################################################################
+
+native_transforms = ('TranslationTransform', 'EulerTransform', 'AffineTransform', 'BSplineTransform')
+"""Elastix transformations supported by :func:`transform_points_native`."""
+
+
+def is_native_transform(transform_parameters):
+  """Checks if a transformation can be applied by :func:`transform_points_native`.
+  
+  Arguments
+  ---------
+  transform_parameters : str or TransformParameters
+    The transformation parameter file.
+  
+  Returns
+  -------
+  native : bool
+    True if all transformations in the chain are supported.
+  """
+  transform_parameters = read_transform_parameters(transform_parameters)
+  for parameters in transform_parameters.chain:
+    if parameters.transform not in native_transforms or 'TransformParameters' not in parameters:
+      return False
+    if parameters.get('FixedImageDimension', 3) != 3:
+      return False
+    if parameters.get('HowToCombineTransforms', 'Compose') != 'Compose':
+      return False
+    if parameters.transform == 'BSplineTransform':
+      if parameters.get('BSplineTransformSplineOrder', 3) != 3 or parameters.get('UseCyclicTransform', 'false') == 'true':
+        return False
+      if any(name not in parameters for name in ('GridSize', 'GridSpacing', 'GridOrigin')):
+        return False
+  return True
+
+
+def transform_points_native(points, transform_parameters, indices = False, processes = None, chunk_size = 2**16):
+  """Transform points via a NumPy evaluation of the elastix transformation.
+  
+  Arguments
+  ---------
+  points : array
+    The points as (n,3) array in (x,y,z) coordinates.
+  transform_parameters : str or TransformParameters
+    The transformation parameter file.
+  indices : bool
+    If True, the points are pixel indices of the fixed image otherwise 
+    spatial coordinates.
+  processes : int or None
+    Number of threads to use. If None, use all cpus.
+  chunk_size : int
+    Number of points transformed by a thread at a time.
+  
+  Returns
+  -------
+  points : array
+    The transformed points :math:`T(x)` in spatial coordinates.
+  
+  Note
+  ----
+  The transformations in the chain are composed starting with the initial 
+  one, as in transformix. Points outside the valid region of a B-spline 
+  transformation are not deformed by it.
+  
+  Pixel indices are converted to spatial coordinates of the fixed image 
+  and the transformed spatial coordinates are returned. This differs from 
+  :func:`transform_points` with indices set to True, which passes the 
+  indices to transformix and reads back the indices reported by it.
+  """
+  transform_parameters = read_transform_parameters(transform_parameters)
+  if not is_native_transform(transform_parameters):
+    raise ValueError('The transformation %r is not supported natively!' % transform_parameters)
+  
+  points = np.array(points, dtype=float, ndmin=2)
+  if points.ndim != 2 or points.shape[1] != 3:
+    raise ValueError('Expecting points of shape (n,3), found %r!' % (points.shape,))
+  
+  if indices:
+    origin, grid = _image_geometry(transform_parameters)
+    points = points.dot(grid.T) + origin
+  
+  functions = [_native_transform(parameters) for parameters in transform_parameters.chain]
+  
+  def transform_chunk(chunk):
+    for function in functions:
+      chunk = function(chunk)
+    return chunk
+  
+  processes = processes if processes is not None else mp.cpu_count()
+  if processes <= 1 or len(points) <= chunk_size:
+    return transform_chunk(points)
+  
+  chunks = [points[i:i+chunk_size] for i in range(0, len(points), chunk_size)]
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    chunks = list(executor.map(transform_chunk, chunks))
+  return np.concatenate(chunks)
+
+
+def _native_transform(parameters):
+  """Returns a function applying a single transformation, cached in the parameters."""
+  function = getattr(parameters, '_native_transform', None)
+  if function is None:
+    function = _native_transform_functions[parameters.transform](parameters)
+    parameters._native_transform = function
+  return function
+
+
+def _translation_transform(parameters):
+  translation = np.array(parameters['TransformParameters'], dtype=float)
+  return lambda points: points + translation
+
+
+def _matrix_transform(matrix, translation, center):
+  offset = translation + center - matrix.dot(center)
+  return lambda points: points.dot(matrix.T) + offset
+
+
+def _euler_transform(parameters):
+  ax, ay, az, tx, ty, tz = parameters['TransformParameters']
+  cx, sx = np.cos(ax), np.sin(ax)
+  cy, sy = np.cos(ay), np.sin(ay)
+  cz, sz = np.cos(az), np.sin(az)
+  rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+  ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+  rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+  if parameters.get('ComputeZYX', 'false') == 'true':
+    matrix = rz.dot(ry).dot(rx)
   else:
-    cmd = '%s -threads %d -m %s -f %s -t0 %s -p %s -p %s -out %s' % (elastix_binary, processes, fixed_image, fixed_image, transform_parameter_file, affinefile, bsplinefile, result_directory)
+    matrix = rz.dot(rx).dot(ry)
+  center = np.array(parameters.get('CenterOfRotationPoint', [0, 0, 0]), dtype=float)
+  return _matrix_transform(matrix, np.array([tx, ty, tz], dtype=float), center)
 
-  res = os.system(cmd)
 
-  if res != 0:
-    raise RuntimeError('inverse_transform: failed executing: ' + cmd)
+def _affine_transform(parameters):
+  values = np.array(parameters['TransformParameters'], dtype=float)
+  center = np.array(parameters.get('CenterOfRotationPoint', [0, 0, 0]), dtype=float)
+  return _matrix_transform(values[:9].reshape(3, 3), values[9:], center)
 
-  return result_directory
+
+def _bspline_transform(parameters):
+  grid_size = np.array(parameters['GridSize'], dtype=int)
+  grid_index = np.array(parameters.get('GridIndex', [0, 0, 0]), dtype=float)
+  grid_origin = np.array(parameters['GridOrigin'], dtype=float)
+  grid_spacing = np.array(parameters['GridSpacing'], dtype=float)
+  grid_direction = np.array(parameters.get('GridDirection', [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=float).reshape(3, 3).T
+  
+  # coefficients are stored per dimension with x running fastest
+  coefficients = np.array(parameters['TransformParameters'], dtype=float).reshape(3, -1).T
+  strides = np.array([1, grid_size[0], grid_size[0] * grid_size[1]])
+  
+  to_index = np.linalg.inv(grid_direction * grid_spacing)
+  valid_begin = grid_index + 1
+  valid_end = grid_index + grid_size - 2
+  
+  def transform(points):
+    index = (points - grid_origin).dot(to_index.T)
+    valid = np.all(np.logical_and(index >= valid_begin, index < valid_end), axis=1)
+    index = index[valid] - grid_index
+    
+    start = np.floor(index - 1).astype(int)
+    weights = [_cubic_bspline_weights(index[:, d] - start[:, d]) for d in range(3)]
+    offset = start.dot(strides)
+    
+    displacement = np.zeros(index.shape)
+    for k in range(4):
+      for j in range(4):
+        wjk = weights[1][:, j] * weights[2][:, k]
+        for i in range(4):
+          w = weights[0][:, i] * wjk
+          c = np.take(coefficients, offset + (i * strides[0] + j * strides[1] + k * strides[2]), axis=0)
+          displacement += w[:, None] * c
+    
+    points = points.copy()
+    points[valid] += displacement
+    return points
+  
+  return transform
+
+
+def _cubic_bspline_weights(u):
+  """Cubic B-spline weights of the four support points at offset u in [1,2)."""
+  t = u - 1
+  t2 = t * t
+  t3 = t2 * t
+  return np.stack([(1 - t)**3 / 6, (3 * t3 - 6 * t2 + 4) / 6, (-3 * t3 + 3 * t2 + 3 * t + 1) / 6, t3 / 6], axis=1)
+
+
+def _image_geometry(parameters):
+  """Origin and index to space matrix of the fixed image."""
+  origin = np.array(parameters.get('Origin', [0, 0, 0]), dtype=float)
+  spacing = np.array(parameters.get('Spacing', [1, 1, 1]), dtype=float)
+  direction = np.array(parameters.get('Direction', [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=float).reshape(3, 3).T
+  return origin, direction * spacing
+
+
+_native_transform_functions = dict(TranslationTransform=_translation_transform, EulerTransform=_euler_transform,
+                                   AffineTransform=_affine_transform, BSplineTransform=_bspline_transform)
+
+
+###############################################################################
+### Sessions
+###############################################################################
+
+class ElastixSession(object):
+  """Session to run a series of elastix and transformix calls.
+  
+  Arguments
+  ---------
+  directory : str or None
+    Parent directory of the session directory. 
+    If None, the system temporary directory is used.
+  processes : int or None
+    Number of threads used by elastix.
+  workspace : Workspace or None
+    If not None, the running elastix process is set as workspace.process
+    so that it can be canceled.
+  clean_up : bool
+    If True, remove the session directory when the session is closed.
+  
+  Attributes
+  ----------
+  directory : str
+    The unique directory of this session.
+  transform_parameters : TransformParameters or None
+    The transformation estimated by the last call to :meth:`align`.
+  logs : list of (str, str)
+    The name and log file of each call in this session.
+  
+  Note
+  ----
+  Each session runs in its own directory and captures the output of each 
+  call in a log file, so that several sessions can run concurrently. 
+  Sessions can be used as context managers::
+  
+    with ElastixSession() as session:
+      session.align(fixed_image, moving_image, affine_parameter_file)
+      points = session.transform_points(points)
+  
+  File names returned by the session, e.g. for sink = [], point into the 
+  session directory and are removed when the session is closed.
+  """
+  def __init__(self, directory = None, processes = None, workspace = None, clean_up = True):
+    self.directory = temporary_directory('elastix_session', directory=directory)
+    self.processes = processes
+    self.workspace = workspace
+    self.clean_up = clean_up
+    self.transform_parameters = None
+    self.logs = []
+  
+  def result_directory(self, name):
+    """Creates a new unique result directory in this session."""
+    return temporary_directory(name, directory=self.directory)
+  
+  def log_file(self, name, result_directory):
+    """Registers and returns the log file of a call."""
+    log_file = os.path.join(result_directory, name + '.log')
+    self.logs.append((name, log_file))
+    return log_file
+  
+  def read_log(self, index = -1):
+    """Returns the content of a log file, by default of the last call."""
+    with open(self.logs[index][1]) as log:
+      return log.read()
+  
+  def align(self, fixed_image, moving_image, affine_parameter_file, bspline_parameter_file = None, result_directory = None, **kwargs):
+    """Estimates a transformation via :func:`align`.
+    
+    Returns
+    -------
+    transform_parameters : TransformParameters
+      The estimated transformation, also stored as transform_parameters.
+    """
+    if result_directory is None:
+      result_directory = self.result_directory('align')
+    align(fixed_image, moving_image, affine_parameter_file, bspline_parameter_file=bspline_parameter_file,
+          result_directory=result_directory, processes=self.processes, workspace=self.workspace,
+          log_file=self.log_file('align', result_directory), **kwargs)
+    set_path_transform_files(result_directory)
+    self.transform_parameters = read_transform_parameters(transform_directory=result_directory)
+    return self.transform_parameters
+  
+  def inverse_transform(self, fixed_image, affine_parameter_file, bspline_parameter_file = None, transform_parameters = None):
+    """Estimates the inverse transformation via :func:`inverse_transform`.
+    
+    Returns
+    -------
+    transform_parameters : TransformParameters
+      The estimated inverse transformation.
+    """
+    transform_parameters = self._transform_parameters(transform_parameters)
+    result_directory = self.result_directory('inverse')
+    inverse_transform(fixed_image, affine_parameter_file, bspline_parameter_file=bspline_parameter_file,
+                      transform_parameter_file=transform_parameters.filename, result_directory=result_directory,
+                      processes=self.processes, log_file=self.log_file('inverse', result_directory))
+    set_path_transform_files(result_directory)
+    return read_transform_parameters(transform_directory=result_directory)
+  
+  def transform(self, source, sink = None, transform_parameters = None):
+    """Transforms an image via :func:`transform`."""
+    transform_parameters = self._transform_parameters(transform_parameters)
+    result_directory = self.result_directory('transform')
+    return transform(source, sink=sink, transform_parameter_file=transform_parameters.filename, 
+                     result_directory=result_directory, log_file=self.log_file('transform', result_directory))
+  
+  def transform_points(self, source, sink = None, transform_parameters = None, indices = False, binary = True, native = False):
+    """Transforms points via :func:`transform_points`."""
+    transform_parameters = self._transform_parameters(transform_parameters)
+    result_directory = self.result_directory('transform_points')
+    temp_file = os.path.join(result_directory, 'input_points.' + ('bin' if binary else 'txt'))
+    return transform_points(source, sink=sink, transform_parameter_file=transform_parameters.filename, 
+                            indices=indices, result_directory=result_directory, temp_file=temp_file, 
+                            binary=binary, log_file=self.log_file('transform_points', result_directory),
+                            native=native, processes=self.processes)
+  
+  def deformation_field(self, sink = None, transform_parameters = None):
+    """Calculates the deformation field via :func:`deformation_field`."""
+    transform_parameters = self._transform_parameters(transform_parameters)
+    result_directory = self.result_directory('deformation_field')
+    return deformation_field(sink=sink, transform_parameter_file=transform_parameters.filename, 
+                             result_directory=result_directory, log_file=self.log_file('deformation_field', result_directory))
+  
+  def close(self):
+    """Closes the session and removes its directory if clean_up is True."""
+    if self.clean_up and os.path.exists(self.directory):
+      shutil.rmtree(self.directory, ignore_errors=True)
+  
+  def _transform_parameters(self, transform_parameters):
+    if transform_parameters is None:
+      transform_parameters = self.transform_parameters
+    if transform_parameters is None:
+      raise ClearMapException('No transformation given or estimated in this session!')
+    return read_transform_parameters(transform_parameters)
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+  
+  def __repr__(self):
+    return '%s[%s]' % (self.__class__.__name__, self.directory)
+
+
+def align_parallel(jobs, processes = None, threads = None):
+  """Runs several alignments in parallel.
+  
+  Arguments
+  ---------
+  jobs : list of dict
+    The arguments of :func:`align` for each alignment.
+  processes : int or None
+    Number of alignments to run in parallel. If None, use the number of 
+    cpus or jobs whichever is smaller.
+  threads : int or None
+    Number of elastix threads per alignment if not specified in the job.
+    If None, the cpus are distributed over the parallel alignments.
+  
+  Returns
+  -------
+  transform_parameters : list of TransformParameters
+    The estimated transformations in the order of the jobs.
+  
+  Note
+  ----
+  Each alignment writes to its own result directory, a unique temporary
+  directory if none is given, and its output to align.log in this directory.
+  """
+  check_elastix_initialized()
+  
+  if not jobs:
+    return []
+  if processes is None:
+    processes = min(mp.cpu_count(), len(jobs))
+  if threads is None:
+    threads = max(1, mp.cpu_count() // processes)
+  
+  def run(job):
+    job = job.copy()
+    if job.get('result_directory') is None:
+      job['result_directory'] = temporary_directory('elastix_align')
+    if not os.path.exists(job['result_directory']):
+      os.makedirs(job['result_directory'])
+    job.setdefault('processes', threads)
+    job.setdefault('log_file', os.path.join(job['result_directory'], 'align.log'))
+    result_directory = align(**job)
+    set_path_transform_files(result_directory)
+    return read_transform_parameters(transform_directory=result_directory)
+  
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    futures = [executor.submit(run, job) for job in jobs]
+    return [future.result() for future in futures]
 
 
 ###############################################################################
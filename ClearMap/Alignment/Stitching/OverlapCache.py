@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+OverlapCache
+============
+
+Persistent cache for the overlap regions of tiles used in the alignment steps
+of the stitching.
+
+Each tile takes part in up to four alignment pairs, and the alignment is
+typically re-run several times while tuning the stitching parameters. This
+module stores the overlap strips and their maximum intensity projections read
+from the raw tiles in a single sqlite file, so that they are read from the
+tiles only once.
+
+Entries are keyed by the tile file, its modification time and size, the
+slicing of the overlap within the tile and the projection, so modified tiles
+are read again automatically.
+
+Example
+-------
+>>> import ClearMap.Alignment.Stitching.StitchingRigid as strg
+>>> import ClearMap.Alignment.Stitching.StitchingWobbly as stw
+>>> cache = 'overlaps.cache'
+>>> strg.align_layout_rigid_mip(layout, depth=[55,155,0], max_shifts=[(-30,30),(-30,30),(-20,20)], cache=cache)
+>>> stw.align_layout(layout, axis_range=(None,None,3), max_shifts=[(-30,30),(-15,15),(0,0)], cache=cache)
+
+Note
+----
+This module is used by :mod:`~ClearMap.Alignment.Stitching.StitchingRigid`
+and :mod:`~ClearMap.Alignment.Stitching.StitchingWobbly`.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import glob
+import zlib
+import sqlite3
+
+import numpy as np
+
+import ClearMap.IO.Slice as slc
+
+import ClearMap.Utils.TagExpression as te
+
+
+###############################################################################
+### Cache
+###############################################################################
+
+default_chunk_size = 2**26
+"""Maximal size in bytes of the data blocks in which an entry is stored.
+
+Note
+----
+sqlite limits the size of a single blob, large overlap strips are thus split
+into several blocks.
+"""
+
+
+class OverlapCache(object):
+  """Persistent on-disk cache for overlap strips and projections of tiles."""
+
+  def __init__(self, location, compression = None, timeout = 600):
+    """OverlapCache constructor.
+
+    Arguments
+    ---------
+    location : str
+      The file name of the cache.
+    compression : int or None
+      If not None, the zlib compression level used to store the data.
+    timeout : float
+      Time in seconds to wait for the cache to be released by other processes.
+    """
+    self._location = location;
+    self.compression = compression;
+    self.timeout = timeout;
+    self._connection = None;
+
+
+  @property
+  def location(self):
+    """The file name of the cache."""
+    return self._location;
+
+
+  @property
+  def connection(self):
+    """The connection to the sqlite database of the cache."""
+    if self._connection is None:
+      connection = sqlite3.connect(self._location, timeout = self.timeout);
+      connection.execute('PRAGMA journal_mode=WAL');
+      connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, dtype TEXT, shape TEXT, compression INTEGER, n_chunks INTEGER)');
+      connection.execute('CREATE TABLE IF NOT EXISTS chunks (key TEXT, chunk INTEGER, data BLOB, PRIMARY KEY (key, chunk))');
+      connection.commit();
+      self._connection = connection;
+    return self._connection;
+
+
+  def close(self):
+    """Close the connection to the cache."""
+    if self._connection is not None:
+      self._connection.close();
+      self._connection = None;
+
+
+  def __getstate__(self):
+    state = self.__dict__.copy();
+    state['_connection'] = None;
+    return state;
+
+
+  def __del__(self):
+    try:
+      self.close();
+    except Exception:
+      pass;
+
+
+  def key(self, source, slicing, projection = None):
+    """Key for the overlap of a source.
+
+    Arguments
+    ---------
+    source : Source class
+      The tile source.
+    slicing : tuple
+      The slicing of the overlap in the source.
+    projection : tuple or None
+      The projection applied to the overlap, e.g. ('max', axis).
+
+    Returns
+    -------
+    key : str or None
+      The key of the overlap or None if the source is not file based.
+    """
+    if isinstance(source, slc.Slice):
+      slicing = slc.sliced_slicing(slicing, source.base_slicing, source.base_shape);
+      source = source.base;
+
+    try:
+      location = source.location;
+    except Exception:
+      location = None;
+    if not isinstance(location, str):
+      return None;
+
+    stamp = _file_stamp(location);
+    if stamp is None:
+      return None;
+
+    slicing = _format_slicing(slicing, source.shape);
+    if slicing is None:
+      return None;
+
+    if projection is not None:
+      projection = tuple(projection);
+
+    return repr((os.path.abspath(location),) + stamp + (slicing, projection));
+
+
+  def get(self, key):
+    """Returns the cached array for a key or None if not cached."""
+    connection = self.connection;
+    entry = connection.execute('SELECT dtype, shape, compression, n_chunks FROM entries WHERE key=?', (key,)).fetchone();
+    if entry is None:
+      return None;
+    dtype, shape, compression, n_chunks = entry;
+
+    chunks = connection.execute('SELECT data FROM chunks WHERE key=? ORDER BY chunk', (key,)).fetchall();
+    if len(chunks) != n_chunks:
+      return None;
+
+    data = [c[0] for c in chunks];
+    if compression is not None:
+      data = [zlib.decompress(d) for d in data];
+    shape = tuple(int(s) for s in shape.split(',') if s);
+
+    return np.frombuffer(b''.join(data), dtype = np.dtype(dtype)).reshape(shape).copy();
+
+
+  def set(self, key, array):
+    """Stores an array under a key."""
+    array = np.ascontiguousarray(array);
+    data = array.tobytes();
+
+    n_chunks = max(1, int(np.ceil(len(data) / default_chunk_size)));
+    chunks = [data[i * default_chunk_size:(i+1) * default_chunk_size] for i in range(n_chunks)];
+    if self.compression is not None:
+      chunks = [zlib.compress(c, self.compression) for c in chunks];
+    shape = ','.join('%d' % s for s in array.shape);
+
+    connection = self.connection;
+    with connection:
+      connection.execute('DELETE FROM chunks WHERE key=?', (key,));
+      connection.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?)',
+                         (key, array.dtype.str, shape, self.compression, n_chunks));
+      connection.executemany('INSERT INTO chunks VALUES (?,?,?)',
+                             [(key, i, sqlite3.Binary(c)) for i,c in enumerate(chunks)]);
+
+
+  def read(self, source, slicing, projection = None):
+    """Reads an overlap region of a source via the cache.
+
+    Arguments
+    ---------
+    source : Source class
+      The tile source.
+    slicing : tuple
+      The slicing of the overlap in the source.
+    projection : tuple or None
+      The projection applied to the overlap, e.g. ('max', axis).
+
+    Returns
+    -------
+    overlap : array
+      The (projected) overlap region.
+    """
+    key = self.key(source, slicing, projection = projection);
+    if key is not None:
+      overlap = self.get(key);
+      if overlap is not None:
+        return overlap;
+
+    overlap = project(np.asarray(source[slicing]), projection);
+
+    if key is not None:
+      self.set(key, overlap);
+    return overlap;
+
+
+  def __len__(self):
+    return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0];
+
+
+  def __contains__(self, key):
+    return self.connection.execute('SELECT 1 FROM entries WHERE key=?', (key,)).fetchone() is not None;
+
+
+  def clear(self):
+    """Removes all entries from the cache."""
+    connection = self.connection;
+    with connection:
+      connection.execute('DELETE FROM chunks');
+      connection.execute('DELETE FROM entries');
+    connection.execute('VACUUM');
+
+
+  def __str__(self):
+    return 'OverlapCache[%s]' % self._location;
+
+  def __repr__(self):
+    return self.__str__();
+
+
+def as_cache(cache):
+  """Converts the cache argument of the alignment routines to a cache.
+
+  Arguments
+  ---------
+  cache : OverlapCache, str or None
+    The cache or its file name.
+
+  Returns
+  -------
+  cache : OverlapCache or None
+    The cache.
+  """
+  if cache is None or isinstance(cache, OverlapCache):
+    return cache;
+  return OverlapCache(cache);
+
+
+def read(source, slicing, projection = None, cache = None):
+  """Reads an overlap region of a source using an optional cache.
+
+  Arguments
+  ---------
+  source : Source class
+    The tile source.
+  slicing : tuple
+    The slicing of the overlap in the source.
+  projection : tuple or None
+    The projection applied to the overlap, e.g. ('max', axis).
+  cache : OverlapCache, str or None
+    The cache to use. If None, the overlap is read from the source.
+
+  Returns
+  -------
+  overlap : array
+    The (projected) overlap region.
+  """
+  cache = as_cache(cache);
+  if cache is None:
+    return project(source[slicing], projection);
+  return cache.read(source, slicing, projection = projection);
+
+
+def project(array, projection = None):
+  """Applies a projection to an overlap region.
+
+  Arguments
+  ---------
+  array : array
+    The overlap region.
+  projection : tuple or None
+    The projection, ('max', axis) for a maximum intensity projection.
+
+  Returns
+  -------
+  projected : array
+    The projected overlap region.
+  """
+  if projection is None:
+    return array;
+  method, axis = projection;
+  if method == 'max':
+    return np.max(array, axis = axis);
+  else:
+    raise ValueError('Projection %r not valid!' % (method,));
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _file_stamp(location):
+  """Modification time and size of the file(s) of a source location."""
+  if os.path.isfile(location):
+    files = [location];
+  elif te.Expression(location).ntags() > 0:
+    files = glob.glob(te.Expression(location).glob());
+  else:
+    return None;
+  if len(files) == 0:
+    return None;
+
+  stats = [os.stat(f) for f in files];
+  return (max(s.st_mtime_ns for s in stats), sum(s.st_size for s in stats), len(files));
+
+
+def _format_slicing(slicing, shape):
+  """Explicit hashable version of a slicing of a source with a given shape."""
+  slicing = slc.unpack_slicing(slicing, len(shape));
+  if not isinstance(slicing, tuple) or len(slicing) != len(shape):
+    return None;
+
+  formatted = ();
+  for s,n in zip(slicing, shape):
+    if isinstance(s, slice):
+      formatted += (s.indices(n),);
+    elif isinstance(s, (int, np.integer)):
+      formatted += (int(s) % n,);
+    else:
+      return None;
+  return formatted;
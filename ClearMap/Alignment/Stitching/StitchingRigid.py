@@ -39,6 +39,8 @@ import ClearMap.IO.FileList as fl
 
 import ClearMap.ParallelProcessing.ParallelTraceback as ptb
 
+import ClearMap.Alignment.Stitching.OverlapCache as ovc
+
 import ClearMap.Visualization.Plot3d as p3d
 import ClearMap.Visualization.Color as col
 
@@ -2936,7 +2938,7 @@ def max_intensity_projection(data, axis = 0, function = np.max):
   return function(data, axis = axis);
 
 
-def align_2_sources_along_axis_mip(src1, src2, axis = 2, depth = 10, max_shifts = 10, clip = None, background = None, verbose = False, with_mip = False):
+def align_2_sources_along_axis_mip(src1, src2, axis = 2, depth = 10, max_shifts = 10, clip = None, background = None, verbose = False, with_mip = False, cache = None):
   """Align 2 images orthogonal to a spcified axis using max projection
   
   Arguments
@@ -2957,6 +2959,8 @@ def align_2_sources_along_axis_mip(src1, src2, axis = 2, depth = 10, max_shifts
     If True, print progress information.
   with_mip: bool
     If True, also return the maximum projections used to aling the two sources.
+  cache : OverlapCache, str or None
+    Optional :class:`~ClearMap.Alignment.Stitching.OverlapCache.OverlapCache` to read the projections from.
         
   Returns
   -------
@@ -2992,8 +2996,13 @@ def align_2_sources_along_axis_mip(src1, src2, axis = 2, depth = 10, max_shifts
   sub2 = tuple(sub2);          
               
   # calculate max projection along axis  
-  mip1 = max_intensity_projection(src1[sub1], axis = axis);
-  mip2 = max_intensity_projection(src2[sub2], axis = axis);                               
+  if cache is None:
+    mip1 = max_intensity_projection(src1[sub1], axis = axis);
+    mip2 = max_intensity_projection(src2[sub2], axis = axis);                               
+  else:
+    cache = ovc.as_cache(cache);
+    mip1 = cache.read(src1, sub1, projection = ('max', axis));
+    mip2 = cache.read(src2, sub2, projection = ('max', axis));
   
   #add position information
   p1 = src1.position[:axis] + src1.position[axis+1:];
@@ -3314,7 +3323,7 @@ def _align_layout_axis(src1, src2, aid, n_alignments, axis, axis_range, depth, m
 
 
 def align_layout_rigid_mip(layout, depth = 10, max_shifts = 10, ranges = None, clip = None, background = None,
-                           processes = None, workspace=None, verbose = False):
+                           processes = None, workspace=None, verbose = False, cache = None):
   """Aligns sources in a layout in a single axis direction only.
   
   Arguments
@@ -3336,6 +3345,9 @@ def align_layout_rigid_mip(layout, depth = 10, max_shifts = 10, ranges = None, c
     Number of processor to use for parallel processing, if 'serial' process in serial.
   verbose : bool
     Print progress information.
+  cache : OverlapCache, str or None
+    Optional :class:`~ClearMap.Alignment.Stitching.OverlapCache.OverlapCache` or its file name
+    to store and reuse the projected overlaps of the sources.
   
   Returns
   -------
@@ -3364,7 +3376,8 @@ def align_layout_rigid_mip(layout, depth = 10, max_shifts = 10, ranges = None, c
   _align = ft.partial(_align_layout_ridgid_mip, 
                       n_alignments=n_alignments,
                       depth=depth, max_shifts=max_shifts, ranges=ranges,
-                      clip=clip, background=background, verbose=verbose);
+                      clip=clip, background=background, verbose=verbose,
+                      cache=ovc.as_cache(cache));
   
   if not isinstance(processes, int) and processes != 'serial':
     processes = mp.cpu_count();
@@ -3397,7 +3410,7 @@ def align_layout_rigid_mip(layout, depth = 10, max_shifts = 10, ranges = None, c
 
 
 @ptb.parallel_traceback
-def _align_layout_ridgid_mip(src1, src2, aid, n_alignments, depth, max_shifts, ranges, clip, background, verbose):
+def _align_layout_ridgid_mip(src1, src2, aid, n_alignments, depth, max_shifts, ranges, clip, background, verbose, cache = None):
   if verbose:
     print('Alignment: aligning %r with %r, alignment pair %d/%d !' % (src1.tile_position, src2.tile_position, aid, n_alignments));
      
@@ -3442,7 +3455,7 @@ def _align_layout_ridgid_mip(src1, src2, aid, n_alignments, depth, max_shifts, r
     src2 = Slice(source = src2, slicing = sl2);                  
                    
               
-  result = align_2_sources_along_axis_mip(src1, src2, axis = mip_axis, depth = mip_depth, max_shifts = max_shifts, clip = clip, background = background, verbose = False);
+  result = align_2_sources_along_axis_mip(src1, src2, axis = mip_axis, depth = mip_depth, max_shifts = max_shifts, clip = clip, background = background, verbose = False, cache = cache);
   
   if verbose:
     shift, quality = result;
@@ -27,9 +27,11 @@ import graph_tool.topology as gtt
 
 import ClearMap.IO.IO as io
 import ClearMap.IO.Slice as slc
+import ClearMap.IO.Pyramid as pyr
 
 import ClearMap.Alignment.Stitching.StitchingRigid as strg
 import ClearMap.Alignment.Stitching.Tracking as trk
+import ClearMap.Alignment.Stitching.OverlapCache as ovc
 
 import ClearMap.ParallelProcessing.ParallelTraceback as ptb
 
@@ -1002,7 +1004,8 @@ def verbose_has_flag(verbose, flag):
 def align_layout(layout, axis_range=None, max_shifts=10, axis_mip=None,
                  stack_validation_params=None, validate=None, prepare='normalization',
                  slice_validation_params=None, validate_slice=None, prepare_slice=None,
-                 find_shifts='minimization',
+                 find_shifts='minimization', engine='batch', dtype=None, batch_size=None,
+                 fft_workers=None, fft_backend=None, cache=None,
                  verbose=False, processes=None, workspace= None):
 
   if validate is not None:
@@ -1030,7 +1033,8 @@ def align_layout(layout, axis_range=None, max_shifts=10, axis_mip=None,
   _align = ft.partial(align_wobbly_axis, axis=axis, axis_range=axis_range, axis_mip=axis_mip, max_shifts=max_shifts,
                       prepare=prepare, stack_validation_params=stack_validation_params,
                       prepare_slice=prepare_slice, slice_validation_params=slice_validation_params,
-                      find_shifts=find_shifts,
+                      find_shifts=find_shifts, engine=engine, dtype=dtype, batch_size=batch_size,
+                      fft_workers=fft_workers, fft_backend=fft_backend, cache=ovc.as_cache(cache),
                       verbose=verbose);
   
   if not isinstance(processes, int) and processes != 'serial':
@@ -1057,12 +1061,121 @@ def align_layout(layout, axis_range=None, max_shifts=10, axis_mip=None,
     timer.print_elapsed_time('Alignment: aligning %d pairs of wobbly sources' % (len(alignments)));
 
 
+default_batch_size = 64
+"""Default number of slices correlated in a single batched fft by the 'batch' alignment engine.
+
+Note
+----
+This value is used if batch_size passed to :func:`align_wobbly_axis` is None.
+"""
+
+
+def _fft_backend(backend=None):
+  """Returns the fft module used by the batched alignment engine.
+  
+  Arguments
+  ---------
+  backend : 'scipy', 'pyfftw' or None
+    The fft backend. If None, pyfftw is used if installed, otherwise scipy.
+  
+  Returns
+  -------
+  module : module
+    Module with scipy.fft like rfftn and irfftn functions supporting workers.
+  
+  Note
+  ----
+  The pyfftw backend enables the pyfftw interface cache so that the fftw plans 
+  for the slice shapes of an alignment are created only once.
+  """
+  if backend in (None, 'pyfftw'):
+    try:
+      import pyfftw;
+      import pyfftw.interfaces.scipy_fft as fft;
+      pyfftw.interfaces.cache.enable();
+      pyfftw.interfaces.cache.set_keepalive_time(60);
+      return fft;
+    except ImportError:
+      if backend == 'pyfftw':
+        raise;
+  if backend in (None, 'scipy'):
+    import scipy.fft as fft;
+    return fft;
+  raise ValueError('FFT backend %r not valid!' % (backend,));
+
+
+def _wssd_batch(buffer, n, w1fft, w2fft_conj, nrm, fft_roi, fft, workers=None):
+  """Weighted sum of squared differences of a batch of padded slices.
+  
+  Arguments
+  ---------
+  buffer : array
+    Array of shape (4, batch_size) + fft shape, with the padded slices of the 
+    first and second source in buffer[0] and buffer[1]. buffer[2] and buffer[3] 
+    are used as work space for the squared slices.
+  n : int
+    Number of slices in the batch.
+  w1fft, w2fft_conj : array
+    Real fft of the first mask and the conjugate of the real fft of the second mask.
+  nrm : array
+    Normalization of the errors in the range of interest.
+  fft_roi : tuple of slice
+    Range of interest in the correlation.
+  fft : module
+    The fft backend.
+  workers : int or None
+    Number of fft threads.
+  
+  Returns
+  -------
+  errors : array
+    The normalized errors of the n slices.
+  """
+  shape = buffer.shape[2:];
+  axes = tuple(range(2, buffer.ndim));
+  
+  i1 = buffer[0,:n]; i2 = buffer[1,:n];
+  np.multiply(i1, i1, out=buffer[2,:n]);
+  np.multiply(i2, i2, out=buffer[3,:n]);
+  
+  i1fft, i2fft, s1fft, s2fft = fft.rfftn(buffer[:,:n], axes=axes, workers=workers);
+  
+  #wssd = w1fft * conj(s2fft) + s1fft * conj(w2fft) - 2 * i1fft * conj(i2fft)
+  wssd = np.conj(i2fft, out=i2fft);
+  wssd *= i1fft;
+  wssd *= -2;
+  s2fft = np.conj(s2fft, out=s2fft);
+  s2fft *= w1fft;
+  wssd += s2fft;
+  s1fft *= w2fft_conj;
+  wssd += s1fft;
+  
+  wssd = fft.irfftn(wssd, s=shape, axes=tuple(a - 1 for a in axes), workers=workers);
+  wssd = np.abs(wssd[(slice(None),) + fft_roi]);
+  wssd /= nrm;
+  
+  return wssd;
+
+
 @ptb.parallel_traceback
 def align_wobbly_axis(source1, source2, axis=2, axis_range=None, max_shifts=10, axis_mip=None,
                       stack_validation_params=None, prepare='normalization', slice_validation_params=None,
                       prepare_slice=None, find_shifts='minimization', with_errors=False, with_overlaps=False,
-                      verbose=True):
-  """Create shifts along the wobble axis, estimate smooth shifts and mark invalid slices, accounts for jumps in minima using multiple minima."""                      
+                      engine='batch', dtype=None, batch_size=None, fft_workers=None, fft_backend=None,
+                      cache=None, verbose=True):
+  """Create shifts along the wobble axis, estimate smooth shifts and mark invalid slices, accounts for jumps in minima using multiple minima.
+  
+  Note
+  ----
+  The 'batch' engine correlates stacks of batch_size slices in single real ffts, 
+  reusing the mask spectra across slices, with fft_workers threads of the 
+  fft_backend. The 'slice' engine correlates the slices one by one. Using 
+  dtype=np.float32 halves memory and speeds up the ffts of the 'batch' engine.
+  
+  The overlaps are read via the optional 
+  :class:`~ClearMap.Alignment.Stitching.OverlapCache.OverlapCache` cache, 
+  so re-running the alignment with different parameters does not re-read the tiles.
+  """                      
   
   if verbose:
     timer = tmr.Timer();
@@ -1124,8 +1237,10 @@ def align_wobbly_axis(source1, source2, axis=2, axis_range=None, max_shifts=10,
   #pad1_full = pad1[:axis] + [(0,0)] + pad1[axis:];
   #pad2_full = pad2[:axis] + [(0,0)] + pad2[axis:];
                                                                                                                                                            
-  i1 = np.array(source1[slice1_full], dtype=float);
-  i2 = np.array(source2[slice2_full], dtype=float);                
+  if dtype is None:
+    dtype = float;
+  i1 = np.array(ovc.read(source1, slice1_full, cache=cache), dtype=dtype);
+  i2 = np.array(ovc.read(source2, slice2_full, cache=cache), dtype=dtype);                
   #print i1.shape, i2.shape       
   
   #initialize the error and status results
@@ -1165,17 +1280,45 @@ def align_wobbly_axis(source1, source2, axis=2, axis_range=None, max_shifts=10,
   shape1 = i1.shape[:axis] + i1.shape[axis+1:]
   w1 = np.pad(np.zeros(shape1), pad1, 'constant');          
   w1[slice_no_pad1] = 1;
-  w1fft = np.fft.fftn(w1);
   
   w2 = np.pad(np.zeros(shape1), pad1, 'constant');     # FIXME: check pad1
   w2[slice_no_pad2] = 1;
-  w2fft = np.fft.fftn(w2);
-   
-  #norm                    
-  nrm  = np.fft.ifftn(w1fft * np.conj(w2fft));                     
-  nrm  = np.abs(nrm[fft_roi]);
+  
   eps =  2.2204e-16;
-  nrm[nrm < eps] = eps;             
+  if engine == 'slice':
+    w1fft = np.fft.fftn(w1);
+    w2fft = np.fft.fftn(w2);
+     
+    #norm                    
+    nrm  = np.fft.ifftn(w1fft * np.conj(w2fft));                     
+    nrm  = np.abs(nrm[fft_roi]);
+    nrm[nrm < eps] = eps;             
+  
+  elif engine == 'batch':
+    #mask spectra and norm are shared by all slices
+    fft = _fft_backend(fft_backend);
+    w1fft = fft.rfftn(w1.astype(i1.dtype), workers=fft_workers);
+    w2fft_conj = np.conj(fft.rfftn(w2.astype(i1.dtype), workers=fft_workers));
+    
+    nrm = fft.irfftn(w1fft * w2fft_conj, s=w1.shape, workers=fft_workers);
+    nrm = np.abs(nrm[fft_roi]);
+    nrm[nrm < eps] = eps;
+    
+    #padded slice buffers
+    if batch_size is None:
+      batch_size = default_batch_size;
+    batch_size = max(1, min(batch_size, len(range(a_start, a_stop, a_step))));
+    buffer = np.zeros((4, batch_size) + w1.shape, dtype=i1.dtype);
+    batch = [];
+    
+    def correlate_batch():
+      n = len(batch);
+      errors[batch] = _wssd_batch(buffer, n, w1fft, w2fft_conj, nrm, fft_roi, fft, workers=fft_workers);
+      status[batch] = WobblyAlignment.MEASURED;
+      del batch[:];
+  
+  else:
+    raise ValueError('Alignment engine %r not valid!' % (engine,));
     
   #align slices              
   for i, a in enumerate(range(start, stop)):
@@ -1218,6 +1361,15 @@ def align_wobbly_axis(source1, source2, axis=2, axis_range=None, max_shifts=10,
       i1a = _prepare(i1a, **prepare_slice);
       i2a = _prepare(i2a, **prepare_slice);
     
+    if engine == 'batch':
+      k = len(batch);
+      buffer[(0, k) + slice_no_pad1] = i1a;
+      buffer[(1, k) + slice_no_pad2] = i2a;
+      batch.append(i);
+      if len(batch) == batch_size:
+        correlate_batch();
+      continue;
+    
     i1a = np.pad(i1a, pad1, 'constant');
     i2a = np.pad(i2a, pad2, 'constant');                  
     
@@ -1237,6 +1389,9 @@ def align_wobbly_axis(source1, source2, axis=2, axis_range=None, max_shifts=10,
     # save least square errors             
     errors[i] = wssd;
     status[i] = WobblyAlignment.MEASURED
+  
+  if engine == 'batch' and len(batch) > 0:
+    correlate_batch();
     
   if verbose:
     timer.print_elapsed_time('Alignment: Wobbly slice alignment %r->%r along axis %d done' % (source1.identifier, source2.identifier, axis));
@@ -2271,7 +2426,17 @@ def fix_isolated(self, exclude_borders=False):
 ###############################################################################
 
 
-def stitch_layout(layout, sink, method = 'interpolation', processes = None, verbose = True, workspace=None):
+default_slab_memory = 2 * 1024**3
+"""Default memory budget in bytes of a worker for slab-wise stitching.
+
+Note
+----
+This value is used if memory_budget passed to :func:`stitch_layout` is None.
+"""
+
+
+def stitch_layout(layout, sink, method = 'interpolation', processes = None, verbose = True, workspace=None,
+                  slabs = True, memory_budget = None, pyramid = None):
   """Stitches the wobbly sources in a wobbly layout.
   
   Arguments
@@ -2284,6 +2449,18 @@ def stitch_layout(layout, sink, method = 'interpolation', processes = None, verb
     Number of processor to use for parallel processing, if 'serial' process in serial.
   verbose : bool 
     If True, print progress information.
+  slabs : bool
+    If True, stitch contiguous ranges of slices along the wobble axis in each 
+    worker, reading the range of each source once and writing each slab at 
+    once. If False, stitch each slice separately. Chunked sinks, see 
+    :mod:`~ClearMap.IO.ZARR`, are always stitched in chunk aligned slabs.
+  memory_budget : int or None
+    Memory budget in bytes of a worker that determines the thickness of the 
+    slabs. If None, :const:`default_slab_memory` is used.
+  pyramid : bool, int or None
+    If True, build a multiresolution pyramid next to the sink after stitching,
+    if an int, build a pyramid with this number of levels, see 
+    :mod:`~ClearMap.IO.Pyramid`.
   
   Returns
   -------
@@ -2299,47 +2476,67 @@ def stitch_layout(layout, sink, method = 'interpolation', processes = None, verb
   
   #overall shape
   axis = layout.axis;
-  origin = layout.origin_wobbly;
-  shape = layout.shape_wobbly;
+  origin = tuple(int(o) for o in layout.origin_wobbly);
+  shape = tuple(int(s) for s in layout.shape_wobbly);
   #print axis, origin, shape
   
   # create sink
   #TODO: make layout a sink ! use io.create
-  io.mmp.create(sink, shape=shape, dtype=layout.dtype, order=layout.order);
+  if io.zarr.is_zarr(sink):
+    #chunked sinks are written in chunk aligned slabs
+    chunk = io.zarr.create(sink, shape=shape, dtype=layout.dtype, order=layout.order).chunks[axis];
+    slabs = True;
+  else:
+    chunk = None;
+    io.mmp.create(sink, shape=shape, dtype=layout.dtype, order=layout.order);
   #print shape
   
-  #create slices
-  coordinates = np.arange(origin[axis], origin[axis] + shape[axis]);
-  layout_slices = layout.layouts_along_axis_wobbly(coordinates);
-  n_slices = len(layout_slices);
-  #print n_slices 
-                
-  if verbose:
-    timer = tmr.Timer();
-    print('Stitching: stitching %d sliced layouts.' % n_slices);                
-  
   #sliced origin and shape
   full_region = strg.Region(position = origin[:axis] + origin[axis+1:], shape = shape[:axis] + shape[axis+1:])                   
   
-  _stitch = ft.partial(_stitch_slice, n_slices=n_slices, sink=sink, method=method, 
-                       axis=axis, full_region=full_region, verbose=verbose);
-               
-  #stitch the data
   if not isinstance(processes, int) and processes != 'serial':
     processes = mp.cpu_count();
   
+  coordinates = np.arange(origin[axis], origin[axis] + shape[axis]);
+  if slabs:
+    #create slabs
+    slab_layouts = _slab_layouts(layout, coordinates, full_region, processes, memory_budget, chunk=chunk);
+    n_slabs = len(slab_layouts);
+    
+    if verbose:
+      print('Stitching: stitching %d slabs of %d slices.' % (n_slabs, len(coordinates)));
+    
+    _stitch = ft.partial(_stitch_slab, n_slabs=n_slabs, sink=sink, method=method, axis=axis, 
+                         full_region=full_region, dtype=layout.dtype, order=layout.order, verbose=verbose);
+    tasks = slab_layouts;
+  else:
+    #create slices
+    layout_slices = layout.layouts_along_axis_wobbly(coordinates);
+    n_slices = len(layout_slices);
+    #print n_slices 
+                  
+    if verbose:
+      print('Stitching: stitching %d sliced layouts.' % n_slices);                
+    
+    _stitch = ft.partial(_stitch_slice, n_slices=n_slices, sink=sink, method=method, 
+                         axis=axis, full_region=full_region, verbose=verbose);
+    tasks = layout_slices;
+  
+  #stitch the data
   if processes == 'serial':
-    [_stitch(l,i) for i,l in enumerate(layout_slices)];
+    [_stitch(l,i) for i,l in enumerate(tasks)];
   else:
     #for l in layout_slices:
     #  l.sources_as_virtual();
     with CancelableProcessPoolExecutor(processes) as executor:
-      executor.map(_stitch, layout_slices, range(n_slices))
+      executor.map(_stitch, tasks, range(len(tasks)))
       if workspace is not None:
         workspace.executor = executor
     if workspace is not None:
       workspace.executor = None
-    
+  
+  if pyramid:
+    pyr.build(sink, levels=None if pyramid is True else pyramid, processes=processes, verbose=verbose);
   
   if verbose:
     timer.print_elapsed_time('Stitching: stitching wobbly layout done!');
@@ -2352,6 +2549,18 @@ def _stitch_slice(slice_layout, slice_id, n_slices, sink, method, axis, full_reg
   if verbose:
     print('Stitching: stitching wobbly slice %d/%d' % (slice_id, n_slices));
   
+  stitched = _stitch_plane(slice_layout, method, full_region);
+  if stitched is None:
+    return;
+  stitched, full_slicing = stitched;
+  full_slicing = full_slicing[:axis] + (slice_id,) + full_slicing[axis:];
+  
+  #write to sink
+  io.write(sink, stitched, slicing = full_slicing);
+
+
+def _stitch_plane(slice_layout, method, full_region):
+  """Stitches a sliced layout and returns the data and its slicing in the full region."""
   if len(slice_layout.sources) == 0:
     return;
   
@@ -2366,15 +2575,95 @@ def _stitch_slice(slice_layout, slice_id, n_slices, sink, method, axis, full_reg
   
   overlap.sources = [slice_region, full_region];
   slice_slicing, full_slicing = overlap.source_slicings();
-  full_slicing = full_slicing[:axis] + (slice_id,) + full_slicing[axis:];
   #print slice_slicing, full_slicing
                              
   #stitch
   stitched = strg.stitch_layout(slice_layout, method = method);
   
-  #write to sink
-  io.write(sink, stitched[slice_slicing], slicing = full_slicing);
+  return stitched[slice_slicing], full_slicing;
+
+
+def _slab_layouts(layout, coordinates, full_region, processes, memory_budget, chunk = None):
+  """Splits the wobbly layout into slabs along the wobble axis.
+  
+  If chunk is given, the slab thickness is a multiple of this chunk size.
+  
+  Returns
+  -------
+  slabs : list of tuples
+    For each slab the range of slice indices and a list of the virtual 
+    sources with their wobble axis range, wobbles and valid slices.
+  """
+  axis = layout.axis;
+  dtype = np.dtype(layout.dtype);
+  if memory_budget is None:
+    memory_budget = default_slab_memory;
+  
+  #slab thickness from the memory of a single slice
+  slice_size = np.prod(full_region.shape) + sum(np.prod(s.shape[:axis] + s.shape[axis+1:]) for s in layout.sources);
+  thickness = max(1, int(memory_budget // (slice_size * dtype.itemsize)));
+  n_coordinates = len(coordinates);
+  if processes != 'serial':
+    thickness = min(thickness, int(np.ceil(n_coordinates / processes)));
+  if chunk is not None:
+    thickness = max(1, thickness // chunk) * chunk;
+  
+  slabs = [];
+  for start in range(0, n_coordinates, thickness):
+    stop = min(start + thickness, n_coordinates);
+    first, last = coordinates[start], coordinates[stop-1] + 1;
+    sources = [];
+    for source in layout.sources:
+      lower = max(first, source.coordinate);
+      upper = min(last, source.coordinate + source.height);
+      if lower >= upper:
+        continue;
+      local = slice(lower - source.coordinate, upper - source.coordinate);
+      valids = source.valids[local];
+      if not np.any(valids):
+        continue;
+      sources.append((source.source.as_virtual(), local, lower, source.wobble[local], valids, source.tile_position));
+    slabs.append(((start, stop), first, sources));
   
+  return slabs;
+
+
+@ptb.parallel_traceback
+def _stitch_slab(slab_layout, slab_id, n_slabs, sink, method, axis, full_region, dtype, order, verbose):
+  (start, stop), first, sources = slab_layout;
+  if verbose:
+    print('Stitching: stitching wobbly slab %d/%d with slices %d-%d' % (slab_id, n_slabs, start, stop));
+  
+  #read the range of each source once
+  ndim = len(full_region.shape) + 1;
+  datas = [];
+  for source, local, lower, wobble, valids, tile_position in sources:
+    slicing = (slice(None),) * axis + (local,) + (slice(None),) * (ndim - 1 - axis);
+    datas.append(np.asarray(source[slicing]));
+  
+  #stitch slices
+  stitched = np.zeros(full_region.shape[:axis] + (stop - start,) + full_region.shape[axis:], dtype=dtype, order=order);
+  for i, coordinate in enumerate(range(first, first + stop - start)):
+    sliced_sources = [];
+    for (source, local, lower, wobble, valids, tile_position), data in zip(sources, datas):
+      j = coordinate - lower;
+      if 0 <= j < len(valids) and valids[j]:
+        plane = data[(slice(None),) * axis + (j,)];
+        sliced_sources.append(strg.Source(source=plane, position=wobble[j], tile_position=tile_position));
+    
+    if len(sliced_sources) == 0:
+      continue;
+    slice_layout = strg.Layout(sources=sliced_sources, dtype=dtype, order=order);
+    plane = _stitch_plane(slice_layout, method, full_region);
+    if plane is None:
+      continue;
+    plane, full_slicing = plane;
+    stitched[full_slicing[:axis] + (i,) + full_slicing[axis:]] = plane;
+  
+  #write slab
+  slicing = (slice(None),) * axis + (slice(start, stop),);
+  io.write(sink, stitched, slicing = slicing);
+
 
 #############################################################################################################
 ### Tests
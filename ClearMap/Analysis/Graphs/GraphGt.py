@@ -486,8 +486,7 @@ class Graph(grp.AnnotatedGraph):
     return self._base.edge_index[self.edge(edge)];
   
   def edge_indices(self):
-    p = self.base.edge_index;
-    return np.array([p[e] for e in self.edge_iterator()], dtype=int);
+    return np.asarray(self._base.get_edges([self._base.edge_index])[:,2], dtype=int);
   
   def add_edge(self, edge):
     if isinstance(edge, tuple):
@@ -16,6 +16,8 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
 import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
 
 import ClearMap.IO.IO as io
 
@@ -178,6 +180,9 @@ def clean_graph(graph, remove_self_loops = True, remove_isolated_vertices = True
   ----
   cliques are replaced by a single vertex connecting to all non-clique neighbours 
   The center coordinate is used for that vertex as the coordinate.
+  The cliques are found and merged on the edge arrays of the graph, the 
+  mappings np.sum, np.max, np.min, np.mean and mean_vertex_coordinates are 
+  evaluated for all cliques at once, other mappings clique by clique.
   """
   
   if verbose:
@@ -199,21 +204,9 @@ def clean_graph(graph, remove_self_loops = True, remove_isolated_vertices = True
     return graph.copy();
   
   # detect 'cliques', i.e. connected components of branch points
-  gb = graph.sub_graph(vertex_filter=branches, view=True);
-  components, counts = gb.label_components(return_vertex_counts=True);
-  
-  #note: graph_tools components of a view is a property map of the full graph
-  components[branches] += 1; 
-  
-  # group components
-  components = _group_labels(components);
-  
-  #note: graph_tools components of a view is a property map of the full graph
-  #note: remove the indices of the non branch nodes
-  components = components[1:];  
-  
-  clique_ids = np.where(counts > 1)[0];
-  n_cliques = len(clique_ids);
+  connectivity = graph.edge_connectivity();
+  clique_ids, clique_vertices, clique_indices = _branch_point_cliques(connectivity, branches);
+  n_cliques = len(clique_indices);
   
   if verbose:
     timer.print_elapsed_time('Graph cleaning: detected %d cliques of branch points' % n_cliques);
@@ -223,37 +216,31 @@ def clean_graph(graph, remove_self_loops = True, remove_isolated_vertices = True
   g = graph.copy();
   g.add_vertex(n_cliques);
   
-  #mappings
-  properties = {};
-  mappings = {};
-  for k in vertex_mappings.keys():
-      if k in graph.vertex_properties:
-        mappings[k] = vertex_mappings[k];
-        properties[k] = graph.vertex_property(k);
-  
-  vertex_filter = np.ones(n_vertices + n_cliques, dtype = bool)  
-  for i,ci in enumerate(clique_ids):
-    vi = n_vertices + i;
-    cc = components[ci];
-    
-    #remove clique vertices 
-    vertex_filter[cc] = False;
-    
-    # get neighbours 
-    neighbours = np.hstack([graph.vertex_neighbours(c) for c in cc])
-    neighbours = np.setdiff1d(np.unique(neighbours), cc);
-    
-    # connect to new node
-    g.add_edge([[n, vi] for n in neighbours]);
-    
-    #map properties
-    for k in mappings.keys():
-      g.set_vertex_property(k, mappings[k](properties[k][cc]), vertex=vi);
-    
-    if verbose and i+1 % 10000 == 0:
-      timer.print_elapsed_time('Graph cleaning: reducing %d / %d' % (i+1, n_cliques));
+  # connect the non-clique neighbours to the new clique vertices
+  clique_source = clique_ids[connectivity];
+  neighbours = np.vstack([np.array([clique_source[:,0], connectivity[:,1]]).T[clique_source[:,0] >= 0],
+                          np.array([clique_source[:,1], connectivity[:,0]]).T[clique_source[:,1] >= 0]]);
+  neighbours = neighbours[clique_ids[neighbours[:,1]] != neighbours[:,0]];
+  neighbours = np.unique(neighbours, axis=0);
+  del clique_source;
+  
+  g.add_edge(np.array([neighbours[:,1], n_vertices + neighbours[:,0]]).T);
+  del neighbours;
+  
+  #map properties
+  for k,m in vertex_mappings.items():
+    if k in graph.vertex_properties:
+      values = g.vertex_property(k);
+      values[n_vertices:] = _reduce_branches(graph.vertex_property(k)[clique_vertices], clique_indices, m);
+      g.set_vertex_property(k, values);
+  
+  if verbose:
+    timer.print_elapsed_time('Graph cleaning: merged %d cliques' % n_cliques);
+    timer.reset();
   
   #generate new graph
+  vertex_filter = np.ones(n_vertices + n_cliques, dtype = bool);
+  vertex_filter[clique_vertices] = False;
   g = g.sub_graph(vertex_filter=vertex_filter);
     
   if remove_self_loops:
@@ -278,16 +265,54 @@ def clean_graph(graph, remove_self_loops = True, remove_isolated_vertices = True
     timer_all.print_elapsed_time('Graph cleaning: cleaned graph has %d nodes and %d edges' % (g.n_vertices, g.n_edges));
   
   return g;
-  
 
-def _group_labels(array):
-  """Helper grouping labels in a 1d array."""
-  idx = np.argsort(array);
-  arr = array[idx];
-  dif = np.diff(arr);
-  res = np.split(idx, np.where(dif > 0)[0]+1);
-  return res
 
+def _branch_point_cliques(connectivity, branches):
+  """Helper to find the connected components of more than one branch point.
+  
+  Arguments
+  ---------
+  connectivity : array
+    The (n_edges, 2) edge connectivity of the graph.
+  branches : array
+    Boolean array indicating the branch points.
+    
+  Returns
+  -------
+  clique_ids : array
+    The clique index of each vertex or -1 if the vertex is not in a clique.
+  clique_vertices : array
+    The vertices of all cliques, grouped by clique.
+  clique_indices : array
+    The (n_cliques, 2) start and end indices of each clique in clique_vertices.
+  
+  Note
+  ----
+  The cliques are ordered by their smallest vertex index.
+  """
+  n_vertices = len(branches);
+  branch_edges = connectivity[np.logical_and(branches[connectivity[:,0]], branches[connectivity[:,1]])];
+  adjacency = sparse.csr_matrix((np.ones(len(branch_edges), dtype=bool), (branch_edges[:,0], branch_edges[:,1])),
+                                shape=(n_vertices, n_vertices));
+  _, labels = csgraph.connected_components(adjacency, directed=False);
+  del branch_edges, adjacency;
+  
+  # components with more than one branch point ordered by their smallest vertex
+  counts = np.bincount(labels);
+  first = np.full(len(counts), n_vertices, dtype=int);
+  np.minimum.at(first, labels, np.arange(n_vertices));
+  cliques = np.where(counts > 1)[0];
+  cliques = cliques[np.argsort(first[cliques])];
+  
+  clique_ids = np.full(len(counts), -1, dtype=int);
+  clique_ids[cliques] = np.arange(len(cliques));
+  clique_ids = clique_ids[labels];
+  
+  clique_vertices = np.where(clique_ids >= 0)[0];
+  clique_vertices = clique_vertices[np.argsort(clique_ids[clique_vertices], kind='stable')];
+  clique_indices = _branch_indices(counts[cliques]);
+  
+  return clique_ids, clique_vertices, clique_indices;
 
 
 ###############################################################################
@@ -300,7 +325,45 @@ def reduce_graph(graph, vertex_to_edge_mappings = {'radii'  : np.max},
                         edge_geometry_vertex_properties = ['coordinates', 'radii'],
                         edge_geometry_edge_properties = None,
                         return_maps = False, verbose = False):
-  """Reduce graph by replacing all vertices with degree two."""
+  """Reduce graph by replacing all vertices with degree two.
+  
+  Arguments
+  ---------
+  graph : Graph
+    The graph to reduce.
+  vertex_to_edge_mappings : dict
+    Vertex properties mapped to edge properties of the reduced edges via 
+    the given functions applied to the property values of all vertices along a branch.
+  edge_to_edge_mappings : dict
+    Edge properties mapped to edge properties of the reduced edges via 
+    the given functions applied to the property values of all edges along a branch.
+  edge_geometry : bool
+    If True, store the vertex properties along each branch as edge geometry.
+  edge_length : bool or None
+    If True, add the number of edges along a branch as length property.
+  edge_geometry_vertex_properties : list of str
+    The vertex properties to store as edge geometry.
+  edge_geometry_edge_properties : list of str or None
+    The edge properties to store as edge geometry.
+  return_maps : bool
+    If True, also return the vertex to vertex, edge to vertex and edge to 
+    edge maps of the reduction.
+  verbose : bool
+    If True, print progress information.
+  
+  Returns
+  -------
+  graph : Graph
+    The reduced graph.
+  maps : tuple
+    The (vertex to vertex, edge to vertex, edge to edge) maps if return_maps is True.
+  
+  Note
+  ----
+  The branches are found on the edge arrays of the graph via :func:`graph_branches`
+  and the mappings np.sum, np.max, np.min and np.mean are evaluated on all 
+  branches at once, other mappings are applied branch by branch.
+  """
   
   if verbose:
     timer = tmr.Timer();
@@ -316,19 +379,6 @@ def reduce_graph(graph, vertex_to_edge_mappings = {'radii'  : np.max},
   #copy graph
   g = graph.copy();
   
-  #find non branching points, i.e. vertices with deg 2    
-  branch_points = g.vertex_degrees() == 2;
-  non_branch_ids = np.where(branch_points)[0];
-  branch_points = np.logical_not(branch_points)
-  branch_ids = np.where(branch_points)[0];
-  n_non_branch_points = len(non_branch_ids);
-  n_branch_points     = len(branch_ids);
-  del branch_points;
-  
-  if verbose:
-    timer.print_elapsed_time('Graph reduction: Found %d branching and %d non-branching nodes' % (n_branch_points, n_non_branch_points));
-    timer.reset();
-  
   #mappings
   if edge_to_edge_mappings is None:
     edge_to_edge_mappings = {};
@@ -341,235 +391,242 @@ def reduce_graph(graph, vertex_to_edge_mappings = {'radii'  : np.max},
     if 'length' not in g.edge_properties:
       g.add_edge_property('length', np.ones(g.n_edges, dtype = float));
   
-  edge_to_edge = {};
-  edge_properties = {};
-  edge_lists = {};
-  for k in edge_to_edge_mappings.keys():
-      if k in g.edge_properties:
-        edge_to_edge[k] = edge_to_edge_mappings[k];
-        edge_properties[k] = g.edge_property_map(k);
-        edge_lists[k] = [];
-  edge_to_edge_keys = edge_to_edge.keys();
-  
-  vertex_to_edge = {};
-  vertex_properties = {};
-  vertex_lists = {};
-  for k in vertex_to_edge_mappings.keys():
-      if k in g.vertex_properties:
-        vertex_to_edge[k] = vertex_to_edge_mappings[k];
-        vertex_properties[k] = g.vertex_property_map(k);
-        vertex_lists[k] = [];
-  vertex_to_edge_keys = vertex_to_edge.keys();
-  
-  #edge geometry
-  calculate_vertex_to_vertex_map = False;
-  calculate_edge_to_edge_map     = False;
-  calculate_edge_to_vertex_map   = False;
-  
-  if edge_geometry:
-    calculate_edge_to_vertex_map = True;
-    reduced_edge_to_vertex_map = [];
-  
-  if return_maps:
-    calculate_vertex_to_vertex_map = True;
-    reduced_vertex_to_vertex_map = [];
-    calculate_edge_to_vertex_map = True;
-    reduced_edge_to_vertex_map = [];
-    calculate_edge_to_edge_map = True;
-    reduced_edge_to_edge_map = [];
-  
-  if edge_geometry_edge_properties is not None:
-    calculate_edge_to_edge_map = True;
-    reduced_edge_to_edge_map = [];
+  edge_to_edge = { k : m for k,m in edge_to_edge_mappings.items() if k in g.edge_properties};
+  vertex_to_edge = { k : m for k,m in vertex_to_edge_mappings.items() if k in g.vertex_properties};
   
   if edge_geometry_vertex_properties is None:
     edge_geometry_vertex_properties = [];
   if edge_geometry_edge_properties is None:
     edge_geometry_edge_properties = [];
   
-  #direct edges between branch points
-  edge_list = []; 
-  checked = np.zeros(g.n_edges, dtype=bool);
-  for i,v in enumerate(branch_ids):
-    for e in g.vertex_edges_iterator(v):
-      if e.target().out_degree() != 2:
-        eid = g.edge_index(e);
-        if not checked[eid]:
-          checked[eid] = True;
-          vertex_ids = [int(e.source()), int(e.target())];
-          edge_list.append(vertex_ids);
-          for k in edge_to_edge_keys:
-            edge_lists[k].append(edge_to_edge[k]([edge_properties[k][e]]));
-          for k in vertex_to_edge_keys:
-            vv = vertex_properties[k];
-            vv = [vv[e.source()], vv[e.target()]];
-            vertex_lists[k].append(vertex_to_edge[k](vv));
-          
-          if calculate_edge_to_vertex_map:
-            reduced_edge_to_vertex_map.append(vertex_ids);
-          
-          if calculate_edge_to_edge_map:
-            reduced_edge_to_edge_map.append([e]);
-          
-    if verbose and (i+1) % 250000 == 0:
-      timer.print_elapsed_time('Graph reduction: Scanned %d/%d branching nodes, found %d branches' % (i+1, n_branch_points, len(edge_list)));
+  #find branches 
+  connectivity = g.edge_connectivity();
+  endpoints, vertices, vertex_indices, edges, edge_indices = graph_branches(connectivity, n_vertices=g.n_vertices);
   
-  if verbose:
-    timer.print_elapsed_time('Graph reduction: Scanned %d/%d branching nodes, found %d branches' % (i +1, n_branch_points, len(edge_list)));
-  
-  #reduce non-direct edges
-  checked = np.zeros(g.n_vertices, dtype=bool);
-  for i,v in enumerate(non_branch_ids):    
-    if not checked[v]:
-      # extract branch 
-      checked[v] = True;
-      vertex = g.vertex(v);
-      vertices, edges, endpoints, isolated_loop = _graph_branch(vertex);
-      #print([int(vv) for vv in vertices], [[int(ee.source()), int(ee.target())] for ee in edges], endpoints, isolated_loop)
-      if not isolated_loop:
-        vertices_ids = [int(vv) for vv in vertices];
-        checked[vertices_ids[1:-1]] = True;
-        edge_list.append([int(ep) for ep in endpoints]);
-        
-        #mappings
-        for k in edge_to_edge.keys():
-          ep = edge_properties[k];
-          edge_lists[k].append(edge_to_edge[k]([ep[e] for e in edges]))
-        
-        for k in vertex_to_edge.keys():
-          vp = vertex_properties[k];          
-          vertex_lists[k].append(vertex_to_edge[k]([vp[vv] for vv in vertices]));
-        
-        #if edge_geometry is not None:
-        #  branch_start.append(index_pos);
-        #  index_pos += len(vertices_ids);
-        #  branch_end.append(index_pos);
-          
-        if calculate_edge_to_vertex_map:
-          reduced_edge_to_vertex_map.append(vertices_ids);
-
-        if calculate_edge_to_edge_map:
-          reduced_edge_to_edge_map.append(edges);
-      
-    if verbose and (i+1) % 250000 == 0:
-      timer.print_elapsed_time('Graph reduction: Scanned %d/%d non-branching nodes found %d branches' % (i+1, n_non_branch_points, len(edge_list)));     
+  #edges as indices into the edge property arrays 
+  edges = g.edge_indices()[edges];
+  
+  #non branching points, i.e. vertices with degree 2 
+  degrees = np.bincount(connectivity.ravel(), minlength=g.n_vertices);
+  vertex_filter = degrees != 2;
+  del connectivity, degrees;
   
   if verbose:
-    timer.print_elapsed_time('Graph reduction: Scanned %d/%d non-branching nodes found %d branches' % (i+1, n_non_branch_points, len(edge_list)));
+    timer.print_elapsed_time('Graph reduction: Found %d branches through %d non-branching nodes' % (len(endpoints), np.logical_not(vertex_filter).sum()));
+    timer.reset();
   
   #reduce graph
   
   #redefine branch edges
   gr = g.sub_graph(edge_filter=np.zeros(g.n_edges, dtype=bool));
-  gr.add_edge(edge_list);
+  gr.add_edge(endpoints);
   
   #determine edge ordering
   edge_order = gr.edge_indices();
   
   # remove non-branching points 
-  if calculate_vertex_to_vertex_map:
-    gr.add_vertex_property('_vertex_id_', graph.vertex_indices());
-  gr = gr.sub_graph(vertex_filter=np.logical_not(checked));
-  if calculate_vertex_to_vertex_map:
-    reduced_vertex_to_vertex_map = gr.vertex_property('_vertex_id_');
-    gr.remove_vertex_property('_vertex_id_');
-
-  # maps
-  if calculate_edge_to_vertex_map:
-    reduced_edge_to_vertex_map = np.array(reduced_edge_to_vertex_map, dtype=object)[edge_order];    
-  if calculate_edge_to_edge_map:
-    reduced_edge_to_edge_map = np.array(reduced_edge_to_edge_map, dtype=object)[edge_order]; 
+  gr = gr.sub_graph(vertex_filter=vertex_filter);
   
   # add edge properties
-  for k in edge_to_edge_keys:
-    gr.define_edge_property(k, np.array(edge_lists[k])[edge_order]);
-  for k in vertex_to_edge_keys:
-    gr.define_edge_property(k, np.array(vertex_lists[k])[edge_order]);
+  for k,m in edge_to_edge.items():
+    values = _reduce_branches(g.edge_property(k)[edges], edge_indices, m);
+    gr.define_edge_property(k, values[edge_order]);
+  for k,m in vertex_to_edge.items():
+    values = _reduce_branches(g.vertex_property(k)[vertices], vertex_indices, m);
+    gr.define_edge_property(k, values[edge_order]);
   
+  if verbose:
+    timer.print_elapsed_time('Graph reduction: Mapped %d edge and %d vertex properties' % (len(edge_to_edge), len(vertex_to_edge)));
+    timer.reset();
   
-  if edge_geometry is not None:
-    branch_indices = np.hstack(reduced_edge_to_vertex_map);
-    indices = [0] + [len(m) for m in reduced_edge_to_vertex_map];
-    indices = np.cumsum(indices);
-    indices = np.array([indices[:-1], indices[1:]]).T;
-    
-    #branch_start = np.array(branch_start);
-    #branch_end   = np.array(branch_end);    
-    #vertex properties
-    #indices = np.array([branch_start, branch_end]).T;
-    #indices = indices[edge_order];
-    indices_use = indices;
+  # order branches as edges in the reduced graph
+  vertex_indices = vertex_indices[edge_order];
+  edge_indices = edge_indices[edge_order];
+  vertices = vertices[_branch_positions(vertex_indices)];
+  edges = edges[_branch_positions(edge_indices)];
+  vertex_indices = _branch_indices(vertex_indices);
+  edge_indices = _branch_indices(edge_indices);
+  
+  if edge_geometry:
+    indices_use = vertex_indices;
     
     for p in edge_geometry_vertex_properties:
       if p in g.vertex_properties:
-        values = g.vertex_property(p);
-        values = values[branch_indices];
+        values = g.vertex_property(p)[vertices];
         gr.set_edge_geometry(name=p, values=values, indices=indices_use);
         indices_use = None;
     
+    #there is one edge less than vertices in each reduced edge, repeat the last edge
+    if len(edge_geometry_edge_properties) > 0:
+      edges_geometry = np.insert(edges, edge_indices[:,1], edges[edge_indices[:,1]-1]);
     for p in edge_geometry_edge_properties:
       if p in g.edge_properties:
-        values = g.edge_property_map(p);
-        #there is one edge less than vertices in each reduced edge !
-        values = [[values[e] for e in edge] + [values[edge[-1]]] for edge in reduced_edge_to_edge_map];
+        values = g.edge_property(p)[edges_geometry];
         gr.set_edge_geometry(name='edge_' + p, values=values, indices=indices_use);
         indices_use = None;
-  
-  if calculate_edge_to_edge_map:
-    reduced_edge_to_edge_map = [[g.edge_index(e) for e in edge] for edge in reduced_edge_to_edge_map]
+    
+    if verbose:
+      timer.print_elapsed_time('Graph reduction: Set edge geometry');
+      timer.reset();
   
   if verbose:
     timer_all.print_elapsed_time('Graph reduction: Graph reduced from %d to %d nodes and %d to %d edges' % (graph.n_vertices, gr.n_vertices, graph.n_edges, gr.n_edges));
   
   if return_maps:
+    reduced_vertex_to_vertex_map = np.where(vertex_filter)[0];
+    reduced_edge_to_vertex_map = _split_branches(vertices, vertex_indices);
+    reduced_edge_to_edge_map = [list(e) for e in _split_branches(edges, edge_indices)];
     return gr, (reduced_vertex_to_vertex_map, reduced_edge_to_vertex_map, reduced_edge_to_edge_map);
   else:
     return gr;
 
 
-def _graph_branch(v0):
-  """Helper to follow a branch in a graph consisting of a chain of vertices of degree 2."""
-
-  edges_v0 = [e for e in v0.out_edges()];
-  assert(len(edges_v0) == 2)
+def graph_branches(connectivity, n_vertices = None):
+  """Find the branches of a graph, i.e. the chains of vertices of degree 2 between branch or end points.
   
-  vertices_1, edges_1, endpoint_1 = _follow_branch(edges_v0[0], v0);
-  if endpoint_1 != v0:
-    vertices_2, edges_2, endpoint_2 = _follow_branch(edges_v0[1], v0);
-    
-    vertices_1.reverse();
-    vertices_1.append(v0);
-    vertices_1.extend(vertices_2); 
-
-    edges_1.reverse();
-    edges_1.extend(edges_2);
-    isolated_loop = False;
+  Arguments
+  ---------
+  connectivity : array
+    The (n_edges, 2) edge connectivity of an undirected graph.
+  n_vertices : int or None
+    The number of vertices of the graph. If None, infer from the connectivity.
+  
+  Returns
+  -------
+  endpoints : array
+    The (n_branches, 2) end points of the branches.
+  vertices : array
+    The vertices along all branches including their end points.
+  vertex_indices : array
+    The (n_branches, 2) start and end indices of each branch in vertices.
+  edges : array
+    The edges, as rows of the connectivity, along all branches.
+  edge_indices : array
+    The (n_branches, 2) start and end indices of each branch in edges.
+  
+  Note
+  ----
+  The edges are split into darts, i.e. oriented edges, and each dart entering 
+  a vertex of degree 2 is linked to the other dart leaving it. The resulting 
+  chains of darts starting at branch or end points are ranked via pointer 
+  jumping, using array operations in a number of passes logarithmic in the 
+  length of the longest branch.
+  Edges directly connecting branch points form branches of length one.
+  Isolated loops consisting of degree 2 vertices only are not returned.
+  """
+  connectivity = np.asarray(connectivity, dtype=int);
+  n_edges = len(connectivity);
+  if n_vertices is None:
+    n_vertices = connectivity.max() + 1 if n_edges > 0 else 0;
+  degrees = np.bincount(connectivity.ravel(), minlength=n_vertices);
+  
+  #darts 2*e and 2*e+1 for edges e = (s,t) oriented s->t and t->s
+  n_darts = 2 * n_edges;
+  tails = connectivity.ravel();
+  heads = connectivity[:,::-1].ravel();
+  
+  #darts leaving each vertex
+  darts = np.argsort(tails, kind='stable');
+  offsets = np.hstack([[0], np.cumsum(degrees)[:-1]]);
+  
+  #link the two darts at vertices of degree 2 
+  chain = np.where(degrees == 2)[0];
+  first = darts[offsets[chain]];
+  second = darts[offsets[chain]+1];
+  links = np.full(n_darts, -1, dtype=int);
+  links[first ^ 1] = second;
+  links[second ^ 1] = first;
+  del darts, offsets, chain, first, second;
+  
+  #chains of darts starting at branch and end points
+  linked = np.where(links >= 0)[0];
+  previous = np.full(n_darts, -1, dtype=int);
+  previous[links[linked]] = linked;
+  del links, linked;
+  
+  #rank darts along the chains via pointer jumping
+  heads_chain = np.where(previous >= 0, previous, np.arange(n_darts));
+  ranks = np.asarray(previous >= 0, dtype=int);
+  active = np.where(previous[heads_chain] >= 0)[0];
+  while len(active) > 0:
+    h = heads_chain[active];
+    ranks[active] += ranks[h];
+    heads_chain[active] = heads_chain[h];
+    still_active = active[previous[heads_chain[active]] >= 0];
+    if len(still_active) == len(active): # isolated loops
+      break;
+    active = still_active;
+  
+  #order darts along chains, darts in isolated loops are not reached
+  starts = np.where(previous < 0)[0];
+  reached = np.where(previous[heads_chain] < 0)[0];
+  del previous;
+  chain_ids = np.full(n_darts, -1, dtype=int);
+  chain_ids[starts] = np.arange(len(starts));
+  chain_ids = chain_ids[heads_chain[reached]];
+  chain_lengths = np.bincount(chain_ids, minlength=len(starts));
+  order = np.empty(len(reached), dtype=int);
+  order[np.cumsum(chain_lengths)[chain_ids] - chain_lengths[chain_ids] + ranks[reached]] = reached;
+  del heads_chain, ranks, reached, chain_ids;
+  
+  #split into branches, each branch is found once from each end point
+  begin = np.cumsum(chain_lengths) - chain_lengths;
+  end = begin + chain_lengths;
+  keep = order[begin] < (order[end-1] ^ 1);
+  lengths = (end - begin)[keep];
+  order = order[np.repeat(keep, end - begin)];
+  
+  edge_indices = _branch_indices(lengths);
+  n_branches = len(edge_indices);
+  vertex_indices = edge_indices + np.arange(n_branches)[:,None];
+  vertex_indices[:,1] += 1;
+  
+  edges = order >> 1;
+  vertices = np.insert(heads[order], edge_indices[:,0], tails[order[edge_indices[:,0]]]);
+  endpoints = np.array([tails[order[edge_indices[:,0]]], heads[order[edge_indices[:,1]-1]]], dtype=int).T;
+  
+  return endpoints, vertices, vertex_indices, edges, edge_indices;
+
+
+_branch_reductions = {np.sum : np.add, np.max : np.maximum, np.amax : np.maximum, 
+                      np.min : np.minimum, np.amin : np.minimum};
+
+def _reduce_branches(values, indices, function):
+  """Helper to apply a mapping to the values along each branch or clique."""
+  values = np.asarray(values);
+  if len(indices) == 0:
+    return np.zeros((0,) + values.shape[1:], dtype=values.dtype);
+  if function in _branch_reductions:
+    return _branch_reductions[function].reduceat(values, indices[:,0], axis=0);
+  elif function is np.mean or function is mean_vertex_coordinates:
+    counts = np.diff(indices, axis=1).reshape((-1,) + (1,) * (values.ndim - 1));
+    return np.add.reduceat(values, indices[:,0], axis=0) / counts;
   else:
-    endpoint_2 = v0;
-    isolated_loop = True;
-    
-  return (vertices_1, edges_1, [int(endpoint_1), int(endpoint_2)], isolated_loop);
+    return np.array([function(values[s:e]) for s,e in indices]);
 
 
-def _follow_branch(e, v0):
-  """Helper to follow branch from vertex v0 in direction of edge e."""
-  #argument v0 to prevent infinte loops for isolated closed loops
-  edges = [e];
-  
-  v = e.target();
-  vertices = [v];
-  
-  while v.out_degree() == 2 and v != v0:
-    for e_new in v.out_edges():
-      if e_new != e:
-        break;
-    e = e_new;
-    edges.append(e);
-    v = e.target();
-    vertices.append(v);
-  
-  return (vertices, edges, v);
+def _branch_indices(lengths):
+  """Helper to convert branch lengths or unordered branch indices into consecutive branch indices."""
+  lengths = np.asarray(lengths, dtype=int);
+  if lengths.ndim == 2:
+    lengths = lengths[:,1] - lengths[:,0];
+  ends = np.cumsum(lengths);
+  return np.array([ends - lengths, ends], dtype=int).reshape(2, -1).T;
+
+
+def _branch_positions(indices):
+  """Helper to get the positions of the elements of all branches in the order of the branches."""
+  lengths = indices[:,1] - indices[:,0];
+  ends = np.cumsum(lengths);
+  return np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(indices[:,0] - (ends - lengths), lengths);
+
 
+def _split_branches(values, indices):
+  """Helper to split the values along the branches into an object array."""
+  result = np.empty(len(indices), dtype=object);
+  for i,(s,e) in enumerate(indices):
+    result[i] = values[s:e];
+  return result;
 
 
 def expand_graph_length(graph,length = 'length', return_edge_mapping = False):
@@ -0,0 +1,257 @@
+#distutils: language = c++
+#cython: language_level=3, boundscheck=False, wraparound=False, nonecheck=False, initializedcheck=False, cdivision=True
+"""
+ShapeDetectionCode
+==================
+
+Cython code for the seeded and bounded watershed used in the shape detection.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel import prange, parallel
+
+from libc.stdlib cimport malloc, calloc, free
+from libcpp.queue cimport priority_queue
+from libcpp.vector cimport vector
+from libcpp.pair cimport pair
+
+ctypedef fused source_t:
+  np.int32_t
+  np.int64_t
+  np.uint8_t
+  np.uint16_t
+  np.uint32_t
+  np.uint64_t
+  np.float32_t
+  np.float64_t
+
+ctypedef fused label_t:
+  np.int32_t
+  np.int64_t
+
+ctypedef Py_ssize_t index_t
+
+# queue entries ((value, -age), local index), the highest value and then the oldest entry is processed first
+ctypedef pair[pair[double, index_t], index_t] entry_t
+
+
+###############################################################################
+### Flooding
+###############################################################################
+
+cpdef void flood(source_t[:] source, index_t[:] shape, index_t[:] strides, index_t axis,
+                 index_t[:,:] seeds, index_t[:] seed_ids, index_t[:,:] groups,
+                 double threshold, bint masked, double radius, label_t[:] label, int processes) nogil:
+  """Floods groups of seeds in parallel.
+
+  Arguments
+  ---------
+  source : array
+    The flattened source.
+  shape, strides : array
+    The shape and element strides of source and label.
+  axis : int
+    The axis along which the groups are separated.
+  seeds : array
+    The (n_seeds, ndim) integer seed coordinates.
+  seed_ids : array
+    The seeds of each group, own seeds first followed by competing seeds.
+  groups : array
+    The (n_groups, 5) start, end of own and end of all seeds in seed_ids
+    and the lower and upper bound of the group region along axis.
+  threshold : float
+    Voxels need to be above this value if masked is True.
+  masked : bool
+    If True, restrict flooding to voxels above threshold.
+  radius : float
+    Maximal distance of a flooded voxel to its seed.
+  label : array
+    The flattened label array, own seeds of each group are written to
+    unlabeled voxels with label seed + 1.
+  processes : int
+    The number of parallel processes.
+
+  Note
+  ----
+  Groups whose regions overlap in voxels labeled by their own seeds must not
+  be flooded in the same call.
+  """
+  cdef index_t g
+  cdef index_t n_groups = groups.shape[0];
+  cdef double radius2 = radius * radius;
+
+  with nogil, parallel(num_threads = processes):
+    for g in prange(n_groups, schedule='dynamic'):
+      _flood_group(source, shape, strides, axis, seeds, seed_ids,
+                   groups[g,0], groups[g,1], groups[g,2], groups[g,3], groups[g,4],
+                   threshold, masked, radius2, label);
+
+
+cdef void _flood_group(source_t[:] source, index_t[:] shape, index_t[:] strides, index_t axis,
+                       index_t[:,:] seeds, index_t[:] seed_ids,
+                       index_t start, index_t own_end, index_t end, index_t lower, index_t upper,
+                       double threshold, bint masked, double radius2, label_t[:] label) noexcept nogil:
+  """Seeded watershed of a single group in a private label buffer."""
+  cdef index_t ndim = shape.shape[0];
+  cdef index_t d, e, i, j, k, l, q, s, x, step, dist, n_local = 1, age = 0;
+
+  cdef index_t* local_shape   = <index_t*>malloc(ndim * sizeof(index_t));
+  cdef index_t* local_strides = <index_t*>malloc(ndim * sizeof(index_t));
+  cdef index_t* offset        = <index_t*>malloc(ndim * sizeof(index_t));
+  cdef index_t* c             = <index_t*>malloc(ndim * sizeof(index_t));
+
+  for d in range(ndim):
+    local_shape[d] = shape[d];
+    offset[d] = 0;
+  local_shape[axis] = upper - lower;
+  offset[axis] = lower;
+  for d in range(ndim-1, -1, -1):
+    local_strides[d] = n_local;
+    n_local = n_local * local_shape[d];
+
+  # local labels are positions in the group's seeds + 1
+  cdef index_t* local_label = <index_t*>calloc(n_local, sizeof(index_t));
+  cdef vector[index_t] flooded;
+  cdef priority_queue[entry_t] queue;
+
+  # initialize with seeds
+  for i in range(start, end):
+    s = seed_ids[i];
+    j = 0;
+    k = 0;
+    for d in range(ndim):
+      j = j + seeds[s,d] * strides[d];
+      k = k + (seeds[s,d] - offset[d]) * local_strides[d];
+    if local_label[k] != 0:
+      continue;
+    if masked and not (source[j] > threshold):
+      continue;
+    local_label[k] = i - start + 1;
+    flooded.push_back(k);
+    queue.push(entry_t(pair[double, index_t](<double>source[j], -age), k));
+    age = age + 1;
+
+  # flood
+  while not queue.empty():
+    k = queue.top().second;
+    queue.pop();
+    l = local_label[k];
+    s = seed_ids[start + l - 1];
+
+    q = k;
+    for d in range(ndim):
+      c[d] = q / local_strides[d];
+      q = q - c[d] * local_strides[d];
+
+    for d in range(ndim):
+      for e in range(2):
+        step = 2 * e - 1;
+        c[d] = c[d] + step;
+        if 0 <= c[d] and c[d] < local_shape[d]:
+          q = k + step * local_strides[d];
+          if local_label[q] == 0:
+            j = 0;
+            dist = 0;
+            for i in range(ndim):
+              x = c[i] + offset[i];
+              j = j + x * strides[i];
+              x = x - seeds[s,i];
+              dist = dist + x * x;
+            if dist <= radius2 and (not masked or source[j] > threshold):
+              local_label[q] = l;
+              flooded.push_back(q);
+              queue.push(entry_t(pair[double, index_t](<double>source[j], -age), q));
+              age = age + 1;
+        c[d] = c[d] - step;
+
+  # write own labels
+  for i in range(<index_t>flooded.size()):
+    k = flooded[i];
+    l = local_label[k];
+    if start + l - 1 < own_end:
+      q = k;
+      j = 0;
+      for d in range(ndim):
+        x = q / local_strides[d];
+        q = q - x * local_strides[d];
+        j = j + (x + offset[d]) * strides[d];
+      if label[j] == 0:
+        label[j] = <label_t>(seed_ids[start + l - 1] + 1);
+
+  free(local_label);
+  free(local_shape);
+  free(local_strides);
+  free(offset);
+  free(c);
+
+
+###############################################################################
+### Voxels
+###############################################################################
+
+cpdef void count_voxels(label_t[:] label, index_t[:] shape, index_t[:] strides,
+                        index_t[:,:] seeds, index_t[:,:] search, index_t[:] counts, int processes) nogil:
+  """Counts the voxels labeled by each seed within the search region around it."""
+  cdef index_t i, j, k, d, n, v, count
+  cdef index_t n_seeds  = seeds.shape[0];
+  cdef index_t n_search = search.shape[0];
+  cdef index_t n_dim    = strides.shape[0];
+
+  with nogil, parallel(num_threads = processes):
+    for n in prange(n_seeds, schedule='guided'):
+      count = 0;
+      for i in range(n_search):
+        j = 0;
+        v = 1;
+        for d in range(n_dim):
+          k = seeds[n,d] + search[i,d];
+          if not (0 <= k and k < shape[d]):
+            v = 0;
+            break;
+          else:
+            j = j + k * strides[d];
+        if v == 1 and label[j] == n + 1:
+          count = count + 1;
+      counts[n] = count;
+
+
+cpdef void collect_voxels(label_t[:] label, index_t[:] shape, index_t[:] strides, index_t[:] voxel_strides,
+                          index_t[:,:] seeds, index_t[:,:] search, index_t[:] starts, index_t[:] voxels, int processes) nogil:
+  """Collects the voxels labeled by each seed within the search region around it.
+
+  Note
+  ----
+  The voxels are written as linear indices with respect to voxel_strides
+  starting at the position given in starts for each seed.
+  """
+  cdef index_t i, j, k, d, n, v, p, w
+  cdef index_t n_seeds  = seeds.shape[0];
+  cdef index_t n_search = search.shape[0];
+  cdef index_t n_dim    = strides.shape[0];
+
+  with nogil, parallel(num_threads = processes):
+    for n in prange(n_seeds, schedule='guided'):
+      p = starts[n];
+      for i in range(n_search):
+        j = 0;
+        w = 0;
+        v = 1;
+        for d in range(n_dim):
+          k = seeds[n,d] + search[i,d];
+          if not (0 <= k and k < shape[d]):
+            v = 0;
+            break;
+          else:
+            j = j + k * strides[d];
+            w = w + k * voxel_strides[d];
+        if v == 1 and label[j] == n + 1:
+          voxels[p] = w;
+          p = p + 1;
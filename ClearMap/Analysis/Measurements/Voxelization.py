@@ -24,7 +24,7 @@ import ClearMap.ParallelProcessing.DataProcessing.DevolvePointList as dpl
 
 def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
              method = 'sphere', radius = (1,1,1), kernel = None, 
-             processes = None, verbose = False):
+             engine = 'sorted', processes = None, verbose = False):
   """Converts a list of points into an volumetric image array
   
   Arguments
@@ -45,6 +45,10 @@ def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
     Radius of the voxel region to integrate over.
   kernel : function
     Optional function of distance to set weights in the voxelization.
+  engine : 'sorted', 'partial' or 'direct'
+    The devolution engine, see 
+    :func:`ClearMap.ParallelProcessing.DataProcessing.DevolvePointList.devolve`.
+    'sorted' and 'partial' give identical results for any number of processes.
   processes : int or None
     Number of processes to use.
   verbose : bool
@@ -80,7 +84,8 @@ def voxelize(source, sink = None, shape = None, dtype = None, weights = None,
     raise ValueError("method not 'sphere', 'rectangle', or 'pixel', but %r!" % method)
   
   return dpl.devolve(points, sink=sink, shape=shape, dtype=dtype,
-                     weights=weights, indices=indices, kernel=kernel, processes=processes, verbose=verbose);
+                     weights=weights, indices=indices, kernel=kernel, engine=engine, 
+                     processes=processes, verbose=verbose);
 
 ###############################################################################
 ### Search indices
@@ -17,6 +17,8 @@ import numpy as np
 
 import scipy.ndimage.measurements as ndm
 import scipy.ndimage.filters as ndf
+import scipy.sparse as sparse
+import scipy.sparse.csgraph as csgraph
 
 import ClearMap.ImageProcessing.GreyReconstruction as gr
 
@@ -28,7 +30,7 @@ import ClearMap.Utils.HierarchicalDict as hdict
 # Basic Transforms
 ##############################################################################
    
-def h_max_transform(source, h_max):
+def h_max_transform(source, h_max, processes=None):
     """
     H-maximum transform of an array.
 
@@ -38,6 +40,8 @@ def h_max_transform(source, h_max):
         Input image.
     h_max : float or None
         H parameter of h-max transform, if None return source.
+    processes : int or None
+        Number of processes to use for the grey reconstruction.
 
     Returns
     -------
@@ -47,7 +51,7 @@ def h_max_transform(source, h_max):
     if h_max is None:
         return source
     else:
-        return gr.reconstruct(source - h_max, source)
+        return gr.reconstruct(source - h_max, source, processes=processes)
 
 
 def local_max(source, shape=5):
@@ -109,7 +113,7 @@ def extended_max(source, h_max=0):
 ##############################################################################
 
 
-def find_maxima(source, h_max=None, shape=5, threshold=None, verbose=None):
+def find_maxima(source, h_max=None, shape=5, threshold=None, verbose=None, processes=None):
     """
     Find local and extended maxima in an image.
 
@@ -126,6 +130,8 @@ def find_maxima(source, h_max=None, shape=5, threshold=None, verbose=None):
         If float, include only maxima larger than this threshold.
     verbose : bool
         Print progress info.
+    processes : int or None
+        Number of processes to use for the h-max transform.
 
     Returns
     -------
@@ -146,7 +152,7 @@ def find_maxima(source, h_max=None, shape=5, threshold=None, verbose=None):
         hdict.pprint(head='Find Maxima:', h_max=h_max, shape=shape, threshold=threshold)
 
     # extended maxima
-    maxima = h_max_transform(source, h_max=h_max)
+    maxima = h_max_transform(source, h_max=h_max, processes=processes)
 
     # local maxima
     maxima = local_max(maxima, shape=shape)
@@ -161,6 +167,43 @@ def find_maxima(source, h_max=None, shape=5, threshold=None, verbose=None):
     return maxima
 
 
+def find_maxima_centers(source, h_max=None, shape=5, threshold=None, weights=None, verbose=False, processes=None):
+    """
+    Find the centers of local and extended maxima in an image.
+
+    Arguments
+    ---------
+    source : array
+        The source data.
+    h_max : float or None
+        H parameter for the initial h-Max transform.
+        If None, do not perform a h-max transform.
+    shape : int or tuple
+        Shape for the structure element for the local maxima filter.
+    threshold : float or None
+        If float, include only maxima larger than this threshold.
+    weights : array or None
+        Intensities to weight the centers with. If None, use source.
+    verbose : bool
+        Print progress info.
+    processes : int or None
+        Number of processes to use for the h-max transform.
+
+    Returns
+    -------
+    centers : array
+        Coordinates of the n centers of maxima as (n,d)-array.
+
+    Note
+    ----
+    Combines :func:`find_maxima` and :func:`find_center_of_maxima`, the
+    extended maxima are grouped on the list of maxima voxels without
+    creating a labeled image.
+    """
+    maxima = find_maxima(source, h_max=h_max, shape=shape, threshold=threshold, verbose=verbose, processes=processes)
+    return find_center_of_maxima(source if weights is None else weights, maxima=maxima, verbose=verbose)
+
+
 def find_center_of_maxima(source, maxima=None, label=None, verbose=False):
     """
     Find center of detected maxima weighted by intensity
@@ -181,6 +224,12 @@ def find_center_of_maxima(source, maxima=None, label=None, verbose=False):
     -------
     coordinates : array
         Coordinates of the n centers of maxima as (n,d)-array.
+
+    Note
+    ----
+    If no label is given, the maxima are grouped into connected components 
+    on the list of maxima voxels via :func:`label_maxima` instead of 
+    labeling the full image.
     """
     if verbose:
         timer = tmr.Timer()
@@ -188,16 +237,69 @@ def find_center_of_maxima(source, maxima=None, label=None, verbose=False):
 
     # center of maxima
     if label is None:
-        label, n_label = ndm.label(maxima)
+        source = np.asarray(source)
+        coordinates = np.array(np.nonzero(maxima))
+        component, n_label = label_maxima(coordinates, shape=source.shape)
+        if n_label > 0:
+            values = np.asarray(source[tuple(coordinates)], dtype=float)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                centers = np.array([np.bincount(component, weights=values * c, minlength=n_label) for c in coordinates]).T
+                centers /= np.bincount(component, weights=values, minlength=n_label)[:, None]
+        else:
+            centers = np.zeros((0, source.ndim))
     else:
         n_label = label.max()
 
-    if n_label > 0:
-        centers = np.array(ndm.center_of_mass(source, label, index=np.arange(1, n_label)))
-    else:
-        centers = np.zeros((0, source.ndim))
+        if n_label > 0:
+            centers = np.array(ndm.center_of_mass(source, label, index=np.arange(1, n_label + 1)))
+        else:
+            centers = np.zeros((0, source.ndim))
 
     if verbose:
         timer.print_elapsed_time(f'Center of Maxima: {centers.shape[0]} maxima detected')
 
     return centers
+
+
+def label_maxima(coordinates, shape):
+    """
+    Label the connected components of a list of voxels.
+
+    Arguments
+    ---------
+    coordinates : array
+        The (d,n)-array of voxel coordinates, in C order as returned by np.nonzero.
+    shape : tuple
+        The shape of the image.
+
+    Returns
+    -------
+    label : array
+        The component of each voxel, numbered in order of their first voxel
+        as in :func:`scipy.ndimage.label`.
+    n_label : int
+        The number of components.
+
+    Note
+    ----
+    Voxels are connected to their direct neighbours along each axis.
+    """
+    n = coordinates.shape[1]
+    if n == 0:
+        return np.zeros(0, dtype=int), 0
+
+    indices = np.ravel_multi_index(tuple(coordinates), shape)
+    strides = np.cumprod(np.hstack([[1], shape[:0:-1]]))[::-1]
+    sources, targets = [], []
+    for axis, stride in enumerate(strides):
+        candidates = np.where(coordinates[axis] + 1 < shape[axis])[0]
+        neighbours = indices[candidates] + stride
+        positions = np.minimum(np.searchsorted(indices, neighbours), n - 1)
+        connected = indices[positions] == neighbours
+        sources.append(candidates[connected])
+        targets.append(positions[connected])
+    sources, targets = np.hstack(sources), np.hstack(targets)
+
+    graph = sparse.csr_matrix((np.ones(len(sources), dtype=bool), (sources, targets)), shape=(n, n))
+    n_label, label = csgraph.connected_components(graph, directed=False)
+    return label, n_label
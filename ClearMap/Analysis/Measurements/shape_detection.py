@@ -8,8 +8,12 @@ Module with routines for shape and size detection of objects such as cells.
 Note
 ----
 The shape detection is based on a seeded and masked watershed. The module is 
-based on the ndimage library. For faster implementation of intensity 
-and radial measurements see the modules listed below.
+based on the ndimage library. If a radius is given, the shapes are instead 
+grown from the seeds by a bounded watershed in a Cython kernel. The seeds are 
+grouped in slabs and each slab containing seeds is flooded in a label buffer 
+spanning the whole slab, so the cost scales with the volume of these slabs.
+For faster implementation of intensity and radial measurements see the 
+modules listed below.
 
 See also
 --------
@@ -32,6 +36,13 @@ import ClearMap.IO.IO as io
 
 import ClearMap.Analysis.Measurements.Voxelization as vox
 
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'ShapeDetectionCode')
+
+import ClearMap.Analysis.Measurements.ShapeDetectionCode as code
+
+import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
+
 import ClearMap.Utils.Timer as tmr
 import ClearMap.Utils.HierarchicalDict as hdict
 
@@ -41,7 +52,7 @@ import ClearMap.Utils.HierarchicalDict as hdict
 ##############################################################################
 
 
-def detect_shape(source, seeds, threshold=None, verbose=False, processes=None):
+def detect_shape(source, seeds, threshold=None, radius=None, verbose=False, processes=None):
     """
     Detect object shapes by generating a labeled image from seeds.
   
@@ -54,14 +65,21 @@ def detect_shape(source, seeds, threshold=None, verbose=False, processes=None):
     threshold : float or None
         Threshold to determine mask for watershed, pixel below this are
         treated as background. If None, the seeds are expanded indefinitely.
+    radius : float or None
+        If not None, the shapes are restricted to this distance from their
+        seed and detected via :func:`flood_shapes`.
     verbose :bool
         If True, print progress info.
+    processes : int or None
+        Number of processes to use.
   
     Returns
     -------
     shapes : array
         Labeled image, where each label indicates an object.
     """
+    if radius is not None:
+        return flood_shapes(source, seeds, threshold=threshold, radius=radius, verbose=verbose, processes=processes)
 
     if verbose:
         timer = tmr.Timer()
@@ -86,7 +104,178 @@ def detect_shape(source, seeds, threshold=None, verbose=False, processes=None):
     return shapes
 
 
-def find_size(label, max_label=None, verbose=False):
+def flood_shapes(source, seeds, threshold=None, radius=5, group_size=None, verbose=False, processes=None):
+    """
+    Detect object shapes by a watershed from seeds bounded by a radius.
+
+    Arguments
+    ---------
+    source : array, str or Source
+        Source image.
+    seeds : array, str or Source
+        Cell centers as point coordinates.
+    threshold : float or None
+        Threshold to determine mask for watershed, pixel below this are
+        treated as background. If None, no mask is used.
+    radius : float
+        Maximal distance of a voxel in a shape to its seed.
+    group_size : int or None
+        Width of the slabs along the longest axis in which seeds are grouped
+        for parallel processing. If None, use 8 times the radius.
+        Each slab allocates a label buffer over its full cross section
+        extended by 3 times the radius on both sides.
+    verbose :bool
+        If True, print progress info.
+    processes : int or None
+        Number of processes to use.
+
+    Returns
+    -------
+    shapes : array
+        Labeled image, where the seed with index i is labeled i+1.
+
+    Note
+    ----
+    Each seed is grown with a priority queue, brightest voxels first, into
+    voxels above threshold and within the radius. Seeds are grouped into slabs
+    that are flooded in parallel, each together with the seeds within twice
+    the radius of the slab, so that neighbouring shapes compete as in a joint
+    watershed. Slabs with even and odd index are written in turn and voxels
+    claimed by shapes of two slabs keep the label of the even slab.
+    Seeds outside the source are not labeled.
+    """
+    if verbose:
+        timer = tmr.Timer()
+        hdict.pprint(head='Shape detection', threshold=threshold, radius=radius)
+
+    processes, _ = ap.initialize_processing(processes=processes, verbose=False)
+
+    source = io.as_source(source).array
+    if not (source.flags.c_contiguous or source.flags.f_contiguous):
+        source = np.ascontiguousarray(source)
+    if source.dtype == bool:
+        source = source.view('uint8')
+    order = 'F' if source.flags.f_contiguous and not source.flags.c_contiguous else 'C'
+    shape = np.array(source.shape, dtype=int)
+    strides = np.array(source.strides, dtype=int) // source.itemsize
+
+    seeds = _seed_coordinates(seeds, source.ndim)
+
+    labels = np.zeros(source.shape, dtype=int, order=order)
+    if len(seeds) == 0:
+        return labels
+
+    # group seeds in slabs along the longest axis
+    r = int(np.ceil(radius))
+    axis = int(np.argmax(shape))
+    if group_size is None:
+        group_size = 8 * max(r, 1)
+    group_size = max(group_size, 2 * r + 1)
+
+    valid = np.where(np.all(np.logical_and(0 <= seeds, seeds < shape), axis=1))[0]
+    valid = valid[np.lexsort(seeds[valid].T[::-1])]
+    coordinate = seeds[valid, axis]
+
+    seed_ids = []
+    groups = []
+    position = 0
+    for slab in range(int(np.ceil(shape[axis] / group_size))):
+        lower, upper = slab * group_size, (slab + 1) * group_size
+        own = valid[np.searchsorted(coordinate, lower):np.searchsorted(coordinate, upper)]
+        if len(own) == 0:
+            continue
+        competing = np.hstack([valid[np.searchsorted(coordinate, lower - 2 * r):np.searchsorted(coordinate, lower)],
+                               valid[np.searchsorted(coordinate, upper):np.searchsorted(coordinate, upper + 2 * r)]])
+        seed_ids.extend([own, competing])
+        groups.append([position, position + len(own), position + len(own) + len(competing),
+                       max(lower - 3 * r, 0), min(upper + 3 * r, shape[axis]), slab % 2])
+        position += len(own) + len(competing)
+    if len(groups) == 0:
+        return labels
+    seed_ids = np.asarray(np.hstack(seed_ids), dtype=int)
+    groups = np.array(groups, dtype=int)
+
+    source_buffer = source.reshape(-1, order='A')
+    labels_buffer = labels.reshape(-1, order='A')
+    threshold_value = -np.inf if threshold is None else float(threshold)
+    for parity in (0, 1):
+        phase = np.ascontiguousarray(groups[groups[:, 5] == parity, :5])
+        code.flood(source_buffer, shape, strides, axis, seeds, seed_ids, phase,
+                   threshold_value, threshold is not None, float(radius), labels_buffer, processes)
+
+    if verbose:
+        timer.print_elapsed_time('Shape detection')
+
+    return labels
+
+
+def find_voxels(label, seeds, radius, verbose=False, processes=None):
+    """
+    Find the voxels of object shapes bounded by a radius around their seeds.
+
+    Arguments
+    ---------
+    label : array, str or Source
+        Labeled image in which the seed with index i is labeled i+1, e.g.
+        from :func:`flood_shapes`.
+    seeds : array, str or Source
+        Cell centers as point coordinates.
+    radius : float
+        Maximal distance of a voxel in a shape to its seed.
+    verbose : bool
+        Print progress info.
+    processes : int or None
+        Number of processes to use.
+
+    Returns
+    -------
+    voxels : tuple of arrays
+        The linear indices (in C order) of the voxels of all shapes grouped by
+        seed and the (n_seeds, 2) start and end indices of each shape in
+        this array.
+
+    Note
+    ----
+    Only the region within the radius around each seed is scanned, thus the
+    voxels can be used to measure sizes and intensities of the shapes
+    without passes over the full image, see :func:`find_size` and
+    :func:`find_intensity`.
+    """
+    if verbose:
+        timer = tmr.Timer()
+        hdict.pprint(head='Voxel detection:', radius=radius)
+
+    processes, _ = ap.initialize_processing(processes=processes, verbose=False)
+
+    label, label_buffer, shape, strides = ap.initialize_source(label, as_1d=True, return_shape=True, return_strides=True)
+    seeds = _seed_coordinates(seeds, len(shape))
+    voxel_strides = np.array(np.cumprod(np.hstack([[1], shape[:0:-1]]))[::-1], dtype=int)
+
+    r = int(np.ceil(radius))
+    search = np.array(np.indices((2 * r + 1,) * len(shape)).reshape(len(shape), -1).T - r, dtype=int)
+
+    counts = np.zeros(len(seeds), dtype=int)
+    code.count_voxels(label_buffer, shape, strides, seeds, search, counts, processes)
+    indices = np.cumsum(counts)
+    indices = np.array([indices - counts, indices], dtype=int).reshape(2, -1).T
+    voxels = np.zeros(indices[-1, 1] if len(indices) > 0 else 0, dtype=int)
+    code.collect_voxels(label_buffer, shape, strides, voxel_strides, seeds, search,
+                        np.ascontiguousarray(indices[:, 0]), voxels, processes)
+
+    if verbose:
+        timer.print_elapsed_time(head='Voxel detection')
+
+    return voxels, indices
+
+
+def _seed_coordinates(seeds, ndim):
+    """Helper to convert seeds to integer coordinates."""
+    seeds = np.asarray(io.as_source(seeds)[:])
+    seeds = np.round(seeds.reshape(-1, ndim))
+    return np.asarray(seeds, dtype=int, order='C')
+
+
+def find_size(label, max_label=None, voxels=None, verbose=False):
     """
     Find size given object shapes as a labled image
 
@@ -96,6 +285,9 @@ def find_size(label, max_label=None, verbose=False):
         Labeled image in which each object has its own label.
     max_label : int or None
         Maximal label to include, if None use all label.
+    voxels : tuple or None
+        The voxels of the objects as returned by :func:`find_voxels`. If
+        given, the sizes are taken from it instead of the labeled image.
     verbose : bool
         Print progress info.
 
@@ -109,13 +301,16 @@ def find_size(label, max_label=None, verbose=False):
         timer = tmr.Timer()
         hdict.pprint(head='Size detection:', max_label=max_label)
 
-    label = io.as_source(label)
+    if voxels is not None:
+        _, indices = voxels
+        sizes = np.diff(indices, axis=1)[:max_label, 0]
+    else:
+        label = io.as_source(label)
 
-    if max_label is None:
-        max_label = int(label.max())
+        if max_label is None:
+            max_label = int(label.max())
 
-    sizes = scipy.ndimage.measurements.sum(np.ones(label.shape, dtype=bool),
-                                           labels=label, index=np.arange(1, max_label + 1))
+        sizes = np.bincount(label.array.reshape(-1, order='A'), minlength=max_label + 1)[1:max_label + 1]
 
     if verbose:
         timer.print_elapsed_time(head='Size detection')
@@ -123,7 +318,7 @@ def find_size(label, max_label=None, verbose=False):
     return sizes
 
 
-def find_intensity(source, label, max_label=None, method='sum', verbose=False):
+def find_intensity(source, label, max_label=None, method='sum', voxels=None, verbose=False):
     """
     Find integrated intensity given object shapes as labeled image.
 
@@ -137,6 +332,9 @@ def find_intensity(source, label, max_label=None, method='sum', verbose=False):
       Maximal label to include. If None, use all.
     method : {'sum', 'mean', 'max', 'min'}
       Method to use to measure the intensities in each object's area.
+    voxels : tuple or None
+      The voxels of the objects as returned by :func:`find_voxels`. If
+      given, only these voxels are read from the source.
     verbose : bool
       If True, print progress information.
 
@@ -151,6 +349,13 @@ def find_intensity(source, label, max_label=None, method='sum', verbose=False):
         hdict.pprint(head='Intensity detection:', max_label=max_label, method=method)
 
     source = io.as_source(source).array
+
+    if voxels is not None:
+        intensities = _measure_voxels(source, *voxels, method=method)[:max_label]
+        if verbose:
+            timer.print_elapsed_time(head='Intensity detection')
+        return intensities
+
     label = io.as_source(label)
 
     if max_label is None:
@@ -172,4 +377,21 @@ def find_intensity(source, label, max_label=None, method='sum', verbose=False):
         timer.print_elapsed_time(head='Intensity detection')
 
     return intensities
-  
\ No newline at end of file
+  
+
+
+def _measure_voxels(source, voxels, indices, method='sum'):
+    """Helper to measure intensities of objects given their voxels."""
+    reductions = {'sum': np.add, 'mean': np.add, 'max': np.maximum, 'min': np.minimum}
+    if method not in reductions:
+        raise RuntimeError(f'Unknown method {method}, expected one of {reductions.keys()}')
+
+    values = source[np.unravel_index(voxels, source.shape)]
+    sizes = np.diff(indices, axis=1)[:, 0]
+    valid = sizes > 0
+    intensities = np.zeros(len(indices), dtype=float if method in ('sum', 'mean') else values.dtype)
+    if np.any(valid):
+        intensities[valid] = reductions[method].reduceat(values, indices[valid, 0])
+    if method == 'mean':
+        intensities[valid] /= sizes[valid]
+    return intensities
@@ -3,12 +3,30 @@
 Compile
 =======
 
-Script to compile all ClearMap code.
+Ahead-of-time compilation of the Cython kernels of ClearMap.
+
+The Cython kernels (the \\*Code.pyx modules) are compiled into extension
+modules next to their sources by the build_ext command of the setup script,
+with optimization (-O3) and, if available, OpenMP flags. Modules using the
+kernels import the compiled extensions directly and only fall back to
+compiling them on first import via pyximport if no up to date extension
+exists.
+
+Usage
+-----
+Compile all kernels in place in a source checkout, e.g. once on a new node:
+
+>>> python -m ClearMap.Compile
+
+or from python:
+
+>>> import ClearMap.Compile as cmp
+>>> cmp.compile_all(processes=8)
 
 Note
 ----
-Cython or C++ coded modules are compiled in a lazy fashion in ClearMap.
-To compile all modules this module can be used. 
+Installing ClearMap via the setup script (`python setup.py install`)
+compiles the kernels as well.
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
@@ -17,37 +35,180 @@ __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
+import os
+import sys
+import glob
+import warnings
+import subprocess
+import importlib.machinery
+
+import multiprocessing as mp
+
+
+###############################################################################
+### Kernels
+###############################################################################
+
+excluded_kernels = ['_Old', '_Todo', 'StatisticsPointListCode', 'flow']
+"""Parts of the paths of Cython kernels that are not compiled.
+
+Note
+----
+Needs to match the exclusions in the setup script.
+"""
+
+
+def clearmap_path():
+  """The directory of the ClearMap package."""
+  return os.path.dirname(os.path.abspath(__file__));
+
+
+def kernel_files():
+  """The Cython kernels of ClearMap.
+
+  Returns
+  -------
+  files : list of str
+    The pyx files of all compiled kernels.
+  """
+  files = glob.glob(os.path.join(clearmap_path(), '**', '*.pyx'), recursive=True);
+  return sorted(f for f in files if not any(e in f for e in excluded_kernels));
+
+
+def extension_file(pyx_file):
+  """The compiled extension module of a Cython kernel.
+
+  Arguments
+  ---------
+  pyx_file : str
+    The pyx file of the kernel.
+
+  Returns
+  -------
+  extension : str or None
+    The compiled extension module or None if the kernel is not compiled.
+  """
+  base = os.path.splitext(pyx_file)[0];
+  for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+    if os.path.isfile(base + suffix):
+      return base + suffix;
+  return None;
+
+
+def is_compiled(pyx_file):
+  """Checks if a Cython kernel has an up to date compiled extension module.
+
+  Arguments
+  ---------
+  pyx_file : str
+    The pyx file of the kernel.
+
+  Returns
+  -------
+  compiled : bool
+    True if the extension exists and is newer than the kernel and the
+    Cython headers in its directory.
+  """
+  extension = extension_file(pyx_file);
+  if extension is None:
+    return False;
+  directory = os.path.dirname(pyx_file);
+  sources = [pyx_file] + glob.glob(os.path.join(directory, '*.pxd')) + glob.glob(os.path.join(directory, '*.pxi'));
+  return os.path.getmtime(extension) >= max(os.path.getmtime(s) for s in sources);
+
+
+def install_pyximport(module_file, *kernels):
+  """Installs the pyximport hook for kernels that are not compiled ahead of time.
+
+  Arguments
+  ---------
+  module_file : str
+    The file of the module using the kernels, kernels are searched in its
+    directory.
+  *kernels : str
+    The names of the kernel modules, e.g. 'ArrayProcessingCode'.
+
+  Returns
+  -------
+  installed : bool
+    True if the pyximport hook was installed.
+
+  Note
+  ----
+  Kernels compiled via pyximport are built as c++ as in the setup script.
+  Extensions older than their kernel are still imported in favour of
+  pyximport and a warning to recompile them is issued.
+  """
+  directory = os.path.dirname(os.path.abspath(module_file));
+  pyx_files = [os.path.join(directory, k + '.pyx') for k in kernels];
+  if all(is_compiled(f) for f in pyx_files):
+    return False;
+
+  for f in pyx_files:
+    if extension_file(f) is not None and not is_compiled(f):
+      warnings.warn('The extension of %s is older than its source, recompile via python -m ClearMap.Compile!' % f);
+
+  import numpy as np
+  import pyximport
+
+  get_distutils_extension = pyximport.pyximport.get_distutils_extension;
+  if not getattr(get_distutils_extension, 'clearmap', False):
+    def _get_distutils_extension(modname, pyxfilename, language_level=None):
+      extension_mod, setup_args = get_distutils_extension(modname, pyxfilename, language_level);
+      extension_mod.language = 'c++';
+      return extension_mod, setup_args;
+    _get_distutils_extension.clearmap = True;
+    pyximport.pyximport.get_distutils_extension = _get_distutils_extension;
+
+  pyximport.install(setup_args={"include_dirs" : [np.get_include(), directory]}, reload_support=True);
+  return True;
+
+
 ###############################################################################
-### ClearMap - Cython
+### Compilation
 ###############################################################################
 
-#ImageProcessing
-print('ClearMap.ImageProcessing.Binary.Filling')
-import ClearMap.ImageProcessing.Binary.Filling as fil
-print('ClearMap.ImageProcessing.Clipping.Clipping')
-import ClearMap.ImageProcessing.Clipping.Clipping as clp
-print('ClearMap.ImageProcessing.Differentiation.Hessian')
-import ClearMap.ImageProcessing.Differentiation.Hessian as hes
-print('ClearMap.ImageProcessing.Filter.Rank')
-import ClearMap.ImageProcessing.Filter.Rank as rnk
-print('ClearMap.ImageProcessing.Thresholding.Thresholding')
-import ClearMap.ImageProcessing.Thresholding.Thresholding as thr
-print('ClearMap.ImageProcessing.Tracing.Trace')
-import ClearMap.ImageProcessing.Tracing.Trace as trc
-
-#ParallelProcessing
-print('ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing')
-import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
-print('ClearMap.ParallelProcessing.DataProcessing.ConvolvePointList')
-import ClearMap.ParallelProcessing.DataProcessing.ConvolvePointList as cpl
-print('ClearMap.ParallelProcessing.DataProcessing.DevolvePointList')
-import ClearMap.ParallelProcessing.DataProcessing.DevolvePointList as dpl
-print('ClearMap.ParallelProcessing.DataProcessing.MeasurePointList')
-import ClearMap.ParallelProcessing.DataProcessing.MeasurePointList as mpl
-print('ClearMap.ParallelProcessing.DataProcessing.StatisticsPointList')
-import ClearMap.ParallelProcessing.DataProcessing.statistics.StatisticsPointList as spl
-
-
-__all__ = ['fil', 'clp', 'hes', 'rnk', 'thr', 'trc',
-           'ap', 'cpl', 'dpl', 'mpl', 'spl']
+def compile_all(processes = None, openmp = None, verbose = True):
+  """Compiles all Cython kernels of ClearMap in place.
+
+  Arguments
+  ---------
+  processes : int or None
+    Number of parallel compiler processes. If None, use all cpus.
+  openmp : bool or None
+    If True or False, enable or disable OpenMP, if None detect it in the
+    setup script.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  kernels : list of str
+    The kernels that are not compiled after the build.
+  """
+  root = os.path.dirname(clearmap_path());
+  setup = os.path.join(root, 'setup.py');
+  if not os.path.isfile(setup):
+    raise RuntimeError('Setup script not found in %s, installed versions of ClearMap are compiled on installation!' % root);
+
+  if processes is None:
+    processes = mp.cpu_count();
+
+  command = [sys.executable, setup, 'build_ext'];
+  if openmp is not None:
+    command += ['use_openmp' if openmp else 'no_openmp'];
+  command += ['--inplace', '--parallel', '%d' % processes];
+
+  if verbose:
+    print('Compiling %d kernels: %s' % (len(kernel_files()), ' '.join(command)));
+  subprocess.check_call(command, cwd=root, stdout=None if verbose else subprocess.DEVNULL);
+
+  missing = [f for f in kernel_files() if not is_compiled(f)];
+  if verbose:
+    for f in missing:
+      print('Kernel %s not compiled!' % f);
+  return missing;
+
 
+if __name__ == '__main__':
+  compile_all();
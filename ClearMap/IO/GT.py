@@ -20,10 +20,12 @@ __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
-import ClearMap.Analysis.Graphs.GraphGt as ggt
-
 import ClearMap.IO.Source as src
 
+from ClearMap.Utils.Lazy import lazy_import
+
+ggt = lazy_import('ClearMap.Analysis.Graphs.GraphGt')  # graph_tool is only imported for graph sources
+
 ###############################################################################
 ### Source classe
 ###############################################################################
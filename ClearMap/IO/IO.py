@@ -37,6 +37,7 @@ import ClearMap.IO.MMP as mmp
 import ClearMap.IO.SMA as sma
 import ClearMap.IO.MHD as mhd
 import ClearMap.IO.GT as gt
+import ClearMap.IO.ZARR as zarr
 import ClearMap.IO.FileList as fl
 import ClearMap.IO.FileUtils as fu
 
@@ -59,11 +60,11 @@ from ClearMap.IO.FileUtils import (is_file, is_directory, file_extension,   #ana
 ###############################################################################
 from ClearMap.Utils.utilities import CancelableProcessPoolExecutor
 
-source_modules = [npy, tif, mmp, sma, fl, nrrd, csv, gt]
+source_modules = [npy, tif, mmp, sma, fl, nrrd, csv, gt, zarr]
 """The valid source modules."""
 
 file_extension_to_module = {"npy": mmp, "tif": tif, "tiff": tif, 'nrrd': nrrd,
-                            'nrdh': nrrd, 'csv': csv, 'gt': gt}
+                            'nrdh': nrrd, 'csv': csv, 'gt': gt, 'zarr': zarr}
 """Map between file extensions and modules that handle this file type."""        
 
 ###############################################################################
@@ -111,7 +112,9 @@ def location_to_module(location):
   module : module
     The module that handles the IO of the source specified by its location.
   """
-  if fl.is_file_list(location):
+  if zarr.is_zarr(location):
+    return zarr;
+  elif fl.is_file_list(location):
     return fl;
   else:
     return filename_to_module(location);
@@ -691,7 +694,7 @@ def min_value(source):
 
 
 
-def convert(source, sink, processes = None, verbose = False, **kwargs):
+def convert(source, sink, processes = None, verbose = False, pyramid = None, **kwargs):
   """Transforms a source into another format.
   
   Arguments
@@ -700,20 +703,38 @@ def convert(source, sink, processes = None, verbose = False, **kwargs):
     The source or list of sources.
   sink : source specification
     The sink or list of sinks.
+  pyramid : bool, int or None
+    If True, build a multiresolution pyramid next to the sink, if an int, 
+    build a pyramid with this number of levels, see :mod:`~ClearMap.IO.Pyramid`.
   
   Returns
   -------
   sink : sink speicication
     The sink or list of sinkfs.
+  
+  Note
+  ----
+  Chunked array sinks, see :mod:`~ClearMap.IO.ZARR`, are written in chunk 
+  aligned blocks.
   """      
   source = as_source(source);
   if verbose:
     print('converting %s -> %s' % (source, sink)) 
-  mod = source_to_module(source);
-  if hasattr(mod, 'convert'):
-    return mod.convert(source, sink, processes=processes, verbose=verbose, **kwargs);
+  if zarr.is_zarr(sink):
+    sink = zarr.convert(source, sink, processes=processes, verbose=verbose, **kwargs);
   else:
-    return write(sink, source);
+    mod = source_to_module(source);
+    if hasattr(mod, 'convert'):
+      sink = mod.convert(source, sink, processes=processes, verbose=verbose, **kwargs);
+    else:
+      sink = write(sink, source);
+  
+  if pyramid:
+    import ClearMap.IO.Pyramid as pyr  # Pyramid depends on this module
+    levels = None if pyramid is True else pyramid;
+    pyr.build(sink, levels=levels, processes=processes, verbose=verbose);
+  
+  return sink;
 
 
 
@@ -299,6 +299,135 @@ def create(location = None, shape = None, dtype = None, order = None, mode = Non
     return memmap;
 
 
+###############################################################################
+### Appendable memmaps
+###############################################################################
+
+class Appendable(object):
+  """Growable npy file to which arrays are appended along the first axis.
+  
+  Note
+  ----
+  The npy header is reserved with enough space for any length and rewritten
+  with the final shape on :meth:`close`, so the file is a standard npy file
+  that can be opened as a memmap afterwards.
+  """
+  
+  def __init__(self, location, dtype, shape = ()):
+    """Appendable memmap constructor.
+    
+    Arguments
+    ---------
+    location : str
+      The filename of the npy file.
+    dtype : dtype
+      The data type of the array, e.g. a structured data type for tables.
+    shape : tuple
+      The shape of a single element along the first axis.
+    """
+    self._file = None;
+    self._location = fu.abspath(location);
+    self._dtype = np.dtype(dtype);
+    self._shape = tuple(shape);
+    self._length = 0;
+    
+    self._header_size = len(_appendable_header(self._dtype, (np.iinfo(np.int64).max,) + self._shape));
+    self._file = open(self._location, 'wb');
+    self._write_header();
+  
+  @property
+  def location(self):
+    return self._location;
+  
+  @property
+  def shape(self):
+    return (self._length,) + self._shape;
+  
+  @property
+  def dtype(self):
+    return self._dtype;
+  
+  def append(self, data):
+    """Append data along the first axis.
+    
+    Arguments
+    ---------
+    data : array
+      The data to append with shape (n,) + shape.
+    """
+    data = np.ascontiguousarray(data, dtype=self._dtype).reshape((-1,) + self._shape);
+    self._file.write(data.tobytes());
+    self._length += data.shape[0];
+  
+  def close(self):
+    """Finalize the npy header and close the file."""
+    if self._file is not None:
+      self._write_header();
+      self._file.close();
+      self._file = None;
+  
+  def as_source(self):
+    """Close the file and return it as a memmap Source.
+    
+    Note
+    ----
+    Zero sized arrays cannot be memory mapped on all platforms, if no data was
+    appended the empty array is returned as a numpy Source.
+    """
+    self.close();
+    if self._length == 0:
+      return npy.Source(np.zeros(self.shape, dtype=self._dtype));
+    return Source(location=self._location, mode='r+');
+  
+  def _write_header(self):
+    header = _appendable_header(self._dtype, self.shape, self._header_size);
+    position = self._file.tell();
+    self._file.seek(0);
+    self._file.write(header);
+    self._file.seek(max(position, len(header)));
+    self._file.flush();
+  
+  def __enter__(self):
+    return self;
+  
+  def __exit__(self, *args):
+    self.close();
+  
+  def __del__(self):
+    self.close();
+
+
+def create_appendable(location, dtype, shape = ()):
+  """Create a growable npy file to append data to.
+  
+  Arguments
+  ---------
+  location : str
+    The filename of the npy file.
+  dtype : dtype
+    The data type of the array.
+  shape : tuple
+    The shape of a single element along the first axis.
+    
+  Returns
+  -------
+  appendable : Appendable
+    The appendable npy file.
+  """
+  return Appendable(location=location, dtype=dtype, shape=shape);
+
+
+def _appendable_header(dtype, shape, size = None):
+  """Npy header (version 1.0) padded to the given size."""
+  header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape});
+  prefix = np.lib.format.magic(1, 0);
+  if size is None:
+    size = len(prefix) + 2 + len(header) + 1;
+    size = 64 * ((size + 63) // 64);
+  header = header + ' ' * (size - len(prefix) - 2 - len(header) - 1) + '\n';
+  return prefix + np.uint16(len(header)).tobytes() + header.encode('latin1');
+
+
 ###############################################################################
 ### Helpers
 ###############################################################################
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Pyramid
+=======
+
+Multiresolution pyramids of large arrays.
+
+A pyramid consists of the source itself as level 0 and successive 2x
+downsampled versions of it. The levels are stored next to the source in a
+directory with the suffix '_pyramid', e.g. the levels of 'stitched.npy' are
+'stitched_pyramid/level_1.npy', 'stitched_pyramid/level_2.npy', ...
+
+Viewers can display the level matching the on-screen zoom and thus only read
+a fraction of the data when showing a zoomed out view of a whole brain, see
+:mod:`~ClearMap.Visualization.Qt.DataViewer`.
+
+Example
+-------
+>>> import ClearMap.IO.Pyramid as pyr
+>>> levels = pyr.build('stitched.npy', verbose=True)
+>>> print([l.shape for l in pyr.pyramid('stitched.npy')])
+
+Note
+----
+Pyramids can also be built as part of :func:`ClearMap.IO.IO.convert` and of
+:func:`ClearMap.Alignment.Stitching.StitchingWobbly.stitch_layout` via their
+pyramid argument.
+
+A level is only used if it is newer than the level it was computed from, so
+modified sources need a rebuild of their pyramid.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+
+import numpy as np
+import multiprocessing as mp
+import concurrent.futures
+
+import ClearMap.IO.IO as io
+import ClearMap.IO.FileUtils as fu
+
+import ClearMap.Utils.Timer as tmr
+
+import ClearMap.ParallelProcessing.ParallelTraceback as ptb
+
+
+###############################################################################
+### Default parameter
+###############################################################################
+
+default_method = 'mean'
+"""Default method to combine 2x2x2 blocks of voxels, 'mean' or 'max'."""
+
+default_min_size = 256
+"""Levels are added until the largest downsampled extent is at most this size."""
+
+default_block_size = 2**26
+"""Size in bytes of the slabs of the finer level read at once."""
+
+pyramid_suffix = '_pyramid'
+"""Suffix of the directory holding the pyramid levels of a source."""
+
+
+###############################################################################
+### Pyramid
+###############################################################################
+
+def pyramid_directory(location):
+  """The directory of the pyramid levels of a source.
+
+  Arguments
+  ---------
+  location : str
+    The location of the source.
+
+  Returns
+  -------
+  directory : str
+    The directory of the pyramid levels.
+  """
+  location = location.rstrip('/' + os.path.sep);
+  return os.path.splitext(location)[0] + pyramid_suffix;
+
+
+def level_location(location, level, extension = None):
+  """The location of a pyramid level of a source.
+
+  Arguments
+  ---------
+  location : str
+    The location of the source.
+  level : int
+    The level, level 0 is the source itself.
+  extension : str or None
+    The file extension of the level. If None, the extension of the source is
+    used for npy and zarr sources and npy otherwise.
+
+  Returns
+  -------
+  location : str
+    The location of the level.
+  """
+  if level == 0:
+    return location;
+  if extension is None:
+    extension = fu.file_extension(location.rstrip('/' + os.path.sep));
+    if extension not in ('npy', 'zarr'):
+      extension = 'npy';
+  return os.path.join(pyramid_directory(location), 'level_%d.%s' % (level, extension));
+
+
+def level_shape(shape, axes = None):
+  """The shape of the next coarser level.
+
+  Arguments
+  ---------
+  shape : tuple
+    The shape of the finer level.
+  axes : list of int or None
+    The axes to downsample. If None, the first three axes are downsampled.
+
+  Returns
+  -------
+  shape : tuple
+    The shape of the coarser level.
+  """
+  axes = _axes(shape, axes);
+  return tuple((s + 1) // 2 if d in axes else s for d,s in enumerate(shape));
+
+
+def pyramid(source, axes = None):
+  """The existing levels of the pyramid of a source.
+
+  Arguments
+  ---------
+  source : str or Source
+    The source.
+  axes : list of int or None
+    The downsampled axes. If None, the first three axes.
+
+  Returns
+  -------
+  levels : list of Source
+    The levels of the pyramid, starting with the source itself.
+
+  Note
+  ----
+  Levels are only returned if they have the expected shape and are newer than
+  the previous level.
+  """
+  source = io.as_source(source);
+  levels = [source];
+
+  location = _location(source);
+  if location is None:
+    return levels;
+
+  mtime = _mtime(location);
+  shape = source.shape;
+  level = 1;
+  while mtime is not None:
+    shape = level_shape(shape, axes=axes);
+    for extension in ('npy', 'zarr'):
+      location = level_location(source.location, level, extension=extension);
+      level_mtime = _mtime(location);
+      if level_mtime is not None and level_mtime >= mtime:
+        break;
+    else:
+      break;
+
+    level_source = io.as_source(location);
+    if level_source.shape != shape:
+      break;
+    levels.append(level_source);
+
+    mtime = level_mtime;
+    level += 1;
+
+  return levels;
+
+
+def build(source, levels = None, axes = None, method = None, extension = None, processes = None, verbose = False):
+  """Builds the multiresolution pyramid of a source.
+
+  Arguments
+  ---------
+  source : str or Source
+    The source.
+  levels : int or None
+    The number of levels to add. If None, levels are added until the largest
+    extent is at most :const:`default_min_size`.
+  axes : list of int or None
+    The axes to downsample. If None, the first three axes are downsampled.
+  method : 'mean', 'max' or None
+    The method to combine blocks of voxels. If None, :const:`default_method`.
+  extension : str or None
+    The file extension of the levels, see :func:`level_location`.
+  processes : int, 'serial' or None
+    Number of threads to downsample slabs in parallel.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  levels : list of Source
+    The levels of the pyramid, starting with the source itself.
+
+  Note
+  ----
+  Each level is computed from the previous one in slabs along the last
+  downsampled axis of about :const:`default_block_size` bytes, so the source
+  is never loaded into memory as a whole.
+  """
+  source = io.as_source(source);
+  if _location(source) is None:
+    raise ValueError('Pyramids can only be built for sources stored on disk, got %r!' % source);
+  axes = _axes(source.shape, axes);
+
+  if verbose:
+    timer = tmr.Timer();
+    print('Pyramid: building pyramid of %s.' % source);
+
+  fu.create_directory(pyramid_directory(source.location), split=False);
+
+  result = [source];
+  level = 1;
+  while (levels is None and max(source.shape[d] for d in axes) > default_min_size) or \
+        (levels is not None and level <= levels):
+    location = level_location(result[0].location, level, extension=extension);
+    source = _downsample_level(source, location, axes=axes, method=method, processes=processes);
+    result.append(source);
+    if verbose:
+      print('Pyramid: level %d with shape %r.' % (level, source.shape));
+    level += 1;
+
+  if verbose:
+    timer.print_elapsed_time('Pyramid: building %d levels' % (len(result) - 1));
+
+  return result;
+
+
+def downsample(data, axes = None, method = None):
+  """Downsamples an array by a factor of 2 along the given axes.
+
+  Arguments
+  ---------
+  data : array
+    The data to downsample.
+  axes : list of int or None
+    The axes to downsample. If None, the first three axes are downsampled.
+  method : 'mean', 'max' or None
+    The method to combine blocks of voxels. If None, :const:`default_method`.
+
+  Returns
+  -------
+  downsampled : array
+    The downsampled data.
+
+  Note
+  ----
+  Odd extents are padded with the last value. Boolean data is always
+  combined with the maximum.
+  """
+  if method is None:
+    method = default_method;
+  if method not in ('mean', 'max'):
+    raise ValueError("Method %r not valid, expecting 'mean' or 'max'!" % method);
+
+  data = np.asarray(data);
+  axes = _axes(data.shape, axes);
+
+  padding = [(0, s % 2 if d in axes else 0) for d,s in enumerate(data.shape)];
+  if any(p[1] for p in padding):
+    data = np.pad(data, padding, mode='edge');
+
+  shape = (); reduce = ();
+  for d,s in enumerate(data.shape):
+    if d in axes:
+      shape += (s // 2, 2);
+      reduce += (len(shape) - 1,);
+    else:
+      shape += (s,);
+  blocks = data.reshape(shape);
+
+  if method == 'max' or data.dtype == bool:
+    return blocks.max(axis=reduce);
+
+  downsampled = blocks.mean(axis=reduce);
+  if np.issubdtype(data.dtype, np.integer):
+    downsampled = np.round(downsampled);
+  return downsampled.astype(data.dtype);
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _axes(shape, axes):
+  """The downsampled axes of an array."""
+  if axes is None:
+    axes = range(min(3, len(shape)));
+  return tuple(d for d in axes if shape[d] > 1);
+
+
+def _location(source):
+  """The location of a source or None if it is not stored on disk."""
+  try:
+    location = source.location;
+  except Exception:
+    location = None;
+  if not isinstance(location, str) or _mtime(location) is None:
+    return None;
+  return location;
+
+
+def _mtime(location):
+  """Modification time of a file or directory or None if it does not exist."""
+  try:
+    return os.stat(location).st_mtime_ns;
+  except (OSError, TypeError):
+    return None;
+
+
+def _downsample_level(source, location, axes, method, processes):
+  """Computes the next coarser level of a source in slabs."""
+  shape = level_shape(source.shape, axes=axes);
+  axis = axes[-1];
+  order = getattr(source, 'order', None);
+
+  if io.zarr.is_zarr(location):
+    sink = io.zarr.create(location, shape=shape, dtype=source.dtype, order=order);
+    step = sink.chunks[axis];
+  else:
+    sink = io.mmp.create(location, shape=shape, dtype=source.dtype, order=order);
+    step = 1;
+
+  plane = source.dtype.itemsize * int(np.prod(source.shape)) // source.shape[axis];
+  thickness = max(1, default_block_size // (2 * plane));
+  thickness = max(step, thickness // step * step);
+  slabs = [(l, min(l + thickness, shape[axis])) for l in range(0, shape[axis], thickness)];
+
+  @ptb.parallel_traceback
+  def func(slab):
+    lower, upper = slab;
+    slicing = (slice(None),) * axis + (slice(2 * lower, min(2 * upper, source.shape[axis])),);
+    data = downsample(source[slicing], axes=axes, method=method);
+    sink[(slice(None),) * axis + (slice(lower, upper),)] = data;
+
+  if processes is None:
+    processes = mp.cpu_count();
+  if processes == 'serial' or processes <= 1 or len(slabs) <= 1:
+    for slab in slabs:
+      func(slab);
+  else:
+    with concurrent.futures.ThreadPoolExecutor(min(processes, len(slabs))) as executor:
+      list(executor.map(func, slabs));
+
+  if hasattr(sink, 'flush'):
+    sink.flush();
+
+  return io.as_source(location);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.IO.IO as io
+  import ClearMap.IO.Pyramid as pyr
+
+  location = 'test.npy'
+  data = np.asarray(np.random.rand(100, 81, 30) * 1000, dtype='uint16', order='F');
+  io.write(location, data)
+
+  levels = pyr.build(location, levels=2, verbose=True)
+  print([l.shape for l in levels])
+  print(np.all(levels[1][:] == pyr.downsample(data)))
+  print([l.shape for l in pyr.pyramid(location)])
+
+  io.delete_file(location)
+  fu.delete_directory(pyr.pyramid_directory(location))
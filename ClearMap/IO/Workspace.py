@@ -88,6 +88,10 @@ file_type_synonyms.update(c="cells")
 default_file_type_to_name_both = {**default_file_type_to_name_cell_map, **default_file_type_to_name_tube_map}
     
 
+# File types stored as chunked and compressed arrays (see ClearMap.IO.ZARR) in chunked workspaces
+default_chunked_file_types = ('stitched', 'background')
+
+
 default_workspaces = OrderedDict(
     CellMap = default_file_type_to_name_cell_map,
     TubeMap = default_file_type_to_name_tube_map,
@@ -96,7 +100,7 @@ default_workspaces = OrderedDict(
     
 
 def filename(ftype, file_type_to_name=None, directory=None, expression=None, values=None, prefix=None, postfix=None,
-             extension=None, debug=None):
+             extension=None, debug=None, chunked=None):
     """
     Returns the standard file name to use for a result file.
 
@@ -121,6 +125,10 @@ def filename(ftype, file_type_to_name=None, directory=None, expression=None, val
     debug : str, bool or None
         Optional string for debug files in which the string is added as postfix.
     If True, 'debug' is added.
+    chunked : bool, list of str or None
+        If True, the npy files of the types in `default_chunked_file_types` are replaced by
+        chunked and compressed zarr arrays. If a list, this is done for the file types in the list.
+        An explicit extension takes precedence.
 
     Returns
     -------
@@ -166,6 +174,11 @@ def filename(ftype, file_type_to_name=None, directory=None, expression=None, val
             debug = 'debug'
         f_name = f'{debug}_{f_name}'
 
+    if chunked and not extension:
+        chunked_types = default_chunked_file_types if chunked is True else chunked
+        if ftype in chunked_types and f_name.endswith('.npy'):
+            extension = '.zarr'
+
     if extension:
         extension = extension if extension.startswith('.') else f'.{extension}'
         f_name = f'{os.path.splitext(f_name)[0]}{extension}'
@@ -183,7 +196,8 @@ def filename(ftype, file_type_to_name=None, directory=None, expression=None, val
 class Workspace(object):
     """Class to organize files."""
   
-    def __init__(self, wtype=None, prefix=None, file_type_to_name=None, directory=None, debug=None, **kwargs):
+    def __init__(self, wtype=None, prefix=None, file_type_to_name=None, directory=None, debug=None, chunked=None,
+                 **kwargs):
         self._wtype = wtype
         self._prefix = prefix
         self.directory = directory
@@ -192,6 +206,7 @@ class Workspace(object):
             self._file_type_to_name.update(file_type_to_name)
         self._file_type_to_name.update(**kwargs)
         self._debug = debug
+        self._chunked = chunked
     
     @property
     def wtype(self):
@@ -243,6 +258,15 @@ class Workspace(object):
             value = None
         self._debug = value
   
+    @property
+    def chunked(self):
+        """The file types stored as chunked and compressed arrays, see :func:`filename`."""
+        return self._chunked
+
+    @chunked.setter
+    def chunked(self, value):
+        self._chunked = value
+
     def create_debug(self, ftype, slicing, debug=None, **kwargs):
         if debug is None:
             debug = self.debug
@@ -268,7 +292,7 @@ class Workspace(object):
             np.save(fid, [self.__dict__])
   
     def filename(self, ftype, file_type_to_name=None, directory=None, expression=None, values=None, prefix=None,
-                 extension=None, debug=None, **kwargs):
+                 extension=None, debug=None, chunked=None, **kwargs):
         if directory is None:
             directory = self.directory
         if prefix is None:
@@ -277,10 +301,12 @@ class Workspace(object):
             file_type_to_name = self.file_type_to_name
         if debug is None:
             debug = self.debug
+        if chunked is None:
+            chunked = self.chunked
         return filename(ftype, file_type_to_name=file_type_to_name,
                         directory=directory, expression=expression,
                         values=values, prefix=prefix, extension=extension,
-                        debug=debug, **kwargs)
+                        debug=debug, chunked=chunked, **kwargs)
 
     def exists(self, ftype, file_type_to_name=None, directory=None, expression=None, values=None, prefix=None,
                extension=None, debug=None, **kwargs):
@@ -428,3 +454,16 @@ class Workspace(object):
                     out += f'{f_type : >{padding}}: no file\n'
 
         print(out)  # TODO: add print option or return s
+
+
+class TmpDebug(object):
+    """Context manager switching a workspace to debug mode."""
+    def __init__(self, workspace):
+        self.workspace = workspace
+
+    def __enter__(self):
+        self.workspace.debug = True
+        return self.workspace
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.workspace.debug = False
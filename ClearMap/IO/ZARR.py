@@ -0,0 +1,1049 @@
+# -*- coding: utf-8 -*-
+"""
+ZARR
+====
+
+IO interface to chunked and compressed arrays.
+
+The arrays are stored in a directory using the zarr (version 2) layout: the
+array meta data is kept in a '.zarray' json file and each chunk is stored in a
+separate compressed file named by its chunk index, e.g. '0.2.5'.
+
+Chunks that contain only the fill value are not stored. Together with the
+compression this typically reduces the size of sparse light sheet data
+several fold. In contrast to flat memmaps, reading a sub-region of the array
+only reads and decompresses the chunks that overlap with it.
+
+Example
+-------
+>>> import ClearMap.IO.IO as io
+>>> io.convert('stitched.npy', 'stitched.zarr', verbose=True)
+>>> source = io.as_source('stitched.zarr')
+>>> print(source.chunks, source.compressor)
+
+Note
+----
+The format is read and written directly using numpy and the compression
+codecs, the zarr package is not required. Arrays written by this module can
+be opened with zarr and vice versa, as long as no filters are used and the
+codec is supported here.
+
+The compressors 'zlib', 'bz2' and 'lzma' are always available, 'blosc',
+'zstd' and 'lz4' require the blosc, zstandard and lz4 packages.
+
+Item access on a source, as used by the workers of
+:func:`ClearMap.ParallelProcessing.BlockProcessing.process`, (de)compresses 
+the chunks serially, :func:`read`, :func:`write` and :func:`convert` use 
+threads unless processes is 'serial'.
+
+Writing into the same chunk from several processes at the same time is not
+safe. Parallel writes thus need to be chunk aligned, as done in
+:func:`convert` and :func:`ClearMap.ParallelProcessing.BlockProcessing.process`.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+
+import os
+import bz2
+import json
+import lzma
+import uuid
+import zlib
+import shutil
+import itertools
+import numbers
+
+import numpy as np
+import multiprocessing as mp
+import concurrent.futures
+
+import ClearMap.IO.Source as src
+import ClearMap.IO.Slice as slc
+import ClearMap.IO.NPY as npy
+import ClearMap.IO.FileUtils as fu
+
+import ClearMap.Utils.Timer as tmr
+
+import ClearMap.ParallelProcessing.ParallelTraceback as ptb
+
+
+###############################################################################
+### Default parameter
+###############################################################################
+
+default_chunk_size = 2**22
+"""Default size of a chunk in bytes.
+
+Note
+----
+If no chunk shape is given, chunks are chosen as cubes of about this size
+with a power of two edge length, clipped to the shape of the array.
+"""
+
+default_block_size = 2**26
+"""Size in bytes of the chunk aligned blocks used to copy data into an array."""
+
+default_compressor = None
+"""Default compressor.
+
+Note
+----
+If None, the fastest available compressor is used, i.e. blosc with lz4 and
+byte shuffling if blosc is installed, zstd if zstandard is installed and
+zlib otherwise.
+"""
+
+default_fill_value = 0
+"""Default fill value of chunks that are not stored."""
+
+metadata_file = '.zarray'
+"""Name of the file with the array meta data."""
+
+
+###############################################################################
+### Source class
+###############################################################################
+
+class Source(src.Source):
+  """Chunked and compressed array source."""
+
+  def __init__(self, location = None, shape = None, dtype = None, order = None, chunks = None, compressor = None, fill_value = None, mode = None, array = None, name = None):
+    """Chunked array source constructor.
+
+    Arguments
+    ---------
+    location : str
+      The directory of the chunked array.
+    shape : tuple or None
+      The shape of the array, if it is created.
+    dtype : dtype or None
+      The data type of the array, if it is created.
+    order : 'C', 'F' or None
+      The order of the data in the chunks, if the array is created.
+    chunks : tuple, int or None
+      The shape of the chunks, if the array is created.
+    compressor : str, dict, False or None
+      The compressor, if the array is created. If False, the chunks are not
+      compressed. If None, :const:`default_compressor` is used.
+    fill_value : number or None
+      The value of chunks that are not stored.
+    mode : 'r', 'r+', 'w' or None
+      If 'w', a new array is created even if one exists at the location.
+    array : array, Source or None
+      Optional data to fill a newly created array with.
+    """
+    super(Source, self).__init__(name=name);
+    self._location = fu.abspath(location) if isinstance(location, str) else location;
+    self._metadata = _open(location=location, shape=shape, dtype=dtype, order=order, chunks=chunks,
+                           compressor=compressor, fill_value=fill_value, mode=mode, array=array);
+
+  @property
+  def name(self):
+    return "Zarr-Source";
+
+
+  @property
+  def metadata(self):
+    """The meta data of the array.
+
+    Returns
+    -------
+    metadata : dict
+      The zarr meta data of the array.
+    """
+    return self._metadata;
+
+  @property
+  def shape(self):
+    """The shape of the source.
+
+    Returns
+    -------
+    shape : tuple
+      The shape of the source.
+    """
+    return tuple(self._metadata['shape']);
+
+  @shape.setter
+  def shape(self, value):
+    if tuple(value) != self.shape:
+      raise ValueError('Cannot change the shape of a chunked array!');
+
+  @property
+  def dtype(self):
+    """The data type of the source.
+
+    Returns
+    -------
+    dtype : dtype
+      The data type of the source.
+    """
+    return np.dtype(self._metadata['dtype']);
+
+  @dtype.setter
+  def dtype(self, value):
+    if np.dtype(value) != self.dtype:
+      raise ValueError('Cannot change the data type of a chunked array!');
+
+  @property
+  def order(self):
+    """The order in which the data is stored in the chunks.
+
+    Returns
+    -------
+    order : str
+      Returns 'C' for C and 'F' for fortran contiguous chunks.
+    """
+    return self._metadata['order'];
+
+  @order.setter
+  def order(self, value):
+    if value is not None and value != self.order:
+      raise ValueError('Cannot change the order of a chunked array!');
+
+  @property
+  def location(self):
+    """The location where the data of the source is stored.
+
+    Returns
+    -------
+    location : str
+      The directory of the chunked array.
+    """
+    return self._location;
+
+  @location.setter
+  def location(self, value):
+    if value != self.location:
+      raise ValueError('Cannot change the location of a chunked array!');
+
+  @property
+  def chunks(self):
+    """The shape of the chunks.
+
+    Returns
+    -------
+    chunks : tuple
+      The shape of a single chunk.
+    """
+    return tuple(self._metadata['chunks']);
+
+  @property
+  def chunks_shape(self):
+    """The number of chunks along each axis.
+
+    Returns
+    -------
+    chunks_shape : tuple
+      The shape of the grid of chunks.
+    """
+    return tuple(-(-s // c) for s,c in zip(self.shape, self.chunks));
+
+  @property
+  def compressor(self):
+    """The compressor of the chunks.
+
+    Returns
+    -------
+    compressor : dict or None
+      The zarr specification of the compressor or None if uncompressed.
+    """
+    return self._metadata['compressor'];
+
+  @property
+  def fill_value(self):
+    """The value of chunks that are not stored.
+
+    Returns
+    -------
+    fill_value : number
+      The fill value.
+    """
+    return _fill_value(self._metadata['fill_value'], self.dtype);
+
+  @property
+  def array(self):
+    """The data of the source as an array.
+
+    Returns
+    -------
+    array : array
+      The full data of the source.
+    """
+    return self.__getitem__(slice(None));
+
+  @array.setter
+  def array(self, value):
+    self.__setitem__(slice(None), value);
+
+
+  def exists(self):
+    return is_zarr(self.location, exists=True);
+
+
+  def chunk_file(self, index):
+    """The file name of a chunk.
+
+    Arguments
+    ---------
+    index : tuple of int
+      The index of the chunk in the grid of chunks.
+
+    Returns
+    -------
+    filename : str
+      The file name of the chunk.
+    """
+    separator = self._metadata.get('dimension_separator', '.');
+    return os.path.join(self.location, *separator.join('%d' % i for i in index).split('/'));
+
+
+  def read_chunk(self, index):
+    """Read a chunk.
+
+    Arguments
+    ---------
+    index : tuple of int
+      The index of the chunk in the grid of chunks.
+
+    Returns
+    -------
+    chunk : array or None
+      The data of the chunk or None if the chunk is not stored.
+    """
+    try:
+      with open(self.chunk_file(index), 'rb') as f:
+        data = f.read();
+    except FileNotFoundError:
+      return None;
+    data = _decompress(data, self.compressor);
+    return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks, order=self.order);
+
+
+  def write_chunk(self, index, data):
+    """Write a chunk.
+
+    Arguments
+    ---------
+    index : tuple of int
+      The index of the chunk in the grid of chunks.
+    data : array
+      The data of the full chunk.
+
+    Note
+    ----
+    Chunks with only the fill value are removed instead of written.
+    """
+    filename = self.chunk_file(index);
+    if _is_fill(data, self.fill_value):
+      if os.path.exists(filename):
+        os.remove(filename);
+      return;
+
+    data = np.asarray(data, dtype=self.dtype).tobytes(order=self.order);
+    data = _compress(data, self.compressor, self.dtype.itemsize);
+
+    #write atomically to not expose partial chunks to readers
+    if self._metadata.get('dimension_separator') == '/':
+      fu.create_directory(filename, split=True);
+    temporary = '%s.%s.partial' % (filename, uuid.uuid4().hex);
+    with open(temporary, 'wb') as f:
+      f.write(data);
+    os.replace(temporary, filename);
+
+
+  def __getitem__(self, slicing, processes = None):
+    shape = self.shape;
+    slicing = slc.unpack_slicing(slicing, len(shape));
+    lower, upper, box_slicing = _bounding_box(slicing, shape);
+    return self._read_box(lower, upper, processes=processes)[box_slicing];
+
+
+  def __setitem__(self, slicing, data, processes = None):
+    shape = self.shape;
+    slicing = slc.unpack_slicing(slicing, len(shape));
+    lower, upper, box_slicing = _bounding_box(slicing, shape);
+    if isinstance(data, src.Source):
+      data = data.array;
+
+    box_shape = tuple(u - l for l,u in zip(lower, upper));
+    if _is_dense(box_slicing, box_shape):
+      box = np.empty(box_shape, dtype=self.dtype, order=self.order);
+    else:
+      box = self._read_box(lower, upper, processes=processes);
+    box[box_slicing] = data;
+
+    self._write_box(lower, box, processes=processes);
+
+
+  def _read_box(self, lower, upper, processes = None):
+    """Read a rectangular region of the array."""
+    shape = tuple(u - l for l,u in zip(lower, upper));
+    data = np.full(shape, self.fill_value, dtype=self.dtype, order=self.order);
+    if data.size == 0:
+      return data;
+
+    def func(index):
+      chunk = self.read_chunk(index);
+      if chunk is not None:
+        chunk_slicing, box_slicing = _chunk_overlap(index, self.chunks, lower, upper);
+        data[box_slicing] = chunk[chunk_slicing];
+
+    _map(func, _chunk_indices(lower, upper, self.chunks), processes=processes);
+
+    return data;
+
+
+  def _write_box(self, lower, data, processes = None):
+    """Write data into a rectangular region of the array."""
+    upper = tuple(l + s for l,s in zip(lower, data.shape));
+    if data.size == 0:
+      return;
+    shape = self.shape;
+    chunks = self.chunks;
+
+    def func(index):
+      chunk_slicing, box_slicing = _chunk_overlap(index, chunks, lower, upper);
+      covered = all(s.stop - s.start == min(c, n - i * c) for s,c,n,i in zip(chunk_slicing, chunks, shape, index));
+      if covered and all(s.start == 0 and s.stop == c for s,c in zip(chunk_slicing, chunks)):
+        chunk = data[box_slicing];
+      else:
+        chunk = None if covered else self.read_chunk(index);
+        if chunk is None:
+          chunk = np.full(chunks, self.fill_value, dtype=self.dtype, order=self.order);
+        else:
+          chunk = chunk.copy(order=self.order);
+        chunk[chunk_slicing] = data[box_slicing];
+      self.write_chunk(index, chunk);
+
+    _map(func, _chunk_indices(lower, upper, chunks), processes=processes);
+
+
+  def as_virtual(self):
+    return VirtualSource(source=self);
+
+  def as_real(self):
+    return self;
+
+  def as_buffer(self):
+    return self.array;
+
+
+  def __str__(self):
+    string = super(Source, self).__str__();
+    try:
+      compressor = self.compressor;
+      compressor = compressor['id'] if compressor is not None else 'raw';
+      string = string + '<%s:%s>' % ('x'.join('%d' % c for c in self.chunks), compressor);
+    except:
+      pass;
+    return string;
+
+
+class VirtualSource(src.VirtualSource):
+  """Virtual chunked array source."""
+
+  def __init__(self, source = None, shape = None, dtype = None, order = None, location = None, chunks = None, name = None):
+    super(VirtualSource, self).__init__(source=source, shape=shape, dtype=dtype, order=order, location=location, name=name);
+    if chunks is None and source is not None:
+      chunks = source.chunks;
+    self._chunks = tuple(chunks) if chunks is not None else None;
+
+  @property
+  def name(self):
+    return 'Virtual-Zarr-Source';
+
+  @property
+  def chunks(self):
+    return self._chunks;
+
+  def exists(self):
+    return is_zarr(self.location, exists=True);
+
+  def as_virtual(self):
+    return self;
+
+  def as_real(self):
+    return Source(location=self.location, name=self.name);
+
+  def as_buffer(self):
+    return self.as_real().as_buffer();
+
+  @property
+  def array(self):
+    return self.as_real().array;
+
+
+###############################################################################
+### IO Interface
+###############################################################################
+
+def is_zarr(source, exists = False):
+  """Checks if this source is a chunked array.
+
+  Arguments
+  ---------
+  source : str, Source
+    The source to check.
+  exists : bool
+    If True, check that the array exists.
+
+  Returns
+  -------
+  is_zarr : bool
+    True if the source is a chunked array.
+  """
+  if isinstance(source, (Source, VirtualSource)):
+    if exists:
+      source = source.location;
+    else:
+      return True;
+  if not isinstance(source, str):
+    return False;
+  if os.path.isfile(os.path.join(source, metadata_file)):
+    return True;
+  if exists:
+    return False;
+  return fu.file_extension(source.rstrip('/' + os.path.sep)) == 'zarr';
+
+
+def read(source, slicing = None, processes = None, **kwargs):
+  """Read data from a chunked array.
+
+  Arguments
+  ---------
+  source : str or Source
+    The chunked array source.
+  slicing : slice specification or None
+    An optional sub-slice to read.
+  processes : int, 'serial' or None
+    Number of threads to decompress the chunks in parallel. If None, use 
+    all cpus.
+
+  Returns
+  -------
+  data : array
+    The data of the source.
+  """
+  if not isinstance(source, Source):
+    source = Source(source);
+  if slicing is None:
+    slicing = slice(None);
+  return source.__getitem__(slicing, processes=_processes(processes));
+
+
+def write(sink, data, slicing = None, processes = None, verbose = False, **kwargs):
+  """Write data to a chunked array.
+
+  Arguments
+  ---------
+  sink : str or Source
+    The chunked array to write to.
+  data : array or Source
+    The data to write.
+  slicing : slice specification or None
+    Optional sub-slice of an existing array to write to. If None, the sink is
+    (re-)created with the shape and type of the data.
+  processes : int, 'serial' or None
+    Number of threads to compress the chunks in parallel. If None, use all 
+    cpus.
+
+  Returns
+  -------
+  sink : str or Source
+    The sink.
+
+  Note
+  ----
+  Additional keyword arguments, e.g. chunks or compressor, are passed to
+  :func:`create` if the sink is created.
+  """
+  if not isinstance(data, src.Source):
+    data = np.asarray(data);
+
+  if slc.is_trivial(slicing):
+    location = sink.location if isinstance(sink, (Source, VirtualSource)) else sink;
+    if isinstance(sink, (Source, VirtualSource)) and sink.shape == data.shape and sink.dtype == data.dtype:
+      created = sink.as_real();
+    else:
+      order = kwargs.pop('order', _order(data));
+      created = create(location, shape=data.shape, dtype=data.dtype, order=order, mode='w', **kwargs);
+    _copy(data, created, processes=_processes(processes), verbose=verbose);
+  else:
+    if not isinstance(sink, Source):
+      sink = Source(sink.location if isinstance(sink, VirtualSource) else sink);
+    sink.__setitem__(slicing, data, processes=_processes(processes));
+
+  return sink;
+
+
+def create(location = None, shape = None, dtype = None, order = None, chunks = None, compressor = None, fill_value = None, mode = None, array = None, as_source = True, **kwargs):
+  """Create a chunked array.
+
+  Arguments
+  ---------
+  location : str
+    The directory of the chunked array.
+  shape : tuple or None
+    The shape of the array.
+  dtype : dtype
+    The data type of the array.
+  order : 'C', 'F', or None
+    The order of the data in the chunks.
+  chunks : tuple, int or None
+    The shape of the chunks.
+  compressor : str, dict, False or None
+    The compressor of the chunks.
+  fill_value : number or None
+    The value of chunks that are not stored.
+  mode : 'r', 'r+', 'w' or None
+    The mode to open the array, if None a new array is created.
+  array : array, Source or None
+    Optional source with data to fill the array with.
+  as_source : bool
+    If True, return as Source class.
+
+  Returns
+  -------
+  source : Source or str
+    The chunked array source or its location.
+
+  Note
+  ----
+  By default the chunks are fortran contiguous if order is None.
+  """
+  mode = 'w' if mode is None else mode;
+  source = Source(location=location, shape=shape, dtype=dtype, order=order, chunks=chunks,
+                  compressor=compressor, fill_value=fill_value, mode=mode, array=array);
+  if as_source:
+    return source;
+  else:
+    return source.location;
+
+
+def convert(source, sink, processes = None, verbose = False, **kwargs):
+  """Converts a source into a chunked array.
+
+  Arguments
+  ---------
+  source : Source
+    The source to convert.
+  sink : str or Source
+    The chunked array to write the source to.
+  processes : int, 'serial' or None
+    Number of threads to copy chunk aligned blocks in parallel. If None, 
+    use all cpus.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  sink : Source
+    The chunked array.
+
+  Note
+  ----
+  The source is copied in chunk aligned blocks of about
+  :const:`default_block_size` bytes, so the full source is never loaded
+  into memory. Additional keyword arguments, e.g. chunks or compressor,
+  are passed to :func:`create`.
+  """
+  if isinstance(sink, (Source, VirtualSource)):
+    sink = sink.location;
+  order = kwargs.pop('order', source.order);
+  sink = create(sink, shape=source.shape, dtype=source.dtype, order=order, mode='w', **kwargs);
+  _copy(source, sink, processes=_processes(processes), verbose=verbose);
+  return sink;
+
+
+###############################################################################
+### Compression
+###############################################################################
+
+compressors = ['zlib', 'bz2', 'lzma', 'blosc', 'zstd', 'lz4']
+"""The supported compressors."""
+
+
+def as_compressor(compressor = None, level = None):
+  """Returns the zarr specification of a compressor.
+
+  Arguments
+  ---------
+  compressor : str, dict, False or None
+    The compressor name or specification. If False, no compression is used.
+    If None, :const:`default_compressor` or the fastest available is used.
+  level : int or None
+    Optional compression level.
+
+  Returns
+  -------
+  compressor : dict or None
+    The compressor specification as used in the zarr meta data.
+  """
+  if compressor is False:
+    return None;
+  if compressor is None:
+    compressor = default_compressor;
+  if compressor is None:
+    if _import('blosc') is not None:
+      compressor = 'blosc';
+    elif _import('zstandard') is not None:
+      compressor = 'zstd';
+    else:
+      compressor = 'zlib';
+
+  if isinstance(compressor, dict):
+    compressor = compressor.copy();
+  elif compressor == 'zlib':
+    compressor = dict(id='zlib', level=1);
+  elif compressor == 'bz2':
+    compressor = dict(id='bz2', level=1);
+  elif compressor == 'lzma':
+    compressor = dict(id='lzma', format=lzma.FORMAT_XZ, check=-1, preset=None, filters=None);
+  elif compressor == 'blosc':
+    compressor = dict(id='blosc', cname='lz4', clevel=5, shuffle=1, blocksize=0);
+  elif compressor == 'zstd':
+    compressor = dict(id='zstd', level=1);
+  elif compressor == 'lz4':
+    compressor = dict(id='lz4', acceleration=1);
+  else:
+    raise ValueError('Compressor %r not in %r!' % (compressor, compressors));
+
+  if compressor.get('id') not in compressors:
+    raise ValueError('Compressor %r not in %r!' % (compressor.get('id'), compressors));
+  if compressor['id'] in ['blosc', 'zstd', 'lz4']:
+    _codec(compressor['id']);
+  if level is not None:
+    key = dict(blosc='clevel', lzma='preset', lz4='acceleration').get(compressor['id'], 'level');
+    compressor[key] = level;
+
+  return compressor;
+
+
+def _import(name):
+  """Returns an optional compression module or None if it is not installed."""
+  try:
+    if name == 'lz4':
+      import lz4.block as module;
+    else:
+      module = __import__(name);
+  except ImportError:
+    module = None;
+  return module;
+
+
+def _codec(name):
+  """Returns the module of an optional compressor."""
+  module = _import(dict(zstd='zstandard').get(name, name));
+  if module is None:
+    raise ImportError('The %s compressor requires the %s package!' % (name, dict(zstd='zstandard').get(name, name)));
+  return module;
+
+
+def _compress(data, compressor, itemsize = 1):
+  """Compresses the bytes of a chunk."""
+  if compressor is None:
+    return data;
+  cid = compressor['id'];
+  if cid == 'zlib':
+    return zlib.compress(data, compressor.get('level', 1));
+  elif cid == 'bz2':
+    return bz2.compress(data, compressor.get('level', 1));
+  elif cid == 'lzma':
+    return lzma.compress(data, format=compressor.get('format', lzma.FORMAT_XZ), check=compressor.get('check', -1),
+                         preset=compressor.get('preset'), filters=compressor.get('filters'));
+  elif cid == 'blosc':
+    blosc = _codec('blosc');
+    shuffle = compressor.get('shuffle', 1);
+    if shuffle == -1:
+      shuffle = 1 if itemsize > 1 else 0;
+    return blosc.compress(data, typesize=itemsize, clevel=compressor.get('clevel', 5),
+                          shuffle=shuffle, cname=compressor.get('cname', 'lz4'));
+  elif cid == 'zstd':
+    return _codec('zstd').ZstdCompressor(level=compressor.get('level', 1)).compress(data);
+  elif cid == 'lz4':
+    return _codec('lz4').compress(data, acceleration=compressor.get('acceleration', 1));
+  else:
+    raise ValueError('Compressor %r not in %r!' % (cid, compressors));
+
+
+def _decompress(data, compressor):
+  """Decompresses the bytes of a chunk."""
+  if compressor is None:
+    return data;
+  cid = compressor['id'];
+  if cid == 'zlib':
+    return zlib.decompress(data);
+  elif cid == 'bz2':
+    return bz2.decompress(data);
+  elif cid == 'lzma':
+    return lzma.decompress(data, format=compressor.get('format', lzma.FORMAT_XZ), filters=compressor.get('filters'));
+  elif cid == 'blosc':
+    return _codec('blosc').decompress(data);
+  elif cid == 'zstd':
+    return _codec('zstd').ZstdDecompressor().decompress(data);
+  elif cid == 'lz4':
+    return _codec('lz4').decompress(data);
+  else:
+    raise ValueError('Compressor %r not in %r!' % (cid, compressors));
+
+
+###############################################################################
+### Helpers
+###############################################################################
+
+def _open(location, shape = None, dtype = None, order = None, chunks = None, compressor = None, fill_value = None, mode = None, array = None):
+  """Opens or creates a chunked array and returns its meta data."""
+  if not isinstance(location, str):
+    raise ValueError('Cannot open chunked array without a location!');
+
+  if array is None and mode != 'w' and is_zarr(location, exists=True):
+    with open(os.path.join(location, metadata_file), 'r') as f:
+      metadata = json.load(f);
+    if metadata.get('zarr_format') != 2:
+      raise ValueError('Chunked array %r has unsupported format %r!' % (location, metadata.get('zarr_format')));
+    if metadata.get('filters'):
+      raise ValueError('Chunked array %r uses filters which are not supported!' % location);
+    return metadata;
+
+  if mode == 'r':
+    raise ValueError('Cannot read chunked array from location %r!' % location);
+
+  if array is not None:
+    if not isinstance(array, src.Source):
+      array = np.asarray(array);
+    shape = shape if shape is not None else array.shape;
+    dtype = dtype if dtype is not None else array.dtype;
+    order = order if order is not None else _order(array);
+    if tuple(shape) != tuple(array.shape):
+      raise ValueError('Shape %r and array shape %r mismatch!' % (shape, array.shape));
+
+  if shape is None:
+    raise ValueError('Cannot create chunked array without shape at location %r!' % location);
+  shape = tuple(int(s) for s in shape);
+  dtype = np.dtype(dtype if dtype is not None else float);
+  order = order if order in ['C', 'F'] else 'F';
+  chunks = _chunks(chunks, shape, dtype);
+  fill_value = default_fill_value if fill_value is None else fill_value;
+
+  metadata = dict(zarr_format=2, shape=list(shape), chunks=list(chunks), dtype=dtype.str,
+                  compressor=as_compressor(compressor), fill_value=_fill_value_to_json(fill_value, dtype),
+                  order=order, filters=None, dimension_separator='.');
+
+  if os.path.exists(location):
+    if not is_zarr(location, exists=True) and not (os.path.isdir(location) and len(os.listdir(location)) == 0):
+      raise ValueError('Cannot create chunked array at existing location %r!' % location);
+    shutil.rmtree(location);
+  os.makedirs(location);
+  with open(os.path.join(location, metadata_file), 'w') as f:
+    json.dump(metadata, f, indent=2);
+
+  if array is not None:
+    _copy(array, Source(location=location), processes=None);
+
+  return metadata;
+
+
+def _chunks(chunks, shape, dtype):
+  """Returns the shape of the chunks for an array."""
+  ndim = len(shape);
+  if chunks is None:
+    edge = np.log2(default_chunk_size / float(np.dtype(dtype).itemsize)) / max(ndim, 1);
+    chunks = (2 ** int(np.round(edge)),) * ndim;
+  elif isinstance(chunks, numbers.Integral):
+    chunks = (int(chunks),) * ndim;
+  if len(chunks) != ndim:
+    raise ValueError('Chunk shape %r does not match the array dimension %d!' % (chunks, ndim));
+  return tuple(max(1, min(int(c) if c is not None and c > 0 else s, s)) for c,s in zip(chunks, shape));
+
+
+def _fill_value(value, dtype):
+  """Converts the fill value of the meta data to the data type."""
+  if value is None:
+    value = 0;
+  if isinstance(value, str):
+    value = dict(NaN=np.nan, Infinity=np.inf).get(value, -np.inf if value == '-Infinity' else value);
+  return np.array(value).astype(dtype)[()];
+
+
+def _fill_value_to_json(value, dtype):
+  """Converts a fill value to its json representation in the meta data."""
+  value = np.array(value).astype(dtype)[()];
+  if np.issubdtype(dtype, np.floating):
+    if np.isnan(value):
+      return 'NaN';
+    elif np.isinf(value):
+      return 'Infinity' if value > 0 else '-Infinity';
+    return float(value);
+  elif np.issubdtype(dtype, np.bool_):
+    return bool(value);
+  elif np.issubdtype(dtype, np.integer):
+    return int(value);
+  return value.item();
+
+
+def _order(source):
+  """The order of an array or source."""
+  if isinstance(source, src.Source):
+    return source.order;
+  return npy.order(source);
+
+
+def _is_fill(data, fill_value):
+  """Checks if a chunk contains only the fill value."""
+  if np.asarray(fill_value).dtype.kind in 'fc' and np.isnan(fill_value):
+    return bool(np.all(np.isnan(data)));
+  return not np.any(data != fill_value);
+
+
+def _bounding_box(slicing, shape):
+  """Bounding box of a slicing and the slicing relative to the box."""
+  lower = (); upper = (); box_slicing = ();
+  d = 0;
+  for s in slicing:
+    if s is None:
+      box_slicing += (None,);
+      continue;
+    n = shape[d];
+    if isinstance(s, slice):
+      r = range(*s.indices(n));
+      if len(r) == 0:
+        lower += (0,); upper += (0,);
+        box_slicing += (slice(0, 0),);
+      else:
+        lo, hi = min(r[0], r[-1]), max(r[0], r[-1]) + 1;
+        stop = r.stop - lo;
+        lower += (lo,); upper += (hi,);
+        box_slicing += (slice(r.start - lo, stop if stop >= 0 else None, r.step),);
+    elif isinstance(s, numbers.Integral):
+      i = int(s) + n if s < 0 else int(s);
+      if i < 0 or i >= n:
+        raise IndexError('Index %d out of bounds for axis %d with size %d!' % (s, d, n));
+      lower += (i,); upper += (i + 1,);
+      box_slicing += (0,);
+    else:
+      s = np.asarray(s);
+      if s.dtype == bool:
+        if s.ndim != 1:
+          raise IndexError('Only one dimensional boolean index arrays are supported!');
+        s = np.nonzero(s)[0];
+      s = np.where(s < 0, s + n, s).astype(int);
+      if s.size > 0 and (s.min() < 0 or s.max() >= n):
+        raise IndexError('Index array out of bounds for axis %d with size %d!' % (d, n));
+      lo, hi = (int(s.min()), int(s.max()) + 1) if s.size > 0 else (0, 0);
+      lower += (lo,); upper += (hi,);
+      box_slicing += (s - lo,);
+    d += 1;
+  return lower, upper, box_slicing;
+
+
+def _is_dense(box_slicing, box_shape):
+  """Checks if a slicing relative to its bounding box covers the full box."""
+  d = 0;
+  for s in box_slicing:
+    if s is None:
+      continue;
+    if isinstance(s, slice):
+      if s.indices(box_shape[d]) != (0, box_shape[d], 1):
+        return False;
+    elif not isinstance(s, numbers.Integral):
+      return False;
+    d += 1;
+  return True;
+
+
+def _chunk_indices(lower, upper, chunks):
+  """Indices of the chunks overlapping with a rectangular region."""
+  ranges = [range(l // c, -(-u // c)) for l,u,c in zip(lower, upper, chunks)];
+  #iterate with the first axis fastest
+  return [i[::-1] for i in itertools.product(*ranges[::-1])];
+
+
+def _chunk_overlap(index, chunks, lower, upper):
+  """Slicings of the overlap of a chunk and a rectangular region in the chunk and in the region."""
+  chunk_slicing = (); box_slicing = ();
+  for i,c,l,u in zip(index, chunks, lower, upper):
+    lo, hi = max(i * c, l), min((i + 1) * c, u);
+    chunk_slicing += (slice(lo - i * c, hi - i * c),);
+    box_slicing += (slice(lo - l, hi - l),);
+  return chunk_slicing, box_slicing;
+
+
+def _processes(processes):
+  """The number of threads of the module level functions, all cpus if None."""
+  return mp.cpu_count() if processes is None else processes;
+
+
+def _map(func, items, processes = None):
+  """Maps a function over items using threads, serially if processes is None."""
+  if processes is None or processes == 'serial' or processes <= 1 or len(items) <= 1:
+    for item in items:
+      func(item);
+  else:
+    with concurrent.futures.ThreadPoolExecutor(min(processes, len(items))) as executor:
+      list(executor.map(func, items));
+
+
+def _blocks(shape, chunks, itemsize, size = None):
+  """Chunk aligned blocks of about the given size in bytes covering an array."""
+  if size is None:
+    size = default_block_size;
+  block = list(chunks);
+  for d in range(len(shape)):
+    n = max(1, int(size // (np.prod(block) * itemsize)));
+    block[d] = min(shape[d], block[d] * n);
+  ranges = [range(0, s, b) for s,b in zip(shape, block)];
+  blocks = [i[::-1] for i in itertools.product(*ranges[::-1])];
+  return [tuple(slice(l, min(l + b, s)) for l,b,s in zip(lower, block, shape)) for lower in blocks];
+
+
+def _copy(source, sink, processes = None, verbose = False):
+  """Copies a source into a chunked array in chunk aligned blocks."""
+  blocks = _blocks(sink.shape, sink.chunks, sink.dtype.itemsize);
+  n_blocks = len(blocks);
+
+  if verbose:
+    timer = tmr.Timer();
+    print('Writing %s to %s in %d blocks.' % (source, sink, n_blocks));
+
+  @ptb.parallel_traceback
+  def func(slicing):
+    data = np.asarray(source[slicing], dtype=sink.dtype);
+    lower = tuple(s.start for s in slicing);
+    sink._write_box(lower, data, processes='serial');
+
+  _map(func, blocks, processes=processes);
+
+  if verbose:
+    timer.print_elapsed_time('Writing %d blocks' % n_blocks);
+
+  return sink;
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.IO.IO as io
+  import ClearMap.IO.ZARR as zarr
+
+  location = 'test.zarr'
+  data = np.zeros((50, 40, 30), dtype='uint16', order='F');
+  data[10:20, 5:15, 7:9] = 100;
+
+  source = zarr.create(location, array=data, chunks=(16,16,16));
+  print(source)
+  print(np.all(source[:] == data), source.compressor)
+
+  source[45:, ::3, 2] = 7;
+  data[45:, ::3, 2] = 7;
+  print(np.all(io.read(location) == data))
+  print(np.all(source[[1, 3, 12], 5:-1:2, -1] == data[[1, 3, 12], 5:-1:2, -1]))
+
+  fu.delete_directory(location)
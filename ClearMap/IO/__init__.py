@@ -41,11 +41,17 @@ nrrd             :mod:`~ClearMap.IO.NRRD`     nearly raw raster data files
 csv              :mod:`~ClearMap.IO.CSV`      text files as comma separated values   
 npy              :mod:`~ClearMap.IO.NPY`      numpy binary file
 gt               :mod:`~ClearMap.IO.GT`       graph tool file
+zarr             :mod:`~ClearMap.IO.ZARR`     chunked and compressed arrays in zarr directories
 file list        :mod:`~ClearMap.IO.FileList` folder, file list or file expression for a list source files
 -                :mod:`~ClearMap.IO.MMP`      memory mapped file
 -                :mod:`~ClearMap.IO.SMA`      shared memory array
 ================ ============================ =============================================================
 
+Note
+----
+Multiresolution pyramids of large sources for viewing are created with the
+:mod:`~ClearMap.IO.Pyramid` module.
+
 Note
 ----
 Sources can be sliced as numpy arrays using the :mod:`~ClearMap.IO.Slice` 
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+BackgroundRemoval
+=================
+
+Removal of a smooth background from the slices of a 3d image via a grey
+opening of each slice.
+
+The opening is calculated in one of two ways:
+
+=============== =========================================================
+Method          Description
+=============== =========================================================
+``rectangles``  the structure element is decomposed into rectangles, the
+                openings use minimum and maximum filters whose cost per
+                voxel is independent of the size of the element
+``opencv``      the opening of each slice via opencv in a thread pool
+=============== =========================================================
+
+Note
+----
+Erosions and dilations by a union of rectangles are the minimum and maximum
+of the erosions and dilations by the rectangles. Row-convex structure
+elements, e.g. disks, are exact unions of a few rectangles, see
+:func:`rectangle_decomposition`, and both methods give identical results.
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+
+import concurrent.futures
+
+import cv2
+
+import ClearMap.ImageProcessing.Filter.StructureElement as se
+
+import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
+
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'BackgroundRemovalCode')
+
+import ClearMap.ImageProcessing.BackgroundRemovalCode as code
+
+
+###############################################################################
+### Background removal
+###############################################################################
+
+opencv_max_size = 40;
+"""Size of structure elements up to which opencv is used by default.
+
+Note
+----
+The cost of the opencv opening grows with the size of the element, the cost
+of the rectangle decomposition with its number of rectangles.
+"""
+
+
+def remove_background(source, shape, form = 'Disk', method = None, rectangles = None, sink = None, processes = None, verbose = False):
+  """Removes the background of the slices along the last axis of an image.
+
+  Arguments
+  ---------
+  source : array
+    The 2d or 3d source image.
+  shape : tuple
+    The shape of the 2d structure element to estimate the background.
+  form : str
+    The form of the structure element, see
+    :func:`~ClearMap.ImageProcessing.Filter.StructureElement.structure_element`.
+  method : 'rectangles', 'opencv' or None
+    The method to calculate the opening. If None, use 'opencv' for exact
+    openings by elements up to :const:`opencv_max_size` and 'rectangles'
+    otherwise.
+  rectangles : int or None
+    If int, approximate the structure element by at most this many
+    rectangles in the 'rectangles' method, making the cost independent of
+    the element's size. If None, use the exact decomposition.
+  sink : array or None
+    The sink for the result.
+  processes : int or None
+    Number of processes to use, if None use number of cpus.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  sink : array
+    The source with the background removed.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='remove_background');
+
+  source = np.asarray(source);
+  selem = np.array(se.structure_element(shape, form=form, ndim=2), dtype=bool);
+
+  if method is None:
+    if rectangles is None and max(selem.shape) <= opencv_max_size and source.dtype in _opencv_dtypes:
+      method = 'opencv';
+    else:
+      method = 'rectangles';
+  if method == 'rectangles':
+    background = _open_rectangles(source, selem, rectangle_decomposition(selem, rectangles), processes=processes);
+  elif method == 'opencv':
+    background = _open_opencv(source, selem, processes=processes);
+  else:
+    raise ValueError("Method %r not valid, expected 'rectangles' or 'opencv'!" % method);
+
+  if sink is None:
+    sink = background;
+  np.subtract(source, np.minimum(source, background, out=background), out=sink);
+
+  ap.finalize_processing(verbose=verbose, function='remove_background (%s)' % method, timer=timer);
+
+  return sink;
+
+
+###############################################################################
+### Rectangle decomposition
+###############################################################################
+
+def rectangle_decomposition(selem, n_rectangles = None):
+  """Decomposes a row-convex 2d structure element into rectangles.
+
+  Arguments
+  ---------
+  selem : array
+    The 2d structure element with its center at shape // 2.
+  n_rectangles : int or None
+    If int, approximate the element with at most this many rectangles
+    inscribed in the element, covering as much of it as possible.
+
+  Returns
+  -------
+  rectangles : array
+    The (n,4) array of the first and last rows and columns of the rectangles
+    relative to the center of the element.
+
+  Note
+  ----
+  For each row the rectangle with the row's extent spanning all neighbouring
+  rows containing this extent is used. The union of these rectangles is the
+  element if its rows are convex.
+  """
+  selem = np.asarray(selem, dtype=bool);
+  if selem.ndim != 2:
+    raise ValueError('Structure element is expected to be 2d, found %d dimensions!' % selem.ndim);
+
+  rectangles = [];
+  for r, row in enumerate(selem):
+    columns = np.nonzero(row)[0];
+    if len(columns) == 0:
+      continue;
+    c0, c1 = columns[0], columns[-1];
+    if not np.all(row[c0:c1+1]):
+      raise ValueError('Structure element is not row-convex!');
+    contained = np.all(selem[:, c0:c1+1], axis=1);
+    r0 = r1 = r;
+    while r0 > 0 and contained[r0 - 1]:
+      r0 -= 1;
+    while r1 < len(selem) - 1 and contained[r1 + 1]:
+      r1 += 1;
+    if (r0, r1, c0, c1) not in rectangles:
+      rectangles.append((r0, r1, c0, c1));
+
+  if n_rectangles is not None and len(rectangles) > n_rectangles:
+    # greedily choose the rectangles adding the largest area
+    covered = np.zeros(selem.shape, dtype=bool);
+    chosen = [];
+    for _ in range(n_rectangles):
+      areas = [np.sum(~covered[r0:r1+1, c0:c1+1]) for r0, r1, c0, c1 in rectangles];
+      r0, r1, c0, c1 = rectangles.pop(int(np.argmax(areas)));
+      covered[r0:r1+1, c0:c1+1] = True;
+      chosen.append((r0, r1, c0, c1));
+    rectangles = chosen;
+
+  center = np.array(selem.shape) // 2;
+  return np.array(rectangles, dtype=int).reshape(-1, 4) - center[[0,0,1,1]];
+
+
+###############################################################################
+### Openings
+###############################################################################
+
+_opencv_dtypes = [np.dtype(d) for d in ('uint8', 'uint16', 'int16', 'float32', 'float64')];
+
+
+def _open_rectangles(source, selem, rectangles, processes):
+  """Opening of the slices by a union of rectangles via 1d minimum and maximum filters."""
+  shape = source.shape;
+  source = np.ascontiguousarray(source.reshape(shape[:2] + (-1,)));
+  if np.issubdtype(source.dtype, np.integer):
+    lowest, highest = np.iinfo(source.dtype).min, np.iinfo(source.dtype).max;
+  else:
+    lowest, highest = -np.inf, np.inf;
+  fill = np.array([highest, lowest], dtype=source.dtype);
+
+  eroded = np.empty_like(source);
+  opened = np.empty_like(source);
+  temp   = np.empty_like(source);
+  for target, maximum in ((eroded, False), (opened, True)):
+    previous = source if not maximum else eroded;
+    for i, (r0, r1, c0, c1) in enumerate(rectangles):
+      code.filter_1d(previous, temp, 0, r0, r1, maximum, fill[int(maximum)], False, processes);
+      code.filter_1d(temp, target, 1, c0, c1, maximum, fill[int(maximum)], i > 0, processes);
+
+  return opened.reshape(shape);
+
+
+def _open_opencv(source, selem, processes):
+  """Opening of the slices via opencv in a thread pool."""
+  selem = selem.astype('uint8');
+  slices = source.reshape(source.shape[:2] + (-1,));
+  opened = np.empty(slices.shape, dtype=source.dtype);
+
+  # opencv releases the gil
+  def open_slice(z):
+    opened[:,:,z] = cv2.morphologyEx(np.ascontiguousarray(slices[:,:,z]), cv2.MORPH_OPEN, selem);
+
+  with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+    list(executor.map(open_slice, range(slices.shape[2])));
+
+  return opened.reshape(source.shape);
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import ClearMap.ImageProcessing.BackgroundRemoval as br
+
+  source = np.array(np.random.rand(100,120,30) * 1000, dtype='uint16');
+  removed = br.remove_background(source, shape=(10,10), method='rectangles');
+  reference = br.remove_background(source, shape=(10,10), method='opencv');
+  assert np.all(removed == reference);
@@ -0,0 +1,158 @@
+#cython: language_level=3, boundscheck=False, wraparound=False, nonecheck=False, initializedcheck=False, cdivision=True
+"""
+BackgroundRemovalCode
+=====================
+
+Cython code for the 1d minimum and maximum filters used in the background
+removal.
+
+Note
+----
+The filters use the algorithm of [vanHerk1992]_ and [GilWerman1993]_ with a
+cost per voxel that is independent of the filter length.
+
+References
+----------
+.. [vanHerk1992] van Herk, M., "A fast algorithm for local minimum and maximum
+   filters on rectangular and octagonal kernels", Pattern Recognition Letters (1992)
+.. [GilWerman1993] Gil, J. and Werman, M., "Computing 2-D min, median, and max
+   filters", IEEE Transactions on Pattern Analysis and Machine Intelligence (1993)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel import prange, parallel
+
+from libc.stdlib cimport malloc, free
+
+ctypedef fused source_t:
+  np.int16_t
+  np.int32_t
+  np.int64_t
+  np.uint8_t
+  np.uint16_t
+  np.uint32_t
+  np.uint64_t
+  np.float32_t
+  np.float64_t
+
+ctypedef Py_ssize_t index_t
+
+
+###############################################################################
+### Minimum and maximum filter
+###############################################################################
+
+cpdef void filter_1d(source_t[:,:,:] source, source_t[:,:,:] sink, int axis, index_t lower, index_t upper,
+                     bint maximum, source_t fill, bint combine, int processes) nogil:
+  """Minimum or maximum filter along the first or second axis.
+
+  Arguments
+  ---------
+  source : array
+    The source.
+  sink : array
+    The sink, of the same shape as the source.
+  axis : int
+    The axis, 0 or 1, to filter along.
+  lower, upper : int
+    The filter window of a voxel at x is [x + lower, x + upper].
+  maximum : bool
+    If True, use a maximum filter, otherwise a minimum filter.
+  fill : number
+    The neutral value of the filter outside the source.
+  combine : bool
+    If True, combine the result with the values in sink via the minimum or
+    maximum, otherwise overwrite sink.
+  processes : int
+    The number of parallel processes.
+
+  Note
+  ----
+  Lines along the third axis are processed together, which should be the
+  contiguous one.
+  """
+  cdef index_t n = source.shape[axis];
+  cdef index_t n_planes = source.shape[1 - axis];
+  cdef index_t n_lines = source.shape[2];
+  cdef index_t p
+
+  with nogil, parallel(num_threads = processes):
+    for p in prange(n_planes, schedule='static'):
+      _filter_plane(source, sink, axis, p, n, n_lines, lower, upper, maximum, fill, combine);
+
+
+cdef inline source_t _select(source_t a, source_t b, bint maximum) noexcept nogil:
+  if maximum:
+    return a if a > b else b;
+  else:
+    return a if a < b else b;
+
+
+cdef void _filter_plane(source_t[:,:,:] source, source_t[:,:,:] sink, int axis, index_t p, index_t n, index_t n_lines,
+                        index_t lower, index_t upper, bint maximum, source_t fill, bint combine) noexcept nogil:
+  """Filters the lines in a plane via forward and backward running extrema in blocks."""
+  cdef index_t k = upper - lower + 1;
+  cdef index_t m = n + k - 1;
+  cdef index_t source_stride = source.strides[2] // sizeof(source_t);
+  cdef index_t sink_stride   = sink.strides[2] // sizeof(source_t);
+  cdef index_t u, t, z
+  cdef source_t* line
+  cdef source_t* f
+  cdef source_t* b
+
+  # running extrema from block starts (forward) and to block ends (backward)
+  cdef source_t* forward  = <source_t*>malloc(m * n_lines * sizeof(source_t));
+  cdef source_t* backward = <source_t*>malloc(m * n_lines * sizeof(source_t));
+
+  for u in range(m):
+    t = u + lower;
+    f = forward + u * n_lines;
+    if 0 <= t and t < n:
+      line = &source[t,p,0] if axis == 0 else &source[p,t,0];
+      if u % k == 0:
+        for z in range(n_lines):
+          f[z] = line[z * source_stride];
+      else:
+        for z in range(n_lines):
+          f[z] = _select(f[z - n_lines], line[z * source_stride], maximum);
+    else:
+      for z in range(n_lines):
+        f[z] = fill if u % k == 0 else f[z - n_lines];
+
+  for u in range(m - 1, -1, -1):
+    t = u + lower;
+    b = backward + u * n_lines;
+    if 0 <= t and t < n:
+      line = &source[t,p,0] if axis == 0 else &source[p,t,0];
+      if u % k == k - 1 or u == m - 1:
+        for z in range(n_lines):
+          b[z] = line[z * source_stride];
+      else:
+        for z in range(n_lines):
+          b[z] = _select(b[z + n_lines], line[z * source_stride], maximum);
+    else:
+      for z in range(n_lines):
+        b[z] = fill if u % k == k - 1 or u == m - 1 else b[z + n_lines];
+
+  # the window [x + lower, x + upper] spans at most two blocks
+  for u in range(n):
+    line = &sink[u,p,0] if axis == 0 else &sink[p,u,0];
+    b = backward + u * n_lines;
+    f = forward + (u + k - 1) * n_lines;
+    if combine:
+      for z in range(n_lines):
+        line[z * sink_stride] = _select(line[z * sink_stride], _select(b[z], f[z], maximum), maximum);
+    else:
+      for z in range(n_lines):
+        line[z * sink_stride] = _select(b[z], f[z], maximum);
+
+  free(forward);
+  free(backward);
@@ -13,24 +13,11 @@ __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
 import os
 import multiprocessing as mp
 import gc
-import pyximport
 
 import numpy as np
 
-
-old_get_distutils_extension = pyximport.pyximport.get_distutils_extension
-
-
-def new_get_distutils_extension(modname, pyxfilename, language_level=None):
-    extension_mod, setup_args = old_get_distutils_extension(modname, pyxfilename, language_level)
-    extension_mod.language = 'c++'
-    return extension_mod, setup_args
-
-
-pyximport.pyximport.get_distutils_extension = new_get_distutils_extension
-
-pyximport.install(setup_args={"include_dirs": [np.get_include(), os.path.dirname(os.path.abspath(__file__))]},
-                  reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'FillingCode')
 
 from . import FillingCode as code
 
@@ -5,6 +5,12 @@ Hessian
 Module to compute curvature measures based on Hessian Matrix
 
 Usefull for filtering vasculature data
+
+The curvature measures are computed from finite differences of the 
+(smoothed) source at each voxel without storing the Hessian tensor, and can be
+calculated in parallel via the processes argument. Passing dtype = 'float32' 
+smoothes the data in single precision, halving the memory of the 
+intermediate arrays.
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
@@ -19,8 +25,8 @@ import scipy.ndimage as ndi
 import ClearMap.IO.IO as io
 
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'HessianCode')
 
 from . import HessianCode as code
 
@@ -33,7 +39,7 @@ __all__ = ['hessian', 'eigenvalues', 'lambda123', 'tubeness'];
 ### Curvature measures
 ###############################################################################
           
-def hessian(source, sink = None, sigma = None):
+def hessian(source, sink = None, sigma = None, dtype = None, processes = None):
   """Returns the hessian matrix at each location calculatd via finite differences.
   
   Arguments
@@ -42,16 +48,24 @@ def hessian(source, sink = None, sigma = None):
     Input array.
   sink : array
     Output, if None, a new array is allocated.  
+  sigma : float or None
+    If not None, a Gaussian filter with std sigma is applied initialliy.
+  dtype : dtype or None
+    The floating point type of the smoothed data and the output.
+    If None, float64 is used.
+  processes : int or None
+    Number of threads to use. If None, the calculation is serial.
 
   Returns
   -------
   hessian : array:
       5d array with the hessian matrix in the first two dimensions.
   """    
-  return _apply_code(code.hessian, source, sink, sink_shape_per_pixel = (2,2), parameter = None, sigma = sigma);
+  return _apply_code(code.hessian, source, sink, sink_shape_per_pixel = (3,3), parameter = None, sigma = sigma,
+                     dtype = dtype, processes = processes);
   
 
-def eigenvalues(source, sink = None, sigma = None):
+def eigenvalues(source, sink = None, sigma = None, dtype = None, processes = None):
   """Hessiean eigenvalues of source data
 
   Arguments
@@ -62,16 +76,22 @@ def eigenvalues(source, sink = None, sigma = None):
     Output, if None, a new array is allocated.
   sigma : float or None
     If not None, a Gaussian filter with std sigma is applied initialliy.
+  dtype : dtype or None
+    The floating point type of the smoothed data and the output.
+    If None, float64 is used.
+  processes : int or None
+    Number of threads to use. If None, the calculation is serial.
   
   Returns
   -------
   sink : array
     The three eigenvalues along the first axis for each source.
   """
-  return _apply_code(code.eigenvalues, source, sink, sink_shape_per_pixel = (3,), parameter = None, sigma = sigma);
+  return _apply_code(code.eigenvalues, source, sink, sink_shape_per_pixel = (3,), parameter = None, sigma = sigma,
+                     dtype = dtype, processes = processes);
           
 
-def tubeness(source, sink = None, threshold = None, sigma = None):
+def tubeness(source, sink = None, threshold = None, sigma = None, dtype = None, processes = None):
   """Tubeness mesure of source data
 
   Arguments
@@ -84,6 +104,11 @@ def tubeness(source, sink = None, threshold = None, sigma = None):
     If float, the tubeness is thresholded at this level.
   sigma : float or None
     If not None, a Gaussian filter with std sigma is applied initialliy.
+  dtype : dtype or None
+    The floating point type of the smoothed data and the output.
+    If None, float64 is used.
+  processes : int or None
+    Number of threads to use. If None, the calculation is serial.
 
   Returns
   -------
@@ -95,12 +120,15 @@ def tubeness(source, sink = None, threshold = None, sigma = None):
   The tubness is the geometric mean of the two smallest eigenvalues.      
   """
   if threshold is None:
-    return _apply_code(code.tubeness, source, sink, sigma = sigma, sink_dtype = float)
+    return _apply_code(code.tubeness, source, sink, sigma = sigma, 
+                       dtype = dtype, processes = processes)
   else: 
-    return _apply_code(code.tubeness_threshold, source, sink, parameter = threshold, sigma = sigma, sink_dtype = bool)
+    return _apply_code(code.tubeness_threshold, source, sink, parameter = threshold, sigma = sigma, sink_dtype = bool, 
+                       dtype = dtype, processes = processes)
 
 
-def lambda123(source, sink = None, gamma12 = 1.0, gamma23 = 1.0, alpha = 0.25, sigma = None, threshold = None):
+def lambda123(source, sink = None, gamma12 = 1.0, gamma23 = 1.0, alpha = 0.25, sigma = None, threshold = None, 
+              dtype = None, processes = None):
   """Generalized tubness measure of source data.
 
   Arguments
@@ -113,6 +141,13 @@ def lambda123(source, sink = None, gamma12 = 1.0, gamma23 = 1.0, alpha = 0.25, s
     Parameters for the tubness measure.
   sigma : float or None
     If not None, a Gaussian filter with std sigma is applied initialliy.
+  threshold : float or None
+    If float, the measure is thresholded at this level.
+  dtype : dtype or None
+    The floating point type of the smoothed data and the output.
+    If None, float64 is used.
+  processes : int or None
+    Number of threads to use. If None, the calculation is serial.
   
   Returns
   -------
@@ -125,18 +160,34 @@ def lambda123(source, sink = None, gamma12 = 1.0, gamma23 = 1.0, alpha = 0.25, s
   """  
   if threshold is None:
     parameter = np.array([gamma12, gamma23, alpha], dtype = float);
-    return _apply_code(code.lambda123, source, sink, parameter=parameter, sigma=sigma, sink_dtype=float);          
+    return _apply_code(code.lambda123, source, sink, parameter=parameter, sigma=sigma, 
+                       dtype=dtype, processes=processes);
   else:
     parameter = np.array([gamma12, gamma23, alpha, threshold], dtype = float);
-    return _apply_code(code.lambda123_threshold, source, sink, parameter=parameter, sigma=sigma, sink_dtype=bool);          
+    return _apply_code(code.lambda123_threshold, source, sink, parameter=parameter, sigma=sigma, sink_dtype=bool, 
+                       dtype=dtype, processes=processes);
 
 
 ###############################################################################
 ### Helpers
 ###############################################################################
 
-def _apply_code(function, source, sink, sink_dtype = None, sink_shape_per_pixel = None, parameter = None, sigma = None):
-  """Helper to apply the core functions"""
+_float_dtypes = (np.dtype('float32'), np.dtype('float64'));
+"""Floating point types for the smoothed data."""
+
+_source_dtypes = (np.dtype('uint8'), np.dtype('uint16')) + _float_dtypes;
+"""Source types supported by the code."""
+
+def _apply_code(function, source, sink, sink_dtype = None, sink_shape_per_pixel = None, parameter = None, sigma = None,
+                dtype = None, processes = None):
+  """Helper to apply the core functions
+  
+  Note
+  ----
+  Sources of a type supported by the code are passed on without conversion, 
+  otherwise they are converted to dtype. The Gaussian filter writes directly 
+  into an array of type dtype.
+  """
   if source.ndim != 3:
     raise ValueError('The tubness measure is implemented for 3d data, found %dd!' % source.ndim);
   
@@ -148,9 +199,15 @@ def _apply_code(function, source, sink, sink_dtype = None, sink_shape_per_pixel
   else:
     shape_per_pixel = sink_shape_per_pixel;
   
+  if dtype is None:
+    dtype = float;
+  dtype = np.dtype(dtype);
+  if dtype not in _float_dtypes:
+    raise ValueError('The dtype %r is not supported, use float32 or float64!' % dtype);
+  
   if sink is None:
     if sink_dtype is None:
-      sink_dtype = float
+      sink_dtype = dtype
     sink = np.zeros(source.shape + shape_per_pixel, dtype = sink_dtype, order = 'F')
   else:
     if shape_per_pixel != (1,):
@@ -171,11 +228,16 @@ def _apply_code(function, source, sink, sink_dtype = None, sink_shape_per_pixel
   parameter = np.asarray([parameter], dtype = float).flatten();
                      
   if sigma is not None:
-    data = ndi.gaussian_filter(np.asarray(source, dtype=float), sigma=sigma);
+    data = ndi.gaussian_filter(np.asarray(source), sigma=sigma, output=dtype);
   else:
-    data = np.asarray(source, dtype=float);
+    data = np.asarray(source);
+    if data.dtype not in _source_dtypes:
+      data = np.asarray(data, dtype=dtype);
+  
+  if processes is None:
+    processes = 1;
   
-  function(source=data, sink=s, sink_stride=sink_stride,  parameter=parameter)
+  function(source=data, sink=s, sink_stride=sink_stride,  parameter=parameter, processes=processes)
   
   if sink_shape_per_pixel is None:
     sink = sink.reshape(sink.shape[:-1]);
@@ -29,9 +29,11 @@ ctypedef Py_ssize_t index_t
 
 
 from libc.math cimport sqrt, atan2, cos, sin, pow
+
+from cython.parallel import prange
     
 #nogil version of abs
-cdef inline double _abs(double a) nogil:
+cdef inline double _abs(double a) noexcept nogil:
     return a if a >= 0 else -a;
 
 #debug
@@ -39,8 +41,8 @@ cdef inline double _abs(double a) nogil:
 #    int printf(char *format, ...) nogil                     
 
 
-def hessian(source_t[:, :, :] source, sink_t[:, :, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  """Compute Hessian eigenvalues at each pixel."""
+def hessian(const source_t[:, :, :] source, sink_t[:, :, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  """Compute the Hessian matrix at each pixel."""
   # array sizes
   cdef index_t nx = source.shape[0]
   cdef index_t ny = source.shape[1]
@@ -50,9 +52,10 @@ def hessian(source_t[:, :, :] source, sink_t[:, :, :, :, :] sink, index_t sink_s
 
   # local variable types
   cdef index_t x,y,z,xm,ym,zm,xp,yp,zp
+  cdef double i
   
   with nogil:
-    for x in range(nx):
+    for x in prange(nx, num_threads=processes, schedule='static'):
       xm = x - 1 if x > 0 else x;
       xp = x + 1 if x < nx - 1 else nx -1;
       
@@ -68,7 +71,7 @@ def hessian(source_t[:, :, :] source, sink_t[:, :, :, :, :] sink, index_t sink_s
           i = 2.0 * <double>source[x,y,z];
           
           sink[x,y,z,0,0] = <sink_t> (source[xm,y, z ] - i + source[xp,y, z ]);
-          sink[x,z,y,1,1] = <sink_t> (source[x, ym,z ] - i + source[x, yp,z ]);
+          sink[x,y,z,1,1] = <sink_t> (source[x, ym,z ] - i + source[x, yp,z ]);
           sink[x,y,z,2,2] = <sink_t> (source[x, y, zm] - i + source[x, y ,zp]);
 
           sink[x,y,z,0,1] = sink[x,y,z,1,0] = <sink_t> ((<double>source[xp,yp,z ] - source[xm,yp,z ] - source[xp,ym,z ] + source[xm,ym,z ]) / 4.0);
@@ -76,9 +79,15 @@ def hessian(source_t[:, :, :] source, sink_t[:, :, :, :, :] sink, index_t sink_s
           sink[x,y,z,1,2] = sink[x,y,z,2,1] = <sink_t> ((<double>source[x ,yp,zp] - source[x ,ym,zp] - source[x ,yp,zm] + source[x ,ym,zm]) / 4.0);
 
 
-cdef void hessian_core(void kernel(sink_t*, index_t, double, double, double, double*) nogil,
-                       source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter) except *:
-  """Compute Hessian eigenvalues for each pixel and apply a measure defined by the kernel."""
+cdef void hessian_core(void kernel(sink_t*, index_t, double, double, double, double*) noexcept nogil,
+                       const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter,
+                       int processes) except *:
+  """Compute Hessian eigenvalues for each pixel and apply a measure defined by the kernel.
+  
+  The Hessian is computed from finite differences at each pixel and passed 
+  directly to the kernel without storing the tensor. 
+  The x-axis is distributed over processes threads.
+  """
   
   # array sizes
   cdef index_t nx = source.shape[0]
@@ -100,14 +109,14 @@ cdef void hessian_core(void kernel(sink_t*, index_t, double, double, double, dou
   
   
   # Compute eigenvalues and apply kernel
-  cdef double i, discriminant, a, b, c, d, q, r, s, t, u, v
+  cdef double i, discriminant, a, b, c, d, q, r, s, t, u, v, first, last
   cdef double e1, e2, e3
   cdef double e1a, e2a, e3a
   cdef double e1s, e2s, e3s
   a = -1.0;
    
   with nogil:
-    for x in range(nx):
+    for x in prange(nx, num_threads=processes, schedule='static'):
       xm = x - 1 if x > 0 else x;
       xp = x + 1 if x < nx - 1 else nx -1;
       
@@ -193,14 +202,14 @@ cdef void hessian_core(void kernel(sink_t*, index_t, double, double, double, dou
 
 
 #Hessina eigenvalues
-cdef inline void eigenvalue_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) nogil:
+cdef inline void eigenvalue_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) noexcept nogil:
   sink[0              ] = <sink_t> e1; 
   sink[1 * sink_stride] = <sink_t> e2;
   sink[2 * sink_stride] = <sink_t> e3;
 
 
 #Tubness part of a Frangi filter, i.e. the geometric mean of lowest two eigenvalues
-cdef inline void tubeness_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) nogil:
+cdef inline void tubeness_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) noexcept nogil:
   if e2 < 0 and e3 < 0:
     sink[0] = <sink_t> sqrt(e2 * e3);
   else:
@@ -208,7 +217,7 @@ cdef inline void tubeness_kernel(sink_t* sink, index_t sink_stride, double e1, d
         
         
 #Thresholded Tubness part of a Frangi filter
-cdef inline void tubeness_threshold_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) nogil:
+cdef inline void tubeness_threshold_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) noexcept nogil:
   if e2 < 0 and e3 < 0:
     if sqrt(e2 * e3) > par[0]:
       sink[0] = 1;
@@ -219,7 +228,7 @@ cdef inline void tubeness_threshold_kernel(sink_t* sink, index_t sink_stride, do
 
 
 #Generalized Frangi filer [Sato et al, Three dimensional multi-scale line filter for segmentation and visualization of curvilinear structures in medicalimages, 1998]
-cdef inline void lambda123_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) nogil:
+cdef inline void lambda123_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) noexcept nogil:
   cdef double a;
   
   if e2 < 0 and e3 < 0:
@@ -236,7 +245,7 @@ cdef inline void lambda123_kernel(sink_t* sink, index_t sink_stride, double e1,
 
 
 #Generalized Frangi filer [Sato et al, Three dimensional multi-scale line filter for segmentation and visualization of curvilinear structures in medicalimages, 1998]
-cdef inline void lambda123_threshold_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) nogil:
+cdef inline void lambda123_threshold_kernel(sink_t* sink, index_t sink_stride, double e1, double e2, double e3, double* par) noexcept nogil:
   cdef double a;
   
   if e2 < 0 and e3 < 0:
@@ -253,22 +262,22 @@ cdef inline void lambda123_threshold_kernel(sink_t* sink, index_t sink_stride, d
 
 
 
-def eigenvalues(source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  hessian_core(eigenvalue_kernel[sink_t], source, sink, sink_stride, parameter);
+def eigenvalues(const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  hessian_core(eigenvalue_kernel[sink_t], source, sink, sink_stride, parameter, processes);
 
 
-def tubeness(source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  hessian_core(tubeness_kernel[sink_t], source, sink, sink_stride, parameter);
+def tubeness(const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  hessian_core(tubeness_kernel[sink_t], source, sink, sink_stride, parameter, processes);
 
   
-def tubeness_threshold(source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  hessian_core(tubeness_threshold_kernel[sink_t], source, sink, sink_stride, parameter);
+def tubeness_threshold(const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  hessian_core(tubeness_threshold_kernel[sink_t], source, sink, sink_stride, parameter, processes);
                 
 
-def lambda123(source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  hessian_core(lambda123_kernel[sink_t], source, sink, sink_stride, parameter);
+def lambda123(const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  hessian_core(lambda123_kernel[sink_t], source, sink, sink_stride, parameter, processes);
 
 
-def lambda123_threshold(source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter):
-  hessian_core(lambda123_threshold_kernel[sink_t], source, sink, sink_stride, parameter);
+def lambda123_threshold(const source_t[:, :, :] source, sink_t[:, :, :, :] sink, index_t sink_stride, double[:] parameter, int processes = 1):
+  hessian_core(lambda123_threshold_kernel[sink_t], source, sink, sink_stride, parameter, processes);
 
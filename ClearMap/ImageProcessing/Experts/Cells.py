@@ -21,17 +21,15 @@ import multiprocessing
 import numpy as np
 import gc
 
-import cv2
-import scipy.ndimage.filters as ndf
-
 import ClearMap.IO.IO as clearmap_io
 
 import ClearMap.ParallelProcessing.BlockProcessing as bp
 import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
 
 import ClearMap.ImageProcessing.IlluminationCorrection as ic
-import ClearMap.ImageProcessing.Filter.StructureElement as se
+import ClearMap.ImageProcessing.BackgroundRemoval as br
 import ClearMap.ImageProcessing.Filter.FilterKernel as fk
+import ClearMap.ImageProcessing.Filter.LinearFilter as lf
 
 import ClearMap.Analysis.Measurements.maxima_detection as md
 import ClearMap.Analysis.Measurements.shape_detection as sd
@@ -71,6 +69,7 @@ default_cell_detection_parameter = dict(
 
     # cell shape detection
     shape_detection=dict(threshold=700,
+                         radius=None,
                          save=False),
 
     # cell intensity detection
@@ -101,7 +100,8 @@ See :func:`ClearMap.ParallelProcessing.BlockProcessing.process` for details."""
 ###############################################################################
                    
 def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detection_parameter,
-                 processing_parameter=default_cell_detection_processing_parameter, workspace=None):
+                 processing_parameter=default_cell_detection_processing_parameter, workspace=None,
+                 stream_results=False):
     """Cell detection pipeline.
 
     Arguments
@@ -115,9 +115,14 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
     processing_parameter : dict
         Parameter for the parallel processing.
         See :func:`ClearMap.ParallelProcessing.BlockProcessing.process` for
-        description of all the parameter.
+        description of all the parameter. If checkpoint is True, the
+        checkpoint is placed next to the sink.
     workspace: Workspace
         The optional workspace object to have a handle to cancel the multiprocess
+    stream_results : bool
+        If True and sink is a npy file name, append the cells of each block to
+        the sink in the order the blocks finish instead of merging all results
+        in memory. The cells are then not ordered by block.
 
     Returns
     -------
@@ -177,6 +182,15 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
         form : str
             The form of the structure element (e.g. 'Disk')
 
+        method : 'rectangles', 'opencv' or None
+            The method to calculate the background, see
+            :mod:`~ClearMap.ImageProcessing.BackgroundRemoval`.
+            If None, determined automatically from the structure element.
+
+        rectangles : int or None
+            If int, approximate the structure element by this many rectangles,
+            making the cost independent of its size. If None, exact.
+
         save : str or None
             Save the result of this step to the specified file if not None.
 
@@ -227,6 +241,10 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
              The std of the outer Gaussian.
              If None, determined automatically from shape.
 
+        method : 'direct', 'separable', 'fft' or None
+             The filter method, see :mod:`~ClearMap.ImageProcessing.Filter.LinearFilter`.
+             If None, determined automatically from the shapes.
+
         save : str or None
             Save the result of this step to the specified file if not None.
 
@@ -265,6 +283,12 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
             Cell shape is expanded from maxima if pixels are above this threshold
             and not closer to another maxima.
 
+        radius : float or None
+            If not None, cell shapes are restricted to this distance from their
+            maxima. Shapes are then grown by a bounded watershed and sizes and
+            intensities are measured on their voxels only, so the cost of these
+            steps scales with the number of cells instead of the block size.
+
         save : str or None
           Save the result of this step to the specified file if not None.
 
@@ -301,12 +325,8 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
     n_processes = multiprocessing.cpu_count() if processing_parameter.get('processes') is None else processing_parameter.get('processes')
     n_threads = int(multiprocessing.cpu_count() / n_processes)  # Number of threads so that * n_processes, fills CPUs
 
-    results, blocks = bp.process(detect_cells_block, source, sink=None, function_type='block', return_result=True,
-                                 return_blocks=True, parameter=cell_detection_parameter, workspace=workspace,
-                                 **{**processing_parameter, **{'n_threads': n_threads}})
-
-    # merge results
-    results = np.vstack([np.hstack(r) for r in results])
+    if processing_parameter.get('checkpoint') is True and isinstance(sink, str):  # The block results are not written to a sink
+        processing_parameter = {**processing_parameter, 'checkpoint': sink + '.checkpoint'}
 
     # create column headers  # FIXME: use pd.DataFrame instead
     header = ['x', 'y', 'z']
@@ -319,14 +339,49 @@ def detect_cells(source, sink=None, cell_detection_parameter=default_cell_detect
     dtypes += [float] * len(measures)
 
     dt = {'names': header, 'formats': dtypes}
-    cells = np.zeros(len(results), dtype=dt)
-    for i, h in enumerate(header):
-        cells[h] = results[:, i]
+
+    if stream_results and isinstance(sink, str):
+        # append the cells of each block to the sink as soon as the block finishes
+        cells_sink = clearmap_io.mmp.create_appendable(sink, dtype=dt)
+        bp.process(detect_cells_block, source, sink=None, function_type='block', return_result=True,
+                   reducer=lambda r: cells_sink.append(cells_table(np.hstack(r), dt)),
+                   parameter=cell_detection_parameter, workspace=workspace,
+                   **{**processing_parameter, **{'n_threads': n_threads}})
+        return cells_sink.as_source()
+
+    results, blocks = bp.process(detect_cells_block, source, sink=None, function_type='block', return_result=True,
+                                 return_blocks=True, parameter=cell_detection_parameter, workspace=workspace,
+                                 **{**processing_parameter, **{'n_threads': n_threads}})
+
+    # merge results
+    results = np.vstack([np.hstack(r) for r in results])
+    cells = cells_table(results, dt)
 
     # save results
     return clearmap_io.write(sink, cells)
 
 
+def cells_table(results, dtype):
+    """Convert the stacked block results into a structured cells array.
+
+    Arguments
+    ---------
+    results : array
+        The results as n x k array with one column per entry of the dtype.
+    dtype : dict
+        The structured dtype with 'names' and 'formats' of the columns.
+
+    Returns
+    -------
+    cells : array
+        The structured array of the cells.
+    """
+    cells = np.zeros(len(results), dtype=dtype)
+    for i, h in enumerate(dtype['names']):
+        cells[h] = results[:, i]
+    return cells
+
+
 def detect_cells_block(source, parameter=default_cell_detection_parameter, n_threads=None):
     """Detect cells in a Block."""
 
@@ -366,13 +421,13 @@ def detect_cells_block(source, parameter=default_cell_detection_parameter, n_thr
                           ic.correct_illumination, **default_step_params)
 
     background = wrap_step('background_correction', corrected, remove_background,
-                           remove_previous_result=True, **default_step_params)
+                           remove_previous_result=True, extra_kwargs={'processes': n_threads}, **default_step_params)
 
     equalized = wrap_step('equalization', background, equalize, remove_previous_result=True,
                           extra_kwargs={'mask': None}, **default_step_params)
 
     dog = wrap_step('dog_filter', equalized, dog_filter,  # TODO: DoG filter != .title()
-                    remove_previous_result=True, **default_step_params)
+                    remove_previous_result=True, extra_kwargs={'processes': n_threads}, **default_step_params)
 
     # Maxima detection
     parameter_maxima = parameter.get('maxima_detection')
@@ -385,7 +440,8 @@ def detect_cells_block(source, parameter=default_cell_detection_parameter, n_thr
 
     if parameter_maxima:
         valid = parameter_maxima.pop('valid', None)
-        maxima = wrap_step('maxima_detection', dog, md.find_maxima, extra_kwargs={'verbose': parameter.get('verbose')},
+        maxima = wrap_step('maxima_detection', dog, md.find_maxima,
+                           extra_kwargs={'verbose': parameter.get('verbose'), 'processes': n_threads},
                            remove_previous_result=False, **default_step_params)
         # center of maxima
         if parameter_maxima['h_max']:  # FIXME: check if source or dog
@@ -412,7 +468,11 @@ def detect_cells_block(source, parameter=default_cell_detection_parameter, n_thr
     if parameter_shape:
         # size detection
         max_label = centers.shape[0]
-        sizes = sd.find_size(shape, max_label=max_label)
+        if parameter_shape.get('radius') is not None:
+            voxels = sd.find_voxels(shape, centers, radius=parameter_shape['radius'], processes=n_threads)
+        else:
+            voxels = None
+        sizes = sd.find_size(shape, max_label=max_label, voxels=voxels)
         valid = sizes > 0
 
         results += (sizes,)
@@ -432,8 +492,8 @@ def detect_cells_block(source, parameter=default_cell_detection_parameter, n_thr
 
         for m in measure:
             if shape is not None:
-                intensity = sd.find_intensity(steps_to_measure[m], label=shape,
-                                              max_label=max_label, **parameter_intensity)
+                intensity = sd.find_intensity(steps_to_measure[m], label=shape, max_label=max_label,
+                                              voxels=voxels, **parameter_intensity)
             else:  # WARNING: prange but me.measure_expression not parallel since processes=1
                 intensity = me.measure_expression(steps_to_measure[m], centers, search_radius=r,
                                                   **parameter_intensity, processes=1, verbose=False)
@@ -461,37 +521,26 @@ def detect_cells_block(source, parameter=default_cell_detection_parameter, n_thr
 # ## Cell detection processing steps
 ###############################################################################
 
-def remove_background(source, shape, form='Disk'):
-    selem = se.structure_element(shape, form=form, ndim=2)  # FIXME: use skimage kernel
-    selem = np.array(selem).astype('uint8')
-    removed = np.empty(source.shape, dtype=source.dtype)
-    for z in range(source.shape[2]):
-        # img[:,:,z] = img[:,:,z] - grey_opening(img[:,:,z], structure=structureElement('Disk', (30,30)))
-        # img[:,:,z] = img[:,:,z] - morph.grey_opening(img[:,:,z], structure=structureElement('Disk', (150,150)))
-        removed[:, :, z] = source[:, :, z] - np.minimum(source[:, :, z],
-                                                        cv2.morphologyEx(source[:, :, z], cv2.MORPH_OPEN, selem))
-    return removed
+def remove_background(source, shape, form='Disk', method=None, rectangles=None, processes=None):
+    return br.remove_background(source, shape, form=form, method=method, rectangles=rectangles, processes=processes)
 
 
-def dog_filter(source, shape, sigma=None, sigma2=None):
+def dog_filter(source, shape, sigma=None, sigma2=None, method=None, processes=None):
     if shape is not None:
-        fdog = fk.filter_kernel(ftype='dog', shape=shape, sigma=sigma, sigma2=sigma2)
-        fdog = fdog.astype('float32')
-        filtered = ndf.correlate(source, fdog)
+        fdog = fk.separable_filter_kernel(ftype='dog', shape=shape, sigma=sigma, sigma2=sigma2)
+        filtered = lf.correlate(source, fdog, method=method, dtype='float32', processes=processes)
         filtered[filtered < 0] = 0
-        return filtered
+        return filtered.astype(source.dtype, copy=False)
     else:
         return source
 
 
 def detect_maxima(source, h_max=None, shape=5, threshold=None, verbose=False):  # FIXME: use to refactor
-    # extended maxima
-    maxima = md.find_maxima(source, h_max=h_max, shape=shape, threshold=threshold, verbose=verbose)
-
-    # center of maxima
+    # center of extended maxima
     if h_max:
-        centers = md.find_center_of_maxima(source, maxima=maxima, verbose=verbose)
+        centers = md.find_maxima_centers(source, h_max=h_max, shape=shape, threshold=threshold, verbose=verbose)
     else:
+        maxima = md.find_maxima(source, h_max=h_max, shape=shape, threshold=threshold, verbose=verbose)
         centers = ap.where(maxima).array  # FIXME: prange
 
     return centers
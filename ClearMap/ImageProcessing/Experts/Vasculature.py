@@ -15,6 +15,7 @@ __webpage__ = 'https://idisco.info'
 __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
   
 import gc
+import multiprocessing
 import tempfile as tmpf
 
 import numpy as np
@@ -28,6 +29,8 @@ import ClearMap.ParallelProcessing.BlockProcessing as bp
 import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
 
 import ClearMap.ImageProcessing.Filter.Rank as rnk
+import ClearMap.ImageProcessing.Filter.FilterKernel as fk
+import ClearMap.ImageProcessing.Filter.LinearFilter as lf
 import ClearMap.ImageProcessing.LocalStatistics as ls
 import ClearMap.ImageProcessing.LightsheetCorrection as lc
 import ClearMap.ImageProcessing.Differentiation.Hessian as hes
@@ -113,7 +116,8 @@ default_binarization_parameter = dict(
     vesselize=dict(background=dict(selem=('disk', (30, 30, 1)),
                                    percentile=0.5),
                    tubeness=dict(sigma=1.0,
-                                 gamma12=0.0),
+                                 gamma12=0.0,
+                                 dtype='float32'),
                    threshold=120,
                    save=False),
 
@@ -325,6 +329,16 @@ def binarize(source, sink=None, binarization_parameter=default_binarization_para
 
             For the vasculature a typical value is 10.
 
+        mode : 'plane' or '3d'
+            If 'plane', the Gaussian filter is applied to each plane along
+            the last axis, otherwise in 3d.
+
+        chunk_size : int or None
+            The number of planes filtered together in 'plane' mode.
+
+        processes : int or None
+            Number of threads used by the filter within each block.
+
         save : str or None
             Save the result of this step to the specified file if not None.
 
@@ -439,6 +453,16 @@ def binarize(source, sink=None, binarization_parameter=default_binarization_para
 
                 For the vasculature a typical value is 1.0.
 
+            dtype : dtype or None
+                Floating point type of the filter, 'float32' reduces the memory
+                of the smoothed data and the result by half.
+
+                For the vasculature a typical value is 'float32'.
+
+            processes : int or None
+                Number of threads used by the filter within each block.
+                If not given, the number of threads per block worker is used.
+
         save : str or None
             Save the result of this step to the specified file if not None.
 
@@ -484,13 +508,20 @@ def binarize(source, sink=None, binarization_parameter=default_binarization_para
 
     binarization_parameter.update(verbose=processing_parameter.get('verbose', False))
 
+    n_processes = processing_parameter.get('processes')
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    elif not isinstance(n_processes, int):  # serial
+        n_processes = 1
+    n_threads = max(1, multiprocessing.cpu_count() // n_processes)  # Number of threads so that * n_processes, fills CPUs
+
     bp.process(binarize_block, source, sink, function_type='block',
-               parameter=binarization_parameter, **processing_parameter)
+               parameter=binarization_parameter, **{**processing_parameter, **{'n_threads': n_threads}})
 
     return sink
 
 
-def binarize_block(source, sink, parameter=default_binarization_parameter):
+def binarize_block(source, sink, parameter=default_binarization_parameter, n_threads=None):
     """Binarize a Block."""
 
     # initialize parameter and slicings
@@ -546,12 +577,12 @@ def binarize_block(source, sink, parameter=default_binarization_parameter):
 
     # lightsheet correction
     corrected = wrap_step('lightsheet', clipped, lc.correct_lightsheet, remove_previous_result=True,
-                          extra_kwargs={'mask': mask, 'max_bin': max_bin}, **default_step_params)
+                          extra_kwargs={'mask': mask, 'max_bin': max_bin, 'processes': n_threads}, **default_step_params)
     # active arrays: corrected, mask, not_low
 
     # median filter
     median = wrap_step('median', corrected, rnk.median, remove_previous_result=True,
-                       extra_kwargs={'max_bin': max_bin, 'mask': not_low}, **default_step_params)
+                       extra_kwargs={'max_bin': max_bin, 'mask': not_low, 'processes': n_threads}, **default_step_params)
     del not_low
     # active arrays: median, mask
 
@@ -666,7 +697,7 @@ def binarize_block(source, sink, parameter=default_binarization_parameter):
             save = parameter_background.pop('save', None)
 
             equalized = np.array(equalized, dtype='uint16')
-            background = rnk.percentile(equalized, max_bin=max_bin, mask=mask, **parameter_background)
+            background = rnk.percentile(equalized, max_bin=max_bin, mask=mask, processes=n_threads, **parameter_background)
             tubeness = equalized - np.minimum(equalized, background)
 
             del background
@@ -678,7 +709,7 @@ def binarize_block(source, sink, parameter=default_binarization_parameter):
             tubeness = equalized
 
         parameter_tubeness = parameter_vesselization.get('tubeness', {})
-        tubeness = tubify(tubeness, **parameter_tubeness)
+        tubeness = tubify(tubeness, **{'processes': n_threads, **parameter_tubeness})
 
         save = parameter_vesselization.get('save')
         if save:
@@ -873,18 +904,75 @@ def clip(source, clip_range=(300, 60000), norm=MAX_BIN, dtype=DTYPE):
     return clipped, mask, high, low
 
 
-def deconvolve(source, binarized, sigma=10):
-    convolved = np.zeros(source.shape, dtype=float)
-    convolved[binarized] = source[binarized]
+def deconvolve(source, binarized, sigma=10, mode='plane', chunk_size=8, processes=None):
+    """
+    Pseudo deconvolution removing the halo around high intensity structures.
 
-    for z in range(convolved.shape[2]):
-        convolved[:, :, z] = ndi.gaussian_filter(convolved[:, :, z], sigma=sigma)
+    Arguments
+    ---------
+    source : array
+        The 3d source.
+    binarized : array
+        The binarized high intensity structures.
+    sigma : float or tuple
+        The std of the Gaussian filter modelling the halo.
+    mode : 'plane' or '3d'
+        If 'plane', filter each plane along the last axis, otherwise filter in 3d.
+    chunk_size : int or None
+        The number of planes filtered together in 'plane' mode.
+        If None, filter all planes together.
+    processes : int or None
+        Number of threads used by the filter.
+
+    Returns
+    -------
+    deconvolved : array
+        The source with the filtered high intensity structures subtracted
+        outside of them as float32 array.
+    """
+    if mode not in ('plane', '3d'):
+        raise ValueError(f"Deconvolution mode {mode} not valid, expected 'plane' or '3d'!")
+
+    # Gaussian kernel truncated as in ndi.gaussian_filter
+    sigma = np.resize(np.array(sigma, dtype=float).flatten(), 3)
+    if mode == 'plane':
+        sigma[2] = 0
+    radius = np.array(4 * sigma + 0.5, dtype=int)
+    kernel = fk.separable_filter_kernel(ftype='gaussian', shape=2 * radius + 1, sigma=np.where(sigma > 0, sigma, 1))
+
+    source = io.as_source(source)[:]
+    n_planes = source.shape[2]
+    if mode == '3d' or chunk_size is None:
+        chunk_size = n_planes
+
+    high = _scratch_buffer('high', source.shape)
+    np.multiply(source, binarized, out=high)
+
+    deconvolved = np.empty(source.shape, dtype='float32')
+    for start in range(0, n_planes, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_planes))
+        lf.correlate(high[:, :, chunk], kernel, sink=deconvolved[:, :, chunk], dtype='float32', processes=processes)
+
+    np.minimum(source, deconvolved, out=deconvolved)
+    np.subtract(source, deconvolved, out=deconvolved)
+    np.copyto(deconvolved, source, where=binarized)
 
-    deconvolved = source - np.minimum(source, convolved)
-    deconvolved[binarized] = source[binarized]
     return deconvolved
 
 
+_scratch_buffers = {}
+
+
+def _scratch_buffer(name, shape, dtype='float32', max_buffers=8):
+    """Scratch buffer reused across the blocks processed by a worker."""
+    key = (name, tuple(shape), np.dtype(dtype))
+    if key not in _scratch_buffers:
+        if len(_scratch_buffers) >= max_buffers:
+            _scratch_buffers.pop(next(iter(_scratch_buffers)))
+        _scratch_buffers[key] = np.empty(shape, dtype=dtype)
+    return _scratch_buffers[key]
+
+
 def threshold_isodata(source):
     try:
         thresholds = skif.threshold_isodata(source, return_all=True)
@@ -904,8 +992,9 @@ def threshold_adaptive(source, function=threshold_isodata, selem=(100, 100, 3),
     return threshold
 
 
-def tubify(source, sigma=1.0, gamma12=1.0, gamma23=1.0, alpha=0.25):
-    return hes.lambda123(source=source, sink=None, sigma=sigma, gamma12=gamma12, gamma23=gamma23, alpha=alpha)
+def tubify(source, sigma=1.0, gamma12=1.0, gamma23=1.0, alpha=0.25, dtype=None, processes=None):
+    return hes.lambda123(source=source, sink=None, sigma=sigma, gamma12=gamma12, gamma23=gamma23, alpha=alpha,
+                         dtype=dtype, processes=processes)
 
 
 ###############################################################################
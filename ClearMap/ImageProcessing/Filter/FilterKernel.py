@@ -361,9 +361,75 @@ def filter_kernel_3d(ftype = 'Gaussian', shape = (5,5,5), sigma = None, sigma2 =
   else:
       raise ValueError('Filter type %r not valid!' % ftype);
 
+
+###############################################################################
+### Separable filter kernel
+###############################################################################
+
+def separable_filter_kernel(ftype = 'Gaussian', shape = (5,5,5), sigma = None, sigma2 = None):
+  """Creates a separable filter kernel of a special type.
+
+  Arguments
+  ---------
+  ftype  : str
+    Filter type, one of 'mean', 'gaussian' or 'dog'.
+  shape : array or tuple
+    Shape of the filter kernel.
+  sigma : tuple or float
+    Std for the first gaussian (if applicable).
+  sigma2 : tuple or float
+    Std of a second gaussian (if present).
+
+  Returns
+  -------
+  kernel : list of tuples of arrays
+    The kernel as a sum of terms, each term a tuple of 1d kernels, one for
+    each axis, whose outer product is the term's kernel.
+
+  Note
+  ----
+  The full kernels are the ones of :func:`filter_kernel`, the difference of
+  Gaussians is the difference of two separable Gaussians.
+  """
+  ftype = ftype.lower();
+  o = se.structure_element_offsets(shape);
+  shape = np.array(shape);
+  ndim = len(shape);
+
+  add = ((shape + 1) % 2) / 2.;
+  x = [np.arange(-o[d,0], o[d,1]) + add[d] for d in range(ndim)];
+
+  def gaussian(sigma):
+    sigma = np.array(sigma, dtype=float).flatten();
+    if len(sigma) < ndim:
+      sigma = np.full(ndim, sigma[0]);
+    ker = tuple(np.exp(-xd * xd / 2. / (s * s)) for xd,s in zip(x, sigma));
+    return tuple(k / k.sum() for k in ker);
+
+  if ftype == 'mean':
+    return [tuple(np.ones(s) / s for s in shape)];
+
+  elif ftype == 'gaussian':
+    if sigma is None:
+      sigma = shape / 2. / math.sqrt(2 * math.log(2));
+    return [gaussian(sigma)];
+
+  elif ftype == 'dog':
+    if sigma2 is None:
+      sigma2 = shape / 2. / math.sqrt(2 * math.log(2));
+    sigma2 = np.array(sigma2, dtype=float).flatten();
+    if sigma is None:
+      sigma = sigma2 / 1.5;
+    sub = gaussian(sigma2);
+    return [gaussian(sigma), (-sub[0],) + sub[1:]];
+
+  else:
+    raise ValueError('Separable filter type %r not valid!' % ftype);
+
+
 ###############################################################################
 ### Tests
-############################################################################### 
+###############################################################################
 
 def _test():
     """Tests"""
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+LinearFilter
+============
+
+Linear filtering of large volumetric arrays.
+
+The correlation of an array with a kernel is done in one of three ways:
+
+=============== =========================================================
+Method          Description
+=============== =========================================================
+``direct``      direct correlation with the full kernel
+``separable``   sums of separable kernels via parallel 1d correlations
+``fft``         overlap-save correlation with blocks of fft transforms
+=============== =========================================================
+
+If no method is given, it is chosen via a cost model from the shape of the
+array and of the kernel, see :func:`filter_method`.
+
+Separable kernels, e.g. Gaussians or their differences, are created via
+:func:`~ClearMap.ImageProcessing.Filter.FilterKernel.separable_filter_kernel`.
+
+Example
+-------
+>>> import numpy as np
+>>> import ClearMap.ImageProcessing.Filter.FilterKernel as fk
+>>> import ClearMap.ImageProcessing.Filter.LinearFilter as lf
+>>> source = np.random.rand(100,100,100);
+>>> kernel = fk.separable_filter_kernel(ftype='dog', shape=(9,9,9));
+>>> filtered = lf.correlate(source, kernel);
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+
+import scipy.fft as fft
+import scipy.ndimage as ndi
+
+import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
+
+
+###############################################################################
+### Cost model
+###############################################################################
+
+direct_cost = 1.0;
+"""Relative cost of a kernel element per voxel in a direct correlation."""
+
+separable_cost = 1.7;
+"""Relative cost of a kernel element per voxel in a 1d correlation pass."""
+
+separable_pass_cost = 5.0;
+"""Relative cost per voxel of a 1d correlation pass."""
+
+fft_cost = 1.0;
+"""Relative cost per voxel and log2 of the transform size of a fft pass."""
+
+fft_block_size = 2**24;
+"""Maximal number of voxels in the blocks of the overlap-save fft correlation."""
+
+
+def filter_method(shape, kernel_shape, n_terms = None):
+  """Chooses the correlation method with the lowest estimated cost.
+
+  Arguments
+  ---------
+  shape : tuple of int
+    The shape of the array to filter.
+  kernel_shape : tuple of int
+    The shape of the kernel.
+  n_terms : int or None
+    The number of separable terms of the kernel, None if not separable.
+
+  Returns
+  -------
+  method : str
+    The method, 'direct', 'separable' or 'fft'.
+
+  Note
+  ----
+  The costs are estimated per voxel with the relative costs defined in this
+  module, measured in units of a multiply-add of a direct correlation.
+  """
+  costs = dict(direct=direct_cost * np.prod(kernel_shape));
+
+  if n_terms is not None:
+    padded = np.prod(np.array(shape) + kernel_shape - 1) / np.prod(shape);
+    costs['separable'] = n_terms * (separable_cost * np.sum(kernel_shape) + separable_pass_cost * len(shape)) * padded;
+
+  block, axes, fft_shape = _fft_blocks(shape, kernel_shape);
+  size = np.prod([block + kernel_shape[0] - 1] + list(np.array(shape[1:]) + kernel_shape[1:] - 1));
+  costs['fft'] = fft_cost * 2 * np.log2(max(np.prod(fft_shape), 2)) * size / (block * np.prod(shape[1:]));
+
+  return min(costs, key=costs.get);
+
+
+###############################################################################
+### Correlation
+###############################################################################
+
+def correlate(source, kernel, sink = None, method = None, dtype = 'float32', processes = None, verbose = False):
+  """Correlates an array with a kernel.
+
+  Arguments
+  ---------
+  source : array
+    The source array.
+  kernel : array or list of tuples of arrays
+    The kernel or a separable kernel as a sum of terms, each term a tuple of
+    1d kernels, one for each axis.
+  sink : array or None
+    The result array, if None an array of dtype is created.
+  method : 'direct', 'separable', 'fft' or None
+    The correlation method. If None, determined via :func:`filter_method`.
+  dtype : dtype
+    The dtype of the intermediate results.
+  processes : int or None
+    Number of processes to use, if None use number of cpus.
+  verbose : bool
+    If True, print progress information.
+
+  Returns
+  -------
+  sink : array
+    The correlated array.
+
+  Note
+  ----
+  The borders are reflected as in :func:`scipy.ndimage.correlate` with
+  mode 'reflect'.
+  """
+  processes, timer = ap.initialize_processing(processes=processes, verbose=verbose, function='correlate');
+
+  source = np.asarray(source);
+  separable = isinstance(kernel, (list, tuple));
+  if separable:
+    kernel = _separable_kernel(kernel);
+    kernel_shape = tuple(len(k) for k in kernel[0]);
+  else:
+    kernel = np.asarray(kernel);
+    kernel_shape = kernel.shape;
+  if len(kernel_shape) != source.ndim:
+    raise ValueError('Kernel dimension %d does not match source dimension %d!' % (len(kernel_shape), source.ndim));
+
+  if method is None:
+    method = filter_method(source.shape, kernel_shape, n_terms=len(kernel) if separable else None);
+  if method == 'separable' and not separable:
+    raise ValueError('Kernel is not separable!');
+  if method not in ('direct', 'separable', 'fft'):
+    raise ValueError("Method %r not valid, expected 'direct', 'separable' or 'fft'!" % method);
+  if method != 'separable' and separable:
+    kernel = _full_kernel(kernel);
+
+  if sink is None:
+    sink = np.zeros(source.shape, dtype=dtype);
+
+  if method == 'separable':
+    _correlate_separable(source, kernel, sink, dtype=dtype, processes=processes);
+  elif method == 'fft':
+    _correlate_fft(source, kernel, sink, dtype=dtype, processes=processes);
+  else:
+    ndi.correlate(np.asarray(source, dtype=dtype), np.asarray(kernel, dtype=dtype), output=sink, mode='reflect');
+
+  ap.finalize_processing(verbose=verbose, function='correlate (%s)' % method, timer=timer);
+
+  return sink;
+
+
+def _separable_kernel(kernel):
+  """Helper to bring the 1d kernels of all terms to a common shape."""
+  kernel = [tuple(np.asarray(k, dtype=float).flatten() for k in term) for term in kernel];
+  shape = np.max([[len(k) for k in term] for term in kernel], axis=0);
+
+  def embed(k, s):
+    embedded = np.zeros(s);
+    start = s // 2 - len(k) // 2;
+    embedded[start:start + len(k)] = k;
+    return embedded;
+
+  return [tuple(embed(k, s) for k,s in zip(term, shape)) for term in kernel];
+
+
+def _full_kernel(kernel):
+  """Helper to expand a separable kernel."""
+  full = 0;
+  for term in kernel:
+    product = np.ones(());
+    for k in term:
+      product = np.multiply.outer(product, k);
+    full = full + product;
+  return full;
+
+
+def _padding(kernel_shape):
+  """Helper to calculate the padding needed for a kernel."""
+  return [(k // 2, k - k // 2 - 1) for k in kernel_shape];
+
+
+def _correlate_separable(source, kernel, sink, dtype, processes):
+  """Correlation with a sum of separable kernels via 1d correlations."""
+  kernel_shape = tuple(len(k) for k in kernel[0]);
+  valid = tuple(slice(b, b + n) for (b,_), n in zip(_padding(kernel_shape), source.shape));
+
+  padded = np.pad(np.asarray(source, dtype=dtype), _padding(kernel_shape), mode='symmetric');
+  buffers = [np.empty(padded.shape, dtype=dtype) for _ in range(2)];
+
+  for t, term in enumerate(kernel):
+    previous = padded;
+    for axis, k in enumerate(term):
+      result = buffers[axis % 2];
+      if padded.shape[axis] > len(k):
+        ap.correlate1d(previous, k, sink=result, axis=axis, processes=processes);
+      else:
+        ndi.correlate1d(previous, k, output=result, axis=axis, mode='constant');
+      previous = result;
+
+    if t == 0:
+      sink[:] = previous[valid];
+    else:
+      sink += previous[valid];
+
+
+def _fft_blocks(shape, kernel_shape):
+  """Helper to determine the block size along the first axis, the axes to transform and the fft shape."""
+  plane = np.prod(np.array(shape[1:]) + kernel_shape[1:] - 1);
+  block = max(fft_block_size // plane - kernel_shape[0] + 1, kernel_shape[0], 1);
+  block = min(block, shape[0]);
+
+  # axes with kernels of length one are not transformed
+  axes = [d for d, k in enumerate(kernel_shape) if k > 1] or [len(shape) - 1];
+  lengths = [block] + list(shape[1:]);
+  fft_shape = [fft.next_fast_len(int(lengths[d] + kernel_shape[d] - 1), real=True) for d in axes];
+  return block, axes, fft_shape;
+
+
+def _correlate_fft(source, kernel, sink, dtype, processes):
+  """Overlap-save correlation in blocks along the first axis."""
+  kernel_shape = kernel.shape;
+  block, axes, fft_shape = _fft_blocks(source.shape, kernel_shape);
+
+  padded = np.pad(np.asarray(source, dtype=dtype), _padding(kernel_shape), mode='symmetric');
+
+  # correlation is the convolution with the flipped kernel
+  flipped = np.asarray(kernel[(slice(None, None, -1),) * kernel.ndim], dtype=dtype);
+  kernel_fft = fft.rfftn(flipped, s=fft_shape, axes=axes, workers=processes);
+
+  valid = tuple(slice(k - 1, k - 1 + n) for k, n in zip(kernel_shape[1:], source.shape[1:]));
+  for start in range(0, source.shape[0], block):
+    stop = min(start + block, source.shape[0]);
+    transformed = fft.rfftn(padded[start:stop + kernel_shape[0] - 1], s=fft_shape, axes=axes, workers=processes);
+    transformed *= kernel_fft;
+    correlated = fft.irfftn(transformed, s=fft_shape, axes=axes, workers=processes);
+    sink[start:stop] = correlated[(slice(kernel_shape[0] - 1, kernel_shape[0] - 1 + stop - start),) + valid];
+
+
+###############################################################################
+### Tests
+###############################################################################
+
+def _test():
+  import numpy as np
+  import scipy.ndimage as ndi
+  import ClearMap.ImageProcessing.Filter.FilterKernel as fk
+  import ClearMap.ImageProcessing.Filter.LinearFilter as lf
+
+  source = np.random.rand(50,60,70);
+  kernel = fk.separable_filter_kernel(ftype='dog', shape=(9,9,9));
+  full = fk.filter_kernel(ftype='dog', shape=(9,9,9));
+
+  reference = ndi.correlate(source, full);
+  for method in ['direct', 'separable', 'fft']:
+    filtered = lf.correlate(source, kernel, method=method, dtype=float);
+    assert np.allclose(filtered, reference);
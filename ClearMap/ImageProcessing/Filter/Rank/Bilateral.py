@@ -29,8 +29,8 @@ import numpy as np
 
 from . import Rank as rnk
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'BilateralCode')
 
 from . import BilateralCode as code
 
@@ -167,7 +167,7 @@ def sum_relative_bilateral(source, selem=None, sink=None, mask=None, s0=0.5, s1=
   Spatial closeness is measured by considering only the local pixel
   neighborhood given by a structuring element (selem).
 
-  Radiometric similarity is defined by the greylevel interval [g-s0, g+s1]
+  Radiometric similarity is defined by the greylevel interval [s0*g, s1*g]
   where g is the current pixel greylevel.
 
   Only pixels belonging to the structuring element AND having a greylevel
@@ -187,8 +187,8 @@ def sum_relative_bilateral(source, selem=None, sink=None, mask=None, s0=0.5, s1=
   mask : array
     Optional mask, if None, the complete source is used.
     Pixels in the mask are zero in the output.
-  s0,s1 : int
-    The lower and upper widths around the center value
+  s0,s1 : float
+    The lower and upper factors of the center value
     for the bilateral window. 
 
   Returns
@@ -196,7 +196,7 @@ def sum_relative_bilateral(source, selem=None, sink=None, mask=None, s0=0.5, s1=
   sink : array
     The filtered array.
   """
-  return rnk._apply_code(code.sum, code.sum_masked, sink_dtype = float,
+  return rnk._apply_code(code.sum_relative, code.sum_relative_masked, sink_dtype = float,
                          source=source, selem=selem, sink=sink, mask=mask, parameter_float=[s0,s1], **kwargs);
 
 
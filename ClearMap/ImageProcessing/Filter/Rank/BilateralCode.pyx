@@ -27,7 +27,7 @@ cdef extern from "stdio.h":
 ###############################################################################
 
 cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                             index_t max_bin, index_t* p, double* q) nogil:
+                             index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i
     cdef double bilat_pop = 0
     cdef double mean = 0
@@ -47,17 +47,17 @@ cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def mean(source_t[:, :, :] source, char[:, :, :] selem,
           sink_t[:, :, :, :] sink, 
-          index_t max_bin, index_t[:] p, double[:] q):
+          index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_mean[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                  char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -65,7 +65,7 @@ def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ############################################################################### 
 
 cdef inline void kernel_pop(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                             index_t max_bin, index_t* p, double* q) nogil:
+                             index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i
     cdef double bilat_pop = 0
 
@@ -80,17 +80,17 @@ cdef inline void kernel_pop(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def pop(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_pop[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def pop_masked(source_t[:, :, :] source, char[:, :, :] selem,
                  char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_pop[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -98,7 +98,7 @@ def pop_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i, s, e
     cdef double bilat_pop = 0
     cdef double sum = 0
@@ -117,17 +117,17 @@ cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def sum(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sum[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_sum[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -135,7 +135,7 @@ def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sum_relative(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i, s, e
     cdef double bilat_pop = 0
     cdef double sum = 0
@@ -156,19 +156,19 @@ cdef inline void kernel_sum_relative(sink_t* sink, index_t* histo, index_t pop,
       sink[0] = <sink_t>0
 
 
-def sum_realtive(source_t[:, :, :] source, char[:, :, :] selem,
+def sum_relative(source_t[:, :, :] source, char[:, :, :] selem,
                  sink_t[:, :, :, :] sink, 
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sum_relative[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
-def sum_relaive_masked(source_t[:, :, :] source, char[:, :, :] selem,
-                       char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                       index_t max_bin, index_t[:] p, double[:] q):
+def sum_relative_masked(source_t[:, :, :] source, char[:, :, :] selem,
+                        char[:, :, :] mask, sink_t[:, :, :, :] sink,
+                        index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_sum_relative[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -176,9 +176,9 @@ def sum_relaive_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_mean_scale(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                   index_t max_bin, index_t* p, double* q) nogil:
+                                   index_t max_bin, index_t* p, double* q) noexcept nogil:
 
-    cdef index_t i, s = 0, e = 0, imax
+    cdef index_t i, s = 0, e = 0, imax = 0
     cdef double bilat_pop = 0
     cdef double mean = 0
 
@@ -208,14 +208,14 @@ cdef inline void kernel_mean_scale(sink_t* sink, index_t* histo, index_t pop, so
 
 def mean_scale(source_t[:, :, :] source, char[:, :, :] selem,
                 sink_t[:, :, :, :] sink, 
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_mean_scale[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def mean_scale_masked(source_t[:, :, :] source, char[:, :, :] selem,
                  char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_mean_scale[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
@@ -15,8 +15,8 @@ import numpy as np
 
 from . import Rank as rnk
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'ParametricCode')
 
 from . import ParametricCode as code
 
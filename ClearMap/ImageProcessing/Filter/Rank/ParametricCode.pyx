@@ -26,7 +26,7 @@ cdef extern from "stdio.h":
 ###############################################################################
 
 cdef inline void kernel_nilblack(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i, max_i
     cdef double sigma = 0.0
     cdef double mu = 0.0
@@ -48,17 +48,17 @@ cdef inline void kernel_nilblack(sink_t* sink, index_t* histo, index_t pop, sour
 
 def nilblack(source_t[:, :, :] source, char[:, :, :] selem,
                sink_t[:, :, :, :] sink, 
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_nilblack[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def nilblack_masked(source_t[:, :, :] source, char[:, :, :] selem,
                       char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                      index_t max_bin, index_t[:] p, double[:] q):
+                      index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_nilblack[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -66,7 +66,7 @@ def nilblack_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sauvola(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i, max_i
     cdef double sigma = 0.0
     cdef double mu = 0.0
@@ -88,17 +88,17 @@ cdef inline void kernel_sauvola(sink_t* sink, index_t* histo, index_t pop, sourc
 
 def sauvola(source_t[:, :, :] source, char[:, :, :] selem,
              sink_t[:, :, :, :] sink, 
-             index_t max_bin, index_t[:] p, double[:] q):
+             index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sauvola[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def sauvola_masked(source_t[:, :, :] source, char[:, :, :] selem,
                     char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                    index_t max_bin, index_t[:] p, double[:] q):
+                    index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
   
   rank_core_masked(kernel_sauvola[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 
@@ -108,7 +108,7 @@ def sauvola_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_clp_index(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t clip_limit = p[0];                   
     cdef index_t* clip_histo = &p[1];
@@ -166,7 +166,7 @@ cdef inline void kernel_clp_index(sink_t* sink, index_t* histo, index_t pop, sou
 
 
 cdef inline void kernel_clp(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef double clip_limit = q[1];                   
     cdef double* clip_histo = &q[2];
@@ -210,17 +210,17 @@ cdef inline void kernel_clp(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def clp(source_t[:, :, :] source, char[:, :, :] selem,
                       sink_t[:, :, :, :] sink, 
-                      index_t max_bin, index_t[:] p, double[:] q):
+                      index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_clp[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def clp_masked(source_t[:, :, :] source, char[:, :, :] selem,
                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_clp[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 
@@ -230,7 +230,7 @@ def clp_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_lsac(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                             index_t max_bin, index_t* p, double* q) nogil:
+                             index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t clip_limit = p[0];                   
     cdef index_t* clip_histo = &p[1];
@@ -335,17 +335,17 @@ cdef inline void kernel_lsac(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def lsac(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_lsac[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def lsac_masked(source_t[:, :, :] source, char[:, :, :] selem,
                 char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_lsac[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 
@@ -355,7 +355,7 @@ def lsac_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ################################################################################
 #
 #cdef inline void kernel_max_slope(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-#                             index_t max_bin, index_t* p, double* q) nogil:
+#                             index_t max_bin, index_t* p, double* q) noexcept nogil:
 #
 #    cdef index_t clip_limit = p[0];                   
 #    cdef index_t* clip_histo = &p[1];
@@ -460,15 +460,15 @@ def lsac_masked(source_t[:, :, :] source, char[:, :, :] selem,
 #
 #def lsac(source_t[:, :, :] source, char[:, :, :] selem,
 #         sink_t[:, :, :, :] sink, 
-#         index_t max_bin, index_t[:] p, double[:] q):
+#         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 #
 #  rank_core(kernel_lsac[sink_t, index_t, source_t], source, selem,
-#            sink, max_bin, p, q)
+#            sink, max_bin, p, q, processes)
 #
 #def lsac_masked(source_t[:, :, :] source, char[:, :, :] selem,
 #                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-#                index_t max_bin, index_t[:] p, double[:] q):
+#                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 #
 #  rank_core_masked(kernel_lsac[sink_t, index_t, source_t], source, selem, 
-#                   mask, sink, max_bin, p, q)
+#                   mask, sink, max_bin, p, q, processes)
 
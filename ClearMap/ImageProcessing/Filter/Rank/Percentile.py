@@ -24,8 +24,8 @@ import numpy as np
 
 from . import Rank as rnk
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'PercentileCode')
 
 from . import PercentileCode as code
 
@@ -126,7 +126,7 @@ def mean_percentile(source, selem=None, sink=None, mask=None, percentiles=(0,1),
     The filtered array.
   """
   return rnk._apply_code(code.mean, code.mean_masked, sink_dtype = float,
-                         source=source, selem=selem, sink=sink, mask=mask, parameter_float=percentiles **kwargs);
+                         source=source, selem=selem, sink=sink, mask=mask, parameter_float=percentiles, **kwargs);
 
 
 
@@ -158,7 +158,7 @@ def subtract_mean_percentile(source, selem=None, sink=None, mask=None, percentil
     The filtered array.
   """
   return rnk._apply_code(code.subtract_mean, code.subtract_mean_masked,
-                         source=source, selem=selem, sink=sink, mask=mask, parameter_float=percentiles **kwargs);
+                         source=source, selem=selem, sink=sink, mask=mask, parameter_float=percentiles, **kwargs);
 
 
 
@@ -17,12 +17,13 @@ cimport numpy as cnp
 from libc.math cimport sqrt
 
 from ClearMap.ImageProcessing.Filter.Rank.RankCoreCode cimport index_t, sink_t, source_t, rank_core, rank_core_masked
+from ClearMap.ImageProcessing.Filter.Rank.RankCoreCode cimport histogram_highest, histogram_rank
 
 
-cdef inline source_t _max(source_t a, source_t b) nogil:
+cdef inline source_t _max(source_t a, source_t b) noexcept nogil:
   return a if a >= b else b
 
-cdef inline source_t _min(source_t a, source_t b) nogil:
+cdef inline source_t _min(source_t a, source_t b) noexcept nogil:
   return a if a <= b else b
 
 
@@ -31,14 +32,14 @@ cdef inline source_t _min(source_t a, source_t b) nogil:
 ###############################################################################
 
 cdef inline void kernel_autolevel(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                  index_t max_bin, index_t* p, double* q) nogil:
+                                  index_t max_bin, index_t* p, double* q) noexcept nogil:
 
-    cdef index_t i, imin, imax, sum, 
-    cdef double delta
+    cdef index_t i, imin, imax, sum
+    cdef double delta, q1
 
     if pop:
         sum = 0
-        q[1] = 1.0 - q[1]
+        q1 = 1.0 - q[1]
         for i in range(max_bin):
             sum += histo[i]
             if sum > q[0] * pop:
@@ -47,7 +48,7 @@ cdef inline void kernel_autolevel(sink_t* sink, index_t* histo, index_t pop, sou
         sum = 0
         for i in range(max_bin - 1, -1, -1):
             sum += histo[i]
-            if sum > q[1] * pop:
+            if sum > q1 * pop:
                 imax = i
                 break
 
@@ -63,17 +64,17 @@ cdef inline void kernel_autolevel(sink_t* sink, index_t* histo, index_t pop, sou
 
 def autolevel(source_t[:, :, :] source, char[:, :, :] selem,
                sink_t[:, :, :, :] sink, 
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_autolevel[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def autolevel_masked(source_t[:, :, :] source, char[:, :, :] selem,
                       char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                      index_t max_bin, index_t[:] p, double[:] q):
+                      index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_autolevel[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -81,13 +82,14 @@ def autolevel_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_gradient(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t i, imin, imax, sum, delta
+    cdef double q1
 
     if pop:
         sum = 0
-        q[1] = 1.0 - q[1]
+        q1 = 1.0 - q[1]
         for i in range(max_bin):
             sum += histo[i]
             if sum >= q[0] * pop:
@@ -96,7 +98,7 @@ cdef inline void kernel_gradient(sink_t* sink, index_t* histo, index_t pop, sour
         sum = 0
         for i in range(max_bin - 1, -1, -1):
             sum += histo[i]
-            if sum >= q[1] * pop:
+            if sum >= q1 * pop:
                 imax = i
                 break
 
@@ -107,17 +109,17 @@ cdef inline void kernel_gradient(sink_t* sink, index_t* histo, index_t pop, sour
 
 def gradient(source_t[:, :, :] source, char[:, :, :] selem,
                sink_t[:, :, :, :] sink, 
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_gradient[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def gradient_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_gradient[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -125,7 +127,7 @@ def gradient_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                             index_t max_bin, index_t* p, double* q) nogil:
+                             index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t i, sum, mean, n
 
@@ -149,17 +151,17 @@ cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def mean(source_t[:, :, :] source, char[:, :, :] selem,
           sink_t[:, :, :, :] sink, 
-          index_t max_bin, index_t[:] p, double[:] q):
+          index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_mean[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                  char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -167,7 +169,7 @@ def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t i, n
     cdef double sum, sum_g
 
@@ -191,17 +193,17 @@ cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def sum(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sum[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
                 char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_sum[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -209,7 +211,7 @@ def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sum_above(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
     cdef index_t n, i, i_high
     cdef double sum, sum_high
     #cdef double p0 = q[0] * pop;
@@ -232,17 +234,17 @@ cdef inline void kernel_sum_above(sink_t* sink, index_t* histo, index_t pop, sou
 
 def sum_above(source_t[:, :, :] source, char[:, :, :] selem,
               sink_t[:, :, :, :] sink, 
-              index_t max_bin, index_t[:] p, double[:] q):
+              index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sum_above[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def sum_above_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_sum_above[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 
@@ -251,7 +253,7 @@ def sum_above_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_subtract_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                      index_t max_bin, index_t* p, double* q) nogil:
+                                      index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t i, sum, n
   cdef double mean
 
@@ -275,17 +277,17 @@ cdef inline void kernel_subtract_mean(sink_t* sink, index_t* histo, index_t pop,
 
 def subtract_mean(source_t[:, :, :] source, char[:, :, :] selem,
                sink_t[:, :, :, :] sink, 
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_subtract_mean[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def subtract_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                           char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                          index_t max_bin, index_t[:] p, double[:] q):
+                          index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_subtract_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -293,13 +295,14 @@ def subtract_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_enhance_contrast(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                         index_t max_bin, index_t* p, double* q) nogil:
+                                         index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t i, imin, imax, sum, delta
+    cdef double q1
 
     if pop:
         sum = 0
-        q[1] = 1.0 - q[1]
+        q1 = 1.0 - q[1]
         for i in range(max_bin):
             sum += histo[i]
             if sum > q[0] * pop:
@@ -308,7 +311,7 @@ cdef inline void kernel_enhance_contrast(sink_t* sink, index_t* histo, index_t p
         sum = 0
         for i in range(max_bin - 1, -1, -1):
             sum += histo[i]
-            if sum > q[1] * pop:
+            if sum > q1 * pop:
                 imax = i
                 break
         if g > imax:
@@ -325,17 +328,17 @@ cdef inline void kernel_enhance_contrast(sink_t* sink, index_t* histo, index_t p
 
 def enhance_contrast(source_t[:, :, :] source, char[:, :, :] selem,
                       sink_t[:, :, :, :] sink, 
-                      index_t max_bin, index_t[:] p, double[:] q):
+                      index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_enhance_contrast[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def enhance_contrast_masked(source_t[:, :, :] source, char[:, :, :] selem,
                              char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                             index_t max_bin, index_t[:] p, double[:] q):
+                             index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_enhance_contrast[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -343,22 +346,15 @@ def enhance_contrast_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_percentile(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                   index_t max_bin, index_t* p, double* q) nogil:
+                                   index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t i
-    cdef index_t sum = 0
-    cdef double percentile = q[0] * pop;
     
     if pop:
         if q[0] == 1:  # make sure q[0] = 1 returns the maximum filter
-            for i in range(max_bin - 1, -1, -1):
-                if histo[i]:
-                    break
+            i = histogram_highest(histo, max_bin)
         else:
-            for i in range(max_bin):
-                sum += histo[i]
-                if sum >= percentile:
-                    break
+            i = histogram_rank(histo, max_bin, q[0] * pop, False)
         sink[0] = <sink_t>i
     else:
         sink[0] = <sink_t>0
@@ -367,24 +363,24 @@ cdef inline void kernel_percentile(sink_t* sink, index_t* histo, index_t pop, so
 
 def percentile(source_t[:, :, :] source, char[:, :, :] selem,
                       sink_t[:, :, :, :] sink, 
-                      index_t max_bin, index_t[:] p, double[:] q):
+                      index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_percentile[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def percentile_masked(source_t[:, :, :] source, char[:, :, :] selem,
                              char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                             index_t max_bin, index_t[:] p, double[:] q):
+                             index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_percentile[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 ###############################################################################
 ### Autolevel
 ###############################################################################
 
 cdef inline void kernel_pop(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                            index_t max_bin, index_t* p, double* q) nogil:
+                            index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef index_t i, sum, n
 
@@ -402,24 +398,24 @@ cdef inline void kernel_pop(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def pop(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_pop[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def pop_masked(source_t[:, :, :] source, char[:, :, :] selem,
                 char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_pop[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 ###############################################################################
 ### Autolevel
 ###############################################################################
 
 cdef inline void kernel_threshold(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                  index_t max_bin, index_t* p, double* q) nogil:
+                                  index_t max_bin, index_t* p, double* q) noexcept nogil:
 
     cdef int i
     cdef index_t sum = 0
@@ -437,17 +433,17 @@ cdef inline void kernel_threshold(sink_t* sink, index_t* histo, index_t pop, sou
 
 def threshold(source_t[:, :, :] source, char[:, :, :] selem,
                sink_t[:, :, :, :] sink, 
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_threshold[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def threshold_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_threshold[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 
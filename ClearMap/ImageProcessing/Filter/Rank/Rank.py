@@ -32,6 +32,12 @@ This implementation outperforms grey.dilation for large structuring elements.
 Input image can be 8-bit or 16-bit, for 16-bit input images, the number of
 histogram bins is determined from the maximum value present in the image.
 
+Histograms with more than 4096 bins, e.g. for 16-bit images, maintain an 
+additional coarse histogram of about sqrt(max_bin) bins in the style of [2]_,
+so that rank queries such as the median, percentiles, minimum and maximum 
+cost O(sqrt(max_bin)) instead of O(max_bin) per pixel. Filters that use the 
+full histogram (e.g. mean or entropy) still scan all bins.
+
 Result image is 8-/16-bit or double with respect to the input image and the
 rank filter operation.
 
@@ -42,6 +48,9 @@ References
 .. [1] Huang, T. ,Yang, G. ;  Tang, G.. "A fast two-dimensional
        median filtering algorithm", IEEE Transactions on Acoustics, Speech and
        Signal Processing, Feb 1979. Volume: 27 , Issue: 1, Page(s): 13 - 18.
+.. [2] Perreault, S., Hebert, P.. "Median Filtering in Constant Time", 
+       IEEE Transactions on Image Processing, Sept 2007. Volume: 16, 
+       Issue: 9, Page(s): 2389 - 2394.
 
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
@@ -52,15 +61,12 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 __note__      = "Code adpated to 3D images from skimage.filters.rank"
 
 
-import warnings
 import numpy as np
 
 import ClearMap.IO.IO as io
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, 
-                  reload_support=True,
-                  language_level=3)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'RankCode', 'RankCoreCode')
 
 from . import RankCode as code
 
@@ -670,8 +676,14 @@ def _initialize_selem(selem, ndim):
 def _apply_code(function, function_mask, source, selem = None, 
                 sink = None, sink_dtype = None, sink_shape_per_pixel = None, 
                 mask = None, max_bin = None,  
-                parameter_index = None, parameter_float = None):
-  """Helper to apply code."""
+                parameter_index = None, parameter_float = None, processes = None):
+  """Helper to apply code.
+  
+  Note
+  ----
+  If processes > 1, the rank filter is computed in parallel in slabs along 
+  the last axis with identical results. If None, the filter runs serially.
+  """
   selem = _initialize_selem(selem, source.ndim)
   
   if source.ndim > 3:
@@ -729,10 +741,6 @@ def _apply_code(function, function_mask, source, selem = None,
   if max_bin >= 2**16:
     raise ValueError('The histograms are to large for this code to be efficient!');
 
-  bitdepth = int(np.log2(max_bin))
-  if bitdepth > 12:
-    warnings.warn("Bitdepth of %d may result in bad rank filter performance." % bitdepth);
-
   if parameter_index is None:
     parameter_index = np.zeros(0, dtype = int);
   parameter_index = np.asarray([parameter_index], dtype = int).flatten();
@@ -743,10 +751,13 @@ def _apply_code(function, function_mask, source, selem = None,
   
   #print(source.__class__, source.dtype, s.__class__, s.dtype, selem.dtype, mask.dtype, max_bin)                           
                               
+  if processes is None:
+    processes = 1;
+  
   if mask is None:
-    function(source=source, selem=selem, sink=s, max_bin=max_bin, p=parameter_index, q=parameter_float);
+    function(source=source, selem=selem, sink=s, max_bin=max_bin, p=parameter_index, q=parameter_float, processes=processes);
   else:
-    function_mask(source=source, selem=selem, mask=mask, sink=s, max_bin=max_bin, p=parameter_index, q=parameter_float);
+    function_mask(source=source, selem=selem, mask=mask, sink=s, max_bin=max_bin, p=parameter_index, q=parameter_float, processes=processes);
   
   if len(shape_remove) > 0:
     shape = tuple(s for d,s in enumerate(sink.shape) if d not in shape_remove);
@@ -809,4 +820,52 @@ def _test():
     plt.imshow(res);
     plt.title(f);
     
-  plt.tight_layout()  
\ No newline at end of file
+  plt.tight_layout()  
+
+
+def _benchmark(shape = (100, 100, 50), selem = (5, 5, 5), bitdepths = (8, 12, 16), processes = None):
+  """Benchmark single versus two-level histograms for median and percentile filters.
+  
+  Arguments
+  ---------
+  shape : tuple
+    Shape of the random test image.
+  selem : tuple
+    Shape of the structure element.
+  bitdepths : tuple of int
+    Bit depths of the random test images.
+  processes : int or None
+    Number of processes passed to the filters.
+  
+  Returns
+  -------
+  timings : dict
+    The timings in seconds for each (filter, bitdepth, histogram) with 
+    histogram either 'single' or 'two-level'.
+  """
+  import time
+  import functools as ft
+  import ClearMap.ImageProcessing.Filter.Rank.RankCoreCode as core
+  import ClearMap.ImageProcessing.Filter.Rank.Percentile as per
+  
+  filters = dict(median=median, percentile=ft.partial(per.percentile, percentile=0.75));
+  timings = {};
+  for bitdepth in bitdepths:
+    max_bin = 2**bitdepth - 1;
+    data = np.random.randint(0, max_bin + 1, size=shape).astype('uint16');
+    for name, f in filters.items():
+      results = {};
+      for histogram, wide_max_bin in [('single', None), ('two-level', 1)]:
+        previous = core.set_wide_histogram_max_bin(wide_max_bin);
+        try:
+          start = time.time();
+          results[histogram] = f(data, selem=selem, max_bin=max_bin, processes=processes);
+          timings[(name, bitdepth, histogram)] = time.time() - start;
+        finally:
+          core.set_wide_histogram_max_bin(previous);
+      if not np.array_equal(results['single'], results['two-level']):
+        raise RuntimeError('Results of the %s filter differ for %d bits!' % (name, bitdepth));
+      print('%s %2d bits: single %.3fs, two-level %.3fs' % 
+            ((name, bitdepth) + tuple(timings[(name, bitdepth, h)] for h in ('single', 'two-level'))));
+  
+  return timings;
@@ -16,8 +16,9 @@ cimport numpy as np
 from libc.math cimport log, exp, sqrt
 
 from ClearMap.ImageProcessing.Filter.Rank.RankCoreCode cimport index_t, sink_t, source_t, rank_core, rank_core_masked
+from ClearMap.ImageProcessing.Filter.Rank.RankCoreCode cimport histogram_lowest, histogram_highest, histogram_rank
 
-cdef inline int round(double r) nogil:
+cdef inline int round(double r) noexcept nogil:
   return <int>((r + 0.5) if (r > 0.0) else (r - 0.5))
 
 
@@ -26,19 +27,13 @@ cdef inline int round(double r) nogil:
 ###############################################################################
 
 cdef inline void kernel_autolevel(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                  index_t max_bin, index_t* p, double* q) nogil:
-  cdef index_t i, imin, imax
+                                  index_t max_bin, index_t* p, double* q) noexcept nogil:
+  cdef index_t imin, imax
   cdef double delta
 
   if pop:
-    for i in range(max_bin - 1, -1, -1):
-      if histo[i]:
-        imax = i
-        break
-    for i in range(max_bin):
-      if histo[i]:
-        imin = i
-        break
+    imax = histogram_highest(histo, max_bin)
+    imin = histogram_lowest(histo, max_bin)
     delta = <double>(imax - imin)
     if delta > 0:
       sink[0] = <sink_t>(((max_bin - 1) * (g - imin)) / delta)
@@ -49,17 +44,17 @@ cdef inline void kernel_autolevel(sink_t* sink, index_t* histo, index_t pop, sou
 
 def autolevel(source_t[:, :, :] source, char[:, :, :] selem,
               sink_t[:, :, :, :] sink, 
-              index_t max_bin, index_t[:] p, double[:] q):
+              index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_autolevel[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def autolevel_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_autolevel[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -67,31 +62,26 @@ def autolevel_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_bottomhat(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                  index_t max_bin, index_t* p, double* q) nogil:   
-  cdef index_t i
-
+                                  index_t max_bin, index_t* p, double* q) noexcept nogil:   
   if pop:
-    for i in range(max_bin):
-      if histo[i]:
-        break
-    sink[0] = <sink_t>(g - i)
+    sink[0] = <sink_t>(g - histogram_lowest(histo, max_bin))
   else:
     sink[0] = <sink_t>0
 
 
 def bottomhat(source_t[:, :, :] source, char[:, :, :] selem,
               sink_t[:, :, :, :] sink, 
-              index_t max_bin, index_t[:] p, double[:] q):
+              index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_bottomhat[sink_t, index_t, source_t], source, selem, 
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def bottomhat_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_bottomhat[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -99,7 +89,7 @@ def bottomhat_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_equalize(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t i
   cdef double total = 0
 
@@ -115,17 +105,17 @@ cdef inline void kernel_equalize(sink_t* sink, index_t* histo, index_t pop, sour
 
 def equalize(source_t[:, :, :] source, char[:, :, :] selem,
              sink_t[:, :, :, :] sink, 
-             index_t max_bin, index_t[:] p, double[:] q):
+             index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_equalize[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def equalize_masked(source_t[:, :, :] source, char[:, :, :] selem,
                     char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                    index_t max_bin, index_t[:] p, double[:] q):
+                    index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_equalize[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -133,19 +123,13 @@ def equalize_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_gradient(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                 index_t max_bin, index_t* p, double* q) nogil:
+                                 index_t max_bin, index_t* p, double* q) noexcept nogil:
 
-  cdef index_t i, imin, imax
+  cdef index_t imin, imax
 
   if pop:
-    for i in range(max_bin - 1, -1, -1):
-      if histo[i]:
-        imax = i
-        break
-    for i in range(max_bin):
-      if histo[i]:
-        imin = i
-        break
+    imax = histogram_highest(histo, max_bin)
+    imin = histogram_lowest(histo, max_bin)
     sink[0] = <sink_t>(imax - imin)
   else:
     sink[0] = <sink_t>0
@@ -153,17 +137,17 @@ cdef inline void kernel_gradient(sink_t* sink, index_t* histo, index_t pop, sour
 
 def gradient(source_t[:, :, :] source, char[:, :, :] selem,
              sink_t[:, :, :, :] sink, 
-             index_t max_bin, index_t[:] p, double[:] q):
+             index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_gradient[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def gradient_masked(source_t[:, :, :] source, char[:, :, :] selem,
                     char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                    index_t max_bin, index_t[:] p, double[:] q):
+                    index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_gradient[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -171,7 +155,7 @@ def gradient_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                             index_t max_bin, index_t* p, double* q) nogil:
+                             index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef double mean = 0
@@ -186,17 +170,17 @@ cdef inline void kernel_mean(sink_t* sink, index_t* histo, index_t pop, source_t
 
 def mean(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_mean[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                 char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -204,7 +188,7 @@ def mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_geometric_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                       index_t max_bin, index_t* p, double* q) nogil:
+                                       index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef double mean = 0.
@@ -220,17 +204,17 @@ cdef inline void kernel_geometric_mean(sink_t* sink, index_t* histo, index_t pop
 
 def geometric_mean(source_t[:, :, :] source, char[:, :, :] selem,
                    sink_t[:, :, :, :] sink, 
-                   index_t max_bin, index_t[:] p, double[:] q):
+                   index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_geometric_mean[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def geometric_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                           char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                          index_t max_bin, index_t[:] p, double[:] q):
+                          index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_geometric_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -238,7 +222,7 @@ def geometric_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_subtract_mean(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                      index_t max_bin, index_t* p, double* q) nogil:
+                                      index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef double mean = 0
@@ -253,17 +237,17 @@ cdef inline void kernel_subtract_mean(sink_t* sink, index_t* histo, index_t pop,
 
 def subtract_mean(source_t[:, :, :] source, char[:, :, :] selem,
                   sink_t[:, :, :, :] sink, 
-                  index_t max_bin, index_t[:] p, double[:] q):
+                  index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_subtract_mean[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def subtract_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
                          char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                         index_t max_bin, index_t[:] p, double[:] q):
+                         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_subtract_mean[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -271,35 +255,27 @@ def subtract_mean_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_median(sink_t* sink, index_t* histo, index_t pop, 
-                               source_t g, index_t max_bin, index_t* p, double* q) nogil:
-
-  cdef index_t i
-  cdef double total = pop / 2.0
+                               source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   if pop:
-    for i in range(max_bin):
-      if histo[i]:
-        total -= histo[i]
-        if total < 0:
-          sink[0] = <sink_t>i
-          return
+    sink[0] = <sink_t>histogram_rank(histo, max_bin, pop / 2.0, True)
   else:
     sink[0] = <sink_t>0
 
 
 def median(source_t[:, :, :] source, char[:, :, :] selem,
            sink_t[:, :, :, :] sink, 
-           index_t max_bin, index_t[:] p, double[:] q):
+           index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_median[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def median_masked(source_t[:, :, :] source, char[:, :, :] selem,
                   char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                  index_t max_bin, index_t[:] p, double[:] q):
+                  index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_median[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -307,32 +283,27 @@ def median_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_maximum(sink_t* sink, index_t* histo, index_t pop, source_t g, 
-                                index_t max_bin, index_t* p, double* q) nogil:
-
-  cdef index_t i
+                                index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   if pop:
-    for i in range(max_bin - 1, -1, -1):
-      if histo[i]:
-        sink[0] = <sink_t>i
-        return
+    sink[0] = <sink_t>histogram_highest(histo, max_bin)
   else:
     sink[0] = <sink_t>0
 
 
 def maximum(source_t[:, :, :] source, char[:, :, :] selem,
             sink_t[:, :, :, :] sink, 
-            index_t max_bin, index_t[:] p, double[:] q):
+            index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_maximum[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def maximum_masked(source_t[:, :, :] source, char[:, :, :] selem,
                    char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                   index_t max_bin, index_t[:] p, double[:] q):
+                   index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_maximum[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -340,32 +311,27 @@ def maximum_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_minimum(sink_t* sink, index_t* histo, index_t pop, 
-                                source_t g, index_t max_bin, index_t* p, double* q) nogil:
-
-  cdef index_t i
+                                source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   if pop:
-    for i in range(max_bin):
-      if histo[i]:
-        sink[0] = <sink_t>i
-        return
+    sink[0] = <sink_t>histogram_lowest(histo, max_bin)
   else:
     sink[0] = <sink_t>0
 
 
 def minimum(source_t[:, :, :] source, char[:, :, :] selem,
             sink_t[:, :, :, :] sink, 
-            index_t max_bin, index_t[:] p, double[:] q):
+            index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_minimum[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def minimum_masked(source_t[:, :, :] source, char[:, :, :] selem,
                    char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                   index_t max_bin, index_t[:] p, double[:] q):
+                   index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_minimum[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -373,19 +339,11 @@ def minimum_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_minmax(sink_t* sink, index_t* histo, index_t pop, 
-                               source_t g, index_t max_bin, index_t* p, double* q) nogil:
-
-  cdef index_t i
+                               source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   if pop:
-    for i in range(max_bin):
-      if histo[i]:
-        sink[0] = <sink_t>i
-        break
-    for i in range(max_bin - 1, -1, -1):
-      if histo[i]:
-        sink[1] = <sink_t>i
-        return
+    sink[0] = <sink_t>histogram_lowest(histo, max_bin)
+    sink[1] = <sink_t>histogram_highest(histo, max_bin)
   else:
     sink[0] = <sink_t>0
     sink[1] = <sink_t>0
@@ -393,17 +351,17 @@ cdef inline void kernel_minmax(sink_t* sink, index_t* histo, index_t pop,
 
 def minmax(source_t[:, :, :] source, char[:, :, :] selem,
            sink_t[:, :, :, :] sink, 
-           index_t max_bin, index_t[:] p, double[:] q):
+           index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_minmax[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def minmax_masked(source_t[:, :, :] source, char[:, :, :] selem,
                   char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                  index_t max_bin, index_t[:] p, double[:] q):
+                  index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_minmax[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -411,7 +369,7 @@ def minmax_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_modal(sink_t* sink, index_t* histo, index_t pop, 
-                              source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                              source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t hmax = 0, imax = 0
 
@@ -427,17 +385,17 @@ cdef inline void kernel_modal(sink_t* sink, index_t* histo, index_t pop,
 
 def modal(source_t[:, :, :] source, char[:, :, :] selem,
           sink_t[:, :, :, :] sink, 
-          index_t max_bin, index_t[:] p, double[:] q):
+          index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_modal[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def modal_masked(source_t[:, :, :] source, char[:, :, :] selem,
                  char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_modal[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -445,7 +403,7 @@ def modal_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_enhance_contrast(sink_t* sink, index_t* histo, index_t pop, 
-                                         source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                                         source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i, imin, imax
 
@@ -468,17 +426,17 @@ cdef inline void kernel_enhance_contrast(sink_t* sink, index_t* histo, index_t p
 
 def enhance_contrast(source_t[:, :, :] source, char[:, :, :] selem,
                      sink_t[:, :, :, :] sink, 
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_enhance_contrast[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def enhance_contrast_masked(source_t[:, :, :] source, char[:, :, :] selem,
                             char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                            index_t max_bin, index_t[:] p, double[:] q):
+                            index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_enhance_contrast[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -486,24 +444,24 @@ def enhance_contrast_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_pop(sink_t* sink, index_t* histo, index_t pop, 
-                            source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                            source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   sink[0] = <sink_t>pop
 
 
 def pop(source_t[:, :, :] source, char[:, :, :] selem,
         sink_t[:, :, :, :] sink, 
-        index_t max_bin, index_t[:] p, double[:] q):
+        index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_pop[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def pop_masked(source_t[:, :, :] source, char[:, :, :] selem,
                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_pop[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -511,7 +469,7 @@ def pop_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop, 
-                            source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                            source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef index_t total = 0
@@ -525,17 +483,17 @@ cdef inline void kernel_sum(sink_t* sink, index_t* histo, index_t pop,
 
 def sum(source_t[:, :, :] source, char[:, :, :] selem,
         sink_t[:, :, :, :] sink, 
-        index_t max_bin, index_t[:] p, double[:] q):
+        index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_sum[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
   
   rank_core_masked(kernel_sum[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -543,7 +501,7 @@ def sum_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_threshold(sink_t* sink, index_t* histo, index_t pop, 
-                                  source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                                  source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef double mean = 0
@@ -558,17 +516,17 @@ cdef inline void kernel_threshold(sink_t* sink, index_t* histo, index_t pop,
 
 def threshold(source_t[:, :, :] source, char[:, :, :] selem,
               sink_t[:, :, :, :] sink, 
-              index_t max_bin, index_t[:] p, double[:] q):
+              index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_threshold[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def threshold_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_threshold[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -576,32 +534,27 @@ def threshold_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_tophat(sink_t* sink, index_t* histo, index_t pop, 
-                               source_t g, index_t max_bin, index_t* p, double* q) nogil:
-
-  cdef index_t i
+                               source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   if pop:
-    for i in range(max_bin - 1, -1, -1):
-      if histo[i]:
-        break
-    sink[0] = <sink_t>(i - g)
+    sink[0] = <sink_t>(histogram_highest(histo, max_bin) - g)
   else:
     sink[0] = <sink_t>0
 
 
 def tophat(source_t[:, :, :] source, char[:, :, :] selem,
            sink_t[:, :, :, :] sink, 
-           index_t max_bin, index_t[:] p, double[:] q):
+           index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_tophat[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def tophat_masked(source_t[:, :, :] source, char[:, :, :] selem,
                   char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                  index_t max_bin, index_t[:] p, double[:] q):
+                  index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_tophat[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -609,7 +562,7 @@ def tophat_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_noise_filter(sink_t* sink, index_t* histo, index_t pop, 
-                                     source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                                     source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
 
   cdef index_t i
   cdef index_t min_i
@@ -633,17 +586,17 @@ cdef inline void kernel_noise_filter(sink_t* sink, index_t* histo, index_t pop,
 
 def noise_filter(source_t[:, :, :] source, char[:, :, :] selem,
                  sink_t[:, :, :, :] sink, 
-                 index_t max_bin, index_t[:] p, double[:] q):
+                 index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_noise_filter[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def noise_filter_masked(source_t[:, :, :] source, char[:, :, :] selem,
                         char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                        index_t max_bin, index_t[:] p, double[:] q):
+                        index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_noise_filter[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -651,7 +604,7 @@ def noise_filter_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_entropy(sink_t* sink, index_t* histo, index_t pop, 
-                                source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                                source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t i
   cdef double e, pp
 
@@ -667,17 +620,17 @@ cdef inline void kernel_entropy(sink_t* sink, index_t* histo, index_t pop,
 
 def entropy(source_t[:, :, :] source, char[:, :, :] selem,
             sink_t[:, :, :, :] sink, 
-            index_t max_bin, index_t[:] p, double[:] q):
+            index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_entropy[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def entropy_masked(source_t[:, :, :] source, char[:, :, :] selem,
                    char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                   index_t max_bin, index_t[:] p, double[:] q):
+                   index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_entropy[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -685,7 +638,7 @@ def entropy_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_otsu(sink_t* sink, index_t* histo, index_t pop, 
-                             source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                             source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t i
   cdef index_t max_i
   cdef double P, mu1, mu2, q1, new_q1, sigma_b, max_sigma_b
@@ -722,17 +675,17 @@ cdef inline void kernel_otsu(sink_t* sink, index_t* histo, index_t pop,
 
 def otsu(source_t[:, :, :] source, char[:, :, :] selem,
          sink_t[:, :, :, :] sink, 
-         index_t max_bin, index_t[:] p, double[:] q):
+         index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_otsu[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def otsu_masked(source_t[:, :, :] source, char[:, :, :] selem,
                 char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                index_t max_bin, index_t[:] p, double[:] q):
+                index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_otsu[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -740,7 +693,7 @@ def otsu_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_std(sink_t* sink, index_t* histo, index_t pop, 
-                            source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                            source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t i
   cdef index_t max_i
   cdef double sigma = 0.0
@@ -763,17 +716,17 @@ cdef inline void kernel_std(sink_t* sink, index_t* histo, index_t pop,
 
 def std(source_t[:, :, :] source, char[:, :, :] selem,
         sink_t[:, :, :, :] sink, 
-        index_t max_bin, index_t[:] p, double[:] q):
+        index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_std[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def std_masked(source_t[:, :, :] source, char[:, :, :] selem,
                char[:, :, :] mask, sink_t[:, :, :, :] sink,
-               index_t max_bin, index_t[:] p, double[:] q):
+               index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_std[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
 
 ###############################################################################
@@ -781,7 +734,7 @@ def std_masked(source_t[:, :, :] source, char[:, :, :] selem,
 ###############################################################################
 
 cdef inline void kernel_histogram(sink_t* sink, index_t* histo, index_t pop, 
-                                  source_t g, index_t max_bin, index_t* p, double* q) nogil:
+                                  source_t g, index_t max_bin, index_t* p, double* q) noexcept nogil:
   cdef index_t odepth = p[0];    
   cdef index_t i
   cdef index_t max_i
@@ -797,15 +750,15 @@ cdef inline void kernel_histogram(sink_t* sink, index_t* histo, index_t pop,
 
 def histogram(source_t[:, :, :] source, char[:, :, :] selem,
               sink_t[:, :, :, :] sink, 
-              index_t max_bin, index_t[:] p, double[:] q):
+              index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core(kernel_histogram[sink_t, index_t, source_t], source, selem,
-            sink, max_bin, p, q)
+            sink, max_bin, p, q, processes)
 
 def histogram_masked(source_t[:, :, :] source, char[:, :, :] selem,
                      char[:, :, :] mask, sink_t[:, :, :, :] sink,
-                     index_t max_bin, index_t[:] p, double[:] q):
+                     index_t max_bin, index_t[:] p, double[:] q, int processes = 1):
 
   rank_core_masked(kernel_histogram[sink_t, index_t, source_t], source, selem, 
-                   mask, sink, max_bin, p, q)
+                   mask, sink, max_bin, p, q, processes)
 
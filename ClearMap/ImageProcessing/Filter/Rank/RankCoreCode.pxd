@@ -5,6 +5,12 @@ RankCordeCode
 =============
 
 Cython definitions for the core rank filter code.
+
+Histograms passed to the kernels are preceded by two header entries: 
+histo[-1] is the bit shift from fine to coarse bins and histo[-2] the offset 
+of the coarse histogram from histo. A shift of zero indicates a single level 
+histogram. The helpers below use the coarse level if present so that rank 
+queries on wide (e.g. 16 bit) histograms cost O(sqrt(max_bin)).
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE.txt)'
@@ -29,13 +35,92 @@ ctypedef fused index_t:
     Py_ssize_t
 
 
-cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) nogil,
+cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
                     source_t[:, :, :] image, char[:, :, :] selem,
                     sink_t[:, :, :, :] sink, index_t max_bin,
-                    index_t[:] parameter_index, double[:] parameter_double) except *
+                    index_t[:] parameter_index, double[:] parameter_double,
+                    int processes) except *
 
 
-cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) nogil,
+cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
                            source_t[:, :, :] source, char[:, :, :] selem, char[:,:,:] mask,
                            sink_t[:, :, :, :] sink, index_t max_bin,
-                           index_t[:] parameter_index, double[:] parameter_double) except *
\ No newline at end of file
+                           index_t[:] parameter_index, double[:] parameter_double,
+                    int processes) except *
+
+###############################################################################
+### Histogram queries
+###############################################################################
+
+cdef inline index_t histogram_lowest(index_t* histo, index_t max_bin) noexcept nogil:
+  """Lowest non-empty bin of the histogram or -1 if empty."""
+  cdef index_t shift = histo[-1]
+  cdef index_t* coarse = histo + histo[-2]
+  cdef index_t c, i, i_end
+  
+  if shift == 0:
+    for i in range(max_bin):
+      if histo[i]:
+        return i
+    return -1
+  
+  for c in range((max_bin >> shift) + 1):
+    if coarse[c]:
+      i_end = (c + 1) << shift
+      if i_end > max_bin:
+        i_end = max_bin
+      for i in range(c << shift, i_end):
+        if histo[i]:
+          return i
+  return -1
+
+
+cdef inline index_t histogram_highest(index_t* histo, index_t max_bin) noexcept nogil:
+  """Highest non-empty bin of the histogram or -1 if empty."""
+  cdef index_t shift = histo[-1]
+  cdef index_t* coarse = histo + histo[-2]
+  cdef index_t c, i, i_end
+  
+  if shift == 0:
+    for i in range(max_bin - 1, -1, -1):
+      if histo[i]:
+        return i
+    return -1
+  
+  for c in range(max_bin >> shift, -1, -1):
+    if coarse[c]:
+      i_end = (c + 1) << shift
+      if i_end > max_bin:
+        i_end = max_bin
+      for i in range(i_end - 1, (c << shift) - 1, -1):
+        if histo[i]:
+          return i
+  return -1
+
+
+cdef inline index_t histogram_rank(index_t* histo, index_t max_bin, double rank, bint strict) noexcept nogil:
+  """First bin at which the cumulative histogram exceeds (strict) or reaches the rank, max_bin - 1 if none."""
+  cdef index_t shift = histo[-1]
+  cdef index_t* coarse = histo + histo[-2]
+  cdef index_t c, i, i_end
+  cdef double total = 0
+  
+  if shift == 0:
+    for i in range(max_bin):
+      total += histo[i]
+      if total > rank or (not strict and total == rank):
+        return i
+    return max_bin - 1
+  
+  for c in range((max_bin >> shift) + 1):
+    if total + coarse[c] > rank or (not strict and total + coarse[c] == rank):
+      i_end = (c + 1) << shift
+      if i_end > max_bin:
+        i_end = max_bin
+      for i in range(c << shift, i_end):
+        total += histo[i]
+        if total > rank or (not strict and total == rank):
+          return i
+      return max_bin - 1
+    total += coarse[c]
+  return max_bin - 1
@@ -19,6 +19,7 @@ import numpy as np
 
 cimport numpy as cnp
 from libc.stdlib cimport malloc, free
+from cython.parallel import prange
 
 from . cimport RankCoreCode
 
@@ -26,36 +27,82 @@ cdef extern from "stdio.h":
   int printf(char *format, ...) nogil
 
 
-cdef inline source_t _max(source_t a, source_t b) nogil:
+cdef inline source_t _max(source_t a, source_t b) noexcept nogil:
   return a if a >= b else b
 
-cdef inline source_t _min(source_t a, source_t b) nogil:
+cdef inline source_t _min(source_t a, source_t b) noexcept nogil:
   return a if a <= b else b
 
 
-cdef inline void histogram_increment(index_t* histo, index_t* pop, source_t value) nogil:
+###############################################################################
+### Histograms
+###############################################################################
+
+cdef Py_ssize_t wide_histogram_max_bin = 4096
+
+def set_wide_histogram_max_bin(max_bin = 4096):
+  """Set the histogram size above which two-level histograms are used.
+  
+  Arguments
+  ---------
+  max_bin : int or None
+    Histograms with more bins use an additional coarse level of about 
+    sqrt(max_bin) bins. If None, only single level histograms are used.
+  
+  Returns
+  -------
+  max_bin : int
+    The previous value.
+  """
+  global wide_histogram_max_bin
+  previous = wide_histogram_max_bin
+  wide_histogram_max_bin = max_bin if max_bin is not None else 2**62
+  return previous
+
+
+cdef inline index_t histogram_shift(index_t max_bin) noexcept nogil:
+  """Bit shift from fine to coarse bins for a histogram of size max_bin."""
+  cdef index_t shift = 0
+  if max_bin > wide_histogram_max_bin:
+    while (<index_t>1 << (2 * shift)) < max_bin + 1:
+      shift += 1
+  return shift
+
+
+cdef inline void histogram_increment(index_t* histo, index_t* pop, source_t value) noexcept nogil:
   histo[value] += 1
+  if histo[-1]:
+    histo[histo[-2] + (value >> histo[-1])] += 1
   pop[0] += 1
 
-cdef inline void histogram_decrement(index_t* histo, index_t* pop, source_t value) nogil:
+cdef inline void histogram_decrement(index_t* histo, index_t* pop, source_t value) noexcept nogil:
   histo[value] -= 1
+  if histo[-1]:
+    histo[histo[-2] + (value >> histo[-1])] -= 1
   pop[0] -= 1
 
 
 cdef inline char is_in_source(index_t nx, index_t ny, index_t nz, 
-                             index_t x,  index_t y,  index_t z) nogil:
+                             index_t x,  index_t y,  index_t z) noexcept nogil:
   if x < 0 or x > nx - 1 or y < 0 or y > ny - 1 or z < 0 or z > nz - 1:
     return 0;
   else:
     return 1;
 
 
-cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) nogil,
-                    source_t[:, :, :] source, char[:, :, :] selem,
-                    sink_t[:, :, :, :] sink,
-                    index_t max_bin, index_t[:] parameter_index, double[:] parameter_double) except *:
-  """Compute histogram for each pixel, azzly kernel function to calculate sinkput."""
-
+cdef void rank_core_slab(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
+                         source_t[:, :, :] source, char[:, :, :] selem,
+                         sink_t[:, :, :, :] sink, index_t max_bin, index_t* par_index, double* par_double,
+                         index_t* se_e_x, index_t* se_e_y, index_t* se_e_z, 
+                         index_t* se_w_x, index_t* se_w_y, index_t* se_w_z, 
+                         index_t* se_n_x, index_t* se_n_y, index_t* se_n_z, 
+                         index_t* se_s_x, index_t* se_s_y, index_t* se_s_z, 
+                         index_t* se_u_x, index_t* se_u_y, index_t* se_u_z, 
+                         index_t* se_d_x, index_t* se_d_y, index_t* se_d_z,
+                         index_t num_se_e, index_t num_se_w, index_t num_se_n, index_t num_se_s, index_t num_se_u, index_t num_se_d,
+                         index_t z_start, index_t z_end) noexcept nogil:
+  """Compute histograms along the snake path through the slab z_start <= z < z_end."""
+  
   cdef index_t nx = source.shape[0]
   cdef index_t ny = source.shape[1]
   cdef index_t nz = source.shape[2]
@@ -63,23 +110,196 @@ cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, i
   cdef index_t snx = selem.shape[0]
   cdef index_t sny = selem.shape[1]
   cdef index_t snz = selem.shape[2]
-  cdef index_t max_se  = snx * sny * snz
 
   cdef index_t scx = <index_t>(selem.shape[0] / 2)
   cdef index_t scy = <index_t>(selem.shape[1] / 2) 
   cdef index_t scz = <index_t>(selem.shape[2] / 2)
   
   #local variables
-  cdef index_t i, xx, yy, zz
+  cdef index_t i, s, xx, yy, zz
   cdef index_t x, y, z, dir_x, dir_y, mode
 
   #number of pixels in heighbourhood
   cdef index_t pop = 0
 
-  # the cuxxent local histogram distribution
-  cdef index_t* histo = <index_t*>malloc(max_bin * sizeof(index_t))
-  for i in range(max_bin):
-    histo[i] = 0
+  # the cuxxent local histogram distribution, see RankCoreCode.pxd for the layout
+  cdef index_t shift = histogram_shift(max_bin)
+  cdef index_t n_bins = max_bin + 1 + ((max_bin >> shift) + 1 if shift > 0 else 0)
+  cdef index_t* histo_buffer = <index_t*>malloc((n_bins + 2) * sizeof(index_t))
+  cdef index_t* histo = histo_buffer + 2
+  for i in range(n_bins + 2):
+    histo_buffer[i] = 0
+  histo[-1] = shift
+  histo[-2] = max_bin + 1
+  
+  # create historgram, including the pixels of the neighbouring slabs
+  for x in range(snx):
+    for y in range(sny):
+      for z in range(snz):
+        xx = x - scx
+        yy = y - scy
+        zz = z_start + z - scz
+        if selem[x, y, z]:
+          if is_in_source(nx, ny, nz, xx, yy, zz):
+            histogram_increment(histo, &pop, source[xx, yy, zz])
+            #printf('hist adding (%d,%d,%d) [%d]\n', xx, yy, zz, source[xx,yy,zz]);    
+  x = 0
+  y = 0
+  z = z_start;
+  kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
+
+  # main loop
+  dir_x = 1;
+  dir_y = 1;
+  mode = 0; # modes 0 r+=1, 1 r-=1, 2 c+=1, 3 c-=1, 4 p+=1
+    
+  while True:
+    #printf('-----\n');          
+    
+    if dir_x == 1 and x < nx - 1:
+      x += 1;
+      mode = 0;
+    elif dir_x == -1 and x > 0:
+      x -= 1;
+      mode = 1;
+    else:
+      if dir_y == 1 and y < ny - 1:
+        y += 1;
+        dir_x *= -1;
+        mode = 2;
+      elif dir_y == -1 and y > 0:
+        y -= 1;
+        dir_x *= -1;
+        mode = 3;
+      else:
+        z += 1
+        if z == z_end:
+          break;
+        dir_x *= -1;
+        dir_y *= -1;
+        mode = 4;
+
+    if mode == 0:
+      for s in range(num_se_e):
+        xx = x + se_e_x[s]
+        yy = y + se_e_y[s]
+        zz = z + se_e_z[s]
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_increment(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+
+      for s in range(num_se_w):
+        xx = x + se_w_x[s] - 1
+        yy = y + se_w_y[s] 
+        zz = z + se_w_z[s]
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_decrement(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+    
+    elif mode == 1:
+      for s in range(num_se_w):
+        xx = x + se_w_x[s]
+        yy = y + se_w_y[s]
+        zz = z + se_w_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_increment(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+      
+      for s in range(num_se_e):
+        xx = x + se_e_x[s] + 1
+        yy = y + se_e_y[s]
+        zz = z + se_e_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_decrement(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+
+    elif mode == 2:
+      for s in range(num_se_n):
+        xx = x + se_n_x[s]
+        yy = y + se_n_y[s]
+        zz = z + se_n_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_increment(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+
+      for s in range(num_se_s):
+        xx = x + se_s_x[s] 
+        yy = y + se_s_y[s] - 1
+        zz = z + se_s_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_decrement(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+    
+    elif mode == 3:
+      for s in range(num_se_s):
+        xx = x + se_s_x[s]
+        yy = y + se_s_y[s]
+        zz = z + se_s_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_increment(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+
+      for s in range(num_se_n):
+        xx = x + se_n_x[s] 
+        yy = y + se_n_y[s] + 1
+        zz = z + se_n_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_decrement(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+    
+    elif mode == 4:
+      for s in range(num_se_u):
+        xx = x + se_u_x[s]
+        yy = y + se_u_y[s]
+        zz = z + se_u_z[s] 
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_increment(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+
+      for s in range(num_se_d):
+        xx = x + se_d_x[s]
+        yy = y + se_d_y[s]
+        zz = z + se_d_z[s] - 1
+        if is_in_source(nx, ny, nz, xx, yy, zz):
+          histogram_decrement(histo, &pop, source[xx, yy, zz])
+          #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
+    
+    kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
+  #while True
+  
+  free(histo_buffer)
+
+
+cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
+                    source_t[:, :, :] source, char[:, :, :] selem,
+                    sink_t[:, :, :, :] sink,
+                    index_t max_bin, index_t[:] parameter_index, double[:] parameter_double,
+                    int processes) except *:
+  """Compute histogram for each pixel, azzly kernel function to calculate sinkput.
+  
+  Note
+  ----
+  With processes > 1 the image is split into slabs along the last axis that 
+  are traversed in parallel, each with its own histogram initialized from the 
+  neighbouring slabs. The result is identical to the serial traversal.
+  """
+
+  cdef index_t nx = source.shape[0]
+  cdef index_t ny = source.shape[1]
+  cdef index_t nz = source.shape[2]
+  
+  cdef index_t snx = selem.shape[0]
+  cdef index_t sny = selem.shape[1]
+  cdef index_t snz = selem.shape[2]
+  cdef index_t max_se  = snx * sny * snz
+
+  cdef index_t scx = <index_t>(selem.shape[0] / 2)
+  cdef index_t scy = <index_t>(selem.shape[1] / 2) 
+  cdef index_t scz = <index_t>(selem.shape[2] / 2)
+  
+  #local variables
+  cdef index_t x, y, z, k
+  cdef index_t n_slabs = nz if nz < processes else processes
 
   # attack borders 
   cdef index_t num_se_n, num_se_s, num_se_e, num_se_w, num_se_d, num_se_u
@@ -173,140 +393,21 @@ cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, i
               se_d_z[num_se_d] = z - scz  
               num_se_d += 1
     
-    # create historgram
-    for x in range(snx):
-      for y in range(sny):
-        for z in range(snz):
-          xx = x - scx
-          yy = y - scy
-          zz = z - scz
-          if selem[x, y, z]:
-            if is_in_source(nx, ny, nz, xx, yy, zz):
-              histogram_increment(histo, &pop, source[xx, yy, zz])
-              #printf('hist adding (%d,%d,%d) [%d]\n', xx, yy, zz, source[xx,yy,zz]);    
-    x = 0
-    y = 0
-    z = 0;
-    kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
-
-    # main loop
-    dir_x = 1;
-    dir_y = 1;
-    mode = 0; # modes 0 r+=1, 1 r-=1, 2 c+=1, 3 c-=1, 4 p+=1
-      
-    while True:
-      #printf('-----\n');          
-      
-      if dir_x == 1 and x < nx - 1:
-        x += 1;
-        mode = 0;
-      elif dir_x == -1 and x > 0:
-        x -= 1;
-        mode = 1;
-      else:
-        if dir_y == 1 and y < ny - 1:
-          y += 1;
-          dir_x *= -1;
-          mode = 2;
-        elif dir_y == -1 and y > 0:
-          y -= 1;
-          dir_x *= -1;
-          mode = 3;
-        else:
-          z += 1
-          if z == nz:
-            break;
-          dir_x *= -1;
-          dir_y *= -1;
-          mode = 4;
-
-      if mode == 0:
-        for s in range(num_se_e):
-          xx = x + se_e_x[s]
-          yy = y + se_e_y[s]
-          zz = z + se_e_z[s]
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_increment(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-
-        for s in range(num_se_w):
-          xx = x + se_w_x[s] - 1
-          yy = y + se_w_y[s] 
-          zz = z + se_w_z[s]
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_decrement(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-      
-      elif mode == 1:
-        for s in range(num_se_w):
-          xx = x + se_w_x[s]
-          yy = y + se_w_y[s]
-          zz = z + se_w_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_increment(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-        
-        for s in range(num_se_e):
-          xx = x + se_e_x[s] + 1
-          yy = y + se_e_y[s]
-          zz = z + se_e_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_decrement(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-
-      elif mode == 2:
-        for s in range(num_se_n):
-          xx = x + se_n_x[s]
-          yy = y + se_n_y[s]
-          zz = z + se_n_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_increment(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-
-        for s in range(num_se_s):
-          xx = x + se_s_x[s] 
-          yy = y + se_s_y[s] - 1
-          zz = z + se_s_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_decrement(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-      
-      elif mode == 3:
-        for s in range(num_se_s):
-          xx = x + se_s_x[s]
-          yy = y + se_s_y[s]
-          zz = z + se_s_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_increment(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-
-        for s in range(num_se_n):
-          xx = x + se_n_x[s] 
-          yy = y + se_n_y[s] + 1
-          zz = z + se_n_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_decrement(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-      
-      elif mode == 4:
-        for s in range(num_se_u):
-          xx = x + se_u_x[s]
-          yy = y + se_u_y[s]
-          zz = z + se_u_z[s] 
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_increment(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d adding (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-
-        for s in range(num_se_d):
-          xx = x + se_d_x[s]
-          yy = y + se_d_y[s]
-          zz = z + se_d_z[s] - 1
-          if is_in_source(nx, ny, nz, xx, yy, zz):
-            histogram_decrement(histo, &pop, source[xx, yy, zz])
-            #printf('mode %d removing (%d,%d,%d) [%d]\n', mode, xx, yy, zz, source[xx,yy,zz]);
-      
-      kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
-    #while True
+    if n_slabs <= 1:
+      rank_core_slab(kernel, source, selem, sink, max_bin, par_index, par_double, 
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     0, nz)
+    else:
+      for k in prange(n_slabs, num_threads=n_slabs, schedule='static', chunksize=1):
+        rank_core_slab(kernel, source, selem, sink, max_bin, par_index, par_double, 
+                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                       (k * nz) / n_slabs, ((k + 1) * nz) / n_slabs)
   #with nogil
         
   # release memory allocated by malloc
@@ -333,22 +434,20 @@ cdef void rank_core(void kernel(sink_t*, index_t*, index_t, source_t, index_t, i
   free(se_d_x)
   free(se_d_y)
   free(se_d_z)
-  
-  free(histo)
 
 
 
 
 
 cdef inline char is_in_masked_source(index_t nx, index_t ny, index_t nz, 
-                                     index_t x,  index_t y,  index_t z, char[:,:,:] mask) nogil:
+                                     index_t x,  index_t y,  index_t z, char[:,:,:] mask) noexcept nogil:
   if x < 0 or x > nx - 1 or y < 0 or y > ny - 1 or z < 0 or z > nz - 1:
     return 0;
   else:
     return mask[x,y,z];
 
 
-cdef inline void move(index_t nx, index_t ny, index_t nz, index_t* x, index_t* y, index_t* z, index_t* dir_x, index_t* dir_y, index_t* mode, index_t* done) nogil:
+cdef inline void move(index_t nx, index_t ny, index_t nz, index_t* x, index_t* y, index_t* z, index_t* dir_x, index_t* dir_y, index_t* mode, index_t* done) noexcept nogil:
   if dir_x[0] == 1 and x[0] < nx - 1:
     x[0] += 1;
     mode[0] = 0;
@@ -381,7 +480,7 @@ cdef inline void move_histo(index_t nx, index_t ny, index_t nz, index_t x, index
                             index_t* se_u_x, index_t* se_u_y, index_t* se_u_z, 
                             index_t* se_d_x, index_t* se_d_y, index_t* se_d_z,
                             index_t num_se_e, index_t num_se_w, index_t num_se_n, index_t num_se_s, index_t num_se_u, index_t num_se_d,
-                            index_t* histo, index_t* pop, source_t[:, :, :] source, char[:,:,:] mask) nogil:
+                            index_t* histo, index_t* pop, source_t[:, :, :] source, char[:,:,:] mask) noexcept nogil:
       cdef index_t xx,yy,zz,s
   
       if mode == 0:
@@ -471,27 +570,18 @@ cdef inline void move_histo(index_t nx, index_t ny, index_t nz, index_t x, index
 
 
 
-cdef inline void clean_up(index_t* se_e_x, index_t* se_e_y, index_t* se_e_z, 
-                          index_t* se_w_x, index_t* se_w_y, index_t* se_w_z, 
-                          index_t* se_n_x, index_t* se_n_y, index_t* se_n_z, 
-                          index_t* se_s_x, index_t* se_s_y, index_t* se_s_z, 
-                          index_t* se_u_x, index_t* se_u_y, index_t* se_u_z, 
-                          index_t* se_d_x, index_t* se_d_y, index_t* se_d_z, index_t* histo) nogil:
-  # release memory allocated by malloc
-  free(se_e_x); free(se_e_y); free(se_e_z);  
-  free(se_w_x); free(se_w_y); free(se_w_z); 
-  free(se_n_x); free(se_n_y); free(se_n_z); 
-  free(se_s_x); free(se_s_y); free(se_s_z)
-  free(se_u_x); free(se_u_y); free(se_u_z)        
-  free(se_d_x); free(se_d_y); free(se_d_z) 
-  free(histo)
-
-
-cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) nogil,
-                           source_t[:, :, :] source, char[:, :, :] selem, char[:,:,:] mask,
-                           sink_t[:, :, :, :] sink, index_t max_bin,
-                           index_t[:] parameter_index, double[:] parameter_double) except *:
-  """Compute histogram for each pixel, azzly kernel function to calculate sinkput."""
+cdef void rank_core_masked_slab(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
+                                source_t[:, :, :] source, char[:, :, :] selem, char[:,:,:] mask,
+                                sink_t[:, :, :, :] sink, index_t max_bin, index_t* par_index, double* par_double,
+                                index_t* se_e_x, index_t* se_e_y, index_t* se_e_z, 
+                                index_t* se_w_x, index_t* se_w_y, index_t* se_w_z, 
+                                index_t* se_n_x, index_t* se_n_y, index_t* se_n_z, 
+                                index_t* se_s_x, index_t* se_s_y, index_t* se_s_z, 
+                                index_t* se_u_x, index_t* se_u_y, index_t* se_u_z, 
+                                index_t* se_d_x, index_t* se_d_y, index_t* se_d_z,
+                                index_t num_se_e, index_t num_se_w, index_t num_se_n, index_t num_se_s, index_t num_se_u, index_t num_se_d,
+                                index_t z_start, index_t z_end) noexcept nogil:
+  """Compute histograms along the masked snake path through the slab z_start <= z < z_end."""
 
   cdef index_t nx = source.shape[0]
   cdef index_t ny = source.shape[1]
@@ -500,7 +590,6 @@ cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, ind
   cdef index_t snx = selem.shape[0]
   cdef index_t sny = selem.shape[1]
   cdef index_t snz = selem.shape[2]
-  cdef index_t max_se  = snx * sny * snz
 
   cdef index_t scx = <index_t>(selem.shape[0] / 2) 
   cdef index_t scy = <index_t>(selem.shape[1] / 2)
@@ -515,10 +604,181 @@ cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, ind
   # number of pixels in heighbourhood
   cdef index_t pop = 0
 
-  # the cuxxent local histogram distribution
-  cdef index_t* histo = <index_t*>malloc(max_bin * sizeof(index_t))
-  for i in range(max_bin):
-    histo[i] = 0
+  # the cuxxent local histogram distribution, see RankCoreCode.pxd for the layout
+  cdef index_t shift = histogram_shift(max_bin)
+  cdef index_t n_bins = max_bin + 1 + ((max_bin >> shift) + 1 if shift > 0 else 0)
+  cdef index_t* histo_buffer = <index_t*>malloc((n_bins + 2) * sizeof(index_t))
+  cdef index_t* histo = histo_buffer + 2
+  for i in range(n_bins + 2):
+    histo_buffer[i] = 0
+  histo[-1] = shift
+  histo[-2] = max_bin + 1
+
+  
+  # move to first non masked pixel of the slab
+  x = 0
+  y = 0
+  z = z_start; 
+  
+  dir_x = 1;
+  dir_y = 1;
+  mode = 0;  # modes 0 x+=1, 1 x-=1, 2 y+=1, 3 y-=1, 4 z+=1
+  done = 0; 
+  while not is_in_masked_source(nx, ny, nz, x, y, z, mask):
+    move(nx, ny, z_end, &x, &y, &z, &dir_x, &dir_y, &mode, &done); 
+    if done:
+      free(histo_buffer);
+      return;
+  #printf('x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x,dir_y,mode);    
+  
+  # create historgram
+  for xp in range(snx):
+    for yp in range(sny):
+      for zp in range(snz):
+        if selem[xp, yp, zp]:
+          xx = x + xp - scx;
+          yy = y + yp - scy;
+          zz = z + zp - scz;
+          if is_in_masked_source(nx, ny, nz, xx, yy, zz, mask):
+            histogram_increment(histo, &pop, source[xx, yy, zz])
+            #printf('hist adding (%d,%d,%d) [%d]\n', xx, yy, zz, source[xx,yy,zz]); 
+  
+  kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
+
+  # main loop 
+  while True:
+    xp = x; yp = y; zp = z; # save previous positions
+    move(nx, ny, z_end, &x, &y, &z, &dir_x, &dir_y, &mode, &done);
+    if done:
+      free(histo_buffer);
+      return;
+    #printf('main move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode);    
+    #printf('pop=%d\n', pop);
+    
+    #move to next valid 
+    if not is_in_masked_source(nx,ny,nz,x,y,z,mask):
+      x,xp = xp,x; y,yp = yp,y; z,zp = zp,z;
+      dir_xp = dir_x; dir_yp = dir_y;
+      modep = mode; donep = done;
+      while not is_in_masked_source(nx,ny,nz,xp,yp,zp,mask):
+        move(nx, ny, z_end, &xp, &yp, &zp, &dir_xp, &dir_yp, &modep, &donep);
+        if donep:
+          free(histo_buffer);
+          return;
+      #printf('masked move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', xp,yp,zp,dir_xp, dir_yp, modep);    
+ 
+      
+      #move to next valid coordinate via shortest path -> speed up for a object surrounded by background 
+      d = xp - x;
+      if d > 0:
+        for i in range(d):
+          mode = 0; 
+          x += 1;
+          move_histo(nx, ny, nz, x, y, z, mode,
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, 
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     histo, &pop, source, mask);
+
+      elif d < 0:
+        for i in range(-d):
+          mode = 1; 
+          x -= 1;
+          move_histo(nx, ny, nz, x, y, z, mode,
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     histo, &pop, source, mask);
+
+      
+      d = yp - y;
+      if d > 0:
+        for i in range(d):
+          mode = 2; 
+          y += 1;
+          move_histo(nx, ny, nz, x, y, z, mode,
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     histo, &pop, source, mask);
+
+      elif d < 0:
+        for i in range(-d):
+          mode = 3; 
+          y -= 1;
+          move_histo(nx, ny, nz, x, y, z, mode,
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     histo, &pop, source, mask);
+
+
+      d = zp - z;
+      if d > 0:
+        for i in range(d):
+          mode = 4; 
+          z += 1;
+          move_histo(nx, ny, nz, x, y, z, mode,
+                     se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                     se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                     se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                     num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                     histo, &pop, source, mask);
+
+    
+      dir_x = dir_xp; dir_y = dir_yp; mode = modep;
+      #printf('after masked move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode); 
+      #printf('pop=%d\n', pop)
+    
+    else: #if is_in_masked_source
+      move_histo(nx, ny, nz, x, y, z, mode,
+                 se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                 se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                 se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                 num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                 histo, &pop, source, mask);
+    
+    #printf('after main move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode); 
+    #printf('pop=%d\n', pop) 
+    
+    kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
+  #while True
+  
+  free(histo_buffer)
+
+
+cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, index_t, index_t*, double*) noexcept nogil,
+                           source_t[:, :, :] source, char[:, :, :] selem, char[:,:,:] mask,
+                           sink_t[:, :, :, :] sink, index_t max_bin,
+                           index_t[:] parameter_index, double[:] parameter_double,
+                           int processes) except *:
+  """Compute histogram for each pixel, azzly kernel function to calculate sinkput.
+  
+  Note
+  ----
+  See :func:`rank_core` for the parallel processing in slabs.
+  """
+
+  cdef index_t nx = source.shape[0]
+  cdef index_t ny = source.shape[1]
+  cdef index_t nz = source.shape[2]
+  
+  cdef index_t snx = selem.shape[0]
+  cdef index_t sny = selem.shape[1]
+  cdef index_t snz = selem.shape[2]
+  cdef index_t max_se  = snx * sny * snz
+
+  cdef index_t scx = <index_t>(selem.shape[0] / 2) 
+  cdef index_t scy = <index_t>(selem.shape[1] / 2)
+  cdef index_t scz = <index_t>(selem.shape[2] / 2)
+
+  # define local variable types
+  cdef index_t x, y, z, k
+  cdef index_t n_slabs = nz if nz < processes else processes
 
   # these lists contain the relative pixel row and column for each of the 6
   # attack borders east, west, north and ssinkh, 
@@ -622,138 +882,26 @@ cdef void rank_core_masked(void kernel(sink_t*, index_t*, index_t, source_t, ind
     #  printf('se_w = (%d,%d,%d)\n' , se_w_x[i], se_w_y[i], se_w_z[i]);
 
     
-    # move to first non masked pixel
-    x = 0
-    y = 0
-    z = 0; 
-    
-    dir_x = 1;
-    dir_y = 1;
-    mode = 0;  # modes 0 x+=1, 1 x-=1, 2 y+=1, 3 y-=1, 4 z+=1
-    done = 0; 
-    while not is_in_masked_source(nx, ny, nz, x, y, z, mask):
-      move(nx, ny, nz, &x, &y, &z, &dir_x, &dir_y, &mode, &done); 
-      if done:
-        clean_up(se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, histo);
-        return;
-    #printf('x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x,dir_y,mode);    
-    
-    # create historgram
-    for xp in range(snx):
-      for yp in range(sny):
-        for zp in range(snz):
-          if selem[xp, yp, zp]:
-            xx = x + xp - scx;
-            yy = y + yp - scy;
-            zz = z + zp - scz;
-            if is_in_masked_source(nx, ny, nz, xx, yy, zz, mask):
-              histogram_increment(histo, &pop, source[xx, yy, zz])
-              #printf('hist adding (%d,%d,%d) [%d]\n', xx, yy, zz, source[xx,yy,zz]); 
-    
-    kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
-
-    # main loop 
-    while True:
-      xp = x; yp = y; zp = z; # save previous positions
-      move(nx, ny, nz, &x, &y, &z, &dir_x, &dir_y, &mode, &done);
-      if done:
-        clean_up(se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, histo);
-        return;
-      #printf('main move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode);    
-      #printf('pop=%d\n', pop);
-      
-      #move to next valid 
-      if not is_in_masked_source(nx,ny,nz,x,y,z,mask):
-        x,xp = xp,x; y,yp = yp,y; z,zp = zp,z;
-        dir_xp = dir_x; dir_yp = dir_y;
-        modep = mode; donep = done;
-        while not is_in_masked_source(nx,ny,nz,xp,yp,zp,mask):
-          move(nx, ny, nz, &xp, &yp, &zp, &dir_xp, &dir_yp, &modep, &donep);
-          if donep:
-            clean_up(se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, histo);
-            return;
-        #printf('masked move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', xp,yp,zp,dir_xp, dir_yp, modep);    
- 
-        
-        #move to next valid coordinate via shortest path -> speed up for a object surrounded by background 
-        d = xp - x;
-        if d > 0:
-          for i in range(d):
-            mode = 0; 
-            x += 1;
-            move_histo(nx, ny, nz, x, y, z, mode,
-                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, 
-                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                       histo, &pop, source, mask);
-
-        elif d < 0:
-          for i in range(-d):
-            mode = 1; 
-            x -= 1;
-            move_histo(nx, ny, nz, x, y, z, mode,
-                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
-                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                       histo, &pop, source, mask);
-
-        
-        d = yp - y;
-        if d > 0:
-          for i in range(d):
-            mode = 2; 
-            y += 1;
-            move_histo(nx, ny, nz, x, y, z, mode,
-                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
-                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                       histo, &pop, source, mask);
-
-        elif d < 0:
-          for i in range(-d):
-            mode = 3; 
-            y -= 1;
-            move_histo(nx, ny, nz, x, y, z, mode,
-                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
-                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                       histo, &pop, source, mask);
-
-
-        d = zp - z;
-        if d > 0:
-          for i in range(d):
-            mode = 4; 
-            z += 1;
-            move_histo(nx, ny, nz, x, y, z, mode,
-                       se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                       se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                       se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
-                       num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                       histo, &pop, source, mask);
-
-      
-        dir_x = dir_xp; dir_y = dir_yp; mode = modep;
-        #printf('after masked move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode); 
-        #printf('pop=%d\n', pop)
-      
-      else: #if is_in_masked_source
-        move_histo(nx, ny, nz, x, y, z, mode,
-                   se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
-                   se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
-                   se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
-                   num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
-                   histo, &pop, source, mask);
-      
-      #printf('after main move: x=%d, y=%d, z=%d, dirx=%d, diry=%d, mode=%d\n', x,y,z,dir_x, dir_y, mode); 
-      #printf('pop=%d\n', pop) 
-      
-      kernel(&sink[x, y, z, 0], histo, pop, source[x, y, z], max_bin, par_index, par_double)
-    #while True
+    if n_slabs <= 1:
+      rank_core_masked_slab(kernel, source, selem, mask, sink, max_bin, par_index, par_double, 
+                            se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                            se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                            se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                            num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                            0, nz)
+    else:
+      for k in prange(n_slabs, num_threads=n_slabs, schedule='static', chunksize=1):
+        rank_core_masked_slab(kernel, source, selem, mask, sink, max_bin, par_index, par_double, 
+                              se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, 
+                              se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, 
+                              se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z,
+                              num_se_e, num_se_w, num_se_n, num_se_s, num_se_u, num_se_d,
+                              (k * nz) / n_slabs, ((k + 1) * nz) / n_slabs)
   #with nogil
  
-  clean_up(se_e_x, se_e_y, se_e_z, se_w_x, se_w_y, se_w_z, se_n_x, se_n_y, se_n_z, se_s_x, se_s_y, se_s_z, se_u_x, se_u_y, se_u_z, se_d_x, se_d_y, se_d_z, histo);
+  free(se_e_x); free(se_e_y); free(se_e_z);  
+  free(se_w_x); free(se_w_y); free(se_w_z); 
+  free(se_n_x); free(se_n_y); free(se_n_z); 
+  free(se_s_x); free(se_s_y); free(se_s_z)
+  free(se_u_x); free(se_u_y); free(se_u_z)        
+  free(se_d_x); free(se_d_y); free(se_d_z)
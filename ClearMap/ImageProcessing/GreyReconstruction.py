@@ -2,7 +2,11 @@
 GreyReconstruction
 ==================
 
-This morphological reconstruction routine was adapted from 
+Morphological grey reconstruction of 2d and 3d images.
+
+The reconstruction uses the hybrid algorithm of Vincent in a Cython kernel,
+see :mod:`ClearMap.ImageProcessing.GreyReconstructionCode`. The interface was
+adapted from the reconstruction routine of 
 `CellProfiler <http://www.cellprofiler.org>`_.
 
 Authors
@@ -19,11 +23,15 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 import numpy as np
 
-from skimage.filters._rank_order import rank_order
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'GreyReconstructionCode')
 
+import ClearMap.ImageProcessing.GreyReconstructionCode as code
 
 import ClearMap.ImageProcessing.Filter.StructureElement as se
 
+import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
+
 import ClearMap.Utils.Timer as tmr
 import ClearMap.Utils.HierarchicalDict as hdict
 
@@ -32,7 +40,7 @@ import ClearMap.Utils.HierarchicalDict as hdict
 ### Grey reconstruction
 ###############################################################################
 
-def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = None):
+def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = None, processes = None):
   """Performs a morphological reconstruction of an image.
   
   Arguments
@@ -47,6 +55,8 @@ def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = N
     Structuring element.
   offset : array or None
     The offset of the structuring element, None is centered.
+  processes : int or None
+    Number of processes to use for the initial scans.
 
   Returns
   -------
@@ -59,10 +69,12 @@ def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = N
   to dilate and a mask image that gives the maximum allowed dilated value at
   each pixel.
   
-  The algorithm is taken from [1]_. Applications for greyscale 
-  reconstruction are discussed in [2]_ and [3]_.
+  The algorithm is the hybrid algorithm of [2]_: a raster and anti-raster
+  scan, done in parallel over slabs along the first axis, initialize a queue
+  from which the reconstruction is propagated. Applications for greyscale 
+  reconstruction are discussed in [2]_ and [3]_. 
   
-  Effectively operates on 2d images.
+  Operates on 2d and 3d images.
   
   Reference:
   
@@ -79,6 +91,8 @@ def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = N
   
   if seed.shape != mask.shape:
     raise ValueError('Seed shape % and mask shape %r do not match' % (seed.shape, mask.shape))
+  if seed.ndim > 3:
+    raise ValueError('Reconstruction is implemented for up to 3d images, found %d dimensions!' % seed.ndim)
   
   if method == 'dilation' and np.any(seed > mask):
     raise ValueError("Intensity of seed image must be less than that "
@@ -86,15 +100,11 @@ def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = N
   elif method == 'erosion' and np.any(seed < mask):
     raise ValueError("Intensity of seed image must be greater than that "
                      "of the mask image for reconstruction by erosion.")
-  try:
-      from skimage.morphology._greyreconstruct import reconstruction_loop
-  except ImportError:
-      raise ImportError("_greyreconstruct extension not available.")
 
   if selem is None:
       selem = np.ones([3] * seed.ndim, dtype=bool)
   else:
-      selem = selem.copy()
+      selem = np.array(selem, dtype=bool)
 
   if offset is None:
     if not all([d % 2 == 1 for d in selem.shape]):
@@ -103,61 +113,51 @@ def reconstruct(seed, mask = None, method = 'dilation', selem = None, offset = N
   
   # Cross out the center of the selem
   selem[tuple(slice(d, d + 1) for d in offset)] = False
-
-  # Make padding for edges of reconstructed image so we can ignore boundaries
-  padding = (np.array(selem.shape) / 2).astype(int)
-  dims = np.zeros(seed.ndim + 1, dtype=int)
-  dims[1:] = np.array(seed.shape) + 2 * padding
-  dims[0] = 2
-  inside_slices = tuple(slice(p, -p) for p in padding)
-  # Set padded region to minimum image intensity and mask along first axis so
-  # we can interleave image and mask pixels when sorting.
-  if method == 'dilation':
-      pad_value = np.min(seed)
-  elif method == 'erosion':
-      pad_value = np.max(seed)
-  images = np.ones(dims, dtype = seed.dtype) * pad_value
-  images[(0,) + inside_slices] = seed
-  images[(1,) + inside_slices] = mask
-
-  # Create a list of strides across the array to get the neighbors within
-  # a flattened array
-  value_stride = np.array(images.strides[1:]) / images.dtype.itemsize
-  image_stride = images.strides[0] // images.dtype.itemsize
-  selem_mgrid = np.mgrid[[slice(-o, d - o)
-                          for d, o in zip(selem.shape, offset)]]
-  selem_offsets = selem_mgrid[:, selem].transpose()
-  nb_strides = np.array([np.sum(value_stride * selem_offset)
-                         for selem_offset in selem_offsets], np.int32)
-
-  images = images.flatten()
-
-  # Erosion goes smallest to largest; dilation goes largest to smallest.
-  index_sorted = np.argsort(images).astype(np.int32)
-  if method == 'dilation':
-      index_sorted = index_sorted[::-1]
-
-  # Make a linked list of pixels sorted by value. -1 is the list terminator.
-  prev = -np.ones(len(images), np.int32)
-  next = -np.ones(len(images), np.int32)
-  prev[index_sorted[1:]] = index_sorted[:-1]
-  next[index_sorted[:-1]] = index_sorted[1:]
-
-  # Cython inner-loop compares the rank of pixel values.
-  if method == 'dilation':
-      value_rank, value_map = rank_order(images)
-  elif method == 'erosion':
-      value_rank, value_map = rank_order(-images)
-      value_map = -value_map
-
-  start = index_sorted[0]
-  reconstruction_loop(value_rank, prev, next, nb_strides, start, image_stride)
-
-  # Reshape reconstructed image to original image shape and remove padding.
-  rec_img = value_map[value_rank[:image_stride]]
-  rec_img.shape = np.array(seed.shape) + 2 * padding
-  
-  return rec_img[inside_slices]
+  
+  # neighbour offsets in raster order, preceding ones are before the center
+  offsets = np.array(np.nonzero(selem)).T - np.asarray(offset)
+  offsets = np.hstack([np.zeros((len(offsets), 3 - seed.ndim), dtype=int), offsets])
+  offsets = np.array(offsets[np.lexsort(offsets.T[::-1])], dtype=int)
+  
+  # reconstruction by erosion is the dual of reconstruction by dilation
+  dtype = np.result_type(seed, mask)
+  if dtype == bool:
+    dtype = np.dtype('uint8')
+  elif dtype == np.float16:
+    dtype = np.dtype('float32')
+  reconstructed = np.array(seed, dtype=dtype, order='C')
+  mask = np.array(mask, dtype=dtype, order='C')
+  if method == 'erosion':
+    reconstructed, mask = _invert(reconstructed), _invert(mask)
+  
+  shape = seed.shape
+  reconstructed = reconstructed.reshape((1,) * (3 - seed.ndim) + shape)
+  mask = mask.reshape(reconstructed.shape)
+  
+  # slabs and their borders to start the propagation from
+  processes, _ = ap.initialize_processing(processes=processes, verbose=False)
+  n0 = reconstructed.shape[0]
+  slab_size = max(int(np.ceil(n0 / processes)), 1)
+  reach = int(np.max(np.abs(offsets[:, 0]))) if len(offsets) > 0 else 0
+  queued = np.zeros(reconstructed.shape, dtype='uint8')
+  for border in range(slab_size, n0, slab_size):
+    queued[max(border - reach, 0):border + reach] = 1
+  
+  code.reconstruct(reconstructed, mask, offsets, slab_size, queued, processes)
+  
+  reconstructed = reconstructed.reshape(shape)
+  if method == 'erosion':
+    reconstructed = _invert(reconstructed)
+  
+  return reconstructed
+
+
+def _invert(source):
+  """Helper to reverse the order of the values of an array."""
+  if np.issubdtype(source.dtype, np.integer):
+    return np.invert(source)
+  else:
+    return np.negative(source)
 
 
 def grey_reconstruct(source, mask = None, sink = None, method = None, shape = 3, verbose = False):
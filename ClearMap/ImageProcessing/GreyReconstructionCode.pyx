@@ -0,0 +1,172 @@
+#distutils: language = c++
+#cython: language_level=3, boundscheck=False, wraparound=False, nonecheck=False, initializedcheck=False, cdivision=True
+"""
+GreyReconstructionCode
+======================
+
+Cython code for the grey reconstruction by dilation in 3d arrays.
+
+Note
+----
+Implements the hybrid algorithm of [Vincent1993]_: a raster and anti-raster
+scan, done in parallel over slabs along the first axis, followed by a queue
+based propagation.
+
+References
+----------
+.. [Vincent1993] Vincent, L., "Morphological Grayscale Reconstruction in Image
+   Analysis: Applications and Efficient Algorithms", IEEE Transactions on
+   Image Processing (1993)
+"""
+__author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
+__license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
+__copyright__ = 'Copyright © 2020 by Christoph Kirst'
+__webpage__   = 'http://idisco.info'
+__download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
+
+import numpy as np
+cimport numpy as np
+
+cimport cython
+from cython.parallel import prange, parallel
+
+from libcpp.queue cimport queue
+
+ctypedef fused source_t:
+  np.int8_t
+  np.int16_t
+  np.int32_t
+  np.int64_t
+  np.uint8_t
+  np.uint16_t
+  np.uint32_t
+  np.uint64_t
+  np.float32_t
+  np.float64_t
+
+ctypedef Py_ssize_t index_t
+
+
+###############################################################################
+### Reconstruction
+###############################################################################
+
+cpdef void reconstruct(source_t[:,:,:] seed, source_t[:,:,:] mask, index_t[:,:] offsets,
+                       index_t slab_size, np.uint8_t[:,:,:] queued, int processes) nogil:
+  """Grey reconstruction by dilation of seed under mask.
+
+  Arguments
+  ---------
+  seed : array
+    The seed, replaced by the reconstruction.
+  mask : array
+    The mask, seed <= mask.
+  offsets : array
+    The (n, 3) neighbour offsets, ordered such that the offsets preceding the
+    center in raster order come first and are followed by the ones after it.
+  slab_size : int
+    The size of the slabs along the first axis scanned in parallel.
+  queued : array
+    Flags of voxels to initialize the propagation queue with. Has to flag
+    all voxels within the neighbourhood range of the slab borders.
+  processes : int
+    The number of parallel processes.
+  """
+  cdef index_t n0 = seed.shape[0], n1 = seed.shape[1], n2 = seed.shape[2];
+  cdef index_t n_offsets = offsets.shape[0];
+  cdef index_t n_slabs = (n0 + slab_size - 1) / slab_size;
+  cdef index_t n_preceding, s, i, j, k, o, x, y, z, lower, upper, p;
+  cdef source_t v, w;
+  cdef queue[index_t] fifo;
+
+  n_preceding = 0;
+  for o in range(n_offsets):
+    if offsets[o,0] < 0 or (offsets[o,0] == 0 and (offsets[o,1] < 0 or (offsets[o,1] == 0 and offsets[o,2] < 0))):
+      n_preceding = n_preceding + 1;
+
+  # raster and anti-raster scans in each slab
+  with nogil, parallel(num_threads = processes):
+    for s in prange(n_slabs, schedule='dynamic'):
+      lower = s * slab_size;
+      upper = lower + slab_size;
+      if upper > n0:
+        upper = n0;
+      _scan(seed, mask, offsets, n_preceding, lower, upper, queued);
+
+  # propagation
+  for i in range(n0):
+    for j in range(n1):
+      for k in range(n2):
+        if queued[i,j,k]:
+          fifo.push((i * n1 + j) * n2 + k);
+
+  while not fifo.empty():
+    p = fifo.front();
+    fifo.pop();
+    k = p % n2;
+    j = (p / n2) % n1;
+    i = p / (n1 * n2);
+    v = seed[i,j,k];
+    for o in range(n_offsets):
+      x = i + offsets[o,0];
+      y = j + offsets[o,1];
+      z = k + offsets[o,2];
+      if 0 <= x and x < n0 and 0 <= y and y < n1 and 0 <= z and z < n2:
+        w = seed[x,y,z];
+        if w < v and mask[x,y,z] != w:
+          if v < mask[x,y,z]:
+            seed[x,y,z] = v;
+          else:
+            seed[x,y,z] = mask[x,y,z];
+          fifo.push((x * n1 + y) * n2 + z);
+
+
+cdef void _scan(source_t[:,:,:] seed, source_t[:,:,:] mask, index_t[:,:] offsets, index_t n_preceding,
+                index_t lower, index_t upper, np.uint8_t[:,:,:] queued) noexcept nogil:
+  """Raster and anti-raster scan of a slab."""
+  cdef index_t n1 = seed.shape[1], n2 = seed.shape[2];
+  cdef index_t n_offsets = offsets.shape[0];
+  cdef index_t i, j, k, o, x, y, z;
+  cdef source_t v, w;
+
+  # raster scan
+  for i in range(lower, upper):
+    for j in range(n1):
+      for k in range(n2):
+        v = seed[i,j,k];
+        for o in range(n_preceding):
+          x = i + offsets[o,0];
+          y = j + offsets[o,1];
+          z = k + offsets[o,2];
+          if lower <= x and x < upper and 0 <= y and y < n1 and 0 <= z and z < n2:
+            if seed[x,y,z] > v:
+              v = seed[x,y,z];
+        if v > mask[i,j,k]:
+          v = mask[i,j,k];
+        seed[i,j,k] = v;
+
+  # anti-raster scan
+  for i in range(upper - 1, lower - 1, -1):
+    for j in range(n1 - 1, -1, -1):
+      for k in range(n2 - 1, -1, -1):
+        v = seed[i,j,k];
+        for o in range(n_preceding, n_offsets):
+          x = i + offsets[o,0];
+          y = j + offsets[o,1];
+          z = k + offsets[o,2];
+          if lower <= x and x < upper and 0 <= y and y < n1 and 0 <= z and z < n2:
+            if seed[x,y,z] > v:
+              v = seed[x,y,z];
+        if v > mask[i,j,k]:
+          v = mask[i,j,k];
+        seed[i,j,k] = v;
+
+        for o in range(n_preceding, n_offsets):
+          x = i + offsets[o,0];
+          y = j + offsets[o,1];
+          z = k + offsets[o,2];
+          if lower <= x and x < upper and 0 <= y and y < n1 and 0 <= z and z < n2:
+            w = seed[x,y,z];
+            if w < v and w < mask[x,y,z]:
+              queued[i,j,k] = 1;
+              break;
@@ -25,7 +25,8 @@ import ClearMap.Utils.Timer as tmr
 def correct_lightsheet(source, percentile = 0.25, max_bin=2**12, mask=None,
                        lightsheet = dict(selem = (150,1,1)), 
                        background = dict(selem = (200,200,1), spacing = (25,25,1), interpolate = 1, dtype = float, step = (2,2,1)),
-                       lightsheet_vs_background = 2, return_lightsheet = False, return_background = False, verbose = True):
+                       lightsheet_vs_background = 2, return_lightsheet = False, return_background = False, 
+                       processes = None, verbose = True):
   """Removes lightsheet artifacts.
   
   Arguments
@@ -51,6 +52,8 @@ def correct_lightsheet(source, percentile = 0.25, max_bin=2**12, mask=None,
     If True, return the lightsheeet artifact estimate.
   return_background : bool
     If True, return the background estimate.
+  processes : int or None
+    Number of threads used by the lightsheet artifact percentile filter.
   verbose : bool
     If True, print progress information.
   
@@ -80,7 +83,7 @@ def correct_lightsheet(source, percentile = 0.25, max_bin=2**12, mask=None,
     timer = tmr.Timer();
   
   #lightsheet artifact estimate
-  l =  rnk.per.percentile(source, percentile=percentile, max_bin=max_bin, mask=mask, **lightsheet);
+  l =  rnk.per.percentile(source, percentile=percentile, max_bin=max_bin, mask=mask, processes=processes, **lightsheet);
   if verbose:
     timer.print_elapsed_time('LightsheetCorrection: lightsheet artifact done')
   
@@ -59,6 +59,13 @@ __license__   = 'MIT License <http://www.opensource.org/licenses/mit-license.php
 __copyright__ = 'Copyright 2020 by Christoph Kirst'
 
 
+import os
+import sys
+import json
+import pickle
+import hashlib
+import itertools
+import collections
 import functools as ft
 import multiprocessing as mp
 import concurrent.futures as cf
@@ -66,6 +73,7 @@ import warnings
 
 import numpy as np
 import gc
+import psutil
 
 import ClearMap.ParallelProcessing.Block as blk
 import ClearMap.ParallelProcessing.ParallelTraceback as ptb
@@ -117,6 +125,20 @@ to :func:`ClearMap.ParallelProcessing.BlockProcessing.process` is None.
 If this is None, a zero overlap will be used.
 """
 
+default_memory_budget = None
+"""Default resident memory budget of a worker process in bytes.
+
+Note
+----
+This value is used if memory_budget passed 
+to :func:`ClearMap.ParallelProcessing.BlockProcessing.process` is None.
+
+If this is None, workers collect garbage after each block and are not recycled.
+"""
+
+default_gc_threshold = 0.75
+"""Fraction of the memory budget above which a worker collects garbage after a block."""
+
 
 ###############################################################################
 ### Processing
@@ -126,7 +148,8 @@ def process(function, source, sink = None,
             axes = None, size_max = None, size_min = None, overlap = None,  
             optimization = True, optimization_fix = 'all', neighbours = False,
             function_type = None, as_memory = False, return_result = False,
-            return_blocks = False,
+            return_blocks = False, checkpoint = None, reducer = None, in_flight = None,
+            memory_budget = None, max_tasks_per_child = None, chunks = None,
             processes = None, verbose = False, workspace=None,
             **kwargs):
   """Create blocks and process a function on them in parallel.
@@ -178,6 +201,35 @@ def process(function, source, sink = None,
     If True, return the results of the proceessing functions.
   return_blocks : bool
     If True, return the block information used to distribute the processing.
+  checkpoint : bool, str or None
+    If True or a directory, keep a manifest of the finished blocks and their
+    results in this directory. If True, the directory is placed next to the 
+    first sink. When restarted with the same parameters, finished blocks are 
+    skipped and their cached results are merged into the result.
+  reducer : function or None
+    If not None, the results of the blocks are passed to this function as 
+    reducer(result) in the order the blocks finish instead of being collected.
+    This is returned instead of the list of results, e.g. use the append 
+    method of :class:`ClearMap.IO.MMP.Appendable` to stream results to disk.
+  in_flight : int or None
+    Maximal number of blocks submitted for parallel processing at a time. 
+    This bounds the memory for results not yet consumed. If None, use 
+    twice the number of processes.
+  memory_budget : int or None
+    Resident memory budget of a worker process in bytes. If given, workers 
+    only collect garbage above :const:`default_gc_threshold` of the budget,
+    the worker processes are recycled once a worker exceeds the budget and 
+    blocks estimated to exceed it are split into smaller blocks. The results
+    of the split blocks are combined via :func:`merge_results` into the 
+    result of the original block.
+    If None, :const:`default_memory_budget` is used.
+  max_tasks_per_child : int or None
+    If given, recycle the worker processes after they processed this 
+    number of blocks on average.
+  chunks : tuple of ints, False or None
+    Chunk shape to which the borders between the valid regions of the blocks
+    are aligned. If None, the chunk shape of chunked sinks, or of chunked 
+    sources if no sink is chunked, is used. If False, blocks are not aligned.
   processes : int, None
     The number of parallel processes, if 'serial', use serial processing.
   verbose : bool
@@ -191,6 +243,10 @@ def process(function, source, sink = None,
   Note
   ----
   This implementation only supports processing into sinks with the same shape as the source.
+  
+  Chunked sinks, e.g. :mod:`~ClearMap.IO.ZARR` arrays, are only safe to write
+  to in parallel if no two blocks write into the same chunk, which is ensured
+  by the chunk alignment of the blocks.
   """
   #sources and sinks
   if isinstance(source, list):
@@ -212,12 +268,14 @@ def process(function, source, sink = None,
   sinks = [io.as_source(s).as_virtual() for s in sinks];
 
   axes = block_axes(sources[0], axes=axes);
+  if chunks is None:
+    chunks = block_chunks(sinks) or block_chunks(sources);
 
   split = ft.partial(split_into_blocks, processes=processes, axes=axes,
                      size_max=size_max, size_min=size_min,
                      overlap=overlap, optimization=optimization,
                      optimization_fix=optimization_fix, neighbours=neighbours,
-                     verbose=False);
+                     chunks=chunks or None, verbose=False);
 
   source_blocks = [split(s) for s in sources];
   sink_blocks = [split(s) for s in sinks];
@@ -240,25 +298,137 @@ def process(function, source, sink = None,
   if not isinstance(processes, int) and processes != "serial":
     processes = mp.cpu_count();
 
+  if memory_budget is None:
+    memory_budget = default_memory_budget;
+  func = ft.partial(process_block_memory, function=func, memory_budget=memory_budget, gc_threshold=default_gc_threshold);
+
+  if checkpoint:
+    checkpoint = checkpoint_directory(checkpoint, sinks);
+    parameter_hash = checkpoint_hash(function, sources, sinks, function_type=function_type, 
+                                     as_memory=as_memory, return_result=return_result, **kwargs);
+    finished = read_checkpoint(checkpoint, parameter_hash, source_blocks, return_result=return_result);
+  else:
+    finished = {};
+  pending = collections.deque(i for i in range(n_blocks) if i not in finished);
+
   if verbose:
     timer = tmr.Timer();
     print("Processing %d blocks with function %r." % (n_blocks, function.__name__))
+    if finished:
+      print("Skipping %d finished blocks from checkpoint %r." % (len(finished), checkpoint))
+
+  results = {};
+  parts = {};  # results of the blocks split from a block, merged into the block's result
+  parents = {};  # the block each split block was split from
+  memory = dict(statistics={}, block=0, baseline=0);
+
+  def finish(i, r):
+    if reducer is None:
+      results[i] = r;
+    else:
+      reducer(r);
+
+  def merge(i, r):
+    if checkpoint:
+      write_checkpoint(checkpoint, parameter_hash, i, source_blocks[i][0], r, return_result=return_result);
+    finish(i, r);
+
+  for i in sorted(finished.keys()):
+    finish(i, finished.pop(i));
+
+  def next_block():
+    i = pending.popleft();
+    if memory_budget is None or memory['block'] <= 0 or i >= n_blocks:  # blocks are only split once
+      return i;
+    voxels = np.prod(source_blocks[i][0].shape);
+    n_split = int(np.ceil(voxels * memory['block'] / max(1, memory_budget - memory['baseline'])));
+    if n_split <= 1:
+      return i;
+    axis = max(axes, key=lambda a: source_blocks[i][0].shape[a]);
+    split = [split_block(b, n_split, axis, chunk=chunks[axis] if chunks else None) for b in source_blocks[i] + sink_blocks[i]];
+    split = [[b[k] for b in split] for k in range(len(split[0]))];
+    if len(split) <= 1:
+      return i;
+    ids = list(range(len(source_blocks), len(source_blocks) + len(split)));
+    source_blocks.extend([b[:len(sources)] for b in split]);
+    sink_blocks.extend([b[len(sources):] for b in split]);
+    parents.update((j, i) for j in ids);
+    parts[i] = dict.fromkeys(ids);
+    pending.extendleft(reversed(ids[1:]));
+    if verbose:
+      print("Splitting block %s into %d blocks to fit the memory budget." % (source_blocks[i][0].info(), len(split)));
+    return ids[0];
+
+  def record(i, r, statistics):
+    """Record the result of a block and return True if the worker exceeded the memory budget."""
+    if i in parents:
+      j = parents.pop(i);
+      parts[j][i] = r;
+      if all(k not in parents for k in parts[j]):
+        merge(j, merge_results(list(parts.pop(j).values())));
+    else:
+      merge(i, r);
+    pid = statistics['pid'];
+    memory['statistics'][pid] = max(memory['statistics'].get(pid, 0), statistics['peak']);
+    if memory_budget is None:
+      return False;
+    memory['baseline'] = max(memory['baseline'], statistics['start']);
+    voxels = np.prod(source_blocks[i][0].shape);
+    memory['block'] = max(memory['block'], float(statistics['peak'] - statistics['start']) / voxels);
+    return statistics['rss'] > memory_budget;
 
   if isinstance(processes, int):
     #from bounded_pool_executor import BoundedProcessPoolExecutor
     #with BoundedProcessPoolExecutor(max_workers=processes) as executor:
     #   executor.map(function, source_blocks, sink_blocks)
-    with CancelableProcessPoolExecutor(max_workers=processes) as executor:
-      if workspace is not None:
-        workspace.executor = executor
-      futures = [executor.submit(func, *args) for args in zip(source_blocks, sink_blocks)]
-      # res = executor.map(func, source_blocks, sink_blocks)
-      result = [f.result() for f in futures]  # To prevent keeping references to futures to avoid mem leaks
-      # result = list(res)
-      if workspace is not None:
-        workspace.executor = None
+    if in_flight is None:
+      in_flight = 2 * processes;
+    while pending:
+      # worker processes are recycled by restarting the executor
+      recycle = False;
+      with CancelableProcessPoolExecutor(max_workers=processes) as executor:
+        if workspace is not None:
+          workspace.executor = executor
+        # res = executor.map(func, source_blocks, sink_blocks)
+        futures = {};
+        n_submitted = 0;
+        def submit():
+          i = next_block();
+          futures[executor.submit(func, source_blocks[i], sink_blocks[i])] = i;
+        while pending and len(futures) < max(1, in_flight):
+          submit();
+          n_submitted += 1;
+        while futures:
+          done, _ = cf.wait(futures, return_when=cf.FIRST_COMPLETED);
+          for f in done:
+            r, statistics = f.result();
+            recycle = record(futures.pop(f), r, statistics) or recycle;  # To prevent keeping references to futures to avoid mem leaks
+            del r;
+            if max_tasks_per_child is not None and n_submitted >= max_tasks_per_child * processes:
+              recycle = True;
+            if pending and not recycle:
+              submit();
+              n_submitted += 1;
+        # result = list(res)
+        if workspace is not None:
+          workspace.executor = None
+      if recycle and pending and verbose:
+        print("Recycling worker processes.");
+  else:
+    while pending:
+      i = next_block();
+      record(i, *func(source_blocks[i], sink_blocks[i]));
+
+  if reducer is None:
+    result = [results.get(i) for i in range(n_blocks)];
   else:
-    result = [func(*args) for args in zip(source_blocks, sink_blocks)]  #analysis:ignore
+    result = reducer;
+  if return_blocks:
+    source_blocks = source_blocks[:n_blocks];
+    sink_blocks = sink_blocks[:n_blocks];
+
+  if verbose and memory['statistics']:
+    print("Peak memory per worker: " + ', '.join('%d: %.2f GB' % (pid, peak / 1024.**3) for pid, peak in memory['statistics'].items()));
 
   if verbose:
     timer.print_elapsed_time("Processed %d blocks with function %r" % (n_blocks, function.__name__))
@@ -278,6 +448,41 @@ def process(function, source, sink = None,
 ### Helpers
 ###############################################################################
 
+def merge_results(results):
+  """Merge the results of the blocks split from a block.
+  
+  Arguments
+  ---------
+  results : list
+    The results of the split blocks in block order.
+    
+  Returns
+  -------
+  result : object
+    None if all results are None, otherwise the result of the type of the
+    block results: the concatenation along the first axis if the results 
+    are arrays, or the tuple or list of these concatenations if the 
+    results are tuples or lists of arrays.
+    
+  Raises
+  ------
+  ValueError
+    If the results cannot be merged into a result of the same type.
+  """
+  if all(r is None for r in results):
+    return None;
+  if all(isinstance(r, np.ndarray) and r.ndim > 0 for r in results):
+    return np.concatenate(results);
+  container = type(results[0]);
+  if container in (tuple, list) and \
+     all(type(r) is container and len(r) == len(results[0]) and 
+         all(isinstance(a, np.ndarray) and a.ndim > 0 for a in r) for r in results):
+    return container(np.concatenate(a) for a in zip(*results));
+  raise ValueError('Cannot merge the results %r of blocks split to fit the memory budget, '
+                   'return arrays or tuples of arrays or increase the memory budget!' % 
+                   sorted(set(type(r).__name__ for r in results)));
+
+
 @ptb.parallel_traceback
 def process_block_source(sources, sinks, function, as_memory = False, as_array = False, verbose = False, **kwargs):
   """Process a block with full traceback.
@@ -315,8 +520,6 @@ def process_block_source(sources, sinks, function, as_memory = False, as_array =
     
   if verbose:
     timer.print_elapsed_time('Processing block %s' % (sources_input[0].info(),));
-   
-  gc.collect(); 
     
   return None;
 
@@ -351,8 +554,6 @@ def process_block_block(sources, sinks, function, as_memory = False, return_resu
 
   if verbose:
     timer.print_elapsed_time('Processing block %s' % (sources[0].info(),));
-   
-  gc.collect();
   
   if return_result:
     return result;
@@ -360,13 +561,258 @@ def process_block_block(sources, sinks, function, as_memory = False, return_resu
     return None;
 
 
+def process_block_memory(sources, sinks, function, memory_budget = None, gc_threshold = default_gc_threshold):
+  """Process a block and apply the memory policy of the worker.
+  
+  Arguments
+  ---------
+  sources :  source specifications
+    Sources passed to the function.
+  sinks : sourcespecifications
+    Sinks where data is written to.
+  function  func : function
+    The block processing function.
+  memory_budget : int or None
+    The memory budget of the worker in bytes. If None, always collect garbage.
+  gc_threshold : float
+    Fraction of the memory budget above which garbage is collected.
+  
+  Returns
+  -------
+  result : object
+    The result of the function.
+  statistics : dict
+    The pid and resident memory of the worker at the start ('start'), 
+    the peak during ('peak') and the end ('rss') of the block.
+  """
+  start = reset_peak_rss();
+  result = function(sources, sinks);
+  peak = peak_rss();
+  
+  if memory_budget is None or psutil.Process().memory_info().rss > gc_threshold * memory_budget:
+    gc.collect();
+  rss = psutil.Process().memory_info().rss;
+  
+  return result, dict(pid=os.getpid(), start=start, peak=max(peak, start, rss), rss=rss);
+
+
+def reset_peak_rss():
+  """Reset the peak resident memory of this process where supported.
+  
+  Returns
+  -------
+  rss : int
+    The current resident memory in bytes.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5');
+  except OSError:
+    pass;
+  return psutil.Process().memory_info().rss;
+
+
+def peak_rss():
+  """Peak resident memory of this process in bytes."""
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024;
+  except OSError:
+    pass;
+  try:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+    return peak if sys.platform == 'darwin' else peak * 1024;
+  except ImportError:
+    return psutil.Process().memory_info().rss;
+
+
+###############################################################################
+### Checkpoints
+###############################################################################
+
+checkpoint_manifest = 'manifest.jsonl'
+"""File name of the manifest of finished blocks in a checkpoint directory."""
+
+def checkpoint_directory(checkpoint, sinks = None):
+  """Determine the checkpoint directory.
+  
+  Arguments
+  ---------
+  checkpoint : True or str
+    The checkpoint directory. If True, use the location of the first sink 
+    with the postfix '.checkpoint'.
+  sinks : list of Sources or None
+    The sinks of the block processing.
+    
+  Returns
+  -------
+  directory : str
+    The checkpoint directory.
+  """
+  if checkpoint is True:
+    locations = [getattr(s, 'location', None) for s in (sinks or [])];
+    locations = [l for l in locations if l is not None];
+    if not locations:
+      raise ValueError('Cannot place a checkpoint next to a sink without a location, specify a checkpoint directory!');
+    checkpoint = locations[0] + '.checkpoint';
+  return checkpoint;
+
+
+def checkpoint_hash(function, sources, sinks, **kwargs):
+  """Content hash of the processing parameters of a block processing run.
+  
+  Arguments
+  ---------
+  function : function
+    The processing function.
+  sources, sinks : list of Sources
+    The sources and sinks to process.
+  kwargs 
+    Further processing parameter.
+  
+  Returns
+  -------
+  hash : str
+    A hex digest identifying the processing parameter.
+  
+  Note
+  ----
+  Sources are identified by their location, size and modification time or,
+  if they live in memory, by a digest of their content, so that a changed 
+  input invalidates the checkpoint. Sinks, and sources processed in place,
+  are identified by their location.
+  """
+  locations = [getattr(s, 'location', None) for s in sinks];
+  parameter = (getattr(function, '__module__', None), getattr(function, '__qualname__', None),
+               [(s.shape, str(s.dtype), _source_identity(s, locations)) for s in sources],
+               [(s.shape, str(s.dtype), l) for s, l in zip(sinks, locations)],
+               sorted(kwargs.items(), key=lambda item: item[0]));
+  try:
+    parameter = pickle.dumps(parameter);
+  except Exception as error:
+    raise ValueError('Cannot checkpoint the processing, the parameters are not picklable: %r!' % error);
+  return hashlib.sha1(parameter).hexdigest();
+
+
+def _source_identity(source, sink_locations):
+  """Helper to identify the data of a source by its files or its content."""
+  location = getattr(source, 'location', None);
+  if location is not None and location in sink_locations:
+    return location;
+  files = getattr(source, 'file_list', None);
+  if files is None and location is not None:
+    files = [location];
+  if files is not None:
+    return [(f, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files];
+  return hashlib.sha1(np.ascontiguousarray(source[:]).view('uint8')).hexdigest();
+
+
+def read_checkpoint(checkpoint, parameter_hash, blocks, return_result = False):
+  """Read the finished blocks from a checkpoint.
+  
+  Arguments
+  ---------
+  checkpoint : str
+    The checkpoint directory.
+  parameter_hash : str
+    The hash of the current processing parameter, see :func:`checkpoint_hash`.
+  blocks : list of lists of Blocks
+    The source blocks of the current processing.
+  return_result : bool
+    If True, only blocks with cached results are considered finished.
+    
+  Returns
+  -------
+  finished : dict
+    Mapping of the finished block numbers to their cached results.
+    
+  Note
+  ----
+  If the parameter hash does not match, the checkpoint is reset.
+  """
+  manifest = os.path.join(checkpoint, checkpoint_manifest);
+  entries = [];
+  truncated = False;
+  if os.path.exists(manifest):
+    with open(manifest, 'r') as f:
+      for line in f:
+        try:
+          entries.append(json.loads(line));
+        except ValueError: # incomplete line from an interrupted write
+          truncated = True;
+          break;
+  
+  if not entries or entries[0].get('parameters') != parameter_hash:
+    os.makedirs(checkpoint, exist_ok=True);
+    for name in os.listdir(checkpoint):
+      if name == checkpoint_manifest or name.startswith('block_'):
+        os.remove(os.path.join(checkpoint, name));
+    with open(manifest, 'w') as f:
+      f.write(json.dumps({'parameters' : parameter_hash}) + '\n');
+    return {};
+  
+  if truncated:
+    with open(manifest, 'w') as f:
+      f.writelines(json.dumps(entry) + '\n' for entry in entries);
+  
+  finished = {};
+  for entry in entries[1:]:
+    i = entry['block'];
+    if i >= len(blocks) or entry['slicing'] != repr(blocks[i][0].slicing):
+      continue;
+    if return_result:
+      filename = entry.get('result');
+      if filename is None or not os.path.exists(os.path.join(checkpoint, filename)):
+        continue;
+      with open(os.path.join(checkpoint, filename), 'rb') as f:
+        finished[i] = pickle.load(f);
+    else:
+      finished[i] = None;
+  
+  return finished;
+
+
+def write_checkpoint(checkpoint, parameter_hash, i, block, result = None, return_result = False):
+  """Record a finished block in the checkpoint manifest.
+  
+  Arguments
+  ---------
+  checkpoint : str
+    The checkpoint directory.
+  parameter_hash : str
+    The hash of the processing parameter, see :func:`checkpoint_hash`.
+  i : int
+    The number of the finished block.
+  block : Block
+    The finished source block.
+  result : object
+    The result of the block processing, cached if return_result is True.
+  """
+  entry = {'block' : i, 'index' : [int(j) for j in block.index], 'slicing' : repr(block.slicing), 
+           'parameters' : parameter_hash};
+  if return_result:
+    entry['result'] = 'block_%06d.pkl' % i;
+    filename = os.path.join(checkpoint, entry['result']);
+    with open(filename + '.tmp', 'wb') as f:
+      pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL);
+    os.replace(filename + '.tmp', filename);
+  
+  with open(os.path.join(checkpoint, checkpoint_manifest), 'a') as f:
+    f.write(json.dumps(entry) + '\n');
+    f.flush();
+    os.fsync(f.fileno());
+
+
 ###############################################################################
 ### Source splitting into blocks
 ###############################################################################
 
 def block_sizes(size, processes = None, 
                 size_max = None, size_min = None, overlap = None, 
-                optimization = True, optimization_fix = 'all', verbose = False):
+                optimization = True, optimization_fix = 'all', chunk = None, verbose = False):
   """Calculates the block sizes along a single axis when splitting up a source .
   
   Arguments
@@ -389,6 +835,9 @@ def block_sizes(size, processes = None,
   optimization_fix : 'increase', 'decrease', 'all' or None
     Increase, decrease or optimally change the block size when optimization 
     is active.
+  chunk : int or None
+    If given, the borders between the valid ranges are moved to multiples 
+    of this chunk size, see :func:`align_block_sizes`.
   verbose : bool
     Print information on block generation.
       
@@ -544,6 +993,9 @@ def block_sizes(size, processes = None,
   
   valid_ranges.append((valid_prev, size));  
   
+  if chunk is not None and chunk > 1:
+    n_blocks, block_ranges, valid_ranges = align_block_sizes(size, block_ranges, valid_ranges, chunk);
+  
   if verbose:
     n_prt = min(10, n_blocks);
     if n_blocks > n_prt:
@@ -559,6 +1011,70 @@ def block_sizes(size, processes = None,
   return n_blocks, block_ranges, valid_ranges;
 
 
+def align_block_sizes(size, block_ranges, valid_ranges, chunk):
+  """Moves the borders between the valid ranges of blocks to multiples of a chunk size.
+  
+  Arguments
+  ---------
+  size : int 
+    Size of the array dimension that is split up.
+  block_ranges : list of tuple of ints
+    Ranges of the blocks of the form [(lo0,hi0),(lo1,hi1),...].
+  valid_ranges : list of tuple of ints
+    Valid ranges of the blocks of the form [(lo0,hi0),(lo1,hi1),...].
+  chunk : int
+    The chunk size.
+    
+  Returns
+  -------
+  n_blocks : int
+   Number of blocks. 
+  block_ranges : list of tuple of ints
+    Ranges of the aligned blocks.
+  valid_ranges : list of tuple of ints
+    Valid ranges of the aligned blocks.
+    
+  Note
+  ----
+  Each border is moved to the closest multiple of the chunk size and blocks 
+  keep the largest margins around their valid ranges to retain the overlap.
+  Blocks whose valid range becomes empty are removed.
+  """
+  margin_lo = max(v[0] - b[0] for b,v in zip(block_ranges, valid_ranges));
+  margin_hi = max(b[1] - v[1] for b,v in zip(block_ranges, valid_ranges));
+  
+  borders = [int(round(float(v[1]) / chunk)) * chunk for v in valid_ranges[:-1]];
+  borders = [0] + sorted(set(b for b in borders if 0 < b < size)) + [size];
+  
+  valid_ranges = list(zip(borders[:-1], borders[1:]));
+  block_ranges = [(max(0, lo - margin_lo), min(size, hi + margin_hi)) for lo,hi in valid_ranges];
+  
+  return len(valid_ranges), block_ranges, valid_ranges;
+
+
+def block_chunks(sources):
+  """Returns the chunk shape to align blocks to for a list of sources.
+  
+  Arguments
+  ---------
+  sources : list of Source
+    The sources to be processed.
+    
+  Returns
+  -------
+  chunks : tuple of ints or None
+    The chunk shape that aligns to the chunks of all chunked sources or 
+    None if no source is chunked.
+  """
+  chunks = None;
+  for source in sources:
+    c = getattr(source, 'chunks', None);
+    if c is None:
+      continue;
+    chunks = tuple(c) if chunks is None else tuple(int(np.lcm(a, b)) for a,b in zip(chunks, c));
+  return chunks;
+
+
 def block_axes(source, axes=None):
   """
   Determine the axes for block processing from source order.
@@ -605,7 +1121,7 @@ def block_axes(source, axes=None):
 def split_into_blocks(source, processes = None, axes = None, 
                       size_max = None, size_min = None, overlap = None,  
                       optimization = True, optimization_fix = 'all', 
-                      neighbours = False, verbose = False, **kwargs):
+                      neighbours = False, chunks = None, verbose = False, **kwargs):
   """splits a source into a list of Block sources for parallel processing.
   
   The block information is described in :mod:`ClearMapBlock`  
@@ -630,6 +1146,9 @@ def split_into_blocks(source, processes = None, axes = None,
     Increase, decrease or optimally change the block size when optimization is active.
   neighbours : bool
     If True, also include information about the neighbourhood in the blocks.
+  chunks : tuple of ints or None
+    If given, align the borders of the valid regions of the blocks to this
+    chunk shape.
   verbose : bool
     Print information on block generation.
       
@@ -662,7 +1181,7 @@ def split_into_blocks(source, processes = None, axes = None,
         block_sizes(shape[d], processes=processes, 
                     size_max=size_max[a], size_min=size_min[a], overlap=overlap[a], 
                     optimization=optimization[a], optimization_fix=optimization_fix[a], 
-                    verbose=verbose);
+                    chunk=chunks[d] if chunks is not None else None, verbose=verbose);
       a += 1;
     else:
       n_blocks = 1;
@@ -707,6 +1226,53 @@ def split_into_blocks(source, processes = None, axes = None,
   return blocks;
 
 
+def split_block(block, n_blocks, axis, chunk = None):
+  """Splits a block into smaller blocks along an axis.
+  
+  Arguments
+  ---------
+  block : Block
+    The block to split.
+  n_blocks : int
+    The number of blocks to split the valid region of the block into.
+  axis : int
+    The axis along which to split the block.
+  chunk : int or None
+    If given, the borders between the new valid regions are moved to 
+    multiples of this chunk size.
+  
+  Returns
+  -------
+  blocks : list of Blocks
+    The blocks covering the valid region of the original block.
+    
+  Note
+  ----
+  The blocks keep the larger of the margins of the original block around 
+  their valid regions to retain the overlap.
+  """
+  size = block.source.shape[axis];
+  lo, hi, _ = block.base_slicing[axis].indices(size);
+  valid_lo, valid_hi, _ = block.valid.base_slicing[axis].indices(size);
+  margin = max(valid_lo - lo, hi - valid_hi);
+  
+  bounds = [int(b) for b in np.unique(np.linspace(valid_lo, valid_hi, min(n_blocks, valid_hi - valid_lo) + 1).astype(int))];
+  if chunk is not None and chunk > 1:
+    inner = set(int(round(float(b) / chunk)) * chunk for b in bounds[1:-1]);
+    bounds = [valid_lo] + sorted(b for b in inner if valid_lo < b < valid_hi) + [valid_hi];
+  blocks = [];
+  for k, (v0, v1) in enumerate(zip(bounds[:-1], bounds[1:])):
+    b0 = lo if k == 0 else max(0, v0 - margin);
+    b1 = hi if k == len(bounds) - 2 else min(size, v1 + margin);
+    slicing = list(block.base_slicing);
+    slicing[axis] = slice(b0, b1);
+    valid_slicing = list(block.valid.slicing);
+    valid_slicing[axis] = slice(v0 - b0, v1 - b0);
+    blocks.append(blk.Block(source=block.source, slicing=tuple(slicing), valid_slicing=tuple(valid_slicing),
+                            index=block.index, blocks_shape=block.blocks_shape));
+  return blocks;
+
+
 def _unpack(values, ndim = None):
   """Helper to parse values into standard form (value0,value1,...)."""
   if not isinstance(values, (list, tuple)):
@@ -817,6 +1383,26 @@ def _test():
   assert(np.all(sink2[:] == d))
   
   
+  #checkpoints
+  shape = (2,3,60);
+  source = io.mmp.create(location='source.npy', shape=shape);
+  source[:] = np.random.rand(*shape);
+  sink = io.mmp.create(location='sink.npy', shape=shape)
+  
+  bp.process(process_image, source, sink, checkpoint=True,
+             size_max = 10, size_min = 6, overlap = 3, axes = [2], verbose = True, processes=None);
+  
+  # finished blocks are skipped
+  bp.process(process_image, source, sink, checkpoint=True,
+             size_max = 10, size_min = 6, overlap = 3, axes = [2], verbose = True, processes=None);
+  assert(np.all(sink[:] == process_image(source))) 
+  
+  import shutil
+  shutil.rmtree(bp.checkpoint_directory(True, [sink]));
+  io.delete_file(source.location)
+  io.delete_file(sink.location)
+  
+  
   #trace backs
   shape = (3,4)
   source = io.sma.Source(array = np.random.rand(*shape));
@@ -26,8 +26,8 @@ from multiprocessing import cpu_count;
 
 import ClearMap.IO.IO as io
 
-import pyximport; 
-pyximport.install(setup_args={"include_dirs": [np.get_include()]}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'ConvolvePointListCode')
 
 import ClearMap.ParallelProcessing.DataProcessing.ConvolvePointListCode as code
 
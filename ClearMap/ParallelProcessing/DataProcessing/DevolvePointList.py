@@ -19,8 +19,8 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 import math
 import numpy as np
 
-import pyximport;
-pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'DevolvePointListCode')
 
 import ClearMap.IO.IO as io
 
@@ -34,6 +34,7 @@ import ClearMap.ParallelProcessing.DataProcessing.DevolvePointListCode as code
 
 def devolve(source, sink = None, shape = None, dtype = None, 
             weights = None, indices = None, kernel = None, 
+            engine = 'sorted', partials = None,
             processes = None, verbose = False):
   """Converts a list of points into an volumetric image array.
   
@@ -56,6 +57,17 @@ def devolve(source, sink = None, shape = None, dtype = None,
     The relative indices to the center to devolve over as nxd array.
   kernel : array
     Optional kernel weights for each index in indices.
+  engine : 'sorted', 'partial' or 'direct'
+    The devolution engine. 'sorted' sorts the points along the slowest sink
+    axis and assigns disjoint slabs of the sink to the threads.
+    'partial' devolves chunks of points into private partial sinks that are 
+    combined via a tree reduction. Both give identical results for any number
+    of processes. 'direct' writes unsynchronized into the sink and is only
+    exact for a single process.
+  partials : int or None
+    Number of partial sinks for the 'partial' engine. If None, use 
+    default_partials. The result is independent of the number of processes
+    but for floating point sinks depends on the number of partials.
   processes : int or None
     Number of processes to use.
   verbose : bool
@@ -97,24 +109,99 @@ def devolve(source, sink = None, shape = None, dtype = None,
   indices = np.asarray(indices, dtype=int);
   if indices.ndim == 1:
     indices = indices[:,None];
-  
+  if len(indices) == 0:
+    return sink;
+
   if kernel is not None:
     kernel = np.asarray(kernel, dtype=float);
   
+  if engine == 'direct':
+    _devolve_direct(points_buffer, weights, indices, kernel, sink_buffer, sink_shape, sink_strides, processes);
+  elif engine == 'sorted':
+    _devolve_sorted(points_buffer, weights, indices, kernel, sink_buffer, sink_shape, sink_strides, processes);
+  elif engine == 'partial':
+    _devolve_partial(points_buffer, weights, indices, kernel, sink_buffer, sink_shape, sink_strides, partials, processes);
+  else:
+    raise ValueError("engine not 'sorted', 'partial' or 'direct', but %r!" % engine);
+  
+  ap.finalize_processing(verbose=verbose, function='devolve', timer=timer);
+
+  return sink;
+
+
+###############################################################################
+### Engines
+###############################################################################
+
+default_partials = 8
+"""Default number of partial sinks for the 'partial' engine."""
+
+slabs_per_process = 4
+"""Number of sink slabs per process for the 'sorted' engine, for load balancing."""
+
+
+def _devolve_direct(points, weights, indices, kernel, sink, shape, strides, processes):
+  """Unsynchronized devolution, exact only for a single process."""
   if weights is None:
     if kernel is None:
-      code.devolve_uniform(points_buffer, indices, sink_buffer, sink_shape, sink_strides, processes);
+      code.devolve_uniform(points, indices, sink, shape, strides, processes);
     else:
-      code.devolve_uniform_kernel(points_buffer, indices, kernel, sink_buffer, sink_shape, sink_strides, processes);
+      code.devolve_uniform_kernel(points, indices, kernel, sink, shape, strides, processes);
   else:
     if kernel is None:
-      code.devolve_weights(points_buffer, weights, indices, sink_buffer, sink_shape, sink_strides, processes);
+      code.devolve_weights(points, weights, indices, sink, shape, strides, processes);
     else:
-      code.devolve_weights_kernel(points_buffer, weights, indices, kernel, sink_buffer, sink_shape, sink_strides, processes);
+      code.devolve_weights_kernel(points, weights, indices, kernel, sink, shape, strides, processes);
 
-  ap.finalize_processing(verbose=verbose, function='devolve', timer=timer);
 
-  return sink;
+def _engine_arguments(weights, kernel):
+  """Replace missing weights or kernel by empty arrays as expected by the engine kernels."""
+  if weights is None:
+    weights = np.zeros(0, dtype=float);
+  else:
+    weights = np.asarray(io.as_source(weights).as_buffer(), dtype=float);
+  if kernel is None:
+    kernel = np.zeros(0, dtype=float);
+  return weights, kernel;
+
+
+def _devolve_sorted(points, weights, indices, kernel, sink, shape, strides, processes):
+  """Devolution into disjoint sink slabs along the axis with the largest stride."""
+  weights, kernel = _engine_arguments(weights, kernel);
+  
+  axis = int(np.argmax(strides));
+  coordinates = points[:,axis].astype(int);
+  order = np.argsort(coordinates, kind='stable');
+  coordinates = coordinates[order];
+  points = np.ascontiguousarray(points[order]);
+  if len(weights) > 0:
+    weights = np.ascontiguousarray(weights[order]);
+  
+  n_slabs = max(1, min(shape[axis], slabs_per_process * processes));
+  slab_bounds = np.linspace(0, shape[axis], n_slabs + 1).astype(int);
+  offset_min, offset_max = indices[:,axis].min(), indices[:,axis].max();
+  
+  slabs = np.zeros((n_slabs, 4), dtype=int);
+  slabs[:,0] = slab_bounds[:-1];
+  slabs[:,1] = slab_bounds[1:];
+  slabs[:,2] = np.searchsorted(coordinates, slabs[:,0] - offset_max, side='left');
+  slabs[:,3] = np.searchsorted(coordinates, slabs[:,1] - offset_min, side='left');
+  
+  code.devolve_sorted(points, weights, indices, kernel, sink, shape, strides, axis, slabs, processes);
+
+
+def _devolve_partial(points, weights, indices, kernel, sink, shape, strides, partials, processes):
+  """Devolution into private partial sinks followed by a tree reduction."""
+  weights, kernel = _engine_arguments(weights, kernel);
+  
+  if partials is None:
+    partials = default_partials;
+  partials = max(1, min(partials, len(points)));
+  chunks = np.linspace(0, len(points), partials + 1).astype(int);
+  
+  partial_sinks = np.zeros((partials, sink.shape[0]), dtype=sink.dtype);
+  code.devolve_partial(points, weights, indices, kernel, partial_sinks, shape, strides, chunks, processes);
+  code.reduce_partials(partial_sinks, sink, processes);
 
 
 ###############################################################################
@@ -148,4 +235,15 @@ def _test():
   kernel = np.random.rand(len(indices));
   v = dpl.devolve(points, shape=(20,20,20), indices=indices, weights=None, kernel=kernel);
   p3d.plot(v)
+  
+  # deterministic engines
+  points = np.random.rand(10000, 3) * 20;
+  weights = np.random.rand(len(points));
+  indices = np.array(np.meshgrid(*[np.arange(-2,3)]*3, indexing='ij')).reshape(3,-1).T;
+  for engine in ['sorted', 'partial']:
+    v = [dpl.devolve(points, shape=(20,20,20), dtype=float, indices=indices, weights=weights, engine=engine, processes=p).array for p in [1,3,8]];
+    print(engine, np.all(v[0] == v[1]), np.all(v[0] == v[2]))
+  v = dpl.devolve(points, shape=(20,20,20), indices=indices, engine='direct', processes=1).array;
+  w = dpl.devolve(points, shape=(20,20,20), indices=indices, engine='sorted').array;
+  print(np.all(v == w))
   
\ No newline at end of file
@@ -152,7 +152,7 @@ cpdef void devolve_weights(point_t[:,:] points, weight_t[:] weights, index_t[:,:
   
 #@cython.boundscheck(False)
 #@cython.wraparound(False)
-cpdef void devovle_weights_kernel(point_t[:,:] points, weight_t[:] weights, index_t[:,:] indices, kernel_t[:] kernel, sink_t[:] sink, index_t[:] shape, index_t[:] strides, int processes) nogil:
+cpdef void devolve_weights_kernel(point_t[:,:] points, weight_t[:] weights, index_t[:,:] indices, kernel_t[:] kernel, sink_t[:] sink, index_t[:] shape, index_t[:] strides, int processes) nogil:
   """Converts a list of points into an volumetric image array."""
   
   cdef index_t i, j, k, v, d, n
@@ -176,4 +176,125 @@ cpdef void devovle_weights_kernel(point_t[:,:] points, weight_t[:] weights, inde
         if v == 1:
           sink[j] += <sink_t>(weights[n] * kernel[i]);
     
-  return;
\ No newline at end of file
+  return;
+
+
+###############################################################################
+### Deterministic devolution 
+###############################################################################
+
+cdef inline index_t devolve_index(point_t[:,:] points, index_t[:,:] indices, index_t n, index_t i, 
+                                  index_t[:] shape, index_t[:] strides, index_t n_dim) nogil:
+  """Flat sink index of the i-th relative index around point n or -1 if outside the sink."""
+  cdef index_t d, k
+  cdef index_t j = 0;
+  for d in range(n_dim):
+    k = <index_t>points[n,d] + indices[i,d];
+    if not (0 <= k and k < shape[d]):
+      return -1;
+    j = j + k * strides[d];
+  return j;
+
+
+cpdef void devolve_sorted(point_t[:,:] points, kernel_t[:] weights, index_t[:,:] indices, kernel_t[:] kernel, 
+                          sink_t[:] sink, index_t[:] shape, index_t[:] strides, 
+                          index_t axis, index_t[:,:] slabs, int processes) nogil:
+  """Devolves points sorted along an axis into disjoint slabs of the sink.
+  
+  Note
+  ----
+  Each slab is a row (slab start, slab end, first point, last point) and is 
+  written by a single thread only. As the points are sorted, each voxel 
+  receives its contributions in the same order independent of the number of
+  slabs or threads, making the result deterministic.
+  Weights are passed as float64, empty weights or kernel arrays indicate 
+  uniform weights.
+  """
+  cdef index_t s, n, i, j, k
+  cdef index_t n_slabs   = slabs.shape[0];
+  cdef index_t n_indices = indices.shape[0];                                   
+  cdef index_t n_dim     = strides.shape[0];
+  cdef bint has_weights  = weights.shape[0] > 0;
+  cdef bint has_kernel   = kernel.shape[0] > 0;
+  
+  with nogil, parallel(num_threads = processes):    
+    for s in prange(n_slabs, schedule='dynamic'):
+      for n in range(slabs[s,2], slabs[s,3]):
+        for i in range(n_indices):
+          k = <index_t>points[n,axis] + indices[i,axis];
+          if k < slabs[s,0] or k >= slabs[s,1]:
+            continue;
+          j = devolve_index(points, indices, n, i, shape, strides, n_dim);
+          if j < 0:
+            continue;
+          if has_weights:
+            if has_kernel:
+              sink[j] += <sink_t>(weights[n] * kernel[i]);
+            else:
+              sink[j] += <sink_t>weights[n];
+          else:
+            if has_kernel:
+              sink[j] += <sink_t>kernel[i];
+            else:
+              sink[j] += 1;
+  
+  return;
+
+
+cpdef void devolve_partial(point_t[:,:] points, kernel_t[:] weights, index_t[:,:] indices, kernel_t[:] kernel, 
+                           sink_t[:,:] partials, index_t[:] shape, index_t[:] strides, 
+                           index_t[:] chunks, int processes) nogil:
+  """Devolves contiguous chunks of points into private partial sinks.
+  
+  Note
+  ----
+  Points chunks[p] to chunks[p+1] are devolved into partials[p]. 
+  Weights are passed as float64, empty weights or kernel arrays indicate 
+  uniform weights.
+  """
+  cdef index_t p, n, i, j
+  cdef index_t n_partials = partials.shape[0];
+  cdef index_t n_indices  = indices.shape[0];                                   
+  cdef index_t n_dim      = strides.shape[0];
+  cdef bint has_weights   = weights.shape[0] > 0;
+  cdef bint has_kernel    = kernel.shape[0] > 0;
+  
+  with nogil, parallel(num_threads = processes):    
+    for p in prange(n_partials, schedule='dynamic'):
+      for n in range(chunks[p], chunks[p+1]):
+        for i in range(n_indices):
+          j = devolve_index(points, indices, n, i, shape, strides, n_dim);
+          if j < 0:
+            continue;
+          if has_weights:
+            if has_kernel:
+              partials[p,j] += <sink_t>(weights[n] * kernel[i]);
+            else:
+              partials[p,j] += <sink_t>weights[n];
+          else:
+            if has_kernel:
+              partials[p,j] += <sink_t>kernel[i];
+            else:
+              partials[p,j] += 1;
+  
+  return;
+
+
+cpdef void reduce_partials(sink_t[:,:] partials, sink_t[:] sink, int processes) nogil:
+  """Adds the partial sinks to the sink via a fixed pairwise tree reduction."""
+  cdef index_t j, p, step
+  cdef index_t n_partials = partials.shape[0];
+  cdef index_t n_sink     = sink.shape[0];
+  
+  with nogil, parallel(num_threads = processes):    
+    for j in prange(n_sink, schedule='static'):
+      step = 1;
+      while step < n_partials:
+        p = 0;
+        while p + step < n_partials:
+          partials[p,j] += partials[p+step,j];
+          p = p + 2 * step;
+        step = 2 * step;
+      sink[j] += partials[0,j];
+  
+  return;
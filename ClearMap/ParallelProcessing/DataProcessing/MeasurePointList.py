@@ -22,8 +22,8 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 import numpy as np;
 
-import pyximport; 
-pyximport.install(setup_args={"include_dirs": [np.get_include()]}, reload_support=True)
+from ClearMap.Compile import install_pyximport
+install_pyximport(__file__, 'MeasurePointListCode')
  
 import ClearMap.ParallelProcessing.DataProcessing.ArrayProcessing as ap
 
@@ -3,7 +3,7 @@
 Lazy
 ====
 
-Lazy evaluation attributes.
+Lazy evaluation attributes and lazy module imports.
 """
 __author__    = 'Christoph Kirst <christoph.kirst.ck@gmail.com>'
 __license__   = 'GPLv3 - GNU General Pulic License v3 (see LICENSE)'
@@ -12,6 +12,11 @@ __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 
 
+import sys
+import types
+import importlib
+
+
 class lazyattr(object):
   """Attribute whose value is computed on first access."""
   
@@ -31,3 +36,50 @@ class lazyattr(object):
       return getattr(super(owner, instance), self.func.__name__)
     setattr(instance, self.func.__name__, value)
     return value
+
+
+class LazyModule(types.ModuleType):
+  """Module that is imported on first attribute access.
+  
+  Note
+  ----
+  Used for heavy optional dependencies, e.g. graph_tool, torch, vispy or 
+  PyQt, so that importing ClearMap modules stays fast and does not fail if 
+  these packages are not installed but not used.
+  """
+  
+  def __init__(self, name):
+    super(LazyModule, self).__init__(name)
+  
+  def _load(self):
+    module = importlib.import_module(self.__name__)
+    self.__dict__.update(module.__dict__)
+    return module
+  
+  def __getattr__(self, name):
+    return getattr(self._load(), name)
+  
+  def __dir__(self):
+    return dir(self._load())
+  
+  def __repr__(self):
+    return "<lazy module '%s'>" % self.__name__
+
+
+def lazy_import(name):
+  """Imports a module on first use.
+  
+  Arguments
+  ---------
+  name : str
+    The full name of the module, e.g. 'matplotlib.pyplot'.
+  
+  Returns
+  -------
+  module : module or LazyModule
+    The module if it is already imported, otherwise a placeholder that 
+    imports it on first attribute access.
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  return LazyModule(name)
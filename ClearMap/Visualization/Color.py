@@ -19,13 +19,15 @@ __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
 import numpy as np
 import colorsys
 
-import vispy as vp
-import vispy.color as vpc
-
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 import matplotlib.colors as mpc
 
+from ClearMap.Utils.Lazy import lazy_import
+
+vp = lazy_import('vispy')
+vpc = lazy_import('vispy.color')
+plt = lazy_import('matplotlib.pyplot')
+
 
 ###############################################################################
 ### Color manipulation
@@ -216,7 +218,7 @@ def colormap(cmap = None, alpha = True, as_int = False, int_type = int):
   if isinstance(cmap, str) and cmap in cmps.keys():
     cmap = vpc.colormap.get_colormap(cmap);
     
-  if isinstance(cmap, vp.color.BaseColormap):
+  if isinstance(cmap, vpc.BaseColormap):
     if alpha is False or alpha is None:
       if as_int:
         def cm(x):
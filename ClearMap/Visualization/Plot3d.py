@@ -16,23 +16,50 @@ __webpage__   = 'http://idisco.info'
 __download__  = 'http://www.github.com/ChristophKirst/ClearMap2'
  
 
+import importlib
+
+
 ###############################################################################
-### Vispy plotting
+### Backends
 ###############################################################################
 
-from ClearMap.Visualization.Vispy.Plot3d import *           #analysis:ignore
-from ClearMap.Visualization.Vispy.PlotGraph3d import *      #analysis:ignore
+_backends = {
+  # Vispy plotting
+  'ClearMap.Visualization.Vispy.Plot3d' : 
+    ('list_line_plot_3d', 'list_plot_3d', 'plot_3d', 'plot_mesh_3d', 'plot_regular_polygon', 'plot_box',
+     'single_color_colormap', 'grays_alpha', 'get_view', 'add_axes', 'set_light_to_camera', 'set_background',
+     'center_view', 'get_view_parameter', 'set_view_parameter', 'initialize_view', 'save'),
+  'ClearMap.Visualization.Vispy.PlotGraph3d' : 
+    ('plot_graph_mesh', 'plot_graph_line', 'plot_graph_edge_property'),
+  # Qt plotting
+  'ClearMap.Visualization.Qt.Plot3d' : 
+    ('plot',),
+  # Matplotlib plotting
+  'ClearMap.Visualization.Matplotlib.PlotUtils' : 
+    ('plot_density', 'plot_curve', 'subplot_tiling', 'handle_fig_fate', 'plot_sample_stats_histogram',
+     'is_gp_stats_df', 'gp_stats_df_to_counts', 'plot_sub_df', 'get_structure_colors', 
+     'fold_sample_stats_dataframe', 'get_prop_from_aba_df', 'get_parent_structure', 'get_parent_id',
+     'get_parent_name', 'plot_volcano')
+}
+"""The plotting functions of the backends.
 
+Note
+----
+The backends import heavy packages (vispy, PyQt, matplotlib), they are only 
+imported when one of their functions is used.
+"""
 
-###############################################################################
-### Qt plotting
-###############################################################################
+__all__ = [name for names in _backends.values() for name in names]
 
-from ClearMap.Visualization.Qt.Plot3d import plot           #analysis:ignore
 
+def __getattr__(name):
+  for module, names in _backends.items():
+    if name in names:
+      value = getattr(importlib.import_module(module), name)
+      globals()[name] = value
+      return value
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-###############################################################################
-### Matplotlib plotting
-###############################################################################
 
-from ClearMap.Visualization.Matplotlib.PlotUtils import *   #analysis:ignore
\ No newline at end of file
+def __dir__():
+  return sorted(list(globals()) + __all__)
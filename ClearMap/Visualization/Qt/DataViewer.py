@@ -12,6 +12,15 @@ Usage
 Note
 ----
 This viewer is based on the pyqtgraph package.
+
+Note
+----
+If a multiresolution pyramid was built for a source, see
+:mod:`~ClearMap.IO.Pyramid`, the viewer shows the level matching the
+on-screen zoom. Displayed slices are kept in a least recently used cache and
+the neighbouring slices are read ahead on a background thread. The cache is
+invalidated when a file backed source is modified, sources changed in place in
+memory need a call to :meth:`DataViewer.invalidateCache`.
 """
 __author__ = 'Christoph Kirst <christoph.kirst.ck@gmail.com>, Charly Rousseau <charly.rousseau@icm-institute.org>'
 __license__ = 'GPLv3 - GNU General Public License v3 (see LICENSE)'
@@ -19,8 +28,12 @@ __copyright__ = 'Copyright © 2020 by Christoph Kirst'
 __webpage__ = 'https://idisco.info'
 __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
 
+import os
 import time
+import threading
 import functools as ft
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
@@ -33,6 +46,7 @@ from PyQt5.QtWidgets import QWidget, QRadioButton, QLabel, QSplitter, QApplicati
 from ClearMap.Utils.utilities import runs_on_spyder
 from ClearMap.IO.IO import as_source
 from ClearMap.IO.Source import Source
+import ClearMap.IO.Pyramid as pyr
 from ClearMap.Visualization.Qt.data_viewer_luts import LUT
 
 pg.CONFIG_OPTIONS['useOpenGL'] = False  # set to False if trouble seeing data.
@@ -41,6 +55,44 @@ if not pg.QAPP:
     pg.mkQApp()
 
 
+class SliceCache(object):
+    """Thread safe least recently used cache of the displayed slices, bounded in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._slices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._slices
+
+    def __len__(self):
+        return len(self._slices)
+
+    def get(self, key):
+        with self._lock:
+            image = self._slices.get(key)
+            if image is not None:
+                self._slices.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            if key in self._slices:
+                self.n_bytes -= self._slices.pop(key).nbytes
+            self._slices[key] = image
+            self.n_bytes += image.nbytes
+            while self.n_bytes > self.max_bytes and len(self._slices) > 1:
+                self.n_bytes -= self._slices.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._slices.clear()
+            self.n_bytes = 0
+
+
 class DataViewer(QWidget):
     mouse_clicked = pyqtSignal(int, int, int)
 
@@ -51,8 +103,12 @@ class DataViewer(QWidget):
         'size': 10
     }
 
+    SLICE_CACHE_BYTES = 2**30  # Memory of the cached slices
+    PREFETCH_DEPTH = 3  # Number of slices read ahead on either side of the current one
+
     def __init__(self, source, axis=None, scale=None, title=None, invertY=False,
-                 minMax=None, screen=None, parent=None, default_lut='flame', original_orientation='zcxy', *args):
+                 minMax=None, screen=None, parent=None, default_lut='flame', original_orientation='zcxy',
+                 pyramid=True, *args):
 
         QWidget.__init__(self, parent, *args)
         # super().__init__(self, parent, *args)
@@ -69,6 +125,17 @@ class DataViewer(QWidget):
         self.source_range_y = None
         self.source_slice = None  # current slice (in scroll axis)
 
+        # ## Resolution levels and slice cache
+        self.use_pyramid = pyramid
+        self.pyramids = []  # levels of each source, starting with the source itself
+        self.level = 0  # displayed pyramid level
+        self.slice_cache = SliceCache(self.SLICE_CACHE_BYTES)
+        self.cache_generation = 0  # incremented when sources change to invalidate cached slices
+        self.source_mtimes = []  # modification times of the file backed sources
+        self.source_lock = threading.Lock()  # sources are read from the GUI and the prefetch thread
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_future = None
+
         self.cross = None  # cursor
         self.pals = []  # linked DataViewers
         self.scatter = None
@@ -116,20 +183,14 @@ class DataViewer(QWidget):
 
         # Image plots
         image_options = dict(clipToView=True, autoDownsample=True, autoLevels=False, useOpenGL=None)
-        if self.all_colour:
-            self.image_items = []
-            for s in self.sources:
-                slc = self.source_slice[:s.ndim]
-                layer = self.color_last(s.array[slc])
-                self.image_items.append(pg.ImageItem(layer, **image_options))
-        else:
-            self.image_items = [pg.ImageItem(s[self.source_slice[:s.ndim]], **image_options) for s in self.sources]
+        self.image_items = [pg.ImageItem(self.getImage(i), **image_options) for i in range(self.n_sources)]
         for itm in self.image_items:
             itm.setRect(QRect(0, 0, self.source_range_x, self.source_range_y))
             itm.setCompositionMode(QPainter.CompositionMode_Plus)
             self.view.addItem(itm)
         self.view.setXRange(0, self.source_range_x)
         self.view.setYRange(0, self.source_range_y)
+        self.view.sigRangeChanged.connect(self.updateLevel)
 
         # Slice Selector
         if original_title:
@@ -238,6 +299,11 @@ class DataViewer(QWidget):
         # self.__cast_bools()
         # self.__ensure_3d()
 
+        self.pyramids = [self.__source_pyramid(s) for s in self.sources]
+        self.source_mtimes = self.__source_mtimes()
+        self.cache_generation += 1
+        self.slice_cache.clear()
+
         # source shapes
         self.source_shape = self.padded_shape(self.sources[0].shape)
         for s in self.sources:
@@ -282,15 +348,44 @@ class DataViewer(QWidget):
             elif s.ndim < 2 or s.ndim > 4:  # FIXME: handle RGB
                 raise RuntimeError(f'Sources dont have dimensions 2, 3 or 4 but {s.ndim} in source {i}!')
 
-            if s.ndim == 4:
-                layer = self.color_last(s.array[self.source_slice[:s.ndim]])
-                self.image_items[i].updateImage(layer)
-            else:
-                if s.ndim == 2:
-                    s.shape = s.shape + (1,)
-                self.image_items[i].updateImage(s[self.source_slice[:s.ndim]])
+            if s.ndim == 2:
+                s.shape = s.shape + (1,)
+            self.pyramids[i] = self.__source_pyramid(s)
         self.sources = source
 
+        self.invalidateCache()
+
+    def invalidateCache(self, update=True):
+        """
+        Drop the cached slices, e.g. after the data of a source was changed in place
+
+        Arguments
+        ---------
+        update : bool
+            If True, redraw the current slice.
+        """
+        self.pyramids = [self.__source_pyramid(s) for s in self.sources]  # drops outdated levels
+        self.source_mtimes = self.__source_mtimes()
+        self.cache_generation += 1
+        self.slice_cache.clear()
+        if update:
+            self.updateImage()
+
+    def __source_mtimes(self):
+        mtimes = []
+        for s in self.sources:
+            try:
+                mtimes.append(os.stat(s.location).st_mtime_ns)
+            except (AttributeError, TypeError, ValueError, OSError):  # not file backed
+                mtimes.append(None)
+        return mtimes
+
+    def __source_pyramid(self, source):
+        if self.use_pyramid and not self.is_color(source):
+            return pyr.pyramid(source)
+        else:
+            return [source]
+
     def __setup_axes_controls(self):
         axis_tools_layout = QtWidgets.QGridLayout()
         for d, ax in enumerate('xyz'):
@@ -461,14 +556,7 @@ class DataViewer(QWidget):
         self.updateSourceRange()
         self.updateSourceSlice()
 
-        for img_itm, src in zip(self.image_items, self.sources):
-            slc = self.source_slice
-            if self.all_colour:
-                layer = src.array[slc]
-                img_itm.updateImage(self.color_last(layer))
-            else:
-                img_itm.updateImage(src[slc])
-            img_itm.setRect(QRect(0, 0, self.source_range_x, self.source_range_y))
+        self.updateImage()
         self.view.setXRange(0, self.source_range_x)
         self.view.setYRange(0, self.source_range_y)
 
@@ -476,16 +564,105 @@ class DataViewer(QWidget):
         self.refresh()
 
     def updateImage(self):
-        for img_item, src in zip(self.image_items, self.sources):
-            slc = self.source_slice[:src.ndim]
+        if self.__source_mtimes() != self.source_mtimes:
+            self.invalidateCache(update=False)
+        for i, img_item in enumerate(self.image_items):
+            img_item.updateImage(self.getImage(i))
+            img_item.setRect(QRect(0, 0, self.source_range_x, self.source_range_y))  # levels differ in shape
+        self.prefetch()
+
+    def updateLevel(self):
+        """Select the pyramid level matching the on-screen zoom"""
+        n_levels = max(len(levels) for levels in self.pyramids)
+        if n_levels <= 1:
+            return
+        x_axis, y_axis = self.getXYAxes()
+        pixel_x, pixel_y = self.view.viewPixelSize()
+        voxels_per_pixel = min(pixel_x / self.source_scale[x_axis], pixel_y / self.source_scale[y_axis])
+        if not np.isfinite(voxels_per_pixel):
+            return
+        level = int(np.clip(np.floor(np.log2(max(voxels_per_pixel, 1))), 0, n_levels - 1))
+        if level != self.level:
+            self.level = level
+            self.updateImage()
+
+    def getImage(self, i, level=None, index=None):
+        """
+        The image of a source in a slice along the scroll axis
+
+        Arguments
+        ---------
+        i : int
+            The index of the source.
+        level : int or None
+            The pyramid level, if None the displayed level.
+        index : int or None
+            The slice index in full resolution, if None the current slice.
+
+        Returns
+        -------
+        image : array
+            The image to display.
+        """
+        level = min(self.level if level is None else level, len(self.pyramids[i]) - 1)
+        index = self.source_index[self.scroll_axis] if index is None else index
+        key = self.__slice_key(i, level, index >> level)
+        image = self.slice_cache.get(key)
+        if image is None:
+            image = self.__read_slice(*key[1:])
+            self.slice_cache.put(key, image)
+        return image
+
+    def prefetch(self):
+        """Read the slices next to the current one into the cache on a background thread"""
+        if self.prefetcher is None:  # closed
+            return
+        if self.prefetch_future is not None:
+            self.prefetch_future.cancel()
+        index = self.source_index[self.scroll_axis]
+        keys = []
+        for offset in range(1, self.PREFETCH_DEPTH + 1):
+            for direction in (1, -1):
+                for i in range(self.n_sources):
+                    level = min(self.level, len(self.pyramids[i]) - 1)
+                    level_index = (index >> level) + direction * offset
+                    if 0 <= level_index < self.pyramids[i][level].shape[self.scroll_axis]:
+                        keys.append(self.__slice_key(i, level, level_index))
+        self.prefetch_future = self.prefetcher.submit(self.__prefetch, keys)
+
+    def __prefetch(self, keys):
+        for key in keys:
+            if key[0] != self.cache_generation:  # sources changed meanwhile
+                return
+            if key not in self.slice_cache:
+                self.slice_cache.put(key, self.__read_slice(*key[1:]))
+
+    def __slice_key(self, i, level, level_index):
+        return self.cache_generation, i, level, self.scroll_axis, level_index
+
+    def __read_slice(self, i, level, axis, level_index):
+        src = self.pyramids[i][level]
+        level_index = min(level_index, src.shape[axis] - 1)
+        slc = [slice(None)] * src.ndim
+        slc[axis] = level_index
+        slc = tuple(slc)
+        with self.source_lock:
             if self.all_colour:
-                image = src.array[slc]
-                image = self.color_last(image)
+                image = self.color_last(src.array[slc])
             else:
-                image = src[slc]
-            if image.dtype == bool:
-                image = image.view('uint8')
-            img_item.updateImage(image)
+                image = np.asarray(src[slc])
+        if image.dtype == bool:
+            image = image.view('uint8')
+        return image
+
+    def closeEvent(self, event):
+        if self.prefetch_future is not None:
+            self.prefetch_future.cancel()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False)
+            self.prefetcher = None
+        self.slice_cache.clear()
+        super().closeEvent(event)
 
     def plot_scatter_markers(self, ax, index):
         self.scatter.clear()
@@ -20,6 +20,9 @@ from PyQt5.QtGui import QColor
 from matplotlib.colors import hsv_to_rgb
 
 from ClearMap.gui.pyuic_utils import loadUiType
+from ClearMap.IO.Workspace import TmpDebug  # noqa: F401, moved to the workspace
+
+matplotlib.use('Qt5Agg')
 
 warnings.filterwarnings('ignore', category=RuntimeWarning, module='ClearMap.gui.gui_utils')  # For surface_project
 
@@ -125,18 +128,6 @@ def format_long_nb_to_str(nb):
     return out
 
 
-class TmpDebug(object):  # FIXME: move as part of workspace
-    def __init__(self, workspace):
-        self.workspace = workspace
-
-    def __enter__(self):
-        self.workspace.debug = True
-        return self.workspace
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.workspace.debug = False
-
-
 def get_current_res(app):
     screen = app.primaryScreen()
     size = np.array((screen.size().width(), screen.size().height()))
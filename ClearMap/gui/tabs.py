@@ -1474,7 +1474,7 @@ class GroupAnalysisProcessor:
 
             p_vals_imgs.append(clearmap_io.read(p_val_path))
         pre_proc = init_preprocessor(os.path.join(self.results_folder, groups[selected_comparisons[0][0]][0]))
-        atlas = clearmap_io.read(pre_proc.annotation_file_path)
+        atlas = annotation.read_volume(pre_proc.annotation_file_path, shared=True)
         if len(p_vals_imgs) == 1:
             gp1_name, gp2_name = selected_comparisons[0]
             gp1_img = clearmap_io.read(os.path.join(self.results_folder, f'avg_density_{gp1_name}.tif'))
@@ -7,11 +7,18 @@ The processor for batch processing a group of samples.
 This can be used from the GUI, from the CLI or interactively from the python interpreter
 """
 import functools
+import json
+import logging
 import multiprocessing
+import os
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import numpy as np
+import psutil
 
 from skimage.transform import rescale
 from tqdm import tqdm
@@ -28,6 +35,8 @@ __copyright__ = 'Copyright © 2022 by Charly Rousseau'
 __webpage__ = 'https://idisco.info'
 __download__ = 'https://www.github.com/ChristophKirst/ClearMap2'
 
+logger = logging.getLogger(__name__)
+
 
 def process_sample(configs, align=False, cells=False, vasc=False):
     patch_pipeline_name(configs, cells, vasc)
@@ -77,13 +86,297 @@ class BatchProcessor:
         self.progress_watcher.finish()
 
 
-def process_folders(folders, align=False, cells=False, vasc=False):
+def process_folders(folders, align=False, cells=False, vasc=False, concurrent=False, **scheduler_kwargs):
+    """
+    Process each sample folder
+
+    Parameters
+    ----------
+    folders : list(str)
+        The sample folders
+    concurrent : bool
+        If True, run the samples concurrently with a BatchScheduler
+        created with scheduler_kwargs (cpus, ram, io, max_samples, stage_resources, resume)
+
+    Returns
+    -------
+    failed : dict
+        The exceptions of the failed samples by folder if concurrent
+    """
+    if concurrent:
+        return BatchScheduler(**scheduler_kwargs).run(folders, sample_stages(align, cells, vasc),
+                                                      align=align, cells=cells, vasc=vasc)
     for folder in tqdm(folders, desc='Processing sample ', unit='brain'):
-        cfg_loader = ConfigLoader(folder)
-        configs = get_configs(cfg_loader.get_cfg_path('sample'), cfg_loader.get_cfg_path('processing'))
+        configs = load_sample_configs(folder)
         process_sample(configs, align=align, cells=cells, vasc=vasc)
 
 
+def load_sample_configs(folder):
+    cfg_loader = ConfigLoader(folder)
+    return get_configs(cfg_loader.get_cfg_path('sample'), cfg_loader.get_cfg_path('processing'))
+
+
+###############################################################################
+# Concurrent scheduling
+###############################################################################
+
+default_stage_resources = {
+    'conversion': {'cpus': 1, 'ram': 4, 'io': 1},
+    'stitching': {'cpus': None, 'ram': 32, 'io': 1},
+    'registration': {'cpus': 4, 'ram': 8},
+    'cell_detection': {'cpus': None, 'ram': 32},
+    'cell_post_processing': {'cpus': 1, 'ram': 8},
+    'voxelization': {'cpus': 1, 'ram': 8},
+    'vessel_binarization': {'cpus': None, 'ram': 64},
+    'vessel_graph': {'cpus': None, 'ram': 64},
+}
+"""
+Resources claimed by each stage of a sample pipeline in the BatchScheduler.
+'cpus' is the number of cores (None for the full CPU budget), 'ram' the memory in GB
+and 'io' the number of concurrent disk intensive stages.
+The cpus granted to a stage are passed to it as its number of processes (see stage_processes_keys).
+"""
+
+STATUS_FILE_NAME = 'batch_status.json'
+
+
+def sample_stages(align=False, cells=False, vasc=False):
+    """The ordered stages of process_sample"""
+    stages = ['conversion']
+    if align:
+        stages += ['stitching', 'registration']
+    if cells:
+        stages += ['cell_detection', 'cell_post_processing']
+    if vasc:
+        stages += ['vessel_binarization', 'vessel_graph']
+    return stages
+
+
+def voxelization_stages(align=False, cells=True):
+    """The ordered stages of voxelize_sample"""
+    stages = ['conversion']
+    if align:
+        stages += ['stitching', 'registration']
+    if cells:
+        stages.append('voxelization')
+    return stages
+
+
+stage_processes_keys = {
+    'conversion': ('n_processes_file_conv',),
+    'stitching': ('n_processes_stitching',),
+    'registration': ('n_processes_resampling',),
+    'cell_detection': ('n_processes_cell_detection',),
+    'vessel_binarization': ('n_processes_binarization',),
+}
+"""The machine config entries setting the number of processes of each stage"""
+
+
+def run_stage(folder, stage, align=False, cells=False, vasc=False, engine=None, processes=None):
+    """
+    Run a single stage of the pipeline of a sample.
+    Stages communicate through the files of the sample workspace,
+    so each stage can run in a separate process.
+
+    Parameters
+    ----------
+    folder : str
+        The sample folder
+    stage : str
+        The stage to run (one of default_stage_resources)
+    engine : str or None
+        The voxelization engine of the 'voxelization' stage
+    processes : int or None
+        The number of processes of the stage, overriding the machine config if not None
+    """
+    configs = load_sample_configs(folder)
+    patch_pipeline_name(configs, cells, vasc)
+    if processes is not None:
+        for key in stage_processes_keys.get(stage, ()):
+            configs[0][key] = processes
+
+    pre_proc = PreProcessor()
+    pre_proc.setup(configs, convert_tiles=stage == 'conversion')
+    pre_proc.setup_atlases()
+    if stage == 'conversion':
+        pass
+    elif stage == 'stitching':
+        pre_proc.stitch()
+    elif stage == 'registration':
+        pre_proc.resample_for_registration()
+        pre_proc.align()
+    elif stage in ('cell_detection', 'cell_post_processing', 'voxelization'):
+        cell_detector = CellDetector(pre_proc)
+        cell_detector.processing_config.reload()
+        if stage == 'cell_detection':
+            cell_detector.run_cell_detection()
+        elif stage == 'cell_post_processing':
+            cell_detector.post_process_cells()
+            cell_detector.voxelize()
+        else:
+            cell_detector.processing_config['voxelization']['radii'] = (10, 10, 10)
+            cell_detector.processing_config.write()
+            cell_detector.voxelize(engine=engine)
+    elif stage == 'vessel_binarization':
+        binary_vessel_processor = BinaryVesselProcessor(pre_proc)
+        binary_vessel_processor.binarize()
+        binary_vessel_processor.combine_binary()
+    elif stage == 'vessel_graph':
+        vessel_graph_processor = VesselGraphProcessor(pre_proc)
+        vessel_graph_processor.pre_process()
+        vessel_graph_processor.post_process()
+    else:
+        raise ValueError(f'Unknown stage {stage}')
+
+
+class SampleStatus:
+    """
+    The status of the stages of a sample, persisted as json in the sample folder
+    so that failed or interrupted samples can be resumed
+    """
+    def __init__(self, folder):
+        self.path = os.path.join(folder, STATUS_FILE_NAME)
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as in_file:
+                self.stages = json.load(in_file).get('stages', {})
+
+    def is_done(self, stage):
+        return self.stages.get(stage, {}).get('status') == 'done'
+
+    @property
+    def failed(self):
+        return any(s.get('status') in ('failed', 'running') for s in self.stages.values())
+
+    def update(self, stage, status, error=None):
+        info = self.stages.setdefault(stage, {})
+        info['status'] = status
+        info['start' if status == 'running' else 'end'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        if error is not None:
+            info['error'] = error
+        else:
+            info.pop('error', None)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as out_file:
+            json.dump({'stages': self.stages}, out_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ResourceBudget:
+    """Global CPU, RAM and IO budget shared by the concurrently running stages"""
+    def __init__(self, cpus=None, ram=None, io=1):
+        self.total = {
+            'cpus': multiprocessing.cpu_count() if cpus is None else cpus,
+            'ram': psutil.virtual_memory().total / 1024**3 if ram is None else ram,
+            'io': io,
+        }
+        self.used = {k: 0 for k in self.total}
+        self.condition = threading.Condition()
+
+    def request(self, resources):
+        """The resources of a stage clipped to the budget, None meaning the full budget"""
+        return {k: min(v if resources.get(k, 0) is None else resources.get(k, 0), v) for k, v in self.total.items()}
+
+    def fits(self, request):
+        return all(self.used[k] + v <= self.total[k] for k, v in request.items())
+
+    def acquire(self, resources):
+        request = self.request(resources)
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(request))
+            for k, v in request.items():
+                self.used[k] += v
+        return request
+
+    def release(self, request):
+        with self.condition:
+            for k, v in request.items():
+                self.used[k] -= v
+            self.condition.notify_all()
+
+
+class BatchScheduler:
+    """
+    Run the stage pipelines of several samples concurrently.
+
+    The stages of a sample run in order, each in a fresh process once its
+    resources (see default_stage_resources) fit into the global budget,
+    so that e.g. the IO bound conversion of one sample overlaps the detection of another.
+    The status of each stage is saved in the sample folder and completed stages are
+    skipped when the batch is run again. Failures are recorded in the status file
+    and logged.
+    """
+    def __init__(self, cpus=None, ram=None, io=1, max_samples=None, stage_resources=None, resume=True):
+        """
+        Parameters
+        ----------
+        cpus : int or None
+            The number of cores to use, all if None
+        ram : float or None
+            The memory budget in GB, the total memory if None
+        io : int
+            The number of disk intensive stages allowed to run concurrently
+        max_samples : int or None
+            The maximal number of samples in flight, if None limited by the budget only
+        stage_resources : dict or None
+            Per stage resources updating default_stage_resources
+        resume : bool
+            If True, skip the stages that completed in a previous run
+        """
+        self.budget = ResourceBudget(cpus=cpus, ram=ram, io=io)
+        self.max_samples = max_samples
+        self.stage_resources = {k: dict(v) for k, v in default_stage_resources.items()}
+        for stage, resources in (stage_resources or {}).items():
+            self.stage_resources.setdefault(stage, {}).update(resources)
+        self.resume = resume
+
+    def run_sample(self, folder, stages, **kwargs):
+        status = SampleStatus(folder)
+        for stage in stages:
+            if self.resume and status.is_done(stage):
+                continue
+            request = self.budget.acquire(self.stage_resources.get(stage, {}))
+            try:
+                status.update(stage, 'running')
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    executor.submit(run_stage, folder, stage, processes=request['cpus'], **kwargs).result()
+            except Exception:
+                status.update(stage, 'failed', error=traceback.format_exc())
+                logger.exception('Stage %s of sample %s failed', stage, folder)
+                raise
+            finally:
+                self.budget.release(request)
+            status.update(stage, 'done')
+
+    def run(self, folders, stages, **kwargs):
+        """
+        Run the stages on all folders
+
+        Returns
+        -------
+        failed : dict
+            The exceptions of the samples that failed, by folder
+        """
+        failed = {}
+        n_samples = self.max_samples or len(folders)
+        with ThreadPoolExecutor(max(1, n_samples)) as executor:
+            futures = {executor.submit(self.run_sample, folder, stages, **kwargs): folder for folder in folders}
+            with tqdm(total=len(folders), desc='Processing sample ', unit='brain') as progress:
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as err:
+                        failed[futures[future]] = err
+                        progress.set_postfix(failed=len(failed))
+                    progress.update()
+        return failed
+
+
+def failed_samples(folders):
+    """The folders with a failed or interrupted stage in their status file"""
+    return [f for f in folders if SampleStatus(f).failed]
+
+
 def main(samples_file):
     with open(samples_file, 'r') as infile:
         folders = infile.readlines()
@@ -91,7 +384,7 @@ def main(samples_file):
     voxelize_folders(folders)
 
 
-def voxelize_sample(configs, align=False, cells=False, vasc=False):
+def voxelize_sample(configs, align=False, cells=False, vasc=False, engine=None):
     patch_pipeline_name(configs, cells, vasc)
 
     pre_proc = PreProcessor()
@@ -107,14 +400,29 @@ def voxelize_sample(configs, align=False, cells=False, vasc=False):
         # cell_detector.export_collapsed_stats()
         cell_detector.processing_config['voxelization']['radii'] = (10, 10, 10)
         cell_detector.processing_config.write()
-        cell_detector.voxelize()
+        cell_detector.voxelize(engine=engine)
 
 
-def voxelize_folders(folders, align=False, cells=True, vasc=False):
+def voxelize_folders(folders, align=False, cells=True, vasc=False, engine=None, concurrent=False, **scheduler_kwargs):
+    """
+    Voxelize the cells of each sample folder
+
+    Parameters
+    ----------
+    folders : list(str)
+        The sample folders
+    engine : str or None
+        The voxelization engine ('sorted', 'partial' or 'direct').
+        If None, use the default of Voxelization.voxelize
+    concurrent : bool
+        If True, run the samples concurrently with a BatchScheduler created with scheduler_kwargs
+    """
+    if concurrent:
+        return BatchScheduler(**scheduler_kwargs).run(folders, voxelization_stages(align, cells),
+                                                      align=align, cells=cells, vasc=vasc, engine=engine)
     for folder in tqdm(folders, desc='Processing sample ', unit='brain'):
-        cfg_loader = ConfigLoader(folder)
-        configs = get_configs(cfg_loader.get_cfg_path('sample'), cfg_loader.get_cfg_path('processing'))
-        voxelize_sample(configs, align=align, cells=cells, vasc=vasc)
+        configs = load_sample_configs(folder)
+        voxelize_sample(configs, align=align, cells=cells, vasc=vasc, engine=engine)
 
 
 def convert_to_cm_2_1(folder, atlas_base_name='ABA_25um'):
@@ -33,30 +33,30 @@ import warnings
 from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
-import pandas as pd
-from PyQt5.QtGui import QColor
-from matplotlib import pyplot as plt
-import pyqtgraph as pg
 
-# noinspection PyPep8Naming
-import ClearMap.Alignment.Elastix as elastix
 # noinspection PyPep8Naming
 import ClearMap.IO.IO as clearmap_io
 # noinspection PyPep8Naming
 import ClearMap.Visualization.Plot3d as plot_3d
-import ClearMap.Visualization.Qt.Plot3d as qplot_3d
 # noinspection PyPep8Naming
 import ClearMap.Alignment.Resampling as resampling
 # noinspection PyPep8Naming
-import ClearMap.ImageProcessing.Experts.Cells as cell_detection
-# noinspection PyPep8Naming
 import ClearMap.Analysis.Measurements.Voxelization as voxelization
 # noinspection PyPep8Naming
 import ClearMap.Alignment.Annotation as annotation
 from ClearMap.processors.sample_preparation import PreProcessor
 from ClearMap.processors.generic_tab_processor import TabProcessor
 from ClearMap.Utils.utilities import runs_on_ui
-from ClearMap.Visualization.Qt.widgets import Scatter3D
+from ClearMap.Utils.Lazy import lazy_import
+
+# Heavy dependencies only imported when used
+elastix = lazy_import('ClearMap.Alignment.Elastix')
+cell_detection = lazy_import('ClearMap.ImageProcessing.Experts.Cells')
+pd = lazy_import('pandas')
+plt = lazy_import('matplotlib.pyplot')
+pg = lazy_import('pyqtgraph')
+qplot_3d = lazy_import('ClearMap.Visualization.Qt.Plot3d')
+qt_widgets = lazy_import('ClearMap.Visualization.Qt.widgets')
 
 __author__ = 'Christoph Kirst <christoph.kirst.ck@gmail.com>, Charly Rousseau <charly.rousseau@icm-institute.org>'
 __license__ = 'GPLv3 - GNU General Public License v3 (see LICENSE)'
@@ -124,9 +124,11 @@ class CellDetector(TabProcessor):
         self.atlas_align()
         self.export_collapsed_stats()
 
-    def voxelize(self, postfix=''):
+    def voxelize(self, postfix='', engine=None):
         self.processing_config.reload()
         coordinates, cells, voxelization_parameter = self.get_voxelization_params(postfix=postfix)
+        if engine is not None:
+            voxelization_parameter['engine'] = engine
         # %% Unweighted
         coordinates, counts_file_path = self.voxelize_unweighted(coordinates, voxelization_parameter)
         if self.processing_config['voxelization']['preview']['counts'] and not runs_on_ui():
@@ -200,7 +202,7 @@ class CellDetector(TabProcessor):
         counts_file_path = self.workspace.filename('density', postfix='counts')  # TODO: improve var name
         clearmap_io.delete_file(counts_file_path)
         self.set_watcher_step('Unweighted voxelisation')
-        voxelization.voxelize(coordinates, sink=counts_file_path, **voxelization_parameter)  # WARNING: prange
+        voxelization.voxelize(coordinates, sink=counts_file_path, **voxelization_parameter)
         self.update_watcher_main_progress()
         # self.remove_crust(coordinates, voxelization_parameter)  # WARNING: currently causing issues
         return coordinates, counts_file_path
@@ -224,7 +226,7 @@ class CellDetector(TabProcessor):
         """
         intensities_file_path = self.workspace.filename('density', postfix='intensities')
         intensities = source['source']
-        voxelization.voxelize(coordinates, sink=intensities_file_path, weights=intensities, **voxelization_parameter)   # WARNING: prange
+        voxelization.voxelize(coordinates, sink=intensities_file_path, weights=intensities, **voxelization_parameter)
         return intensities_file_path
 
     def atlas_align(self):
@@ -240,14 +242,12 @@ class CellDetector(TabProcessor):
             df['yt'] = coordinates_transformed[:, 1]
             df['zt'] = coordinates_transformed[:, 2]
 
-            structure_ids = annotation.label_points(coordinates_transformed,
-                                                    annotation_file=self.preprocessor.annotation_file_path,
-                                                    key='id')
+            structure_ids, hemisphere_labels = annotation.label_points(
+                coordinates_transformed,
+                annotation_file=self.preprocessor.annotation_file_path,
+                hemispheres_file=self.preprocessor.hemispheres_file_path,
+                key='id', shared=True)
             df['id'] = structure_ids
-
-            hemisphere_labels = annotation.label_points(coordinates_transformed,
-                                                        annotation_file=self.preprocessor.hemispheres_file_path,
-                                                        key='id')
             df['hemisphere'] = hemisphere_labels
 
             names = annotation.convert_label(structure_ids, key='id', value='name')
@@ -307,6 +307,7 @@ class CellDetector(TabProcessor):
         cell_detection_param['maxima_detection']['shape'] = self.processing_config['detection']['maxima_detection']['shape']
         cell_detection_param['intensity_detection']['measure'] = ['source']
         cell_detection_param['shape_detection']['threshold'] = self.processing_config['detection']['shape_detection']['threshold']
+        cell_detection_param['shape_detection']['radius'] = self.processing_config['detection']['shape_detection'].get('radius')
         if tuning:
             clearmap_io.delete_file(self.workspace.filename('cells', postfix='bkg'))
             cell_detection_param['background_correction']['save'] = self.workspace.filename('cells', postfix='bkg')
@@ -436,13 +437,13 @@ class CellDetector(TabProcessor):
             # coordinates = coordinates.astype(int)  # required to match integer z  # FIXME: correct scaling for anisotropic
         else:
             coordinates = df[['xt', 'yt', 'zt']].values.astype(int)  # required to match integer z
-            dv.atlas = clearmap_io.read(self.preprocessor.annotation_file_path)
+            dv.atlas = annotation.read_volume(self.preprocessor.annotation_file_path, shared=True)
             dv.structure_names = annotation.get_names_map()
         if 'hemisphere' in df.columns:
             hemispheres = df['hemisphere']
         else:
             hemispheres = None
-        dv.scatter_coords = Scatter3D(coordinates, colors=df['color'].values,
+        dv.scatter_coords = qt_widgets.Scatter3D(coordinates, colors=df['color'].values,
                                       hemispheres=hemispheres, half_slice_thickness=0)
         dv.refresh()
         return [dv]
@@ -471,7 +472,7 @@ class CellDetector(TabProcessor):
         dv.view.addItem(scatter)
         dv.scatter = scatter
 
-        dv.scatter_coords = Scatter3D(coordinates, smarties=smarties, half_slice_thickness=3)
+        dv.scatter_coords = qt_widgets.Scatter3D(coordinates, smarties=smarties, half_slice_thickness=3)
         dv.refresh()
         return [dv]
 
@@ -573,13 +574,13 @@ class CellDetector(TabProcessor):
         # FIXME: Put key ID and get ID directly
         hemisphere_label = annotation.label_points(coordinates_transformed,
                                                    annotation_file=self.preprocessor.hemispheres_file_path,
-                                                   key='id')
+                                                   key='id', shared=True)
         unique_labels = np.sort(df['order'].unique())
         color_map = {lbl: annotation.find(lbl, key='order')['rgb'] for lbl in
                      unique_labels}  # WARNING RGB upper case should give integer but does not work
         id_map = {lbl: annotation.find(lbl, key='order')['id'] for lbl in unique_labels}
 
-        atlas = clearmap_io.read(self.preprocessor.annotation_file_path)
+        atlas = annotation.read_volume(self.preprocessor.annotation_file_path, shared=True)
         atlas_scale = self.preprocessor.processing_config['registration']['resampling']['autofluo_sink_resolution']
         atlas_scale = np.prod(atlas_scale)
         volumes = {_id: (atlas == _id).sum() * atlas_scale for _id in
@@ -13,40 +13,32 @@ from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
 
-# noinspection PyPep8Naming
-import matplotlib
-import tifffile
-
-matplotlib.use('Qt5Agg')
-
-
 import ClearMap.Settings as settings
 from ClearMap.Utils.utilities import runs_on_ui, requires_files, FilePath
+from ClearMap.Utils.Lazy import lazy_import
 from ClearMap.config.atlas import ATLAS_NAMES_MAP, STRUCTURE_TREE_NAMES_MAP
-from ClearMap.gui.gui_utils import TmpDebug  # REFACTOR: move to workspace object
 from ClearMap.processors.generic_tab_processor import TabProcessor, CanceledProcessing
 # noinspection PyPep8Naming
-import ClearMap.Alignment.Elastix as elastix
-# noinspection PyPep8Naming
 import ClearMap.Alignment.Annotation as annotation
 # noinspection PyPep8Naming
 import ClearMap.IO.Workspace as workspace
+from ClearMap.IO.Workspace import TmpDebug
 # noinspection PyPep8Naming
 import ClearMap.IO.IO as clearmap_io
 # noinspection PyPep8Naming
-import ClearMap.Visualization.Qt.Plot3d as plot_3d
-# noinspection PyPep8Naming
 import ClearMap.Alignment.Resampling as resampling
-# noinspection PyPep8Naming
-import ClearMap.Alignment.Stitching.StitchingRigid as stitching_rigid
-# noinspection PyPep8Naming
-import ClearMap.Alignment.Stitching.StitchingWobbly as stitching_wobbly
 from ClearMap.IO.metadata import define_auto_stitching_params, define_auto_resolution, pattern_finders_from_base_dir
 from ClearMap.IO.elastix_config import ElastixParser
 from ClearMap.config.config_loader import get_configs, ConfigLoader, CLEARMAP_CFG_DIR
 from ClearMap.config.update_config import update_default_config
 import ClearMap.Visualization.Plot3d as q_plot_3d
 
+# Heavy dependencies only imported when used
+tifffile = lazy_import('tifffile')
+elastix = lazy_import('ClearMap.Alignment.Elastix')
+plot_3d = lazy_import('ClearMap.Visualization.Qt.Plot3d')
+stitching_rigid = lazy_import('ClearMap.Alignment.Stitching.StitchingRigid')
+stitching_wobbly = lazy_import('ClearMap.Alignment.Stitching.StitchingWobbly')
 
 
 __author__ = 'Christoph Kirst <christoph.kirst.ck@gmail.com>, Charly Rousseau <charly.rousseau@icm-institute.org>'
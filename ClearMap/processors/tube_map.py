@@ -13,35 +13,36 @@ import copy
 import re
 
 import numpy as np
-from PyQt5.QtWidgets import QDialogButtonBox
 
 from ClearMap.Utils.exceptions import PlotGraphError, ClearMapVRamException
-from ClearMap.Visualization.Qt.utils import link_dataviewers_cursors
 from ClearMap.processors.generic_tab_processor import TabProcessor, ProcessorSteps
 
 import ClearMap.IO.IO as clearmap_io
 
 import ClearMap.Alignment.Annotation as annotation_module
 import ClearMap.Alignment.Resampling as resampling_module
-import ClearMap.Alignment.Elastix as elastix
 
-import ClearMap.ImageProcessing.Experts.Vasculature as vasculature
-import ClearMap.ImageProcessing.machine_learning.vessel_filling.vessel_filling as vessel_filling
-import ClearMap.ImageProcessing.Skeletonization.Skeletonization as skeletonization
-import ClearMap.ImageProcessing.Binary.Filling as binary_filling
-
-import ClearMap.Analysis.Measurements.MeasureExpression as measure_expression
-import ClearMap.Analysis.Measurements.MeasureRadius as measure_radius
-import ClearMap.Analysis.Graphs.GraphProcessing as graph_processing
 import ClearMap.Analysis.Measurements.Voxelization as voxelization
 
 import ClearMap.ParallelProcessing.BlockProcessing as block_processing
 
-from ClearMap.Visualization.Qt import Plot3d as q_p3d
-from ClearMap.Visualization.Vispy import PlotGraph3d as plot_graph_3d  # WARNING: vispy dependency
-
-from ClearMap.gui.dialogs import warning_popup
 from ClearMap.Utils.utilities import is_in_range, get_free_v_ram, requires_files, FilePath
+from ClearMap.Utils.Lazy import lazy_import
+
+# Heavy dependencies only imported when used
+elastix = lazy_import('ClearMap.Alignment.Elastix')
+vasculature = lazy_import('ClearMap.ImageProcessing.Experts.Vasculature')
+vessel_filling = lazy_import('ClearMap.ImageProcessing.machine_learning.vessel_filling.vessel_filling')  # torch
+skeletonization = lazy_import('ClearMap.ImageProcessing.Skeletonization.Skeletonization')
+binary_filling = lazy_import('ClearMap.ImageProcessing.Binary.Filling')
+measure_expression = lazy_import('ClearMap.Analysis.Measurements.MeasureExpression')
+measure_radius = lazy_import('ClearMap.Analysis.Measurements.MeasureRadius')
+graph_processing = lazy_import('ClearMap.Analysis.Graphs.GraphProcessing')  # graph_tool
+q_p3d = lazy_import('ClearMap.Visualization.Qt.Plot3d')
+qt_utils = lazy_import('ClearMap.Visualization.Qt.utils')
+plot_graph_3d = lazy_import('ClearMap.Visualization.Vispy.PlotGraph3d')  # vispy
+dialogs = lazy_import('ClearMap.gui.dialogs')
+qt_widgets = lazy_import('PyQt5.QtWidgets')
 
 __author__ = 'Christoph Kirst <christoph.kirst.ck@gmail.com>, Sophie Skriabine <sophie.skriabine@icm-institute.org>, Charly Rousseau <charly.rousseau@icm-institute.org>'
 __license__ = 'GPLv3 - GNU General Public License v3 (see LICENSE)'
@@ -287,13 +288,13 @@ class BinaryVesselProcessor(TabProcessor):
     def _fill_vessels(self, size_max, overlap, channel, resample_factor=1):
         REQUIRED_V_RAM = 22000
         if not get_free_v_ram() > REQUIRED_V_RAM:
-            btn = warning_popup(f'Insufficient VRAM',
+            btn = dialogs.warning_popup(f'Insufficient VRAM',
                                 f'You do not have enough free memory on your graphics card to '
                                 f'run this operation. This step needs 22GB VRAM, {get_free_v_ram()/1000} were found. '
                                 f'Please free some or upgrade your hardware.')
-            if btn == QDialogButtonBox.Abort:
+            if btn == qt_widgets.QDialogButtonBox.Abort:
                 raise ClearMapVRamException(f'Insufficient VRAM, found only {get_free_v_ram()} < {REQUIRED_V_RAM}')
-            elif btn == QDialogButtonBox.Retry:
+            elif btn == qt_widgets.QDialogButtonBox.Retry:
                 self._fill_vessels(size_max, overlap, channel, resample_factor)
 
         self.steps[channel].remove_next_steps_files(self.steps[channel].filled)
@@ -358,7 +359,7 @@ class BinaryVesselProcessor(TabProcessor):
             titles = ' vs '.join(titles)
         dvs = q_p3d.plot(images, title=titles, arrange=arrange, lut=self.machine_config['default_lut'], parent=parent)
         if len(dvs) > 1:
-            link_dataviewers_cursors(dvs)
+            qt_utils.link_dataviewers_cursors(dvs)
         return dvs
 
 
@@ -649,13 +650,13 @@ class VesselGraphProcessor(TabProcessor):
         def annotation(coordinates):
             label = annotation_module.label_points(coordinates,
                                                    annotation_file=self.preprocessor.annotation_file_path,
-                                                   key='id')
+                                                   key='id', shared=True)
             return label
 
         def annotation_hemisphere(coordinates):
             hemisphere_labels = annotation_module.label_points(coordinates,
                                                                annotation_file=self.preprocessor.hemispheres_file_path,
-                                                               key='id')
+                                                               key='id', shared=True)
             return hemisphere_labels
 
         self.graph_reduced.annotate_properties(annotation,
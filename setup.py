@@ -27,12 +27,13 @@ requirements = [  # pip
 ]
 
 OPTIMISE_COMPILATION_FOR_TARGET = os.environ.get('OPTIMISE_CLEARMAP_COMPILATION_FOR_TARGET', True) != 'False' # Cython code will run on the machine where is was compiled
-N_PROCS = cpu_count() - 2
+N_PROCS = max(1, cpu_count() - 2)
 DEFAULT_COMPILE_ARGS = ['-w', '-O3']
 DEFAULT_LINK_ARGS = []
 
-if len(sys.argv) > 2:
-    USE_OPENMP = sys.argv[2].lower() in ('use_openmp', 'true')
+OPENMP_OPTIONS = {'use_openmp': True, 'true': True, 'no_openmp': False, 'false': False}
+if len(sys.argv) > 2 and sys.argv[2].lower() in OPENMP_OPTIONS:  # e.g. setup.py build_ext use_openmp --inplace
+    USE_OPENMP = OPENMP_OPTIONS[sys.argv.pop(2).lower()]
 else:
     os_name = platform.system().lower()
     if os_name.startswith('linux'):
@@ -62,7 +63,7 @@ def find_data_files(src_dir):
     return out
 
 
-excluded_pyx = ['_Old', '_Todo', 'StatisticsPointListCode', 'flow']
+excluded_pyx = ['_Old', '_Todo', 'StatisticsPointListCode', 'flow']  # keep in sync with ClearMap.Compile.excluded_kernels
 extension_paths = [str(p) for p in Path('ClearMap').rglob('*.pyx') if not any([excl in str(p) for excl in excluded_pyx])]
 
 extra_args = ['-fopenmp'] if USE_OPENMP else []
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+try:
+    import ClearMap.Alignment.Elastix as elx
+except (RuntimeError, ImportError) as error:  # elastix binaries not built
+    pytest.skip(f'elastix is not available: {error}', allow_module_level=True)
+
+SHAPE = (40, 50, 30)
+GRID_SIZE = (7, 8, 6)
+GRID_SPACING = (8.0, 8.0, 8.0)
+GRID_ORIGIN = (-8.0, -8.0, -8.0)
+
+HEADER = """(InitialTransformParametersFileName "{initial}")
+(HowToCombineTransforms "Compose")
+(FixedImageDimension 3)
+(MovingImageDimension 3)
+(FixedInternalImagePixelType "float")
+(MovingInternalImagePixelType "float")
+(Size {size})
+(Index 0 0 0)
+(Spacing 1.0 1.0 1.0)
+(Origin 0.0 0.0 0.0)
+(Direction 1 0 0 0 1 0 0 0 1)
+(UseDirectionCosines "true")
+(ResampleInterpolator "FinalBSplineInterpolator")
+(FinalBSplineInterpolationOrder 3)
+(Resampler "DefaultResampler")
+(DefaultPixelValue 0)
+(ResultImageFormat "tif")
+(ResultImagePixelType "float")
+(CompressResultImage "false")
+"""
+
+
+def _values(values):
+    return ' '.join(f'{v:.6f}' if isinstance(v, float) else str(v) for v in values)
+
+
+def _write(filename, transform, parameters, initial='NoInitialTransform', extra=''):
+    with open(filename, 'w') as f:
+        f.write(f'(Transform "{transform}")\n')
+        f.write(f'(NumberOfParameters {len(parameters)})\n')
+        f.write(f'(TransformParameters {_values(parameters)})\n')
+        f.write(HEADER.format(initial=initial, size=_values(SHAPE)))
+        f.write(extra)
+    return str(filename)
+
+
+@pytest.fixture
+def affine_file(tmp_path):
+    matrix = [1.02, 0.01, -0.03, -0.02, 0.97, 0.01, 0.02, 0.015, 1.01]
+    translation = [2.5, -1.5, 0.75]
+    center = f'(CenterOfRotationPoint {_values([s / 2 for s in SHAPE])})\n'
+    return _write(tmp_path / 'TransformParameters.0.txt', 'AffineTransform', matrix + translation, extra=center)
+
+
+@pytest.fixture
+def bspline_file(tmp_path, affine_file):
+    rng = np.random.default_rng(0)
+    coefficients = list(rng.normal(scale=1.5, size=3 * int(np.prod(GRID_SIZE))))
+    grid = (f'(GridSize {_values(GRID_SIZE)})\n(GridIndex 0 0 0)\n'
+            f'(GridSpacing {_values(GRID_SPACING)})\n(GridOrigin {_values(GRID_ORIGIN)})\n'
+            f'(GridDirection 1 0 0 0 1 0 0 0 1)\n(BSplineTransformSplineOrder 3)\n(UseCyclicTransform "false")\n')
+    return _write(tmp_path / 'TransformParameters.1.txt', 'BSplineTransform', coefficients,
+                  initial=affine_file, extra=grid)
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(42)
+    return rng.random((500, 3)) * (np.array(SHAPE) - 1)
+
+
+@pytest.mark.parametrize('transform', ['affine_file', 'bspline_file'])
+def test_native_matches_transformix(request, transform, points, tmp_path):
+    transform_parameter_file = request.getfixturevalue(transform)
+    reference = elx.transform_points(points, transform_parameter_file=transform_parameter_file,
+                                     result_directory=str(tmp_path / 'transformix'), native=False)
+    result = elx.transform_points(points, transform_parameter_file=transform_parameter_file, native=True)
+    np.testing.assert_allclose(result, reference, atol=1e-3)
@@ -0,0 +1,244 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+
+import ClearMap.Analysis.Graphs.GraphGt as ggt
+import ClearMap.Analysis.Graphs.GraphProcessing as gp
+
+
+def branching_graph(seed):
+    """Random tree with chords whose edges are subdivided into chains of degree 2 vertices.
+
+    Undivided tree edges join branch points directly and form cliques, an isolated ring is appended.
+    """
+    rng = np.random.default_rng(seed)
+    n_nodes = 24
+    skeleton = [(i, int(rng.integers(0, i)), 0) for i in range(1, n_nodes)]
+    skeleton += [(0, 7, 1), (3, 11, 1), (5, 13, 1)]
+    skeleton += [(1, 2, 0), (2, 4, 0), (1, 4, 0)]  # a triangle of branch points
+    n_vertices = n_nodes
+    edges = []
+    for s, t, min_length in skeleton:
+        length = int(rng.integers(min_length, 3))
+        path = [s] + list(range(n_vertices, n_vertices + length)) + [t]
+        n_vertices += length
+        edges += list(zip(path[:-1], path[1:]))
+    ring = list(range(n_vertices, n_vertices + 5))
+    n_vertices += 5
+    edges += list(zip(ring, ring[1:] + ring[:1]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    return edges[rng.permutation(len(edges))], n_vertices
+
+
+def walk_branches(connectivity, n_vertices):
+    """The branch walk of the former reduce_graph, following each chain vertex by vertex."""
+    adjacency = [[] for _ in range(n_vertices)]
+    for e, (s, t) in enumerate(connectivity):
+        adjacency[s].append((t, e))
+        adjacency[t].append((s, e))
+    degrees = np.array([len(a) for a in adjacency])
+
+    def follow(v0, v, e):
+        vertices, edges = [v], [e]
+        while degrees[v] == 2 and v != v0:
+            v, e = next((w, f) for w, f in adjacency[v] if f != e)
+            vertices.append(v)
+            edges.append(e)
+        return vertices, edges
+
+    branches = []
+    checked = np.zeros(len(connectivity), dtype=bool)
+    for v in np.where(degrees != 2)[0]:
+        for w, e in adjacency[v]:
+            if degrees[w] != 2 and not checked[e]:
+                checked[e] = True
+                branches.append(([v, w], [e]))
+
+    checked = np.zeros(n_vertices, dtype=bool)
+    for v in np.where(degrees == 2)[0]:
+        if not checked[v]:
+            checked[v] = True
+            (w1, e1), (w2, e2) = adjacency[v]
+            vertices_1, edges_1 = follow(v, w1, e1)
+            if vertices_1[-1] != v:  # not an isolated loop
+                vertices_2, edges_2 = follow(v, w2, e2)
+                vertices = vertices_1[::-1] + [v] + vertices_2
+                checked[vertices[1:-1]] = True
+                branches.append((vertices, edges_1[::-1] + edges_2))
+    return branches
+
+
+def canonical_branch(vertices, edges):
+    forward = (tuple(int(v) for v in vertices), tuple(int(e) for e in edges))
+    backward = (forward[0][::-1], forward[1][::-1])
+    return min(forward, backward)
+
+
+def branch_point_components(connectivity, branches):
+    """Connected components of more than one branch point, found by a search from each branch point."""
+    adjacency = [set() for _ in range(len(branches))]
+    for s, t in connectivity:
+        adjacency[s].add(t)
+        adjacency[t].add(s)
+    checked = np.zeros(len(branches), dtype=bool)
+    components = []
+    for v in np.where(branches)[0]:
+        if not checked[v]:
+            checked[v] = True
+            component, stack = [], [v]
+            while stack:
+                u = stack.pop()
+                component.append(u)
+                for w in adjacency[u]:
+                    if branches[w] and not checked[w]:
+                        checked[w] = True
+                        stack.append(w)
+            if len(component) > 1:
+                components.append(sorted(component))
+    return components
+
+
+def make_graph(connectivity, n_vertices, seed=0):
+    rng = np.random.default_rng(seed)
+    graph = ggt.Graph(n_vertices=n_vertices)
+    graph.add_edge(connectivity)
+    graph.set_vertex_coordinates(rng.random((n_vertices, 3)))
+    graph.set_vertex_radii(rng.random(n_vertices))
+    graph.add_edge_property('length', rng.random(graph.n_edges))
+    return graph
+
+
+def clean_graph_loop(graph, vertex_mappings):
+    """The former clean_graph, merging the cliques of branch points one by one."""
+    n_vertices = graph.n_vertices
+    branches = graph.vertex_degrees() >= 3
+
+    gb = graph.sub_graph(vertex_filter=branches, view=True)
+    components, counts = gb.label_components(return_vertex_counts=True)
+    components[branches] += 1
+    order = np.argsort(components)
+    components = np.split(order, np.where(np.diff(components[order]) > 0)[0] + 1)[1:]
+    clique_ids = np.where(counts > 1)[0]
+
+    g = graph.copy()
+    g.add_vertex(len(clique_ids))
+    properties = {k: graph.vertex_property(k) for k in vertex_mappings}
+    vertex_filter = np.ones(n_vertices + len(clique_ids), dtype=bool)
+    for i, ci in enumerate(clique_ids):
+        vi = n_vertices + i
+        cc = components[ci]
+        vertex_filter[cc] = False
+        neighbours = np.hstack([graph.vertex_neighbours(c) for c in cc])
+        neighbours = np.setdiff1d(np.unique(neighbours), cc)
+        g.add_edge([[n, vi] for n in neighbours])
+        for k, mapping in vertex_mappings.items():
+            g.set_vertex_property(k, mapping(properties[k][cc]), vertex=vi)
+
+    g = g.sub_graph(vertex_filter=vertex_filter)
+    g.remove_self_loops()
+    return g.sub_graph(vertex_filter=g.vertex_degrees() > 0)
+
+
+def canonical_graph(graph):
+    """Vertices sorted by their coordinates and edges between the sorted vertices."""
+    coordinates = graph.vertex_coordinates()
+    order = np.lexsort(coordinates.T[::-1])
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    edges = np.sort(rank[graph.edge_connectivity()], axis=1)
+    edges = edges[np.lexsort(edges.T[::-1])]
+    return coordinates[order], graph.vertex_radii()[order], edges
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_graph_branches_match_branch_walk(seed):
+    connectivity, n_vertices = branching_graph(seed)
+    reference = sorted(canonical_branch(v, e) for v, e in walk_branches(connectivity, n_vertices))
+
+    endpoints, vertices, vertex_indices, edges, edge_indices = gp.graph_branches(connectivity, n_vertices=n_vertices)
+    branches = [canonical_branch(vertices[vs:ve], edges[es:ee])
+                for (vs, ve), (es, ee) in zip(vertex_indices, edge_indices)]
+    assert sorted(branches) == reference
+    assert np.array_equal(endpoints[:, 0], vertices[vertex_indices[:, 0]])
+    assert np.array_equal(endpoints[:, 1], vertices[vertex_indices[:, 1] - 1])
+
+
+@pytest.mark.parametrize('function', [np.max, np.min, np.sum, np.mean, np.median])
+def test_reduce_branches_match_branch_walk(function):
+    connectivity, n_vertices = branching_graph(0)
+    rng = np.random.default_rng(1)
+    vertex_values = rng.random(n_vertices)
+    edge_values = rng.random(len(connectivity))
+
+    _, vertices, vertex_indices, edges, edge_indices = gp.graph_branches(connectivity, n_vertices=n_vertices)
+    reduced_vertices = gp._reduce_branches(vertex_values[vertices], vertex_indices, function)
+    reduced_edges = gp._reduce_branches(edge_values[edges], edge_indices, function)
+
+    reference = {canonical_branch(v, e): (function(vertex_values[v]), function(edge_values[e]))
+                 for v, e in walk_branches(connectivity, n_vertices)}
+    for i, ((vs, ve), (es, ee)) in enumerate(zip(vertex_indices, edge_indices)):
+        vertex_value, edge_value = reference[canonical_branch(vertices[vs:ve], edges[es:ee])]
+        assert np.isclose(reduced_vertices[i], vertex_value)
+        assert np.isclose(reduced_edges[i], edge_value)
+
+
+def test_reduce_branches_vertex_coordinates():
+    coordinates = np.random.default_rng(0).random((10, 3))
+    indices = np.array([[0, 3], [3, 4], [4, 10]])
+    result = gp._reduce_branches(coordinates, indices, gp.mean_vertex_coordinates)
+    reference = [gp.mean_vertex_coordinates(coordinates[s:e]) for s, e in indices]
+    np.testing.assert_allclose(result, reference)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_branch_point_cliques_match_components(seed):
+    connectivity, n_vertices = branching_graph(seed)
+    branches = np.bincount(connectivity.ravel(), minlength=n_vertices) >= 3
+    reference = branch_point_components(connectivity, branches)
+
+    clique_ids, clique_vertices, clique_indices = gp._branch_point_cliques(connectivity, branches)
+    cliques = [sorted(clique_vertices[s:e].tolist()) for s, e in clique_indices]
+    assert cliques == reference
+    for i, clique in enumerate(cliques):
+        assert np.all(clique_ids[clique] == i)
+    assert np.sum(clique_ids >= 0) == sum(len(c) for c in cliques)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_reduce_graph_matches_branch_walk(seed):
+    connectivity, n_vertices = branching_graph(seed)
+    graph = make_graph(connectivity, n_vertices, seed)
+    reduced, (vertex_map, edge_to_vertex_map, edge_to_edge_map) = gp.reduce_graph(graph, return_maps=True)
+
+    connectivity = graph.edge_connectivity()
+    edge_ids = graph.edge_indices()
+    radii, lengths, coordinates = graph.vertex_radii(), graph.edge_property('length'), graph.vertex_coordinates()
+    reference = {}
+    for vertices, edges in walk_branches(connectivity, graph.n_vertices):
+        edges = edge_ids[edges]
+        reference[canonical_branch(vertices, edges)] = (np.max(radii[vertices]), np.sum(lengths[edges]))
+    assert reduced.n_edges == len(reference)
+
+    geometry = reduced.edge_geometry('coordinates', as_list=True)
+    for i, (s, t) in enumerate(reduced.edge_connectivity()):
+        vertices, edges = edge_to_vertex_map[i], edge_to_edge_map[i]
+        assert {vertex_map[s], vertex_map[t]} == {vertices[0], vertices[-1]}
+        radius, length = reference.pop(canonical_branch(vertices, edges))
+        assert np.isclose(reduced.edge_property('radii')[i], radius)
+        assert np.isclose(reduced.edge_property('length')[i], length)
+        np.testing.assert_allclose(geometry[i], coordinates[vertices])
+    assert not reference
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_clean_graph_matches_clique_loop(seed):
+    connectivity, n_vertices = branching_graph(seed)
+    graph = make_graph(connectivity, n_vertices, seed)
+    mappings = {'coordinates': gp.mean_vertex_coordinates, 'radii': np.max}
+
+    result = canonical_graph(gp.clean_graph(graph, vertex_mappings=mappings))
+    reference = canonical_graph(clean_graph_loop(graph, mappings))
+    np.testing.assert_allclose(result[0], reference[0])
+    np.testing.assert_allclose(result[1], reference[1])
+    assert np.array_equal(result[2], reference[2])
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+import skimage.segmentation
+
+import ClearMap.Analysis.Measurements.shape_detection as sd
+
+SHAPE = (64, 30, 24)
+RADIUS = 7
+GROUP_SIZE = 2 * RADIUS + 1
+THRESHOLD = 0.3
+
+
+@pytest.fixture
+def blobs():
+    """Gaussian blobs of different heights centered on and next to the slab borders along the first axis."""
+    centers = np.array([[GROUP_SIZE, 10, 8], [GROUP_SIZE + 3, 13, 10], [2 * GROUP_SIZE - 1, 12, 14],
+                        [2 * GROUP_SIZE + 2, 14, 12], [3 * GROUP_SIZE, 20, 8], [40, 6, 18], [3, 22, 5]])
+    heights = np.linspace(1, 2, len(centers))
+    sigmas = np.linspace(1.5, 2, len(centers))
+    grid = np.indices(SHAPE).reshape(3, -1).T
+    source = np.zeros(len(grid))
+    for center, height, sigma in zip(centers, heights, sigmas):
+        source += height * np.exp(-np.sum((grid - center) ** 2, axis=1) / (2 * sigma ** 2))
+    return source.reshape(SHAPE), centers
+
+
+def watershed(source, seeds):
+    markers = np.zeros(source.shape, dtype=int)
+    markers[tuple(seeds.T)] = np.arange(1, len(seeds) + 1)
+    return skimage.segmentation.watershed(-source, markers, mask=source > THRESHOLD)
+
+
+@pytest.mark.parametrize('group_size', [GROUP_SIZE, GROUP_SIZE + 4, None])
+@pytest.mark.parametrize('processes', [1, 2])
+def test_flood_shapes_matches_watershed(blobs, group_size, processes):
+    source, seeds = blobs
+    reference = watershed(source, seeds)
+    assert np.max(np.linalg.norm(np.argwhere(reference > 0) - seeds[reference[reference > 0] - 1], axis=1)) <= RADIUS
+
+    result = sd.flood_shapes(source, seeds, threshold=THRESHOLD, radius=RADIUS, group_size=group_size,
+                             processes=processes)
+    assert np.array_equal(result, reference)
+
+
+def test_flood_shapes_fortran_order(blobs):
+    source, seeds = blobs
+    result = sd.flood_shapes(np.asfortranarray(source), seeds, threshold=THRESHOLD, radius=RADIUS,
+                             group_size=GROUP_SIZE)
+    assert np.array_equal(result, watershed(source, seeds))
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import ClearMap.ImageProcessing.Filter.Rank.Rank as rnk
+import ClearMap.ImageProcessing.Filter.Rank.Percentile as per
+import ClearMap.ImageProcessing.Filter.Rank.Bilateral as bil
+import ClearMap.ImageProcessing.Filter.Rank.RankCoreCode as core
+
+SHAPE = (21, 17, 23)
+SELEM = np.ones((3, 5, 3), dtype=bool)
+
+FILTERS = [getattr(rnk, name) for name in rnk.__all__ if name != 'histogram'] + \
+          [getattr(per, name) for name in per.__all__] + \
+          [getattr(bil, name) for name in bil.__all__]
+
+
+@pytest.fixture
+def source():
+    return np.random.default_rng(0).integers(0, 200, size=SHAPE).astype('uint8')
+
+
+@pytest.fixture
+def mask():
+    mask = np.zeros(SHAPE, dtype=bool)
+    mask[3:15, 2:14, 5:20] = True
+    return mask
+
+
+@pytest.mark.parametrize('function', FILTERS, ids=lambda f: f.__name__)
+@pytest.mark.parametrize('processes', [2, 5])
+@pytest.mark.parametrize('masked', [False, True])
+def test_parallel_matches_serial(source, mask, function, processes, masked):
+    mask = mask if masked else None
+    reference = function(source, selem=SELEM, mask=mask, processes=1)
+    result = function(source, selem=SELEM, mask=mask, processes=processes)
+    assert result.dtype == reference.dtype
+    assert np.array_equal(result, reference, equal_nan=result.dtype.kind == 'f')
+
+
+@pytest.mark.parametrize('function', FILTERS, ids=lambda f: f.__name__)
+@pytest.mark.parametrize('wide_max_bin, max_bin', [(1, 255), (4096, 2**13 - 1)])
+@pytest.mark.parametrize('masked', [False, True])
+def test_two_level_matches_single_level(mask, function, wide_max_bin, max_bin, masked):
+    source = np.random.default_rng(1).integers(0, max_bin + 1, size=SHAPE).astype('uint16')
+    selem = np.ones((7, 9, 5), dtype=bool)
+    mask = mask if masked else None
+
+    previous = core.set_wide_histogram_max_bin(wide_max_bin)
+    try:
+        result = function(source, selem=selem, mask=mask, max_bin=max_bin, processes=2)
+    finally:
+        core.set_wide_histogram_max_bin(None)
+    try:
+        reference = function(source, selem=selem, mask=mask, max_bin=max_bin, processes=2)
+    finally:
+        core.set_wide_histogram_max_bin(previous)
+    assert np.array_equal(result, reference, equal_nan=result.dtype.kind == 'f')
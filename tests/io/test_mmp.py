@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+
+import ClearMap.IO.MMP as mmp
+
+DTYPE = {'names': ['x', 'y', 'size'], 'formats': [int, int, float]}
+
+
+@pytest.fixture
+def location(tmp_path):
+    return str(tmp_path / 'cells.npy')
+
+
+def test_appendable(location):
+    appendable = mmp.create_appendable(location, dtype=DTYPE)
+    rows = np.zeros(5, dtype=DTYPE)
+    rows['x'] = np.arange(5)
+    appendable.append(rows)
+    appendable.append(rows[:2])
+    source = appendable.as_source()
+    assert source.shape == (7,)
+    assert np.array_equal(source.array['x'], np.hstack([np.arange(5), np.arange(2)]))
+    assert np.load(location).shape == (7,)
+
+
+def test_appendable_empty(location):
+    appendable = mmp.create_appendable(location, dtype=DTYPE)
+    source = appendable.as_source()
+    assert source.shape == (0,)
+    assert os.path.exists(location)
+    assert np.load(location).shape == (0,)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import ClearMap.ParallelProcessing.DataProcessing.DevolvePointList as dpl
+
+SHAPE = (20, 25, 30)
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(42)
+    return rng.random((2000, 3)) * np.array(SHAPE)
+
+
+@pytest.fixture
+def indices():
+    return np.array(np.meshgrid(*[np.arange(-2, 3)] * 3, indexing='ij')).reshape(3, -1).T
+
+
+def devolve(points, engine, processes, **kwargs):
+    return np.asarray(dpl.devolve(points, shape=SHAPE, engine=engine, processes=processes, **kwargs))
+
+
+@pytest.mark.parametrize('engine', ['sorted', 'partial'])
+@pytest.mark.parametrize('processes', [1, 3])
+def test_engines_match_direct_uniform(points, indices, engine, processes):
+    reference = devolve(points, 'direct', 1, indices=indices)
+    assert np.array_equal(devolve(points, engine, processes, indices=indices), reference)
+
+
+@pytest.mark.parametrize('engine', ['sorted', 'partial'])
+@pytest.mark.parametrize('processes', [1, 3])
+def test_engines_match_direct_weights_kernel(points, indices, engine, processes):
+    rng = np.random.default_rng(0)
+    weights = rng.random(len(points))
+    kernel = rng.random(len(indices))
+    reference = devolve(points, 'direct', 1, dtype=float, indices=indices, weights=weights, kernel=kernel)
+    result = devolve(points, engine, processes, dtype=float, indices=indices, weights=weights, kernel=kernel)
+    assert np.allclose(result, reference)
+
+
+@pytest.mark.parametrize('engine', ['sorted', 'partial', 'direct'])
+def test_empty_indices(points, engine):
+    result = devolve(points, engine, 2, indices=np.zeros((0, 3), dtype=int))
+    assert result.shape == SHAPE
+    assert not np.any(result)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import ClearMap.IO.IO as io
+import ClearMap.ParallelProcessing.BlockProcessing as bp
+
+SHAPE = (60, 12, 10)
+
+processed_shapes = []
+
+
+def valid_values(source):
+    """Block function returning the values of the valid region, with a peak allocation to estimate the memory."""
+    processed_shapes.append(source.shape)
+    np.ones(8 * 10**6).sum()  # above the mmap threshold, so the allocation is returned to the system
+    return np.asarray(source.valid.array).ravel(), np.asarray(source.valid.base_slicing[0].indices(SHAPE[0]))[None]
+
+
+@pytest.fixture
+def source():
+    return np.arange(np.prod(SHAPE), dtype=float).reshape(SHAPE)
+
+
+def process(source, memory_budget):
+    processed_shapes.clear()
+    return bp.process(valid_values, source, function_type='block', return_result=True, axes=[0],
+                      size_min=10, size_max=20, overlap=4, processes='serial', memory_budget=memory_budget)
+
+
+def test_split_block_covers_valid_region(source):
+    block = bp.split_into_blocks(io.as_source(source), processes=1, axes=[0], size_min=30, size_max=40, overlap=4)[0]
+    lo, hi, _ = block.valid.base_slicing[0].indices(SHAPE[0])
+    for chunk in (None, 4):
+        parts = bp.split_block(block, 3, 0, chunk=chunk)
+        bounds = [p.valid.base_slicing[0].indices(SHAPE[0])[:2] for p in parts]
+        assert bounds[0][0] == lo and bounds[-1][1] == hi
+        assert all(b[1] == c[0] for b, c in zip(bounds[:-1], bounds[1:]))
+        if chunk:
+            assert all(b[1] % chunk == 0 for b in bounds[:-1])
+        values = np.hstack([np.asarray(p.valid.array).ravel() for p in parts])
+        assert np.array_equal(values, np.asarray(block.valid.array).ravel())
+
+
+def test_memory_budget_splits_and_merges_blocks(source):
+    reference = process(source, None)
+    n_blocks = len(processed_shapes)
+
+    result = process(source, 1)
+    assert len(processed_shapes) > n_blocks
+    assert len(result) == len(reference) == n_blocks
+    for r, ref in zip(result, reference):
+        assert isinstance(r, tuple)
+        assert np.array_equal(r[0], ref[0])
+    assert np.array_equal(np.hstack([r[0] for r in result]), source.ravel())
+
+
+@pytest.mark.parametrize('container', [tuple, list])
+def test_merge_results_keeps_type(container):
+    results = [container([np.arange(3), np.ones((3, 2))]), container([np.arange(2), np.zeros((2, 2))])]
+    merged = bp.merge_results(results)
+    assert type(merged) is container
+    assert np.array_equal(merged[0], [0, 1, 2, 0, 1])
+    assert merged[1].shape == (5, 2)
+
+
+def test_merge_results_arrays_and_none():
+    assert bp.merge_results([None, None]) is None
+    assert np.array_equal(bp.merge_results([np.arange(2), np.arange(3)]), [0, 1, 0, 1, 2])
+
+
+@pytest.mark.parametrize('results', [[np.arange(2), None], [(np.arange(2),), [np.arange(2)]], [1, 2],
+                                     [np.array(1), np.array(2)]])
+def test_merge_results_heterogeneous_raises(results):
+    with pytest.raises(ValueError):
+        bp.merge_results(results)